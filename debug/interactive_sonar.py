@@ -1,10 +1,12 @@
 import sqlite3
 import struct
-import json
 import os
 import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
 import sqlite_vec
-from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
 
 # --- PATH SETUP INTELLIGENTE ---
@@ -17,63 +19,161 @@ else:
     load_dotenv(dotenv_path)
     PROJECT_ROOT = os.path.dirname(dotenv_path)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+from llm_provider import get_provider
+import fast_reader
+import bulk_ingestion as engine
 
 # CONFIGURAZIONE DEFAULT
-DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v2_bulk.db")
+DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v3_smart.db")
 DEFAULT_THRESHOLD = 0.72
+DEFAULT_TOP_K = 5
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBED_BATCH_SIZE = 200     # Testi per chiamata di embedding
+SEARCH_BLOCK = 256         # Query per blocco nel calcolo delle distanze (memoria limitata)
+PRICING_STRATEGY = "SMART_ADAPTIVE"
+
+# Indice caricato una volta sola (matrice embedding + metadati ricette)
+INDEX = None
 
 def serialize_f32(vector):
     return struct.pack(f"<{len(vector)}f", *vector)
 
 def get_embedding(text):
     text = str(text).replace("\n", " ")
-    return client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
+    return get_provider().embed([text], "text-embedding-3-small")[0]
 
 def get_db():
     conn = sqlite3.connect(DB_FILE)
-    conn.enable_load_extension(True)
-    sqlite_vec.load(conn)
-    conn.enable_load_extension(False)
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    except Exception:
+        pass
     conn.row_factory = sqlite3.Row # Importante per Pandas
     return conn
 
-def sonar_ping(query, threshold):
-    conn = get_db()
-    
-    print(f"\n📡 SONAR PING: '{query}' (Soglia: {threshold})")
-    print("   Calcolo embedding...", end="", flush=True)
-    
-    try:
-        query_vec = get_embedding(query)
-        query_bin = serialize_f32(query_vec)
-        print(" Fatto.")
-    except Exception as e:
-        print(f"\n❌ Errore API OpenAI: {e}")
-        return []
+def load_index(conn=None):
+    """
+    Carica in memoria (una volta) la matrice degli embedding dello spazio attivo (float32, N x dim)
+    allineata ai metadati delle ricette. Prezzi da price_snapshots se presente (DB v3).
+    """
+    own = conn is None
+    conn = conn or get_db()
+    start = time.time()
+    has_snapshots = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='price_snapshots'").fetchone() is not None
+    if has_snapshots:
+        meta_sql = """
+            SELECT r.id, r.code, r.description,
+                   COALESCE(ps.unit_material_price, r.unit_material_price),
+                   COALESCE(ps.unit_manpower_price, r.unit_manpower_price)
+            FROM recipes r LEFT JOIN price_snapshots ps ON ps.recipe_id = r.id AND ps.strategy = ?
+        """
+        meta_rows = conn.execute(meta_sql, (PRICING_STRATEGY,))
+    else:
+        meta_rows = conn.execute("SELECT id, code, description, unit_material_price, unit_manpower_price FROM recipes")
+    meta = {r[0]: tuple(r) for r in meta_rows}
+
+    space = engine.get_space(conn)
+    ids, vectors = [], []
+    for rowid, blob in conn.execute(f"SELECT rowid, embedding FROM {engine.space_index(space['name'], 'recipes')['vec']}"):
+        if blob is None or rowid not in meta:
+            continue
+        ids.append(rowid)
+        vectors.append(np.frombuffer(blob, dtype="<f4"))
+    if own:
+        conn.close()
+
+    matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    return {
+        "ids": np.array(ids, dtype=np.int64),
+        "matrix": matrix,
+        "sq_norms": np.einsum("ij,ij->i", matrix, matrix) if vectors else np.zeros(0, dtype=np.float32),
+        "meta": [meta[i] for i in ids],
+        "model": space["model"],
+        "dim": space["dim"],
+        "load_s": time.time() - start,
+    }
 
-    # Recuperiamo SEMPRE i top 5
-    sql = """
-        SELECT r.id, r.code, r.description, r.unit_material_price, r.unit_manpower_price, v.distance
-        FROM vec_recipes v
-        JOIN recipes r ON v.rowid = r.id
-        WHERE v.embedding MATCH ? AND k = 5
-        ORDER BY v.distance ASC
+def get_index():
+    global INDEX
+    if INDEX is None:
+        INDEX = load_index()
+        print(f"🗂️  Indice caricato: {len(INDEX['ids'])} ricette x {INDEX['matrix'].shape[1] if len(INDEX['ids']) else 0} dim "
+              f"in {INDEX['load_s']:.2f}s")
+    return INDEX
+
+def embed_queries(texts, model=None, dimensions=None):
+    """Embedding delle query a batch (una chiamata ogni EMBED_BATCH_SIZE testi)."""
+    texts = [str(t).replace("\n", " ").strip() for t in texts]
+    vectors = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        vectors.extend(get_provider().embed(texts[i:i + EMBED_BATCH_SIZE], model or EMBEDDING_MODEL, dimensions))
+    return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+def search_matrix(index, query_vectors, k=DEFAULT_TOP_K):
     """
-    
-    rows = conn.execute(sql, (query_bin,)).fetchall()
-    conn.close()
-    
-    print(f"\n   Analisi vettoriale (Top 5 vicini):")
+    Top-k per tutte le query in un passaggio vettorizzato (distanza L2 come vec0):
+    ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x, calcolato a blocchi di SEARCH_BLOCK query.
+    Ritorna (indici nella matrice, distanze), entrambi (n_query x k) ordinati per distanza.
+    """
+    matrix = index["matrix"]
+    k = min(k, len(index["ids"]))
+    n = len(query_vectors)
+    top_idx = np.zeros((n, k), dtype=np.int64)
+    top_dist = np.zeros((n, k), dtype=np.float32)
+    if k == 0:
+        return top_idx, top_dist
+    for start in range(0, n, SEARCH_BLOCK):
+        q = query_vectors[start:start + SEARCH_BLOCK]
+        d2 = index["sq_norms"][None, :] - 2.0 * (q @ matrix.T) + np.einsum("ij,ij->i", q, q)[:, None]
+        part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        part_d = np.take_along_axis(d2, part, axis=1)
+        order = np.argsort(part_d, axis=1)
+        top_idx[start:start + len(q)] = np.take_along_axis(part, order, axis=1)
+        top_dist[start:start + len(q)] = np.sqrt(np.maximum(np.take_along_axis(part_d, order, axis=1), 0.0))
+    return top_idx, top_dist
+
+def sonar_batch(queries, k=DEFAULT_TOP_K, index=None):
+    """
+    Sonar su molte query: un embedding a batch e una ricerca vettorizzata sull'indice in memoria.
+    Ritorna (risultati per query, tempi in secondi per fase).
+    """
+    index = index or get_index()
+    timings = {"load_s": index["load_s"]}
+    start = time.time()
+    vectors = embed_queries(queries, index.get("model"), index.get("dim"))
+    timings["embed_s"] = time.time() - start
+    start = time.time()
+    top_idx, top_dist = search_matrix(index, vectors, k)
+    timings["search_s"] = time.time() - start
+
+    results = []
+    for row_idx, row_dist in zip(top_idx, top_dist):
+        hits = []
+        for i, dist in zip(row_idx, row_dist):
+            rid, code, desc, p_mat, p_man = index["meta"][i]
+            hits.append({"id": rid, "code": code, "desc": desc or "", "price_mat": p_mat or 0.0,
+                         "price_man": p_man or 0.0, "distance": float(dist), "score": 1 / (1 + float(dist))})
+        results.append(hits)
+    return results, timings
+
+def print_hits(query, hits, threshold):
+    print(f"\n📡 SONAR PING: '{query}' (Soglia: {threshold})")
+    print(f"\n   Analisi vettoriale (Top {len(hits)} vicini):")
     print("-" * 120)
     print(f"   {'SCORE':<8} | {'DIST':<8} | {'ID':<6} | {'P.MAT.':<10} | {'P.MAN.':<10} | {'DESCRIZIONE'}")
     print("-" * 120)
     
     candidates_over_threshold = []
 
-    for row in rows:
-        dist = row['distance']
-        sim = 1 / (1 + dist)
+    for hit in hits:
+        row = {"id": hit["id"], "code": hit["code"], "description": hit["desc"],
+               "unit_material_price": hit["price_mat"], "unit_manpower_price": hit["price_man"]}
+        dist = hit['distance']
+        sim = hit['score']
         
         is_valid = sim >= threshold
         color = "\033[92m" if is_valid else "\033[90m" # Verde / Grigio
@@ -94,6 +194,43 @@ def sonar_ping(query, threshold):
             
     return candidates_over_threshold
 
+def sonar_ping(query, threshold, k=DEFAULT_TOP_K):
+    try:
+        results, _ = sonar_batch([query], k=k)
+    except Exception as e:
+        print(f"\n❌ Errore API OpenAI: {e}")
+        return []
+    return print_hits(query, results[0], threshold)
+
+def load_queries(path):
+    """Query da file: .txt una per riga, oppure RDO .xlsx/.csv (colonna DESCRIZIONE o prima colonna)."""
+    if path.lower().endswith(".txt"):
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    df = fast_reader.read_table(path, header=0)
+    col = "DESCRIZIONE" if "DESCRIZIONE" in df.columns else df.columns[0]
+    return [str(v).strip() for v in df[col].dropna() if str(v).strip()]
+
+def run_batch(path, threshold, k, out_path=None):
+    """Sonar su un file di query / RDO intero: tabelle top-k, riepilogo e tempi."""
+    queries = load_queries(path)
+    print(f"📂 {len(queries)} query da {os.path.basename(path)}")
+    results, timings = sonar_batch(queries, k=k)
+    for query, hits in zip(queries, results):
+        print_hits(query, hits, threshold)
+
+    top1 = np.array([hits[0]["score"] for hits in results if hits]) if results else np.zeros(0)
+    print("\n" + "═" * 100)
+    print(f"📊 {len(queries)} query | top-1 ≥ soglia: {int((top1 >= threshold).sum())} "
+          f"| top-1 mediano: {np.median(top1) if len(top1) else 0:.4f}")
+    print(f"⏱️  Indice {timings['load_s']:.2f}s | Embedding {timings['embed_s']:.2f}s "
+          f"| Ricerca {timings['search_s'] * 1000:.1f}ms ({timings['search_s'] * 1000 / max(len(queries), 1):.2f}ms/query)")
+    if out_path:
+        pd.DataFrame([{"query": q, "rank": r + 1, **hit} for q, hits in zip(queries, results)
+                      for r, hit in enumerate(hits)]).to_csv(out_path, index=False)
+        print(f"💾 Risultati salvati in {out_path}")
+    return results, timings
+
 def get_recipe_details(recipe_id):
     conn = get_db()
     # Query per la ricetta (Padre)
@@ -124,13 +261,12 @@ def check_gpt(query, candidates):
     """
     
     try:
-        res = client.chat.completions.create(
+        content, _ = get_provider().chat_json(
+            [{"role": "user", "content": prompt}],
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0
+            task="validate",
+            context={"rdo": query, "options": [c['desc'] for c in candidates]}
         )
-        content = json.loads(res.choices[0].message.content)
         
         idx = content.get("selected_index", -1)
         reason = content.get("reason", "")
@@ -148,24 +284,25 @@ def check_gpt(query, candidates):
         print(f"❌ Errore GPT: {e}")
         return None
 
-def main():
+def main(threshold_default=DEFAULT_THRESHOLD, k=DEFAULT_TOP_K):
     print("╔════════════════════════════════════════════════════╗")
     print("║      SONAR DEBUGGER - PREVENTIVATORE AI            ║")
     print("╚════════════════════════════════════════════════════╝")
     
+    get_index()
     while True:
         query = input("\n📝 Inserisci descrizione RDO (o 'q' per uscire): ").strip()
         if query.lower() in ['exit', 'quit', 'q']:
             break
         if not query: continue
 
-        thr_input = input(f"🎚️  Soglia (Default {DEFAULT_THRESHOLD}): ").strip()
+        thr_input = input(f"🎚️  Soglia (Default {threshold_default}): ").strip()
         try:
-            threshold = float(thr_input) if thr_input else DEFAULT_THRESHOLD
+            threshold = float(thr_input) if thr_input else threshold_default
         except:
-            threshold = DEFAULT_THRESHOLD
+            threshold = threshold_default
 
-        candidates = sonar_ping(query, threshold)
+        candidates = sonar_ping(query, threshold, k=k)
         
         if candidates:
             gpt_choice = input(f"\n🧠 Validare {len(candidates)} candidati con GPT? [y/n]: ").lower().strip()
@@ -232,4 +369,17 @@ def main():
             print("   (Nessun candidato valido per GPT)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sonar: ispezione del retrieval vettoriale")
+    parser.add_argument("--db", type=str, default=DB_FILE, help="DB da ispezionare (Default: v3 smart)")
+    parser.add_argument("--queries", type=str,
+                        help="File di query (.txt una per riga) o RDO intera (.xlsx/.csv): modalità batch")
+    parser.add_argument("-k", "--top-k", type=int, default=DEFAULT_TOP_K, help="Vicini per query")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Soglia di similarità")
+    parser.add_argument("--out", type=str, help="CSV con i risultati della modalità batch")
+    args = parser.parse_args()
+    DB_FILE = args.db
+
+    if args.queries:
+        run_batch(args.queries, args.threshold, args.top_k, args.out)
+    else:
+        main(args.threshold, args.top_k)
\ No newline at end of file
@@ -1,14 +1,13 @@
 import sqlite3
 import pandas as pd
 import struct
-import json
 import os
 import csv
 import time
 import sys
+import argparse
 import sqlite_vec
 from datetime import datetime
-from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
 
 # --- PATH SETUP INTELLIGENTE ---
@@ -23,7 +22,14 @@ else:
     load_dotenv(dotenv_path)
     PROJECT_ROOT = os.path.dirname(dotenv_path)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Motore prezzi condiviso (scripts/bulk_ingestion.py) per il pricing point-in-time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+import bulk_ingestion as engine
+from llm_provider import get_provider, estimate_cost, usage_delta
+import tracing
+import fast_reader
+import tech_attributes
+import catalog_snapshot
 
 # --- CONFIGURAZIONE ---
 DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v3_smart.db")
@@ -45,6 +51,40 @@ HEADER_RDO = ["DESCRIZIONE", "QUANTITA", "UNITA_MISURA"]
 # SOGLIE CONFIGURABILI
 SIMILARITY_THRESHOLD_STRICT = 0.90 
 
+# ROUTING DELLA VALIDAZIONE LLM (costo prevedibile per preventivo)
+MODEL_VALIDATOR_FAST = "gpt-4o-mini"  # Casi netti: top-1 alto e staccato dal secondo
+MODEL_VALIDATOR_STRONG = "gpt-4o"     # Casi ambigui
+ROUTER_FAST_MIN_SIMILARITY = 0.80
+ROUTER_FAST_MIN_MARGIN = 0.05         # Distacco minimo top-1 / top-2 per il modello economico
+VECTOR_ONLY_CHECK_SIMILARITY = 0.80   # Budget esaurito: top-1 sopra soglia -> CHECK, sotto -> NO MATCH
+QUOTE_BUDGET_USD = None               # Budget LLM per preventivo (None = illimitato, configurabile da args)
+
+# VALIDAZIONE A BATCH: K righe RDO (stessa sezione, stesso modello) per richiesta JSON
+VALIDATION_BATCH_SIZE = 8             # 1 = una richiesta per riga (configurabile da args)
+VALID_GPT_STATUS = ["OK", "CHECK", "NO MATCH"]
+
+# STRATEGIA PREZZI (lookup su price_snapshots, configurabile da args)
+PRICING_STRATEGIES = ["SMART_ADAPTIVE", "MAX", "LATEST", "SMART_1Y"]
+PRICING_STRATEGY = "SMART_ADAPTIVE"
+
+# PREVENTIVO STORICO (--as-of): prezzi ricalcolati solo sullo storico fino alla data
+AS_OF = None
+AS_OF_OVERFETCH = 3 # Candidati extra: le ricette senza storico alla data vengono scartate
+
+# FALLBACK COMPONENTI: righe senza ricetta valida prezzate dai componenti (vec_components), senza GPT
+COMPONENT_FALLBACK = True
+COMPONENT_FALLBACK_K = 10
+COMPONENT_FALLBACK_MIN_SIMILARITY = 0.80
+EMBED_BATCH_SIZE = 200
+
+# ATTRIBUTI TECNICI (scripts/tech_attributes.py): filtro/riordino dei candidati prima dell'LLM
+ATTRIBUTE_FILTER = True
+ATTRIBUTE_CANDIDATES = 10           # Ricette extra trovate per attributi esatti (oltre al KNN)
+ATTRIBUTE_MIN_SIMILARITY = 0.80     # Tutti gli attributi coincidenti + sim >= soglia -> OK senza LLM
+
+# SNAPSHOT DEL CATALOGO (--catalog): ricerca e prezzi da array mappati in memoria, senza SQLite
+CATALOG_SNAPSHOT = None             # Cartella esportata da scripts/catalog_snapshot.py
+
 # --- UTILS DATABASE ---
 
 def get_db_connection():
@@ -53,12 +93,38 @@ def get_db_connection():
     conn.enable_load_extension(True)
     sqlite_vec.load(conn)
     conn.enable_load_extension(False)
-    return conn
+    return tracing.get_tracer().instrument_connection(conn)
 
-def get_embedding(text):
-    """Genera embedding usando il modello OpenAI configurato."""
+def has_price_snapshots(conn):
+    """True se il DB contiene la tabella materializzata price_snapshots."""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='price_snapshots'").fetchone()
+    return row is not None
+
+def apply_point_in_time_prices(conn, candidates):
+    """
+    Riprezza i candidati usando solo lo storico fino ad AS_OF.
+    Scarta le ricette che a quella data non avevano ancora prezzi.
+    """
+    priced = []
+    for cand in candidates:
+        result = engine.evaluate_recipe_prices(conn, cand["id"], as_of=AS_OF)
+        if result is None:
+            continue
+        totals = result["totals"][PRICING_STRATEGY]
+        cand.update({
+            "price_mat": totals["MAT"],
+            "price_man": totals["MAN"],
+            "volatility": result["volatility"],
+            "is_complex": result["is_complex"]
+        })
+        priced.append(cand)
+    return priced
+
+def get_embedding(text, model=None, dimensions=None):
+    """Genera embedding usando il provider configurato (OpenAI o stand-in offline)."""
     text = text.replace("\n", " ").strip()
-    return client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
+    with tracing.span("quote.embedding"):
+        return get_provider().embed([text], model or engine.EMBEDDING_MODEL, dimensions)[0]
 
 def serialize_f32(vector):
     """Serializza il vettore per sqlite-vec."""
@@ -71,29 +137,56 @@ def search_similar_candidates(description, limit=5):
     Cerca nel DB vettoriale i candidati più simili.
     Include recupero metriche di volatilità (Smart Pricing).
     """
+    if CATALOG_SNAPSHOT:
+        return search_snapshot_candidates(description, limit)
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # 1. Embedding della query
-    query_embedding = get_embedding(description)
+    # 1. Embedding della query nello spazio attivo (modello e tabella vec letti a ogni ricerca:
+    # uno switch di spazio durante il preventivo vale dalla riga successiva)
+    space = engine.get_space(conn)
+    vec_table = engine.space_index(space["name"], "recipes")["vec"]
+    query_embedding = get_embedding(description, space["model"], space["dim"])
+    knn_limit = limit * AS_OF_OVERFETCH if AS_OF else limit
     
     # 2. Query Vettoriale + Metadati Statistici
-    # Aggiornato per estrarre anche volatility_index e is_complex_assembly
-    sql = """
-        SELECT 
-            r.id, r.code, r.description, 
-            r.unit_material_price, r.unit_manpower_price, 
-            r.source_file, 
-            r.volatility_index, r.is_complex_assembly,
-            v.distance
-        FROM vec_recipes v
-        JOIN recipes r ON v.rowid = r.id
-        WHERE v.embedding MATCH ? AND k = ?
-        ORDER BY v.distance ASC
-    """
+    # I prezzi arrivano da price_snapshots (PK recipe_id, strategy): pura lookup indicizzata.
+    # Fallback alle colonne di recipes per DB non ancora migrati.
+    if has_price_snapshots(conn):
+        sql = f"""
+            SELECT 
+                r.id, r.code, r.description, 
+                COALESCE(ps.unit_material_price, r.unit_material_price),
+                COALESCE(ps.unit_manpower_price, r.unit_manpower_price),
+                r.source_file, 
+                COALESCE(ps.volatility_index, r.volatility_index),
+                COALESCE(ps.is_complex_assembly, r.is_complex_assembly),
+                v.distance
+            FROM {vec_table} v
+            JOIN recipes r ON v.rowid = r.id
+            LEFT JOIN price_snapshots ps ON ps.recipe_id = r.id AND ps.strategy = ?
+            WHERE v.embedding MATCH ? AND k = ?
+            ORDER BY v.distance ASC
+        """
+        params = (PRICING_STRATEGY, serialize_f32(query_embedding), knn_limit)
+    else:
+        sql = f"""
+            SELECT 
+                r.id, r.code, r.description, 
+                r.unit_material_price, r.unit_manpower_price, 
+                r.source_file, 
+                r.volatility_index, r.is_complex_assembly,
+                v.distance
+            FROM {vec_table} v
+            JOIN recipes r ON v.rowid = r.id
+            WHERE v.embedding MATCH ? AND k = ?
+            ORDER BY v.distance ASC
+        """
+        params = (serialize_f32(query_embedding), knn_limit)
     
     try:
-        results = cursor.execute(sql, (serialize_f32(query_embedding), limit)).fetchall()
+        with tracing.span("quote.knn", k=knn_limit):
+            results = cursor.execute(sql, params).fetchall()
     except Exception as e:
         print(f"Errore ricerca vettoriale: {e}")
         conn.close()
@@ -115,21 +208,248 @@ def search_similar_candidates(description, limit=5):
             "is_complex": row[7] if row[7] is not None else 0,     # Campo Nuovo
             "similarity": similarity
         })
+
+    if ATTRIBUTE_FILTER:
+        with tracing.span("quote.attributes"):
+            candidates = apply_attribute_filter(conn, description, candidates, query_embedding, vec_table)[:knn_limit]
+
+    if AS_OF:
+        with tracing.span("quote.point_in_time"):
+            candidates = apply_point_in_time_prices(conn, candidates)[:limit]
     
     conn.close()
     return candidates
 
-def validate_match_with_gpt(rdo_desc, options):
+def search_snapshot_candidates(description, limit=5):
+    """
+    Come search_similar_candidates, sullo snapshot mappato in memoria: KNN esatta sulla matrice
+    degli embedding e prezzi della strategia dalle colonne esportate. Il DB è aperto solo per
+    il riprezzamento point-in-time (--as-of).
+    """
+    snapshot = catalog_snapshot.load_snapshot(CATALOG_SNAPSHOT)
+    query_embedding = get_embedding(description, snapshot.model, snapshot.manifest["dim"])
+    knn_limit = limit * AS_OF_OVERFETCH if AS_OF else limit
+    with tracing.span("quote.knn", k=knn_limit):
+        candidates = snapshot.search(query_embedding, knn_limit, PRICING_STRATEGY)
+
+    if ATTRIBUTE_FILTER:
+        with tracing.span("quote.attributes"):
+            candidates = apply_attribute_filter(None, description, candidates, query_embedding, None, snapshot)[:knn_limit]
+
+    if AS_OF:
+        conn = get_db_connection()
+        with tracing.span("quote.point_in_time"):
+            candidates = apply_point_in_time_prices(conn, candidates)[:limit]
+        conn.close()
+    return candidates
+
+def fetch_candidates_by_id(conn, ids, query_embedding, vec_table):
+    """Righe candidato per id (trovate per attributi), con la distanza calcolata sul vettore salvato."""
+    placeholders = ",".join("?" * len(ids))
+    price_join, price_cols, params = "", "r.unit_material_price, r.unit_manpower_price, r.volatility_index, r.is_complex_assembly", []
+    if has_price_snapshots(conn):
+        price_join = "LEFT JOIN price_snapshots ps ON ps.recipe_id = r.id AND ps.strategy = ?"
+        price_cols = ("COALESCE(ps.unit_material_price, r.unit_material_price), COALESCE(ps.unit_manpower_price, r.unit_manpower_price), "
+                      "COALESCE(ps.volatility_index, r.volatility_index), COALESCE(ps.is_complex_assembly, r.is_complex_assembly)")
+        params.append(PRICING_STRATEGY)
+    sql = f"""
+        SELECT r.id, r.code, r.description, {price_cols}, r.source_file, vec_distance_l2(v.embedding, ?)
+        FROM recipes r
+        JOIN {vec_table} v ON v.rowid = r.id
+        {price_join}
+        WHERE r.id IN ({placeholders})
+    """
+    rows = conn.execute(sql, [serialize_f32(query_embedding)] + params + list(ids)).fetchall()
+    return [{"id": r[0], "code": r[1], "desc": r[2], "price_mat": r[3], "price_man": r[4],
+             "volatility": r[5] if r[5] is not None else 0.0, "is_complex": r[6] if r[6] is not None else 0,
+             "source_file": r[7], "similarity": 1 / (1 + r[8])} for r in rows]
+
+def apply_attribute_filter(conn, description, candidates, query_embedding, vec_table, snapshot=None):
+    """
+    Attributi tecnici della riga RDO (sezione, sigla cavo, dimensioni...): aggiunge le ricette con
+    gli stessi attributi sfuggite al KNN e riordina i candidati (conflitti in fondo, match esatti
+    in cima). Senza attributi riconosciuti i candidati restano invariati.
+    Con uno snapshot del catalogo attributi e vettori arrivano dalle sue colonne invece che dal DB.
+    """
+    query_attrs = tech_attributes.extract_attributes(description)
+    if not query_attrs:
+        return candidates
+    known = {c["id"] for c in candidates}
+    if snapshot is not None:
+        found = snapshot.find_by_attributes(query_attrs, limit=ATTRIBUTE_CANDIDATES)
+    else:
+        found = tech_attributes.find_by_attributes(conn, "recipes", query_attrs, limit=ATTRIBUTE_CANDIDATES)
+    extra_ids = [i for i in found if i not in known]
+    if extra_ids and snapshot is not None:
+        candidates = candidates + snapshot.candidates_by_id(extra_ids, query_embedding, PRICING_STRATEGY)
+    elif extra_ids:
+        try:
+            candidates = candidates + fetch_candidates_by_id(conn, extra_ids, query_embedding, vec_table)
+        except sqlite3.OperationalError as e:
+            print(f"Errore ricerca per attributi: {e}")
+    ids = [c["id"] for c in candidates]
+    attrs_by_id = snapshot.load_attributes(ids) if snapshot is not None else tech_attributes.load_attributes(conn, "recipes", ids)
+    for cand in candidates:
+        cand["attributes"] = attrs_by_id.get(cand["id"], {})
+    return tech_attributes.rank_candidates(query_attrs, candidates, attrs_by_id)
+
+def search_component_candidates(descriptions, limit=COMPONENT_FALLBACK_K):
+    """
+    Ricerca a batch su vec_components: un embedding per tutte le descrizioni (a blocchi di
+    EMBED_BATCH_SIZE), poi un KNN locale per riga. Ritorna una lista di hit per descrizione.
+    """
+    conn = get_db_connection()
+    space = engine.get_space(conn)
+    vec_table = engine.space_index(space["name"], "components")["vec"]
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (vec_table,)).fetchone() is None:
+        conn.close()
+        return [[] for _ in descriptions]
+
+    texts = [str(d).replace("\n", " ").strip() for d in descriptions]
+    vectors = []
+    with tracing.span("quote.component_embedding", texts=len(texts)):
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            vectors.extend(get_provider().embed(texts[i:i + EMBED_BATCH_SIZE], space["model"], space["dim"]))
+
+    sql = f"""
+        SELECT c.id, c.recipe_id, c.description, c.type, c.unit_price, r.description, v.distance
+        FROM {vec_table} v
+        JOIN components c ON c.id = v.rowid
+        JOIN recipes r ON r.id = c.recipe_id
+        WHERE v.embedding MATCH ? AND k = ?
+        ORDER BY v.distance ASC
+    """
+    results = []
+    with tracing.span("quote.component_knn", k=limit, rows=len(texts)):
+        for vector in vectors:
+            rows = conn.execute(sql, (serialize_f32(vector), limit)).fetchall()
+            hits = []
+            for cid, rid, desc, ctype, unit_price, recipe_desc, dist in rows:
+                hits.append({"component_id": cid, "recipe_id": rid, "desc": desc, "type": ctype,
+                             "unit_price": unit_price, "recipe_desc": recipe_desc, "similarity": 1 / (1 + dist)})
+            results.append(hits)
+    conn.close()
+    return results
+
+def component_strategy_price(conn, component_id):
+    """Prezzo del componente con la strategia del preventivo (storico fino ad AS_OF se impostato)."""
+    prices = engine.component_strategy_prices(conn, component_id, AS_OF)
+    return prices[PRICING_STRATEGY] if prices else None
+
+def assemble_component_price(hits, conn):
+    """
+    Prezzo di una riga dai componenti trovati: materiale dal miglior componente MAT sopra soglia,
+    manodopera dal miglior componente MAN sopra soglia, ciascuno al proprio prezzo unitario con la
+    strategia del preventivo. Il coefficiente di quantità del componente descrive la ricetta da cui
+    proviene, non un'unità della riga RDO, e non è applicato: la quantità resta quella della riga.
+    Righe di sola manodopera (nessun MAT) sono prezzate dal solo MAN. None se nessun componente.
+    """
+    picked = {}
+    for hit in hits:
+        bucket = "MAN" if hit["type"] == "MAN" else "MAT"
+        if bucket in picked or hit["similarity"] < COMPONENT_FALLBACK_MIN_SIMILARITY:
+            continue
+        price = component_strategy_price(conn, hit["component_id"])
+        if price:
+            picked[bucket] = dict(hit, price=price)
+    if not picked:
+        return None, None
+    mat, man = picked.get("MAT"), picked.get("MAN")
+    main = mat or man
+    best_match = {
+        "id": main["recipe_id"], "code": "", "desc": main["desc"],
+        "price_mat": mat["price"] if mat else 0.0, "price_man": man["price"] if man else 0.0,
+        "source_file": "", "volatility": 0.0, "is_complex": 0, "similarity": main["similarity"],
+        "component_ids": [p["component_id"] for p in picked.values()],
+    }
+    reason = (f"Fallback componenti (nessuna ricetta valida): '{main['desc'][:60]}' dalla ricetta "
+              f"'{str(main['recipe_desc'])[:40]}' (sim {main['similarity']:.2f})")
+    if mat and man:
+        reason += f" + manodopera '{man['desc'][:40]}'"
+    return best_match, {"status": "CHECK", "reason": reason}
+
+def apply_component_fallback(lines):
+    """
+    Tier di fallback dopo routing e validazione: le righe rimaste senza ricetta accettabile
+    (nessun candidato, NO MATCH solo vettoriale per budget o similarità bassa, NO MATCH dell'LLM)
+    sono cercate a batch su vec_components e prezzate dai componenti, sempre come CHECK e senza
+    chiamate GPT.
+    """
+    misses = [line for line in lines if line["best_match"] is None]
+    if not misses:
+        return 0
+    try:
+        all_hits = search_component_candidates([line["desc"] for line in misses])
+    except Exception as e:
+        print(f"⚠️  Fallback componenti non disponibile: {e}")
+        return 0
+    conn = get_db_connection()
+    found = 0
+    for line, hits in zip(misses, all_hits):
+        best_match, validation = assemble_component_price(hits, conn)
+        if best_match:
+            line["route"], line["model"] = "COMPONENT", None
+            line["best_match"], line["validation"] = best_match, validation
+            found += 1
+    conn.close()
+    print(f"🔩 Fallback componenti: {found}/{len(misses)} righe prezzate dai componenti")
+    return found
+
+def route_validation(candidates, spent_usd=0.0, budget_usd=None):
+    """
+    Sceglie come decidere una riga. Ritorna (route, modello):
+    - ATTRIBUTES: top-1 con tutti gli attributi tecnici della riga coincidenti e identificativi
+      (sigla del cavo o almeno 3 attributi), nessuna chiamata LLM;
+    - VECTOR: top-1 sopra la soglia strict e senza attributi in conflitto, nessuna chiamata LLM;
+    - BUDGET: budget del preventivo esaurito, decisione solo vettoriale;
+    - FAST: top-1 alto e con margine netto sul secondo -> modello economico;
+    - STRONG: caso ambiguo -> modello completo.
+    """
+    top = candidates[0]['similarity']
+    second = candidates[1]['similarity'] if len(candidates) > 1 else 0.0
+    if (candidates[0].get('attr_exact') and tech_attributes.is_identifying(candidates[0]['attr_matches'])
+            and top >= ATTRIBUTE_MIN_SIMILARITY):
+        return "ATTRIBUTES", None
+    if top > SIMILARITY_THRESHOLD_STRICT and not candidates[0].get('attr_conflicts'):
+        return "VECTOR", None
+    if budget_usd is not None and spent_usd >= budget_usd:
+        return "BUDGET", None
+    if top >= ROUTER_FAST_MIN_SIMILARITY and top - second >= ROUTER_FAST_MIN_MARGIN:
+        return "FAST", MODEL_VALIDATOR_FAST
+    return "STRONG", MODEL_VALIDATOR_STRONG
+
+def vector_only_decision(candidates):
+    """Fallback senza LLM (budget esaurito): il top-1 vettoriale, sempre da verificare."""
+    top = candidates[0]
+    if top['similarity'] >= VECTOR_ONLY_CHECK_SIMILARITY:
+        return top, {"status": "CHECK", "reason": f"Budget LLM esaurito: match solo vettoriale (sim {top['similarity']:.2f})"}
+    return None, {"status": "NO MATCH", "reason": f"Budget LLM esaurito: similarità insufficiente ({top['similarity']:.2f})"}
+
+# Istruzioni comuni alla validazione singola e a batch
+VALIDATION_RULES = """ISTRUZIONI CRITICHE (NORMALIZZAZIONE & LOGICA):
+    1. NORMALIZZAZIONE UNITÀ: Converti sempre mentalmente le unità (es. 120mm = 12cm = 0.12m). Se le dimensioni fisiche coincidono, È UN MATCH.
+    2. TOLLERANZA SINTATTICA: "3x1.5" equivale a "3G1,5" (G = Giallo/Verde).
+    3. ANALISI FUNZIONALE: Chiediti "Posso installare l'articolo del DB al posto di quello richiesto senza varianti sostanziali?"."""
+
+def format_options(options):
+    options_text = ""
+    for idx, opt in enumerate(options):
+        options_text += f"Opzione {idx+1}:\n- Descrizione: {opt['desc']}\n- Prezzo Mat: {opt['price_mat']}\n- ID: {opt['id']}\n"
+        if opt.get('attr_conflicts'):
+            options_text += f"- Attributi diversi dalla RDO: {tech_attributes.describe(opt['attributes'], opt['attr_conflicts'])}\n"
+        options_text += "\n"
+    return options_text
+
+def validate_match_with_gpt(rdo_desc, options, model=None):
     """
-    Usa GPT-4o per selezionare il miglior match tecnico con ragionamento CoT.
+    Usa GPT-4o (o il modello scelto dal router) per selezionare il miglior match tecnico con ragionamento CoT.
     Gestisce normalizzazione unità e analisi funzionale.
     """
+    model = model or MODEL_VALIDATOR_STRONG
     if not options:
         return {"selected_index": 0, "status": "NO MATCH", "reason": "Nessuna opzione fornita"}
 
-    options_text = ""
-    for idx, opt in enumerate(options):
-        options_text += f"Opzione {idx+1}:\n- Descrizione: {opt['desc']}\n- Prezzo Mat: {opt['price_mat']}\n- ID: {opt['id']}\n\n"
+    options_text = format_options(options)
 
     # PROMPT AGGIORNATO (SMART PRICING V2 - Senior Quantity Surveyor)
     prompt = f"""
@@ -142,10 +462,7 @@ def validate_match_with_gpt(rdo_desc, options):
     Opzioni DATABASE:
     {options_text}
     
-    ISTRUZIONI CRITICHE (NORMALIZZAZIONE & LOGICA):
-    1. NORMALIZZAZIONE UNITÀ: Converti sempre mentalmente le unità (es. 120mm = 12cm = 0.12m). Se le dimensioni fisiche coincidono, È UN MATCH.
-    2. TOLLERANZA SINTATTICA: "3x1.5" equivale a "3G1,5" (G = Giallo/Verde).
-    3. ANALISI FUNZIONALE: Chiediti "Posso installare l'articolo del DB al posto di quello richiesto senza varianti sostanziali?".
+    {VALIDATION_RULES}
     
     OUTPUT JSON:
     Rispondi esclusivamente con questo formato JSON:
@@ -157,24 +474,191 @@ def validate_match_with_gpt(rdo_desc, options):
     """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o", 
-            messages=[
-                {"role": "system", "content": "Sei un assistente JSON rigoroso."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0
-        )
-        
-        content = response.choices[0].message.content
-        result = json.loads(content)
+        with tracing.span("quote.gpt_validate", options=len(options), model=model):
+            result, usage = get_provider().chat_json(
+                [
+                    {"role": "system", "content": "Sei un assistente JSON rigoroso."},
+                    {"role": "user", "content": prompt}
+                ],
+                model=model,
+                task="validate",
+                context={"rdo": rdo_desc, "options": [opt['desc'] for opt in options]}
+            )
+        result["model"] = model
+        result["usage"] = usage
         return result
         
     except Exception as e:
         print(f"Errore GPT: {e}")
         return {"selected_index": 0, "status": "ERROR", "reason": str(e)}
 
+def parse_batch_decisions(data, items):
+    """
+    Decisioni valide dell'output a batch: {riga (1-based): decisione}.
+    Voci malformate (riga fuori range, indice non valido, stato sconosciuto) vengono scartate.
+    """
+    decisions = {}
+    entries = data.get("decisions") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        return decisions
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        line, sel = entry.get("riga"), entry.get("selected_index")
+        if not isinstance(line, int) or not 1 <= line <= len(items) or line in decisions:
+            continue
+        if not isinstance(sel, int) or not 0 <= sel <= len(items[line - 1][1]):
+            continue
+        if entry.get("status") not in VALID_GPT_STATUS:
+            continue
+        decisions[line] = {"selected_index": sel, "status": entry["status"], "reason": str(entry.get("reason", ""))}
+    return decisions
+
+def validate_batch_with_gpt(items, model=None):
+    """
+    Valida K righe RDO in una sola richiesta JSON (istruzioni inviate una volta sola).
+    items: [(rdo_desc, options)]. Ritorna i risultati allineati a items; le righe con
+    output mancante o malformato ricadono sulla validazione singola.
+    """
+    model = model or MODEL_VALIDATOR_STRONG
+    if len(items) == 1:
+        return [validate_match_with_gpt(items[0][0], items[0][1], model=model)]
+
+    lines_text = ""
+    for i, (rdo_desc, options) in enumerate(items):
+        lines_text += f"RIGA {i+1}:\nVoce RDO: \"{rdo_desc}\"\nOpzioni DATABASE:\n{format_options(options)}\n"
+
+    prompt = f"""
+    Sei un Senior Quantity Surveyor ed esperto in computi metrici MEP.
+    
+    OBIETTIVO: Per OGNI riga RDO, identificare la voce del database tecnicamente equivalente.
+    Le righe appartengono alla stessa sezione del computo: usa il contesto comune, ma decidi ogni riga in modo indipendente.
+    
+    INPUT:
+    {lines_text}
+    {VALIDATION_RULES}
+    
+    OUTPUT JSON:
+    Rispondi esclusivamente con questo formato JSON, con una decisione per ciascuna delle {len(items)} righe:
+    {{
+      "decisions": [
+        {{
+          "riga": [numero della riga, 1-based],
+          "selected_index": [numero intero 1-based tra le opzioni della riga, o 0 se nessun match valido],
+          "status": "OK" | "CHECK" | "NO MATCH",
+          "reason": "Spiegazione sintetica con le conversioni fatte."
+        }}
+      ]
+    }}
+    """
+
+    data = {}
+    try:
+        with tracing.span("quote.gpt_validate_batch", lines=len(items), model=model):
+            data, _ = get_provider().chat_json(
+                [
+                    {"role": "system", "content": "Sei un assistente JSON rigoroso."},
+                    {"role": "user", "content": prompt}
+                ],
+                model=model,
+                task="validate_batch",
+                context={"items": [{"rdo": d, "options": [o['desc'] for o in opts]} for d, opts in items]}
+            )
+    except Exception as e:
+        print(f"Errore GPT (batch): {e}")
+
+    decisions = parse_batch_decisions(data, items)
+    results = []
+    for i, (rdo_desc, options) in enumerate(items):
+        result = decisions.get(i + 1)
+        if result is None:
+            # Fallback: output malformato per questa riga -> richiesta singola
+            tracing.count("batch_fallbacks")
+            result = validate_match_with_gpt(rdo_desc, options, model=model)
+        else:
+            result["model"] = model
+        results.append(result)
+    return results
+
+def section_key(code):
+    """Sezione del computo dal codice voce (es. 'A3.1.12' -> 'A3.1'); None se il codice manca."""
+    code = str(code or "").strip()
+    return code.rsplit(".", 1)[0] if "." in code else (code or None)
+
+def line_section(line):
+    """
+    Sezione di una riga RDO: dal CODICE se presente, altrimenti dai METADATI
+    (intestazione di sezione del normalizzatore). Senza nessuno dei due -> None:
+    le righe restano raggruppate nell'ordine di input, al più batch_size per batch.
+    """
+    return section_key(line.get("code")) or (str(line.get("section") or "").strip() or None)
+
+def group_validation_batches(lines, batch_size):
+    """Raggruppa in ordine le righe da validare: stesso modello, stessa sezione, al più batch_size righe."""
+    batches, current = [], []
+    for line in lines:
+        if current and (len(current) >= batch_size or line["model"] != current[-1]["model"]
+                        or line_section(line) != line_section(current[-1])):
+            batches.append(current)
+            current = []
+        current.append(line)
+    if current:
+        batches.append(current)
+    return batches
+
+def add_usage(target, usage, share=1.0):
+    """Somma (una quota di) usage_by_model nel consumo di una riga."""
+    for model, u in usage.items():
+        t = target.setdefault(model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        for key, value in u.items():
+            t[key] = t.get(key, 0) + value * share
+
+def decide_lines(lines, budget_usd=None, batch_size=1):
+    """
+    FASE 2: routing e validazione delle righe (candidati già recuperati).
+    Le righe da validare con LLM vengono inviate a batch; il costo di un batch è
+    ripartito in parti uguali tra le sue righe. Budget esaurito -> solo vettori.
+    """
+    provider = get_provider()
+    spent_usd = sum(estimate_cost(line["usage"]) for line in lines)
+    pending = []
+    for line in lines:
+        candidates = line["candidates"]
+        if not candidates:
+            continue
+        line["route"], line["model"] = route_validation(candidates)
+        if line["route"] == "VECTOR":
+            # Filtro preliminare di sicurezza (se il primo è > 99% simile, saltiamo GPT per risparmiare, opzionale)
+            line["best_match"] = candidates[0]
+            line["validation"] = {"status": "OK", "reason": "Match vettoriale esatto (>99%)"}
+        elif line["route"] == "ATTRIBUTES":
+            top = candidates[0]
+            line["best_match"] = top
+            line["validation"] = {"status": "OK", "reason": f"Attributi tecnici coincidenti: "
+                                  f"{tech_attributes.describe(top['attributes'], top['attr_matches'])} (sim {top['similarity']:.2f})"}
+        else:
+            pending.append(line)
+
+    for batch in group_validation_batches(pending, max(1, batch_size)):
+        if budget_usd is not None and spent_usd >= budget_usd:
+            for line in batch:
+                line["route"], line["model"] = "BUDGET", None
+                line["best_match"], line["validation"] = vector_only_decision(line["candidates"])
+            continue
+
+        usage_before = provider.usage_snapshot()
+        results = validate_batch_with_gpt([(l["desc"], l["candidates"]) for l in batch], model=batch[0]["model"])
+        batch_usage = usage_delta(usage_before, provider.usage_snapshot())
+        spent_usd += estimate_cost(batch_usage)
+
+        for line, result in zip(batch, results):
+            add_usage(line["usage"], batch_usage, 1.0 / len(batch))
+            line["validation"] = result
+            sel_idx = result.get("selected_index", 0)
+            if sel_idx > 0 and sel_idx <= len(line["candidates"]):
+                line["best_match"] = line["candidates"][sel_idx - 1]
+    return lines
+
 def get_recipe_details(recipe_id):
     """Ottiene dettagli ricetta e componenti per l'output finale."""
     conn = get_db_connection()
@@ -193,6 +677,14 @@ def main():
     print("🚀 AVVIO GENERATORE PREVENTIVI (SMART PRICING ENABLED)...")
     print(f"📂 Input: {FILE_INPUT_RDO}")
     print(f"💾 Output: {FILE_FINAL_XLSX}")
+    print(f"💶 Strategia Prezzi: {PRICING_STRATEGY}")
+    if QUOTE_BUDGET_USD is not None:
+        print(f"💰 Budget LLM: $ {QUOTE_BUDGET_USD:.2f}")
+    if AS_OF:
+        print(f"🕰️  Preventivo storico: prezzi as-of {AS_OF}")
+    if CATALOG_SNAPSHOT:
+        manifest = catalog_snapshot.load_snapshot(CATALOG_SNAPSHOT).manifest
+        print(f"📦 Catalogo: snapshot {manifest['version']} ({manifest['rows']} ricette, {manifest['model']}, {manifest['dtype']})")
 
     if not os.path.exists(FILE_INPUT_RDO):
         print("❌ File di input non trovato!")
@@ -200,7 +692,8 @@ def main():
 
     # Lettura Excel Input
     try:
-        df_input = pd.read_excel(FILE_INPUT_RDO)
+        with tracing.span("quote.read_input"):
+            df_input = fast_reader.read_table(FILE_INPUT_RDO, header=0)
     except Exception as e:
         print(f"❌ Errore lettura Excel: {e}")
         return
@@ -237,32 +730,53 @@ def main():
     row_num = 1
     total_quote = 0.0
 
-    # --- LOOP RIGHE ---
+    # Contabilità token/costi (per riga e per run)
+    provider = get_provider()
+    run_usage_start = provider.usage_snapshot()
+    usage_rows = []
+    has_codes = "CODICE" in df_input.columns
+    has_sections = "METADATI" in df_input.columns
+
+    # --- FASE 1: RETRIEVE (candidati vettoriali per ogni riga) ---
+    lines = []
     for index, row in df_input.iterrows():
+        row_start = time.perf_counter()
+        usage_before = provider.usage_snapshot()
         rdo_desc = str(row['DESCRIZIONE']).strip()
-        rdo_qty = float(row['QUANTITA']) if pd.notna(row['QUANTITA']) else 0.0
-        rdo_um = str(row['UNITA_MISURA']) if pd.notna(row['UNITA_MISURA']) else ""
         
         print(f"\n🔹 Processing Riga {index+1}: {rdo_desc[:50]}...")
 
         # 1. Ricerca Candidati
-        candidates = search_similar_candidates(rdo_desc, limit=5)
-        
-        # 2. Validazione GPT
-        best_match = None
-        validation_result = {}
-        
-        if candidates:
-            # Filtro preliminare di sicurezza (se il primo è > 99% simile, saltiamo GPT per risparmiare, opzionale)
-            if candidates[0]['similarity'] > SIMILARITY_THRESHOLD_STRICT:
-                best_match = candidates[0]
-                validation_result = {"status": "OK", "reason": "Match vettoriale esatto (>99%)"}
-            else:
-                validation_result = validate_match_with_gpt(rdo_desc, candidates)
-                sel_idx = validation_result.get("selected_index", 0)
-                
-                if sel_idx > 0 and sel_idx <= len(candidates):
-                    best_match = candidates[sel_idx - 1]
+        with tracing.span("quote.retrieve"):
+            candidates = search_similar_candidates(rdo_desc, limit=5)
+        lines.append({
+            "index": index,
+            "desc": rdo_desc,
+            "qty": float(row['QUANTITA']) if pd.notna(row['QUANTITA']) else 0.0,
+            "um": str(row['UNITA_MISURA']) if pd.notna(row['UNITA_MISURA']) else "",
+            "code": str(row['CODICE']) if has_codes and pd.notna(row['CODICE']) else "",
+            "section": str(row['METADATI']) if has_sections and pd.notna(row['METADATI']) else "",
+            "candidates": candidates,
+            "route": "NONE", "model": None, "best_match": None, "validation": {},
+            "usage": usage_delta(usage_before, provider.usage_snapshot()),
+            "elapsed_s": time.perf_counter() - row_start,
+        })
+
+    # --- FASE 2: DECIDE (routing per costo + validazione GPT a batch) ---
+    # 2. Validazione GPT (instradata per costo: vettoriale / modello economico / gpt-4o / budget)
+    with tracing.span("quote.decide", lines=len(lines)):
+        decide_lines(lines, budget_usd=QUOTE_BUDGET_USD, batch_size=VALIDATION_BATCH_SIZE)
+    if COMPONENT_FALLBACK:
+        with tracing.span("quote.component_fallback"):
+            apply_component_fallback(lines)
+
+    # --- FASE 3: WRITE (prezzi finali e scrittura Excel) ---
+    for line in lines:
+        row_start = time.perf_counter()
+        index, rdo_desc, rdo_qty, rdo_um = line["index"], line["desc"], line["qty"], line["um"]
+        best_match, validation_result = line["best_match"], line["validation"]
+        route, model = line["route"], line["model"]
+        tracing.count(f"route_{route.lower()}")
         
         # 3. Determinazione Dati Finali (Smart Pricing Logic)
         final_mat = 0.0
@@ -309,6 +823,7 @@ def main():
             total_quote += line_total
 
         # 5. Scrittura Excel
+        write_start = time.perf_counter()
         worksheet.write(row_num, 0, rdo_desc, cell_format_text)
         worksheet.write(row_num, 1, rdo_qty, cell_format_text)
         worksheet.write(row_num, 2, rdo_um, cell_format_text)
@@ -324,16 +839,78 @@ def main():
         
         worksheet.write(row_num, 7, status, fmt_status)
         worksheet.write(row_num, 8, ai_note, cell_format_text)
+        tracing.observe("quote.xlsx_write", time.perf_counter() - write_start)
         
         row_num += 1
+        line_usage = line["usage"]
+        usage_rows.append({
+            "RIGA": index + 1,
+            "DESCRIZIONE RDO": rdo_desc[:80],
+            "ROUTE": route,
+            "MODELLO": model or "",
+            "PROMPT_TOKENS": int(round(sum(u["prompt_tokens"] for u in line_usage.values()))),
+            "COMPLETION_TOKENS": int(round(sum(u["completion_tokens"] for u in line_usage.values()))),
+            "COSTO_USD": round(estimate_cost(line_usage), 6),
+        })
+        tracing.count(f"rows_{status.lower()}")
+        tracing.observe("quote.row", line["elapsed_s"] + time.perf_counter() - row_start, status=status)
 
     # Footer Totali
     row_num += 1
     worksheet.write(row_num, 5, "TOTALE STIMATO", cell_format_header)
     worksheet.write(row_num, 6, total_quote, cell_format_currency)
 
-    workbook.close()
+    with tracing.span("quote.xlsx_close"):
+        workbook.close()
     print(f"\n✅ Preventivo generato con successo: {FILE_FINAL_XLSX}")
 
+    # Report costi: dettaglio per riga (CSV accanto al preventivo) e riepilogo del run
+    run_usage = usage_delta(run_usage_start, provider.usage_snapshot())
+    usage_file = os.path.splitext(FILE_FINAL_XLSX)[0] + "_costi_ai.csv"
+    with open(usage_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["RIGA", "DESCRIZIONE RDO", "ROUTE", "MODELLO",
+                                               "PROMPT_TOKENS", "COMPLETION_TOKENS", "COSTO_USD"])
+        writer.writeheader()
+        writer.writerows(usage_rows)
+    routes = {}
+    for r in usage_rows:
+        routes[r["ROUTE"]] = routes.get(r["ROUTE"], 0) + 1
+    print(f"💰 Costo LLM stimato: $ {estimate_cost(run_usage):.4f} | "
+          + " | ".join(f"{m}: {u['prompt_tokens']}+{u['completion_tokens']} tok" for m, u in run_usage.items()))
+    print(f"🔀 Routing: " + ", ".join(f"{k}={v}" for k, v in sorted(routes.items())))
+    print(f"📄 Dettaglio costi: {usage_file}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generatore Preventivi (Smart Pricing)")
+    parser.add_argument("--strategy", type=str, choices=PRICING_STRATEGIES, default="SMART_ADAPTIVE",
+                        help="Strategia di prezzo letta da price_snapshots (Default: SMART_ADAPTIVE)")
+    parser.add_argument("--as-of", type=str,
+                        help="Preventivo storico: usa solo lo storico prezzi fino alla data (YYYY-MM-DD)")
+    parser.add_argument("--budget", type=float,
+                        help="Budget LLM per preventivo in USD: raggiunto il limite le righe sono decise solo sui vettori")
+    parser.add_argument("--batch-size", type=int, default=VALIDATION_BATCH_SIZE,
+                        help="Righe RDO per richiesta di validazione GPT (1 = una richiesta per riga)")
+    parser.add_argument("--no-component-fallback", action="store_true",
+                        help="Disattiva il prezzo dai componenti (vec_components) per le righe senza ricetta")
+    parser.add_argument("--catalog", type=str, nargs="?", const=catalog_snapshot.SNAPSHOT_DIR,
+                        help="Cerca e prezza dallo snapshot del catalogo (scripts/catalog_snapshot.py) invece che dal DB")
+    parser.add_argument("--no-attribute-filter", action="store_true",
+                        help="Disattiva filtro e riordino dei candidati per attributi tecnici")
+    parser.add_argument("--trace", type=str,
+                        help="Report JSON-lines del run (span per stage, p50/p95, contatori)")
+    parser.add_argument("--metrics-out", type=str,
+                        help="Export delle metriche del run in formato testo Prometheus")
+    args = parser.parse_args()
+    PRICING_STRATEGY = args.strategy
+    COMPONENT_FALLBACK = not args.no_component_fallback
+    ATTRIBUTE_FILTER = not args.no_attribute_filter
+    CATALOG_SNAPSHOT = args.catalog
+    QUOTE_BUDGET_USD = args.budget
+    VALIDATION_BATCH_SIZE = args.batch_size
+    AS_OF = engine.parse_as_of(args.as_of)
+    if args.trace or args.metrics_out:
+        tracing.enable_tracing()
+    main()
+    tracing.export_run(args.trace, args.metrics_out,
+                       run={"command": "generate_quote", "input": FILE_INPUT_RDO,
+                            "strategy": PRICING_STRATEGY, "as_of": args.as_of})
\ No newline at end of file
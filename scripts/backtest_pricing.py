@@ -0,0 +1,288 @@
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+import numpy as np
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv, find_dotenv
+
+import bulk_ingestion as engine
+import fast_reader
+
+# --- PATH SETUP ---
+dotenv_path = find_dotenv()
+if not dotenv_path:
+    PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+else:
+    load_dotenv(dotenv_path)
+    PROJECT_ROOT = os.path.dirname(dotenv_path)
+
+# CONFIGURAZIONE
+ARCHIVE_FOLDER = os.path.join(PROJECT_ROOT, "data")
+WORK_DIR = os.path.join(PROJECT_ROOT, "db", "backtest")
+REPLAY_DB_FILE = os.path.join(WORK_DIR, "replay.db")
+CACHE_FILE = os.path.join(PROJECT_ROOT, "db", "llm_cache.db")
+
+# Parametri del motore prezzi esplorabili con --grid
+GRID_PARAMS = ["DEVIATION_THRESHOLD", "STALENESS_DAYS", "VOLATILITY_THRESHOLD"]
+
+# Codice offerta nel nome file: NNNN-YY (+ revisione opzionale, es. 0008-24R1FS)
+OFFER_CODE_RE = re.compile(r"^(\d{4})-(\d{2})(?:R(\d+))?")
+
+# --- FASE 0: ORDINAMENTO CRONOLOGICO ---
+
+def infer_offer_dates(files, overrides=None):
+    """
+    Data di ogni offerta: da overrides (nome file -> YYYY-MM-DD) se presente,
+    altrimenti dal codice NNNN-YY (anno dal suffisso, progressivi distribuiti
+    uniformemente nell'anno). I file senza codice né override vengono esclusi.
+    Ritorna [(path, datetime)] in ordine cronologico.
+    """
+    overrides = overrides or {}
+    dated, by_year, skipped = [], {}, []
+
+    for path in files:
+        name = os.path.basename(path)
+        m = OFFER_CODE_RE.match(name)
+        if name in overrides:
+            dated.append((path, engine.parse_as_of(overrides[name]).replace(hour=12, minute=0, second=0)))
+        elif m:
+            year = 2000 + int(m.group(2))
+            by_year.setdefault(year, []).append((int(m.group(1)), int(m.group(3) or 0), path))
+        else:
+            skipped.append(name)
+
+    for year, items in by_year.items():
+        items.sort()
+        for rank, (_, revision, path) in enumerate(items):
+            day = int((rank + 0.5) / len(items) * 364)
+            dated.append((path, datetime(year, 1, 1, 12) + timedelta(days=day, minutes=revision)))
+
+    for name in skipped:
+        print(f"   ⚠️  Data offerta non determinabile, escluso: {name}")
+    return sorted(dated, key=lambda x: x[1])
+
+def block_actuals(block):
+    """Prezzi unitari reali della voce nel file: (materiale, manodopera)."""
+    mat = sum(c["qty"] * c["price"] for c in block["components"] if c["type"] != "MAN")
+    man = sum(c["qty"] * c["price"] for c in block["components"] if c["type"] == "MAN")
+    return mat, man
+
+# --- FASE 1: REPLAY CRONOLOGICO ---
+
+def replay_archive(dated_files, db_path):
+    """
+    Ingerisce l'archivio in ordine cronologico su un DB di lavoro.
+    Prima di ogni file registra, per ogni voce, la ricetta su cui il motore
+    l'avrebbe unita (stesse regole MERGE/BRANCH dell'ingestion).
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine.DB_FILE = db_path
+
+    conn = engine.get_db_connection()
+    engine.init_db_schema(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS backtest_observations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_file TEXT, offer_date DATETIME, description TEXT,
+        action TEXT, recipe_id INTEGER, similarity REAL,
+        actual_mat REAL, actual_man REAL
+    )''')
+    conn.commit()
+
+    stats = {"files": 0, "items": 0, "matched": 0, "cache_miss": 0}
+    start_time = time.time()
+
+    for path, offer_date in dated_files:
+        filename = os.path.basename(path)
+        layout = engine.read_layout(path)
+        if layout["name"] == "FLAT":
+            continue   # Listini piatti: nessuna ricetta da prezzare
+        df = fast_reader.read_table(path, usecols=layout["idx"].values())
+        rows = itertools.islice(df.itertuples(index=False, name=None), layout["data_start"], None)
+        blocks = list(engine.iter_recipe_blocks(rows, layout["idx"]))
+
+        rows = []
+        for block in blocks:
+            mat, man = block_actuals(block)
+            try:
+                action, rid, sim = engine.match_recipe_block(conn, block)
+            except engine.OfflineCacheMiss:
+                action, rid, sim = "CACHE_MISS", None, 0.0
+                stats["cache_miss"] += 1
+            matched_rid = rid if action == "MERGE" else None
+            stats["matched"] += 1 if matched_rid else 0
+            rows.append((filename, offer_date.strftime(engine.DATE_FORMAT), block["desc"],
+                         action, matched_rid, sim, mat, man))
+        conn.executemany("""
+            INSERT INTO backtest_observations
+                (source_file, offer_date, description, action, recipe_id, similarity, actual_mat, actual_man)
+            VALUES (?,?,?,?,?,?,?,?)
+        """, rows)
+        conn.commit()
+
+        # Solo ora il file entra nello storico (datato alla data dell'offerta)
+        engine.process_file(path, price_date=offer_date)
+        engine.sync_vectors()
+
+        stats["files"] += 1
+        stats["items"] += len(blocks)
+        print(f"   📄 {offer_date:%Y-%m-%d} {filename[:60]} -> {len(blocks)} voci")
+
+    conn.close()
+    stats["elapsed_s"] = round(time.time() - start_time, 2)
+    return stats
+
+# --- FASE 2: SCORING (parallelo sulla griglia di parametri) ---
+
+def summarize_errors(errors):
+    """Distribuzione degli errori relativi (pred - reale) / reale."""
+    if not errors:
+        return {"n": 0}
+    e = np.asarray(errors, dtype=float)
+    ape = np.abs(e)
+    return {
+        "n": int(len(e)),
+        "mape": float(ape.mean()),
+        "median_ape": float(np.median(ape)),
+        "p90_ape": float(np.percentile(ape, 90)),
+        "bias": float(np.median(e)),
+        "within_10pct": float((ape <= 0.10).mean()),
+        "within_20pct": float((ape <= 0.20).mean()),
+    }
+
+def score_parameters(task):
+    """Worker: applica i parametri al motore e valuta tutte le osservazioni con storico precedente."""
+    db_path, params = task
+    for key, value in params.items():
+        setattr(engine, key, value)
+
+    conn = sqlite3.connect(db_path)
+    observations = conn.execute("""
+        SELECT offer_date, recipe_id, actual_mat, actual_man
+        FROM backtest_observations WHERE recipe_id IS NOT NULL
+    """).fetchall()
+
+    errors = {s: {"MAT": [], "TOT": []} for s in engine.PRICING_STRATEGIES}
+    priced, manual = 0, 0
+    for offer_date, rid, mat, man in observations:
+        # Solo storico STRETTAMENTE precedente all'offerta
+        as_of = engine.parse_as_of(offer_date) - timedelta(seconds=1)
+        result = engine.evaluate_recipe_prices(conn, rid, as_of=as_of)
+        if result is None:
+            continue
+        priced += 1
+        manual += result["is_complex"]
+        for strategy, totals in result["totals"].items():
+            if mat > 0:
+                errors[strategy]["MAT"].append((totals["MAT"] - mat) / mat)
+            if mat + man > 0:
+                errors[strategy]["TOT"].append((totals["MAT"] + totals["MAN"] - mat - man) / (mat + man))
+    conn.close()
+
+    return {
+        "params": params,
+        "priced": priced,
+        "manual_estimation": manual,
+        "strategies": {s: {k: summarize_errors(v) for k, v in e.items()} for s, e in errors.items()},
+    }
+
+def build_grid(grid_args):
+    """--grid KEY=v1,v2 ripetibile -> prodotto cartesiano di dizionari di parametri."""
+    axes = {}
+    for item in grid_args or []:
+        key, _, values = item.partition("=")
+        key = key.strip().upper()
+        if key not in GRID_PARAMS:
+            raise ValueError(f"Parametro non supportato: {key} (ammessi: {', '.join(GRID_PARAMS)})")
+        cast = type(getattr(engine, key))
+        axes[key] = [cast(v) for v in values.split(",") if v.strip()]
+    if not axes:
+        return [{key: getattr(engine, key) for key in GRID_PARAMS}]
+    keys = list(axes)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(axes[k] for k in keys))]
+
+def print_report(results):
+    print("\n" + "═" * 110)
+    print(f"   {'PARAMETRI':<45} | {'STRATEGIA':<15} | {'N':>5} | {'MAPE':>7} | {'MEDIAN':>7} | {'P90':>7} | {'BIAS':>7} | {'<=10%':>6}")
+    print("─" * 110)
+    for res in results:
+        label = " ".join(f"{k}={v}" for k, v in res["params"].items())
+        for strategy, kinds in res["strategies"].items():
+            m = kinds["MAT"]
+            if not m["n"]:
+                continue
+            print(f"   {label[:45]:<45} | {strategy:<15} | {m['n']:>5} | {m['mape']:>7.1%} | {m['median_ape']:>7.1%} | "
+                  f"{m['p90_ape']:>7.1%} | {m['bias']:>+7.1%} | {m['within_10pct']:>6.0%}")
+    print("═" * 110)
+
+# --- ENTRY POINT ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Back-testing del motore prezzi sull'archivio offerte")
+    parser.add_argument("--archive", type=str, default=ARCHIVE_FOLDER, help="Cartella con le offerte prezzate (.xlsx)")
+    parser.add_argument("--dates", type=str, help="JSON {nome_file: 'YYYY-MM-DD'} con le date reali delle offerte")
+    parser.add_argument("--db", type=str, default=REPLAY_DB_FILE, help="DB di lavoro del replay")
+    parser.add_argument("--cache", type=str, default=CACHE_FILE, help="Cache embedding/decisioni LLM")
+    parser.add_argument("--offline", action="store_true", help="Nessuna chiamata API: usa solo la cache")
+    parser.add_argument("--reuse-replay", action="store_true", help="Salta il replay se il DB di lavoro esiste già")
+    parser.add_argument("--grid", action="append", help="Griglia parametri, es. DEVIATION_THRESHOLD=0.1,0.2,0.3")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processi per lo scoring della griglia")
+    parser.add_argument("--output", type=str, help="File JSON del report")
+    args = parser.parse_args()
+
+    print("🧪 BACKTEST MOTORE PREZZI")
+    os.makedirs(os.path.dirname(args.cache), exist_ok=True)
+    cache = engine.enable_llm_cache(args.cache, offline=args.offline)
+
+    replay_stats = None
+    if args.reuse_replay and os.path.exists(args.db):
+        print(f"♻️  Riuso replay esistente: {args.db}")
+    else:
+        overrides = {}
+        if args.dates:
+            with open(args.dates, encoding="utf-8") as f:
+                overrides = json.load(f)
+        files = glob.glob(os.path.join(args.archive, "*.xlsx"))
+        dated_files = infer_offer_dates(files, overrides)
+        print(f"📦 Replay cronologico di {len(dated_files)} offerte...")
+        replay_stats = replay_archive(dated_files, args.db)
+        print(f"   -> Voci: {replay_stats['items']} | Con storico: {replay_stats['matched']} | "
+              f"Cache miss: {replay_stats['cache_miss']} ({replay_stats['elapsed_s']}s)")
+
+    grid = build_grid(args.grid)
+    workers = max(1, min(args.workers or 1, len(grid)))
+    print(f"📊 Scoring di {len(grid)} combinazioni di parametri su {workers} processi...")
+    start_time = time.time()
+    tasks = [(args.db, params) for params in grid]
+    if workers == 1:
+        results = [score_parameters(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(score_parameters, tasks))
+    scoring_s = round(time.time() - start_time, 2)
+
+    print_report(results)
+
+    report = {
+        "created_at": datetime.now().strftime(engine.DATE_FORMAT),
+        "replay": replay_stats,
+        "scoring_s": scoring_s,
+        "cache": {"hits": cache.hits, "misses": cache.misses},
+        "results": results,
+    }
+    output = args.output or os.path.join(WORK_DIR, f"backtest_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Report salvato: {output}")
+
+if __name__ == "__main__":
+    main()
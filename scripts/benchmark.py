@@ -0,0 +1,368 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from dotenv import load_dotenv, find_dotenv
+
+import bulk_ingestion as engine
+from llm_provider import get_provider
+import fast_reader
+
+# --- PATH SETUP ---
+dotenv_path = find_dotenv()
+if not dotenv_path:
+    PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+else:
+    load_dotenv(dotenv_path)
+    PROJECT_ROOT = os.path.dirname(dotenv_path)
+
+# CONFIGURAZIONE
+INPUT_FOLDER = os.path.join(PROJECT_ROOT, "data")
+RDO_FOLDER = os.path.join(PROJECT_ROOT, "richieste_ordine")
+WORK_DIR = os.path.join(PROJECT_ROOT, "db", "benchmark")
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "benchmarks")
+
+STAGES = ["ingest", "recalc", "search", "quote"]
+SEARCH_SIZES = [1000, 10000, 50000]  # Righe di vec_recipes (scalate sinteticamente)
+SEARCH_QUERIES = 200
+SEARCH_NOISE = 0.05                 # Rumore sulle copie sintetiche dei vettori reali
+REGRESSION_TOLERANCE = 0.10         # --compare: peggioramento oltre il 10% -> segnalato
+
+# Ogni stage gira in un sottoprocesso dedicato: il picco RSS misurato è quello dello stage.
+
+# --- MISURE ---
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo corrente (ru_maxrss: KB su Linux, byte su macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+def api_calls(stats):
+    return stats["embedding_calls"] + stats["chat_calls"]
+
+def import_quote_module():
+    """generate_quote.py vive nella root del repository (accanto a scripts/)."""
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if repo_root not in sys.path:
+        sys.path.append(repo_root)
+    import generate_quote
+    return generate_quote
+
+def bench_db_path(work_dir):
+    return os.path.join(work_dir, "bench.db")
+
+def connect_bench_db(db_path):
+    """DB di lavoro del benchmark (creato se manca, con lo schema del motore)."""
+    engine.DB_FILE = db_path
+    conn = engine.get_db_connection()
+    engine.init_db_schema(conn)
+    return conn
+
+# --- STAGE ---
+
+def stage_ingest(work_dir, args):
+    """Ingestion completa di data/*.xlsx su un DB vuoto + sync dei vettori."""
+    db_path = bench_db_path(work_dir)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine.DB_FILE = db_path
+    engine.init_db()
+    files = sorted(glob.glob(os.path.join(args.input, "*.xlsx")))
+    items = 0
+    for f in files:
+        s = engine.process_file(f)
+        items += s["branch"] + s["merge"]
+    engine.sync_vectors()
+    return {"rows": items, "files": len(files)}
+
+def stage_recalc(work_dir, args):
+    """recalc_recipe_stats su tutte le ricette del DB (con upsert di price_snapshots)."""
+    conn = connect_bench_db(bench_db_path(work_dir))
+    n = engine.rebuild_price_snapshots(conn)
+    conn.close()
+    return {"rows": n}
+
+def build_scaled_db(source_db, target_db, size, seed=0):
+    """
+    DB sintetico con `size` righe in vec_recipes: i vettori reali del DB di
+    benchmark vengono replicati con rumore gaussiano e rinormalizzati.
+    """
+    src = connect_bench_db(source_db)
+    rows = src.execute("SELECT id, description FROM recipes ORDER BY id").fetchall()
+    space = engine.get_space(src)
+    src.close()
+    if not rows:
+        raise RuntimeError("DB di benchmark vuoto: eseguire prima lo stage ingest")
+
+    base = np.asarray(engine.embed_texts([r[1] for r in rows], space["model"], space["dim"]), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+
+    if os.path.exists(target_db):
+        os.remove(target_db)
+    conn = connect_bench_db(target_db)
+    batch = []
+    for i in range(size):
+        src_idx = i % len(rows)
+        vec = base[src_idx]
+        if i >= len(rows):
+            vec = vec + rng.normal(0, SEARCH_NOISE / np.sqrt(len(vec)), len(vec)).astype(np.float32)
+            vec /= np.linalg.norm(vec)
+        batch.append((i + 1, f"{rows[src_idx][1]} [syn {i}]", vec))
+        if len(batch) >= 5000 or i == size - 1:
+            conn.executemany("INSERT INTO recipes (id, code, description, unit_material_price, unit_manpower_price) VALUES (?,?,?,1,1)",
+                             [(rid, f"SYN{rid}", desc) for rid, desc, _ in batch])
+            conn.executemany("INSERT INTO vec_recipes(rowid, embedding) VALUES (?, ?)",
+                             [(rid, engine.serialize_f32(v)) for rid, _, v in batch])
+            conn.commit()
+            batch = []
+    conn.close()
+    return [r[1] for r in rows]
+
+def stage_search(work_dir, args):
+    """Ricerca KNN del preventivatore a dimensioni crescenti del DB."""
+    generate_quote = import_quote_module()
+    by_size = {}
+    total_queries, total_s = 0, 0.0
+    for size in args.sizes:
+        db_path = os.path.join(work_dir, f"search_{size}.db")
+        descriptions = build_scaled_db(bench_db_path(work_dir), db_path, size)
+        queries = [descriptions[i % len(descriptions)] for i in range(args.queries)]
+        # Embedding delle query fuori dal cronometro (nello spazio attivo): si misura solo la ricerca
+        conn = connect_bench_db(db_path)
+        space = engine.get_space(conn)
+        conn.close()
+        vectors = dict(zip(queries, engine.embed_texts(queries, space["model"], space["dim"])))
+        generate_quote.DB_FILE = db_path
+        original_embedding = generate_quote.get_embedding
+        generate_quote.get_embedding = lambda text, model=None, dimensions=None: vectors[text]
+        try:
+            latencies = []
+            for q in queries:
+                t0 = time.perf_counter()
+                generate_quote.search_similar_candidates(q, limit=5)
+                latencies.append(time.perf_counter() - t0)
+        finally:
+            generate_quote.get_embedding = original_embedding
+        lat = np.asarray(latencies)
+        by_size[str(size)] = {
+            "queries": len(queries),
+            "p50_ms": round(float(np.percentile(lat, 50)) * 1000, 3),
+            "p95_ms": round(float(np.percentile(lat, 95)) * 1000, 3),
+            "queries_per_s": round(len(queries) / lat.sum(), 1) if lat.sum() else None,
+        }
+        total_queries += len(queries)
+        total_s += float(lat.sum())
+    return {"rows": total_queries, "search_s": round(total_s, 3), "by_size": by_size}
+
+def load_rdo_lines(path):
+    """
+    Righe RDO (DESCRIZIONE, QUANTITA, UNITA_MISURA) da un computo metrico grezzo.
+    Estrazione locale e approssimata, sufficiente per il benchmark: una voce inizia
+    su una riga con CODICE e descrizione; la quantità è quella della riga stessa
+    (liste piatte) o quella della riga 'Totale' che chiude le righe di misura.
+    """
+    df = fast_reader.read_table(path)
+    header_idx, cols = None, {}
+    for i, row in enumerate(df.itertuples(index=False, name=None)):
+        labels = [str(v).strip().upper() if pd.notna(v) else "" for v in row]
+        qty = [j for j, v in enumerate(labels) if v.startswith("QUANTIT")]
+        desc = [j for j, v in enumerate(labels) if v.startswith("DESCRIZIONE") or v.startswith("INDICAZIONE")]
+        if qty and desc:
+            header_idx = i
+            code = [j for j, v in enumerate(labels) if v.startswith("CODICE")]
+            um = [j for j, v in enumerate(labels) if re.match(r"U\.?\s?M", v)]
+            cols = {"desc": desc[0], "qty": qty[0], "code": code[0] if code else None, "um": um[0] if um else None}
+            break
+    if header_idx is None:
+        return pd.DataFrame(columns=["DESCRIZIONE", "QUANTITA", "UNITA_MISURA"])
+
+    def cell(row, key):
+        i = cols[key]
+        return str(row[i]).strip() if i is not None and pd.notna(row[i]) else ""
+
+    lines, curr = [], None
+    for row in df.iloc[header_idx + 1:].itertuples(index=False, name=None):
+        desc, code = cell(row, "desc"), cell(row, "code")
+        qty = engine.parse_number(cell(row, "qty") or None)
+        if code and desc:
+            if curr and curr["QUANTITA"]:
+                lines.append(curr)
+            curr = {"DESCRIZIONE": desc, "QUANTITA": qty, "UNITA_MISURA": cell(row, "um")}
+        elif curr and desc.lower().startswith("totale") and qty:
+            curr["QUANTITA"] = qty
+            curr["UNITA_MISURA"] = curr["UNITA_MISURA"] or cell(row, "um")
+            lines.append(curr)
+            curr = None
+    if curr and curr["QUANTITA"]:
+        lines.append(curr)
+    return pd.DataFrame(lines, columns=["DESCRIZIONE", "QUANTITA", "UNITA_MISURA"])
+
+def stage_quote(work_dir, args):
+    """Preventivazione dei computi metrici in richieste_ordine/ sul DB di benchmark."""
+    generate_quote = import_quote_module()
+    generate_quote.DB_FILE = bench_db_path(work_dir)
+    workbooks = sorted(glob.glob(os.path.join(args.rdo, "**", "*.xlsx"), recursive=True))
+    lines, per_file = 0, {}
+    for wb in workbooks:
+        clean = load_rdo_lines(wb)
+        if args.max_lines:
+            clean = clean.head(args.max_lines)
+        name = os.path.splitext(os.path.basename(wb))[0]
+        clean_path = os.path.join(work_dir, f"{name}_clean.xlsx")
+        clean.to_excel(clean_path, index=False)
+        generate_quote.FILE_INPUT_RDO = clean_path
+        generate_quote.FILE_FINAL_XLSX = os.path.join(work_dir, f"{name}_preventivo.xlsx")
+        t0 = time.perf_counter()
+        generate_quote.main()
+        per_file[os.path.basename(wb)] = {"lines": len(clean), "elapsed_s": round(time.perf_counter() - t0, 3)}
+        lines += len(clean)
+    return {"rows": lines, "files": per_file}
+
+STAGE_FUNCS = {"ingest": stage_ingest, "recalc": stage_recalc, "search": stage_search, "quote": stage_quote}
+
+def run_stage(name, args):
+    """Esegue uno stage nel processo corrente e ritorna le metriche."""
+    provider = get_provider()
+    provider.reset_stats()
+    start = time.perf_counter()
+    try:
+        result = STAGE_FUNCS[name](args.work_dir, args)
+        status = "ok"
+    except Exception as e:
+        result, status = {"error": f"{type(e).__name__}: {e}"}, "error"
+    wall = time.perf_counter() - start
+    rows = result.get("rows", 0)
+    result.update({
+        "stage": name,
+        "status": status,
+        "wall_s": round(wall, 3),
+        "rows_per_s": round(rows / wall, 1) if rows and wall else None,
+        "api_calls": api_calls(provider.stats),
+        "api_stats": dict(provider.stats),
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+# --- ORCHESTRAZIONE ---
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def spawn_stage(name, args):
+    """Lancia lo stage in un sottoprocesso (RSS isolato) e ne legge il risultato JSON."""
+    result_file = os.path.join(args.work_dir, f"stage_{name}.json")
+    cmd = [sys.executable, os.path.abspath(__file__), "--stage", name, "--result-file", result_file,
+           "--work-dir", args.work_dir, "--input", args.input, "--rdo", args.rdo,
+           "--queries", str(args.queries), "--max-lines", str(args.max_lines),
+           "--sizes", *[str(s) for s in args.sizes]]
+    out = None if args.verbose else subprocess.DEVNULL
+    subprocess.run(cmd, stdout=out, check=False)
+    if not os.path.exists(result_file):
+        return {"stage": name, "status": "error", "error": "sottoprocesso terminato senza risultato"}
+    with open(result_file, encoding="utf-8") as f:
+        return json.load(f)
+
+COMPARED_METRICS = [("wall_s", False), ("rows_per_s", True), ("api_calls", False), ("peak_rss_mb", False)]
+
+def compare_reports(old, new):
+    """Delta per stage rispetto a un report precedente. Ritorna le regressioni oltre tolleranza."""
+    regressions = []
+    old_stages = {s["stage"]: s for s in old.get("stages", [])}
+    print(f"\n📈 CONFRONTO con {old.get('git_revision') or '?'} ({old.get('created_at')})")
+    for stage in new["stages"]:
+        prev = old_stages.get(stage["stage"])
+        if not prev:
+            continue
+        parts = []
+        for metric, higher_is_better in COMPARED_METRICS:
+            a, b = prev.get(metric), stage.get(metric)
+            if not a or b is None:
+                continue
+            delta = (b - a) / a
+            parts.append(f"{metric} {a} -> {b} ({delta:+.0%})")
+            worse = -delta if higher_is_better else delta
+            if worse > REGRESSION_TOLERANCE:
+                regressions.append((stage["stage"], metric, a, b))
+        print(f"   {stage['stage']:<7} " + " | ".join(parts))
+    for stage, metric, a, b in regressions:
+        print(f"   ⚠️  Regressione {stage}.{metric}: {a} -> {b}")
+    return regressions
+
+def print_summary(stages):
+    print(f"\n{'STAGE':<8}{'STATO':<7}{'WALL s':>10}{'RIGHE':>9}{'RIGHE/s':>10}{'API':>7}{'RSS MB':>9}")
+    for s in stages:
+        print(f"{s['stage']:<8}{s['status']:<7}{s.get('wall_s', 0):>10}{s.get('rows', 0):>9}"
+              f"{str(s.get('rows_per_s')):>10}{s.get('api_calls', 0):>7}{s.get('peak_rss_mb', 0):>9}")
+        if s["status"] != "ok":
+            print(f"         ❌ {s.get('error')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end della pipeline (tempi per stage)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stage da eseguire (in ordine)")
+    parser.add_argument("--input", type=str, default=INPUT_FOLDER, help="Cartella delle offerte da ingerire")
+    parser.add_argument("--rdo", type=str, default=RDO_FOLDER, help="Cartella dei computi metrici da preventivare")
+    parser.add_argument("--work-dir", type=str, default=WORK_DIR, help="Cartella dei DB di lavoro")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SEARCH_SIZES, help="Dimensioni DB per lo stage search")
+    parser.add_argument("--queries", type=int, default=SEARCH_QUERIES, help="Query per dimensione nello stage search")
+    parser.add_argument("--max-lines", type=int, default=0, help="Limita le righe RDO per file nello stage quote (0 = tutte)")
+    parser.add_argument("--provider", choices=["offline", "openai"], default="offline",
+                        help="Provider LLM (Default: offline deterministico, nessun costo API)")
+    parser.add_argument("--output", type=str, help="File JSON dei risultati")
+    parser.add_argument("--compare", type=str, help="Report JSON precedente da confrontare")
+    parser.add_argument("--verbose", action="store_true", help="Mostra l'output degli stage")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    # Processo figlio: un singolo stage
+    if args.stage:
+        result = run_stage(args.stage, args)
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        return
+
+    os.environ["LLM_PROVIDER"] = args.provider
+    print(f"⏱️  BENCHMARK PIPELINE ({args.provider}) | stage: {', '.join(args.stages)}")
+    stages = []
+    for name in args.stages:
+        print(f"▶️  Stage {name}...")
+        t0 = time.perf_counter()
+        result = spawn_stage(name, args)
+        result["process_s"] = round(time.perf_counter() - t0, 3)
+        stages.append(result)
+
+    report = {
+        "created_at": datetime.now().strftime(engine.DATE_FORMAT),
+        "git_revision": git_revision(),
+        "provider": args.provider,
+        "python": sys.version.split()[0],
+        "stages": stages,
+    }
+    print_summary(stages)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_reports(json.load(f), report)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{datetime.now():%Y%m%d_%H%M%S}_{report['git_revision'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Risultati salvati: {output}")
+
+if __name__ == "__main__":
+    main()
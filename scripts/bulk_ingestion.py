@@ -1,17 +1,35 @@
 import pandas as pd
 import sqlite3
 import os
+import sys
 import glob
+import itertools
+import hashlib
+import random
+import re
+import threading
 import struct
 import time
-import json
+import csv
 import numpy as np
 import argparse
+try:
+    import resource
+except ImportError:   # Windows: niente picco RSS nei report di avanzamento
+    resource = None
 import sqlite_vec
-from datetime import datetime, timedelta
-from openai import OpenAI
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv, find_dotenv
 
+# Moduli condivisi in scripts/ (importabili anche come scripts.bulk_ingestion)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from llm_cache import LLMCache
+from llm_provider import get_provider, RateLimiter
+import tracing
+import fast_reader
+import tech_attributes
+
 # --- SETUP ---
 dotenv_path = find_dotenv()
 if not dotenv_path:
@@ -21,12 +39,28 @@ else:
     load_dotenv(dotenv_path)
     PROJECT_ROOT = os.path.dirname(dotenv_path)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # CONFIGURAZIONE
 INPUT_FOLDER = os.path.join(PROJECT_ROOT, "data")
 DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v2_bulk.db")
 VECTOR_BATCH_SIZE = 200
+# SYNC VETTORI: hash del testo per ricetta (solo nuove/modificate), batch in parallelo con retry
+VECTOR_SYNC_WORKERS = 4
+VECTOR_SYNC_RETRIES = 4
+VECTOR_SYNC_BACKOFF_S = 2.0
+VECTOR_COMMIT_EVERY = 5        # Batch per transazione
+# Indici vettoriali sincronizzati: ricette (retrieval principale) e componenti (fallback del preventivo)
+VECTOR_INDEXES = {
+    "recipes": {"table": "recipes", "vec": "vec_recipes", "state": "vector_sync_state", "key": "recipe_id", "label": "ricette"},
+    "components": {"table": "components", "vec": "vec_components", "state": "component_vector_state", "key": "component_id", "label": "componenti"},
+}
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+# SPAZI DI EMBEDDING VERSIONATI (embedding_spaces): modello + dimensione + tabelle vec proprie.
+# Lo spazio 'default' usa le tabelle storiche (vec_recipes, vec_components); un nuovo spazio ha
+# tabelle ombra (vec_recipes__<nome>) riempite in background mentre il preventivatore continua
+# a leggere lo spazio attivo, poi uno switch atomico lo rende attivo.
+DEFAULT_SPACE = "default"
+REEMBED_TEXTS_PER_MIN = 3000   # Throttling del re-embedding in background (None = nessun limite)
 
 # SOGLIE SMART PRICING ADATTIVO
 SIMILARITY_MERGE = 0.98  
@@ -35,9 +69,27 @@ VOLATILITY_THRESHOLD = 0.5
 DEVIATION_THRESHOLD = 0.20 # 20% di variazione fa scattare il trigger
 STALENESS_DAYS = 180       # 6 mesi di buco fanno scattare il trigger
 
+# INGESTION IN STREAMING (listini fornitore molto grandi)
+# Righe lette una alla volta (openpyxl read-only / CSV a blocchi) e commit ogni N ricette:
+# la memoria resta costante qualunque sia la dimensione del file.
+STREAM_MIN_MB = 20             # File più grandi di così vanno in streaming automaticamente
+STREAM_COMMIT_EVERY = 500      # Ricette per commit
+STREAM_PROGRESS_EVERY = 10000  # Righe tra due report di avanzamento
+
 # GLOBALS (Configurabili da args)
 PRICING_MODE = "SMART_ADAPTIVE" # Options: SMART_ADAPTIVE, MAX, LATEST, SMART_1Y
 
+# Strategie materializzate in price_snapshots (una riga per ricetta/strategia)
+PRICING_STRATEGIES = ["SMART_ADAPTIVE", "MAX", "LATEST", "SMART_1Y"]
+
+# CACHE LLM (opzionale): embedding e decisioni del giudice riusati tra run.
+# OFFLINE=True -> nessuna chiamata API: un dato non in cache solleva OfflineCacheMiss.
+LLM_CACHE = None
+OFFLINE = False
+
+class OfflineCacheMiss(Exception):
+    """Dato LLM richiesto in modalità OFFLINE ma assente dalla cache."""
+
 # MAPPATURA V5 STRICT (O Formato Cliente)
 IDX = {
     "ARTICOLO": 0, "DESCRIZIONE": 1, "UM": 2, "Q_COMP": 3,
@@ -45,12 +97,56 @@ IDX = {
     "P_MAN": 10, "IMPORTO_TOT": 14
 }
 
+# FORMATI DI INPUT: il layout di ogni file è riconosciuto dall'intestazione (prime righe).
+# - V5_STRICT: ricette (header -> componenti -> 2 footer) con le posizioni IDX, anche nella
+#   variante con colonne aggiuntive dopo DESCRIZIONE (es. 16 colonne: tutto spostato di uno);
+# - FLAT: listino fornitore (codice, descrizione, UM, prezzo): i prezzi dei componenti già noti
+#   (per codice o descrizione identica) sono caricati in blocco in price_history, senza LLM.
+HEADER_SCAN_ROWS = 40
+FLAT_ALIASES = {
+    "CODICE": ("CODICE", "COD.", "COD ", "ARTICOLO", "CODE", "SKU"),
+    "DESCRIZIONE": ("DESCRIZIONE", "DESCRIPTION", "DENOMINAZIONE"),
+    "UM": ("U.M.", "UM", "U.M", "UNITA"),
+    "PREZZO": ("PREZZO", "LISTINO", "PRICE", "P.U."),
+}
+V5_SUBHEADER = {"COMP.", "ART.", "MAN.", "FAB."}
+FLAT_BATCH_SIZE = 5000
+
 def serialize_f32(vector):
     return struct.pack(f"<{len(vector)}f", *vector)
 
-def get_embedding_single(text):
-    text = str(text).replace("\n", " ").strip()
-    return client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
+def enable_llm_cache(path, offline=False):
+    """Attiva la cache persistente di embedding/decisioni (e opzionalmente la modalità offline)."""
+    global LLM_CACHE, OFFLINE
+    LLM_CACHE = LLMCache(path)
+    OFFLINE = offline
+    return LLM_CACHE
+
+def embed_texts(texts, model=None, dimensions=None):
+    """
+    Embedding batch con lookup in cache: solo i testi mancanti vanno all'API.
+    dimensions: dimensione richiesta al modello (quella dello spazio di embedding).
+    """
+    model = model or EMBEDDING_MODEL
+    texts = [str(t).replace("\n", " ").strip() for t in texts]
+    vectors = LLM_CACHE.get_embeddings(texts, model, dimensions) if LLM_CACHE else [None] * len(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if LLM_CACHE:
+        tracing.count("cache_hits", len(texts) - len(missing))
+        tracing.count("cache_misses", len(missing))
+    if missing:
+        if OFFLINE:
+            raise OfflineCacheMiss(f"{len(missing)} embedding non presenti in cache")
+        with tracing.span("embedding", texts=len(missing)):
+            fresh = get_provider().embed([texts[i] for i in missing], model, dimensions)
+        for i, v in zip(missing, fresh):
+            vectors[i] = v
+        if LLM_CACHE:
+            LLM_CACHE.put_embeddings([texts[i] for i in missing], [vectors[i] for i in missing], model, dimensions)
+    return vectors
+
+def get_embedding_single(text, model=None, dimensions=None):
+    return embed_texts([text], model, dimensions)[0]
 
 def get_db_connection():
     conn = sqlite3.connect(DB_FILE)
@@ -59,7 +155,243 @@ def get_db_connection():
         sqlite_vec.load(conn)
         conn.enable_load_extension(False)
     except: pass
-    return conn
+    return tracing.get_tracer().instrument_connection(conn)
+
+def init_db():
+    """Crea o aggiorna lo schema di DB_FILE (entry point che scrivono sul DB: ingestion, manutenzione)."""
+    conn = get_db_connection()
+    init_db_schema(conn)
+    conn.commit()
+    conn.close()
+
+def init_db_schema(conn):
+    """
+    Schema V3 completo (Smart Pricing), idempotente.
+    Chiamato esplicitamente dove un DB viene creato o migrato (ingestion, migrazione legacy,
+    DB di lavoro di backtest e benchmark): get_db_connection non tocca lo schema, così i
+    percorsi di sola lettura (preventivo, sonar, snapshot) non prendono lock di scrittura.
+    """
+    c = conn.cursor()
+    # 1. Recipes (con colonne volatilità)
+    c.execute('''CREATE TABLE IF NOT EXISTS recipes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT, description TEXT,
+        unit_material_price REAL, unit_manpower_price REAL,
+        source_file TEXT,
+        volatility_index REAL DEFAULT 0.0,
+        is_complex_assembly BOOLEAN DEFAULT 0,
+        confidence_score REAL DEFAULT 0.0,
+        last_price_date DATETIME
+    )''')
+    
+    # 2. Components (con cache prezzi)
+    c.execute('''CREATE TABLE IF NOT EXISTS components (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, recipe_id INTEGER,
+        code TEXT, description TEXT, type TEXT, qty_coefficient REAL, 
+        unit_price REAL, last_calculated_at DATETIME,
+        FOREIGN KEY(recipe_id) REFERENCES recipes(id)
+    )''')
+    
+    c.execute("CREATE INDEX IF NOT EXISTS idx_components_code ON components(code)")
+
+    # 3. Price History (fondamentale per Smart Pricing)
+    c.execute('''CREATE TABLE IF NOT EXISTS price_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        component_id INTEGER,
+        raw_price REAL,
+        date DATETIME DEFAULT CURRENT_TIMESTAMP,
+        source_file TEXT,
+        context_tags TEXT,
+        reliability_score REAL DEFAULT 1.0,
+        FOREIGN KEY(component_id) REFERENCES components(id)
+    )''')
+
+    # 3b. Stato della sincronizzazione vettori (hash del testo embeddato per ricetta)
+    c.execute('''CREATE TABLE IF NOT EXISTS vector_sync_state (
+        recipe_id INTEGER PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        model TEXT,
+        synced_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # 3c. Stato dei vettori dei componenti (vec_components, fallback del preventivo)
+    c.execute('''CREATE TABLE IF NOT EXISTS component_vector_state (
+        component_id INTEGER PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        model TEXT,
+        synced_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # 4. Ingested Files (Tracking)
+    c.execute('''CREATE TABLE IF NOT EXISTS ingested_files (
+        filename TEXT PRIMARY KEY,
+        file_hash TEXT,
+        import_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+        status TEXT,
+        recipes_count INTEGER
+    )''')
+
+    # 5. Tabelle derivate del motore prezzi (price_snapshots)
+    ensure_pricing_schema(conn)
+
+    # 5b. Attributi tecnici estratti dalle descrizioni (colonne attr_* indicizzate)
+    tech_attributes.ensure_attribute_schema(conn)
+
+    # 6. Vector Tables per ogni spazio di embedding in uso (richiedono l'estensione sqlite-vec caricata)
+    ensure_space_schema(conn)
+    for name, dim in c.execute("SELECT name, dim FROM embedding_spaces WHERE status != 'retired'").fetchall():
+        create_space_tables(conn, name, dim)
+
+def ensure_space_schema(conn):
+    """Registro degli spazi di embedding; un DB esistente parte con lo spazio 'default' attivo."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS embedding_spaces (
+        name TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        dim INTEGER NOT NULL,
+        status TEXT DEFAULT 'building',   -- building | active | retired
+        rows_total INTEGER DEFAULT 0,
+        rows_done INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        activated_at DATETIME,
+        updated_at DATETIME
+    )''')
+    # Al più uno spazio attivo: lo switch è un'unica transazione
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_embedding_spaces_active ON embedding_spaces(status) WHERE status = 'active'")
+    conn.execute("""INSERT OR IGNORE INTO embedding_spaces (name, model, dim, status, activated_at)
+                    SELECT ?, ?, ?, 'active', CURRENT_TIMESTAMP
+                    WHERE NOT EXISTS (SELECT 1 FROM embedding_spaces WHERE status = 'active')""",
+                 (DEFAULT_SPACE, EMBEDDING_MODEL, EMBEDDING_DIM))
+
+def create_space_tables(conn, space, dim):
+    """Tabelle vec0 e di stato di uno spazio (lo spazio 'default' ha quelle storiche, create sopra)."""
+    for index in VECTOR_INDEXES:
+        spec = space_index(space, index)
+        if space != DEFAULT_SPACE:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS {spec['state']} (
+                {spec['key']} INTEGER PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                model TEXT,
+                synced_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''')
+        try:
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {spec['vec']} USING vec0(embedding float[{dim}])")
+        except Exception:
+            pass
+
+def ensure_pricing_schema(conn):
+    """Crea (se mancanti) le tabelle derivate del motore prezzi (idempotente)."""
+    # Snapshot materializzato: prezzi per ricetta e per strategia, letti dal preventivatore
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_snapshots (
+        recipe_id INTEGER NOT NULL,
+        strategy TEXT NOT NULL,
+        unit_material_price REAL,
+        unit_manpower_price REAL,
+        volatility_index REAL DEFAULT 0.0,
+        is_complex_assembly BOOLEAN DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (recipe_id, strategy),
+        FOREIGN KEY(recipe_id) REFERENCES recipes(id)
+    ) WITHOUT ROWID''')
+    # Indici per il pricing point-in-time (range scan per componente e data)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_price_history_component_date ON price_history(component_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_components_recipe ON components(recipe_id)")
+    ensure_price_stats_schema(conn)
+
+# Aggregati incrementali per componente, mantenuti da trigger su price_history:
+# - conteggio, media e M2 di Welford (volatilità), massimo, ultimi due prezzi (LATEST / trigger adattivi);
+# - somme per fascia d'età (<=365, <=730 giorni, oltre) e ultimo anno, riferite a banded_at;
+# - bucket per data esatta: quando "adesso" avanza, solo i bucket che cambiano fascia vengono spostati.
+# UPDATE/DELETE sullo storico invalidano gli aggregati del componente (ricostruiti alla lettura).
+# Un componente senza aggregati ma con storico (grezzo o compattato) non viene riaperto dal trigger.
+PRICE_STATS_TRIGGERS = {
+    "trg_price_stats_insert": """
+        CREATE TRIGGER IF NOT EXISTS trg_price_stats_insert AFTER INSERT ON price_history
+        WHEN EXISTS (SELECT 1 FROM component_price_stats WHERE component_id = NEW.component_id)
+          OR (NOT EXISTS (SELECT 1 FROM price_history WHERE component_id = NEW.component_id AND id != NEW.id)
+              AND NOT EXISTS (SELECT 1 FROM price_history_monthly WHERE component_id = NEW.component_id))
+        BEGIN
+            INSERT OR IGNORE INTO component_price_stats (component_id, banded_at) VALUES (NEW.component_id, CURRENT_TIMESTAMP);
+            UPDATE component_price_stats SET
+                n = n + 1,
+                mean = mean + (COALESCE(NEW.raw_price, 0.0) - mean) / (n + 1),
+                m2 = m2 + (COALESCE(NEW.raw_price, 0.0) - mean)
+                          * (COALESCE(NEW.raw_price, 0.0) - (mean + (COALESCE(NEW.raw_price, 0.0) - mean) / (n + 1))),
+                max_price = MAX(COALESCE(max_price, COALESCE(NEW.raw_price, 0.0)), COALESCE(NEW.raw_price, 0.0)),
+                latest_price = CASE WHEN latest_date IS NULL OR COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > latest_date
+                                    THEN COALESCE(NEW.raw_price, 0.0) ELSE latest_price END,
+                latest_date = CASE WHEN latest_date IS NULL OR COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > latest_date
+                                   THEN COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) ELSE latest_date END,
+                prev_price = CASE WHEN latest_date IS NULL THEN NULL
+                                  WHEN COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > latest_date THEN latest_price
+                                  WHEN prev_date IS NULL OR COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > prev_date
+                                  THEN COALESCE(NEW.raw_price, 0.0) ELSE prev_price END,
+                prev_date = CASE WHEN latest_date IS NULL THEN NULL
+                                 WHEN COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > latest_date THEN latest_date
+                                 WHEN prev_date IS NULL OR COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > prev_date
+                                 THEN COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) ELSE prev_date END,
+                b1_n = b1_n + (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > datetime(banded_at, '-366 days')),
+                b1_sum = b1_sum + COALESCE(NEW.raw_price, 0.0) * (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > datetime(banded_at, '-366 days')),
+                b2_n = b2_n + (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) <= datetime(banded_at, '-366 days')
+                               AND COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > datetime(banded_at, '-731 days')),
+                b2_sum = b2_sum + COALESCE(NEW.raw_price, 0.0) * (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) <= datetime(banded_at, '-366 days')
+                                                                 AND COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) > datetime(banded_at, '-731 days')),
+                b3_n = b3_n + (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) <= datetime(banded_at, '-731 days')),
+                b3_sum = b3_sum + COALESCE(NEW.raw_price, 0.0) * (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) <= datetime(banded_at, '-731 days')),
+                y_n = y_n + (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) >= datetime(banded_at, '-365 days')),
+                y_sum = y_sum + COALESCE(NEW.raw_price, 0.0) * (COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP) >= datetime(banded_at, '-365 days'))
+            WHERE component_id = NEW.component_id;
+            INSERT INTO component_price_buckets (component_id, date, n, sum)
+            VALUES (NEW.component_id, COALESCE(datetime(NEW.date), CURRENT_TIMESTAMP), 1, COALESCE(NEW.raw_price, 0.0))
+            ON CONFLICT(component_id, date) DO UPDATE SET n = n + 1, sum = sum + excluded.sum;
+        END""",
+    "trg_price_stats_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_price_stats_update AFTER UPDATE OF component_id, raw_price, date ON price_history
+        BEGIN
+            DELETE FROM component_price_stats WHERE component_id IN (OLD.component_id, NEW.component_id);
+            DELETE FROM component_price_buckets WHERE component_id IN (OLD.component_id, NEW.component_id);
+        END""",
+    "trg_price_stats_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_price_stats_delete AFTER DELETE ON price_history
+        BEGIN
+            DELETE FROM component_price_stats WHERE component_id = OLD.component_id;
+            DELETE FROM component_price_buckets WHERE component_id = OLD.component_id;
+        END""",
+}
+
+def ensure_price_stats_schema(conn):
+    """Crea (se mancanti) component_price_stats, i bucket per data e i trigger su price_history."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS component_price_stats (
+        component_id INTEGER PRIMARY KEY,
+        n INTEGER DEFAULT 0, mean REAL DEFAULT 0.0, m2 REAL DEFAULT 0.0, max_price REAL,
+        latest_price REAL, latest_date TEXT, prev_price REAL, prev_date TEXT,
+        banded_at TEXT NOT NULL,
+        b1_n INTEGER DEFAULT 0, b1_sum REAL DEFAULT 0.0,
+        b2_n INTEGER DEFAULT 0, b2_sum REAL DEFAULT 0.0,
+        b3_n INTEGER DEFAULT 0, b3_sum REAL DEFAULT 0.0,
+        y_n INTEGER DEFAULT 0, y_sum REAL DEFAULT 0.0
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS component_price_buckets (
+        component_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        n INTEGER DEFAULT 0,
+        sum REAL DEFAULT 0.0,
+        PRIMARY KEY (component_id, date)
+    ) WITHOUT ROWID''')
+    # Storico compattato: aggregati mensili delle righe fuori dalla finestra grezza (compact_price_history)
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_history_monthly (
+        component_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        mean REAL, min_price REAL, max_price REAL, m2 REAL DEFAULT 0.0,
+        last_price REAL, last_date TEXT, first_date TEXT,
+        PRIMARY KEY (component_id, month)
+    ) WITHOUT ROWID''')
+    # Trigger creato prima dei mesi compattati: va ricreato con la nuova condizione
+    old = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='trg_price_stats_insert'").fetchone()
+    if old and "price_history_monthly" not in old[0]:
+        conn.execute("DROP TRIGGER trg_price_stats_insert")
+    for sql in PRICE_STATS_TRIGGERS.values():
+        conn.execute(sql)
 
 def judge_similarity(new_desc, existing_desc):
     """LLM Judge per decidere Merge vs Branch."""
@@ -78,178 +410,710 @@ def judge_similarity(new_desc, existing_desc):
     
     Rispondi JSON: {{ "is_merge": true/false, "reason": "..." }}
     """
+    cache_key = [existing_desc, new_desc]
+    if LLM_CACHE:
+        cached = LLM_CACHE.get_decision("judge", cache_key)
+        tracing.count("cache_hits" if cached is not None else "cache_misses")
+        if cached is not None:
+            return cached.get("is_merge", False), cached.get("reason", "")
+    if OFFLINE:
+        return False, "Offline: decisione non in cache"
     try:
-        res = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0
-        )
-        data = json.loads(res.choices[0].message.content)
+        with tracing.span("ingest.judge"):
+            data, _ = get_provider().chat_json(
+                [{"role": "user", "content": prompt}],
+                model="gpt-4o-mini",
+                task="judge",
+                context={"existing": existing_desc, "new": new_desc}
+            )
+        if LLM_CACHE:
+            LLM_CACHE.put_decision("judge", cache_key, data)
         return data.get("is_merge", False), data.get("reason", "")
     except:
         return False, "Error"
 
 def find_semantic_match(desc, conn):
-    vec = get_embedding_single(desc)
+    space = get_space(conn)
+    vec = get_embedding_single(desc, space["model"], space["dim"])
     bin_vec = serialize_f32(vec)
-    row = conn.execute("""
-        SELECT r.id, r.description, v.distance
-        FROM vec_recipes v
-        JOIN recipes r ON v.rowid = r.id
-        WHERE v.embedding MATCH ? AND k = 1
-        ORDER BY v.distance ASC
-    """, (bin_vec,)).fetchone()
+    with tracing.span("ingest.knn"):
+        row = conn.execute(f"""
+            SELECT r.id, r.description, v.distance
+            FROM {space_index(space['name'], 'recipes')['vec']} v
+            JOIN recipes r ON v.rowid = r.id
+            WHERE v.embedding MATCH ? AND k = 1
+            ORDER BY v.distance ASC
+        """, (bin_vec,)).fetchone()
     if row:
         return row[0], row[1], 1 / (1 + row[2])
     return None, None, 0.0
 
 # --- CORE PRICING ENGINE ---
 
-def calculate_smart_adaptive_price(history, now):
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+SECONDS_PER_DAY = 86400
+
+def utc_now():
     """
-    Implementa le regole di Smart Pricing Adattivo:
-    1. Deviazione Significativa -> Peso alto all'ultimo prezzo.
-    2. Dato Vecchio -> Peso alto all'ultimo prezzo.
-    3. Altrimenti -> Media pesata temporale standard.
+    'Adesso' del motore prezzi, in UTC senza fuso: stesso orologio di CURRENT_TIMESTAMP di SQLite
+    (default di price_history.date, banded_at e date mancanti nei trigger). Età e fasce
+    ≤365/≤730 giorni restano coerenti tra trigger e Python anche fuori da UTC.
     """
-    if not history: return 0.0
-    
-    # Ordina per data decrescente (più recente prima)
-    # history item: (price, date_obj)
-    sorted_hist = sorted(history, key=lambda x: x[1], reverse=True)
-    
-    latest_price, latest_date = sorted_hist[0]
-    
-    if len(sorted_hist) == 1:
-        return latest_price
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_as_of(value):
+    """Converte 'YYYY-MM-DD' (fine giornata) o 'YYYY-MM-DD HH:MM:SS' in datetime."""
+    if value is None or isinstance(value, datetime):
+        return value
+    value = str(value).strip()
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+
+def parse_price_dates(date_values, now):
+    """
+    Parsing vettoriale delle date di price_history in datetime64[s].
+    Le date non interpretabili valgono 'now' (stesso comportamento storico).
+    """
+    try:
+        return np.array([str(d) for d in date_values], dtype="datetime64[s]")
+    except ValueError:
+        out = []
+        for d in date_values:
+            try: out.append(np.datetime64(datetime.strptime(str(d), DATE_FORMAT), "s"))
+            except: out.append(np.datetime64(now, "s"))
+        return np.array(out, dtype="datetime64[s]")
+
+def _time_weights(age_days):
+    """Pesi temporali standard: 1.0 (<=1 anno), 0.5 (<=2 anni), 0.1 (storico antico)."""
+    return np.where(age_days <= 365, 1.0, np.where(age_days <= 730, 0.5, 0.1))
+
+def _sort_latest_first(prices, dates):
+    """Ordina per data decrescente mantenendo l'ordine di inserimento sui pari merito."""
+    order = np.argsort(-dates.astype("int64"), kind="stable")
+    return prices[order], dates[order]
+
+def _smart_adaptive_from_arrays(prices, dates, now):
+    """Core vettoriale di calculate_smart_adaptive_price (array già ordinati, più recente prima)."""
+    latest_price = prices[0]
+    if len(prices) == 1:
+        return float(latest_price)
+
+    # Età in giorni (floor, come timedelta.days)
+    age_days = (np.datetime64(now, "s") - dates).astype("int64") // SECONDS_PER_DAY
+    weights = _time_weights(age_days)
 
     # Calcolo media storica "Reference" (escluso l'ultimo dato)
-    # Usiamo pesi temporali standard per il reference
-    ref_w_sum = 0.0
-    ref_p_sum = 0.0
-    
-    rest_hist = sorted_hist[1:]
-    latest_prev_date = rest_hist[0][1] # Data del penultimo aggiornamento
-    
-    for price, date_obj in rest_hist:
-        days = (now - date_obj).days
-        w = 1.0 if days <= 365 else (0.5 if days <= 730 else 0.1)
-        ref_p_sum += price * w
-        ref_w_sum += w
-        
-    ref_avg = ref_p_sum / ref_w_sum if ref_w_sum > 0 else 0.0
-    
-    # --- CHECK TRIGGERS ---
-    
+    ref_w_sum = weights[1:].sum()
+    ref_avg = float((prices[1:] * weights[1:]).sum() / ref_w_sum) if ref_w_sum > 0 else 0.0
+
     # Trigger 1: Deviazione Significativa
     deviation = abs(latest_price - ref_avg) / ref_avg if ref_avg > 0 else 0.0
     is_significant_deviation = deviation > DEVIATION_THRESHOLD
-    
+
     # Trigger 2: Staleness (Tempo passato dall'ultimo aggiornamento)
-    gap_days = (latest_date - latest_prev_date).days
+    gap_days = (dates[0] - dates[1]).astype("int64") // SECONDS_PER_DAY
     is_stale = gap_days > STALENESS_DAYS
-    
+
     if is_significant_deviation or is_stale:
-        # "Vicino a quest'ultimo" -> Peso dominante (es. 90%)
         # Formula: 0.9 * Latest + 0.1 * Reference
-        final_price = (0.9 * latest_price) + (0.1 * ref_avg)
+        return float((0.9 * latest_price) + (0.1 * ref_avg))
+    # Standard Time Weighted su tutto lo storico
+    return float((prices * weights).sum() / weights.sum())
+
+def calculate_smart_adaptive_price(history, now):
+    """
+    Implementa le regole di Smart Pricing Adattivo:
+    1. Deviazione Significativa -> Peso alto all'ultimo prezzo.
+    2. Dato Vecchio -> Peso alto all'ultimo prezzo.
+    3. Altrimenti -> Media pesata temporale standard.
+    """
+    if not history: return 0.0
+    # history item: (price, date_obj)
+    prices = np.array([h[0] for h in history], dtype=float)
+    dates = np.array([h[1] for h in history], dtype="datetime64[s]")
+    prices, dates = _sort_latest_first(prices, dates)
+    return _smart_adaptive_from_arrays(prices, dates, now)
+
+def strategy_prices_from_arrays(prices, dates, now):
+    """
+    Calcola il prezzo unitario di un componente per TUTTE le strategie
+    a partire da array numpy (prezzi float, date datetime64[s]).
+    """
+    prices, dates = _sort_latest_first(np.asarray(prices, dtype=float), dates)
+    out = {"MAX": float(prices.max()), "LATEST": float(prices[0])}
+
+    # SMART_1Y: media semplice sull'ultimo anno (fallback a latest se vuoto)
+    in_year = dates >= np.datetime64(now - timedelta(days=365), "s")
+    out["SMART_1Y"] = float(prices[in_year].mean()) if in_year.any() else float(prices[0])
+
+    out["SMART_ADAPTIVE"] = _smart_adaptive_from_arrays(prices, dates, now)
+    return out
+
+def compute_strategy_prices(history, now):
+    """
+    Calcola il prezzo unitario di un componente per TUTTE le strategie.
+    history: lista di (price, date_obj). Ritorna {strategia: prezzo}.
+    """
+    prices = np.array([h[0] for h in history], dtype=float)
+    dates = np.array([h[1] for h in history], dtype="datetime64[s]")
+    return strategy_prices_from_arrays(prices, dates, now)
+
+# --- AGGREGATI INCREMENTALI (component_price_stats) ---
+
+PRICE_STATS_ENABLED = True      # False -> prezzi sempre ricalcolati dallo storico completo
+PRICE_STATS_TOLERANCE = 1e-6    # Tolleranza relativa della verifica contro il ricalcolo esatto
+STATS_FIELDS = ["component_id", "n", "mean", "m2", "max_price", "latest_price", "latest_date", "prev_price",
+                "prev_date", "banded_at", "b1_n", "b1_sum", "b2_n", "b2_sum", "b3_n", "b3_sum", "y_n", "y_sum"]
+# Confini delle fasce in giorni: età <= 365 -> fascia 1, <= 730 -> fascia 2 (età = floor dei giorni)
+BAND_LIMITS = [("b1", "b2", 366), ("b2", "b3", 731)]
+YEAR_DAYS = 365
+
+def _shift_ts(ts, days):
+    return (datetime.strptime(ts, DATE_FORMAT) - timedelta(days=days)).strftime(DATE_FORMAT)
+
+def _bucket_sum(conn, cid, lo, hi, lo_op=">", hi_op="<="):
+    n, total = conn.execute(f"SELECT COALESCE(SUM(n), 0), COALESCE(SUM(sum), 0.0) FROM component_price_buckets "
+                            f"WHERE component_id = ? AND date {lo_op} ? AND date {hi_op} ?", (cid, lo, hi)).fetchone()
+    return n, total
+
+def load_price_stats(conn, component_ids):
+    """Aggregati dei componenti richiesti ({component_id: dict}); {} se la tabella non esiste."""
+    stats = {}
+    ids = list(component_ids)
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        rows = conn.execute(f"SELECT {', '.join(STATS_FIELDS)} FROM component_price_stats "
+                            f"WHERE component_id IN ({','.join('?' * len(chunk))})", chunk)
+        stats.update({r[0]: dict(zip(STATS_FIELDS, r)) for r in rows})
+    return stats
+
+def shift_price_stats(conn, st, now):
+    """
+    Somme per fascia riportate da banded_at a now spostando solo i bucket che hanno cambiato
+    fascia (range scan sulla PK dei bucket): costo proporzionale ai prezzi che invecchiano.
+    Sola lettura: ritorna una copia dell'aggregato, il DB non viene toccato.
+    """
+    t0, t1 = st["banded_at"], now.strftime(DATE_FORMAT)
+    if t0 == t1:
+        return st
+    st = dict(st)
+    cid = st["component_id"]
+    for young, old, days in BAND_LIMITS:
+        lo, hi = sorted([_shift_ts(t0, days), _shift_ts(t1, days)])
+        n, total = _bucket_sum(conn, cid, lo, hi)
+        sign = 1 if t1 > t0 else -1    # Avanti: young -> old; indietro (orologio): old -> young
+        st[f"{young}_n"] -= sign * n
+        st[f"{young}_sum"] -= sign * total
+        st[f"{old}_n"] += sign * n
+        st[f"{old}_sum"] += sign * total
+    lo, hi = sorted([_shift_ts(t0, YEAR_DAYS), _shift_ts(t1, YEAR_DAYS)])
+    n, total = _bucket_sum(conn, cid, lo, hi, lo_op=">=", hi_op="<")
+    sign = 1 if t1 > t0 else -1
+    st["y_n"] -= sign * n
+    st["y_sum"] -= sign * total
+    for band in ["b1", "b2", "b3", "y"]:
+        if st[f"{band}_n"] == 0:
+            st[f"{band}_sum"] = 0.0   # Niente residui di arrotondamento sulle fasce vuote
+    st["banded_at"] = t1
+    return st
+
+def advance_price_stats(conn, st, now):
+    """Come shift_price_stats, ma salva le fasce spostate in component_price_stats (manutenzione)."""
+    if st["banded_at"] == now.strftime(DATE_FORMAT):
+        return st
+    st = shift_price_stats(conn, st, now)
+    conn.execute("UPDATE component_price_stats SET banded_at=?, b1_n=?, b1_sum=?, b2_n=?, b2_sum=?, b3_n=?, b3_sum=?, "
+                 "y_n=?, y_sum=? WHERE component_id=?",
+                 (st["banded_at"], st["b1_n"], st["b1_sum"], st["b2_n"], st["b2_sum"], st["b3_n"], st["b3_sum"],
+                  st["y_n"], st["y_sum"], st["component_id"]))
+    return st
+
+def strategy_prices_from_stats(st, now):
+    """Stesse strategie di strategy_prices_from_arrays, in O(1) dagli aggregati (fasce già riferite a now)."""
+    now = now.replace(microsecond=0)
+    latest = st["latest_price"]
+    out = {"MAX": st["max_price"], "LATEST": latest,
+           "SMART_1Y": st["y_sum"] / st["y_n"] if st["y_n"] else latest}
+    if st["n"] == 1:
+        out["SMART_ADAPTIVE"] = float(latest)
+        return out
+
+    latest_date = datetime.strptime(st["latest_date"], DATE_FORMAT)
+    age_days = np.array([int((now - latest_date).total_seconds()) // SECONDS_PER_DAY])
+    w0 = float(_time_weights(age_days)[0])
+    w_sum = st["b1_n"] + 0.5 * st["b2_n"] + 0.1 * st["b3_n"]
+    wp_sum = st["b1_sum"] + 0.5 * st["b2_sum"] + 0.1 * st["b3_sum"]
+
+    # Media "Reference" (escluso l'ultimo dato) e trigger come in _smart_adaptive_from_arrays
+    ref_w_sum = w_sum - w0
+    ref_avg = (wp_sum - w0 * latest) / ref_w_sum if ref_w_sum > 1e-9 else 0.0
+    deviation = abs(latest - ref_avg) / ref_avg if ref_avg > 0 else 0.0
+    gap_days = int((latest_date - datetime.strptime(st["prev_date"], DATE_FORMAT)).total_seconds()) // SECONDS_PER_DAY
+    if deviation > DEVIATION_THRESHOLD or gap_days > STALENESS_DAYS:
+        out["SMART_ADAPTIVE"] = float((0.9 * latest) + (0.1 * ref_avg))
     else:
-        # "Mantenere media nell'intorno ultimo aggiornamento" -> Standard Time Weighted
-        # Ricalcoliamo includendo latest con il suo peso naturale (che sarà alto essendo recente)
-        all_w_sum = 0.0
-        all_p_sum = 0.0
-        for price, date_obj in sorted_hist:
-            days = (now - date_obj).days
-            w = 1.0 if days <= 365 else (0.5 if days <= 730 else 0.1)
-            all_p_sum += price * w
-            all_w_sum += w
-        final_price = all_p_sum / all_w_sum
-        
-    return final_price
+        out["SMART_ADAPTIVE"] = float(wp_sum / w_sum)
+    return out
 
-def recalc_recipe_stats(recipe_id, conn):
+def _date_strings(dates):
+    return [d.replace("T", " ") for d in np.datetime_as_string(dates, unit="s")]
+
+# --- STORICO COMPATTATO (price_history_monthly) ---
+
+RAW_RETENTION_DAYS = 731        # Righe grezze conservate; le più vecchie diventano aggregati mensili
+# Oltre i 730 giorni il peso temporale è uniforme (0.1) e l'ultimo anno non è coinvolto:
+# con una finestra di almeno 731 giorni i mesi compattati non cambiano nessuna strategia.
+MIN_RAW_RETENTION_DAYS = 731
+ROLLUP_FIELDS = ["n", "mean", "min_price", "max_price", "m2", "last_price", "last_date", "first_date"]
+
+def load_component_history(conn, cid, as_of=None):
     """
-    Ricalcola i prezzi in base alla PRICING_MODE selezionata.
+    Storico di un componente: righe grezze (prezzi, date in ordine di indice) e mesi compattati
+    (dict di ROLLUP_FIELDS). Con as_of i mesi compattati contano solo se interamente anteriori.
     """
+    if as_of:
+        limit = as_of.strftime(DATE_FORMAT)
+        rows = conn.execute("SELECT raw_price, date FROM price_history WHERE component_id=? AND date <= ?", (cid, limit)).fetchall()
+        rollup_sql, params = "WHERE component_id=? AND last_date <= ?", (cid, limit)
+    else:
+        rows = conn.execute("SELECT raw_price, date FROM price_history WHERE component_id=?", (cid,)).fetchall()
+        rollup_sql, params = "WHERE component_id=?", (cid,)
+    try:
+        rollups = [dict(zip(ROLLUP_FIELDS, r)) for r in conn.execute(
+            f"SELECT {', '.join(ROLLUP_FIELDS)} FROM price_history_monthly {rollup_sql} ORDER BY month", params)]
+    except sqlite3.OperationalError:
+        rollups = []   # DB senza compattazione
+    return np.array([r[0] or 0.0 for r in rows], dtype=float), [r[1] for r in rows], rollups
+
+def _history_entries(prices, dates, rollups):
+    """
+    Storico come "voci" ordinate dalla più recente: righe grezze (conteggio 1) e mesi compattati
+    (conteggio n, data e prezzo dell'ultimo dato del mese). A pari data i mesi compattati,
+    più vecchi per inserimento, vengono prima (come l'ordinamento stabile delle righe grezze).
+    """
+    rollups = rollups or []
+    e = {
+        "last": np.concatenate([[r["last_price"] for r in rollups], prices]).astype(float),
+        "sums": np.concatenate([[r["n"] * r["mean"] for r in rollups], prices]).astype(float),
+        "counts": np.concatenate([[r["n"] for r in rollups], np.ones(len(prices))]).astype(float),
+        "maxes": np.concatenate([[r["max_price"] for r in rollups], prices]).astype(float),
+        "m2": np.concatenate([[r["m2"] for r in rollups], np.zeros(len(prices))]).astype(float),
+        "dates": np.concatenate([np.array([r["last_date"] for r in rollups], dtype="datetime64[s]"), dates]),
+    }
+    order = np.argsort(-e["dates"].astype("int64"), kind="stable")
+    return {k: v[order] for k, v in e.items()}
+
+def _entries_moments(e):
+    n = e["counts"].sum()
+    mean = e["sums"].sum() / n
+    m2 = e["m2"].sum() + (e["counts"] * (e["sums"] / e["counts"] - mean) ** 2).sum()
+    return int(n), float(mean), float(m2)
+
+def strategy_prices_from_entries(e, now):
+    """strategy_prices_from_arrays esteso ai mesi compattati (voci con conteggio > 1)."""
+    latest = float(e["last"][0])
+    out = {"MAX": float(e["maxes"].max()), "LATEST": latest}
+    in_year = e["dates"] >= np.datetime64(now - timedelta(days=365), "s")
+    out["SMART_1Y"] = float(e["sums"][in_year].sum() / e["counts"][in_year].sum()) if in_year.any() else latest
+    if e["counts"].sum() == 1:
+        out["SMART_ADAPTIVE"] = latest
+        return out
+
+    age_days = (np.datetime64(now, "s") - e["dates"]).astype("int64") // SECONDS_PER_DAY
+    weights = _time_weights(age_days)
+    w_sum = (weights * e["counts"]).sum()
+    wp_sum = (weights * e["sums"]).sum()
+    ref_w_sum = w_sum - weights[0]
+    ref_avg = float((wp_sum - weights[0] * latest) / ref_w_sum) if ref_w_sum > 1e-9 else 0.0
+    deviation = abs(latest - ref_avg) / ref_avg if ref_avg > 0 else 0.0
+    second = e["dates"][0] if e["counts"][0] > 1 else e["dates"][1]
+    gap_days = (e["dates"][0] - second).astype("int64") // SECONDS_PER_DAY
+    if deviation > DEVIATION_THRESHOLD or gap_days > STALENESS_DAYS:
+        out["SMART_ADAPTIVE"] = float((0.9 * latest) + (0.1 * ref_avg))
+    else:
+        out["SMART_ADAPTIVE"] = float(wp_sum / w_sum)
+    return out
+
+def price_component_history(prices, dates, rollups, now):
+    """Prezzi per strategia e momenti (n, media, M2) di un componente da righe grezze + mesi compattati."""
+    if not rollups:
+        mean = float(prices.mean())
+        return strategy_prices_from_arrays(prices, dates, now), (len(prices), mean, float(((prices - mean) ** 2).sum()))
+    e = _history_entries(prices, dates, rollups)
+    return strategy_prices_from_entries(e, now), _entries_moments(e)
+
+def component_strategy_prices(conn, cid, as_of=None):
+    """Prezzi per strategia di un singolo componente (storico fino ad as_of). None se senza storico."""
+    as_of = parse_as_of(as_of)
+    now = as_of or utc_now()
+    prices, date_values, rollups = load_component_history(conn, cid, as_of)
+    if not len(prices) and not rollups:
+        return None
+    return price_component_history(prices, parse_price_dates(date_values, now), rollups, now)[0]
+
+def rebuild_component_stats(conn, cid, prices, dates, now, rollups=None):
+    """Aggregati esatti di un componente dal suo storico (righe grezze in ordine di indice + mesi compattati)."""
+    now_s = np.datetime64(now.replace(microsecond=0), "s")
+    e = _history_entries(prices, dates, rollups)
+    n, mean, m2 = _entries_moments(e)
+    age = (now_s - e["dates"]).astype("int64")
+    in_b1 = age < 366 * SECONDS_PER_DAY
+    in_b2 = ~in_b1 & (age < 731 * SECONDS_PER_DAY)
+    in_b3 = ~in_b1 & ~in_b2
+    in_year = e["dates"] >= now_s - np.timedelta64(YEAR_DAYS, "D")
+    date_strs = _date_strings(e["dates"][:2])
+    if e["counts"][0] > 1:
+        prev_price, prev_date = float(e["last"][0]), date_strs[0]   # Ultimo mese compattato con più prezzi
+    elif len(e["last"]) > 1:
+        prev_price, prev_date = float(e["last"][1]), date_strs[1]
+    else:
+        prev_price, prev_date = None, None
+    band = lambda mask: (int(e["counts"][mask].sum()), float(e["sums"][mask].sum()))
+    conn.execute(f"INSERT OR REPLACE INTO component_price_stats ({', '.join(STATS_FIELDS)}) "
+                 f"VALUES ({','.join('?' * len(STATS_FIELDS))})", (
+        cid, n, mean, m2, float(e["maxes"].max()), float(e["last"][0]), date_strs[0], prev_price, prev_date,
+        now.strftime(DATE_FORMAT), *band(in_b1), *band(in_b2), *band(in_b3), *band(in_year)))
+    # Bucket solo per le righe grezze: i mesi compattati non cambiano più fascia
+    buckets = {}
+    for d, p in zip(_date_strings(dates), prices):
+        count, total = buckets.get(d, (0, 0.0))
+        buckets[d] = (count + 1, total + float(p))
+    conn.execute("DELETE FROM component_price_buckets WHERE component_id = ?", (cid,))
+    conn.executemany("INSERT INTO component_price_buckets (component_id, date, n, sum) VALUES (?,?,?,?)",
+                     [(cid, d, count, total) for d, (count, total) in buckets.items()])
+
+def _iter_component_history(conn, now):
+    """Storico di tutti i componenti con prezzi: (component_id, prezzi, date, mesi compattati)."""
+    cids = {r[0] for r in conn.execute("SELECT DISTINCT component_id FROM price_history")}
+    try:
+        cids.update(r[0] for r in conn.execute("SELECT DISTINCT component_id FROM price_history_monthly"))
+    except sqlite3.OperationalError:
+        pass
+    for cid in sorted(cids):
+        prices, date_values, rollups = load_component_history(conn, cid)
+        yield cid, prices, parse_price_dates(date_values, now), rollups
+
+def rebuild_price_stats(conn, now=None):
+    """Ricostruzione esatta di tutti gli aggregati dallo storico. Ritorna il numero di componenti."""
+    now = now or utc_now()
+    conn.execute("DELETE FROM component_price_stats")
+    conn.execute("DELETE FROM component_price_buckets")
+    count = 0
+    for cid, prices, dates, rollups in _iter_component_history(conn, now):
+        rebuild_component_stats(conn, cid, prices, dates, now, rollups)
+        count += 1
+    conn.commit()
+    return count
+
+def refresh_price_stats(conn, component_ids, now=None):
+    """
+    Manutenzione degli aggregati dei componenti indicati: porta le fasce a now e ricostruisce
+    dallo storico gli aggregati mancanti (invalidati da modifiche manuali allo storico).
+    Ritorna il numero di aggregati ricostruiti; il commit resta al chiamante.
+    """
+    if not PRICE_STATS_ENABLED:
+        return 0
+    now = now or utc_now()
+    ids = list(component_ids)
+    try:
+        stats = load_price_stats(conn, ids)
+    except sqlite3.OperationalError:
+        return 0   # DB senza aggregati
+    rebuilt = 0
+    for cid in ids:
+        if cid in stats:
+            advance_price_stats(conn, stats[cid], now)
+            continue
+        prices, date_values, rollups = load_component_history(conn, cid)
+        if not len(prices) and not rollups:
+            continue
+        rebuild_component_stats(conn, cid, prices, parse_price_dates(date_values, now), now, rollups)
+        rebuilt += 1
+    return rebuilt
+
+def verify_price_stats(conn, now=None, repair=False):
+    """
+    Confronta gli aggregati incrementali con il ricalcolo esatto dallo storico (strategie,
+    conteggio, media, M2). Con repair=True i componenti divergenti o mancanti sono ricostruiti.
+    """
+    now = now or utc_now()
+    report = {"checked": 0, "missing": 0, "mismatches": []}
+    for cid, prices, dates, rollups in _iter_component_history(conn, now):
+        st = load_price_stats(conn, [cid]).get(cid)
+        if st is None:
+            report["missing"] += 1
+        else:
+            report["checked"] += 1
+            st = advance_price_stats(conn, st, now)
+            exact, (n, mean, m2) = price_component_history(prices, dates, rollups, now)
+            expected = dict(exact, n=n, mean=mean, m2=m2)
+            actual = dict(strategy_prices_from_stats(st, now), n=st["n"], mean=st["mean"], m2=st["m2"])
+            bad = [k for k in expected
+                   if abs(expected[k] - actual[k]) > PRICE_STATS_TOLERANCE * max(1.0, abs(expected[k]))]
+            if not bad:
+                continue
+            report["mismatches"].append({"component_id": cid, "fields": bad})
+        if repair:
+            rebuild_component_stats(conn, cid, prices, dates, now, rollups)
+    conn.commit()
+    return report
+
+def evaluate_recipe_prices(conn, recipe_id, as_of=None):
+    """
+    Valuta i prezzi di una ricetta: non aggiorna components, recipes né price_snapshots.
+    Sempre in sola lettura. Senza as_of (e con PRICE_STATS_ENABLED) i prezzi dei componenti derivano
+    dagli aggregati incrementali (component_price_stats, O(1) per componente), con le fasce spostate
+    in memoria fino a oggi; i componenti senza aggregato sono calcolati dallo storico. La manutenzione
+    degli aggregati (fasce salvate, ricostruzioni) è in refresh_price_stats, chiamata da recalc_recipe_stats.
+    Con as_of usa solo lo storico fino a quella data (point-in-time pricing), servito dall'indice
+    price_history(component_id, date) e dai mesi compattati.
+    Ritorna None se la ricetta non ha storico alla data richiesta.
+    """
+    as_of = parse_as_of(as_of)
+    now = as_of or utc_now()
+
     comps = conn.execute("SELECT id, qty_coefficient, type FROM components WHERE recipe_id=?", (recipe_id,)).fetchall()
-    recipe_total = 0.0
-    all_prices_for_volatility = []
+    totals = {s: {"MAT": 0.0, "MAN": 0.0} for s in PRICING_STRATEGIES}
+    component_prices = {}
+    volatility_moments = []
+
+    use_stats = as_of is None and PRICE_STATS_ENABLED
+    stats = {}
+    if use_stats:
+        try:
+            stats = load_price_stats(conn, [c[0] for c in comps])
+        except sqlite3.OperationalError:
+            pass   # DB senza aggregati: calcolo dallo storico
 
     for cid, qty, ctype in comps:
-        # Fetch history raw
-        rows = conn.execute("SELECT raw_price, date FROM price_history WHERE component_id=?", (cid,)).fetchall()
-        if not rows: continue
-        
-        # Parse Dates
-        history = []
-        now = datetime.now()
-        for r_price, r_date_str in rows:
-            try: d = datetime.strptime(str(r_date_str), "%Y-%m-%d %H:%M:%S")
-            except: d = now
-            history.append((r_price, d))
-            
-        # --- APPLICAZIONE STRATEGIA ---
-        new_unit_price = 0.0
-        
-        if PRICING_MODE == "MAX":
-            new_unit_price = max([h[0] for h in history])
-            
-        elif PRICING_MODE == "LATEST":
-            # Sort by date desc, take first
-            history.sort(key=lambda x: x[1], reverse=True)
-            new_unit_price = history[0][0]
-            
-        elif PRICING_MODE == "SMART_1Y":
-            # Filter last 1 year, then weighted avg
-            one_year_ago = now - timedelta(days=365)
-            filtered = [h for h in history if h[1] >= one_year_ago]
-            if not filtered: # Fallback a latest se vuoto
-                filtered = sorted(history, key=lambda x: x[1], reverse=True)[:1]
-            
-            # Simple average of filtered (or weighted, but sticking to simple for "SMART_1Y" usually implies focus on recency)
-            # Let's use weighted standard on the subset
-            w_sum = 0; p_sum = 0
-            for p, d in filtered:
-                w = 1.0
-                p_sum += p * w; w_sum += w
-            new_unit_price = p_sum / w_sum
-            
-        else: # DEFAULT: SMART_ADAPTIVE
-            new_unit_price = calculate_smart_adaptive_price(history, now)
-
-        # Update Cache
-        conn.execute("UPDATE components SET unit_price=?, last_calculated_at=CURRENT_TIMESTAMP WHERE id=?", (new_unit_price, cid))
-        
+        st = stats.get(cid)
+        if st is not None:
+            st = shift_price_stats(conn, st, now)
+            strategy_prices = strategy_prices_from_stats(st, now)
+            n, mean, m2 = st["n"], st["mean"], st["m2"]
+        else:
+            # Fetch history raw (range scan sull'indice component_id, date) + mesi compattati
+            prices, date_values, rollups = load_component_history(conn, cid, as_of)
+            if not len(prices) and not rollups: continue
+
+            dates = parse_price_dates(date_values, now)
+            strategy_prices, (n, mean, m2) = price_component_history(prices, dates, rollups, now)
+        component_prices[cid] = strategy_prices
+
+        bucket = "MAN" if ctype == 'MAN' else "MAT"
+        for strategy, price in strategy_prices.items():
+            totals[strategy][bucket] += price * (qty or 0)
+
         if ctype != 'MAN':
-            recipe_total += new_unit_price * qty
-            # Per volatilità usiamo tutto lo storico raw
-            all_prices_for_volatility.extend([h[0] * qty for h in history])
+            # Per volatilità usiamo tutto lo storico raw (momenti per componente, scalati per la quantità)
+            q = qty or 0
+            volatility_moments.append((n, mean * q, m2 * q * q))
 
-    # 2. Volatilità (Sempre calcolata su tutto lo storico per sicurezza)
-    if len(all_prices_for_volatility) > 1:
-        cv = np.std(all_prices_for_volatility) / np.mean(all_prices_for_volatility) if np.mean(all_prices_for_volatility) > 0 else 0.0
-    else:
-        cv = 0.0
-        
-    is_complex = 1 if cv > VOLATILITY_THRESHOLD else 0
-    conn.execute("UPDATE recipes SET unit_material_price=?, volatility_index=?, is_complex_assembly=?, last_price_date=CURRENT_TIMESTAMP WHERE id=?", 
-                 (recipe_total, cv, is_complex, recipe_id))
+    if not component_prices:
+        return None
+
+    # Volatilità (Sempre calcolata su tutto lo storico per sicurezza): CV dei prezzi x quantità
+    # di tutti i componenti materiali, combinando i momenti (Chan et al.) senza rileggere lo storico
+    total_n = sum(m[0] for m in volatility_moments)
+    cv = 0.0
+    if total_n > 1:
+        total_mean = sum(n * mean for n, mean, _ in volatility_moments) / total_n
+        total_m2 = sum(m2 + n * (mean - total_mean) ** 2 for n, mean, m2 in volatility_moments)
+        if total_mean > 0:
+            cv = float(np.sqrt(max(total_m2, 0.0) / total_n) / total_mean)
+
+    return {
+        "components": component_prices,
+        "totals": totals,
+        "volatility": cv,
+        "is_complex": 1 if cv > VOLATILITY_THRESHOLD else 0,
+    }
+
+def _merge_rollup(old, new):
+    """Unisce due aggregati mensili dello stesso componente e mese (Chan et al. per media e M2)."""
+    if old is None:
+        return new
+    n = old["n"] + new["n"]
+    delta = new["mean"] - old["mean"]
+    latest = new if new["last_date"] > old["last_date"] else old
+    return {
+        "n": n, "mean": old["mean"] + delta * new["n"] / n,
+        "min_price": min(old["min_price"], new["min_price"]), "max_price": max(old["max_price"], new["max_price"]),
+        "m2": old["m2"] + new["m2"] + delta * delta * old["n"] * new["n"] / n,
+        "last_price": latest["last_price"], "last_date": latest["last_date"],
+        "first_date": min(old["first_date"], new["first_date"]),
+    }
+
+def _month_rollups(rows):
+    """Righe (component_id, prezzo, data) ordinate per componente, data, id -> aggregati per (componente, mese)."""
+    for (cid, month), group in itertools.groupby(rows, key=lambda r: (r[0], str(r[2])[:7])):
+        group = list(group)
+        prices = np.array([g[1] or 0.0 for g in group], dtype=float)
+        last_date = group[-1][2]
+        last_price = next(g[1] or 0.0 for g in group if g[2] == last_date)   # A pari data: il primo inserito
+        mean = float(prices.mean())
+        yield cid, month, {
+            "n": len(prices), "mean": mean, "min_price": float(prices.min()), "max_price": float(prices.max()),
+            "m2": float(((prices - mean) ** 2).sum()), "last_price": float(last_price),
+            "last_date": last_date, "first_date": group[0][2],
+        }
+
+def compact_price_history(conn, retention_days=None, now=None):
+    """
+    Compattazione dello storico prezzi:
+    1. dedup: un file contribuisce una sola volta per componente e prezzo (re-ingestion dello stesso file);
+    2. le righe più vecchie di retention_days diventano aggregati mensili in price_history_monthly
+       (conteggio, media, min, max, ultimo prezzo; M2 per la volatilità) e vengono eliminate;
+    3. aggregati incrementali dei componenti toccati ricostruiti, prezzi delle ricette ricalcolati
+       dove il dedup ha tolto righe.
+    Il motore prezzi legge righe recenti + mesi compattati in modo trasparente.
+    """
+    now = now or utc_now()
+    retention = max(retention_days or RAW_RETENTION_DAYS, MIN_RAW_RETENTION_DAYS)
+    if retention_days and retention_days < MIN_RAW_RETENTION_DAYS:
+        print(f"⚠️  Finestra minima {MIN_RAW_RETENTION_DAYS} giorni (fasce di peso): uso {retention}.")
+    cutoff = (now - timedelta(days=retention)).strftime(DATE_FORMAT)
+    report = {"duplicates": 0, "rolled_rows": 0, "months": 0, "components": 0, "cutoff": cutoff}
+
+    # 1. Dedup delle ingestion ripetute
+    duplicates = conn.execute("""
+        SELECT id, component_id FROM price_history
+        WHERE source_file IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM price_history WHERE source_file IS NOT NULL
+            GROUP BY component_id, source_file, raw_price)
+    """).fetchall()
+    conn.executemany("DELETE FROM price_history WHERE id = ?", [(d[0],) for d in duplicates])
+    deduped = {d[1] for d in duplicates}
+    report["duplicates"] = len(duplicates)
+
+    # 2. Aggregati mensili delle righe fuori finestra
+    cur = conn.execute("SELECT component_id, raw_price, date FROM price_history WHERE date < ? "
+                       "ORDER BY component_id, date, id", (cutoff,))
+    rows = itertools.chain.from_iterable(iter(lambda: cur.fetchmany(10000), []))
+    rolled, upserts = set(), []
+    for cid, month, agg in _month_rollups(rows):
+        old = conn.execute(f"SELECT {', '.join(ROLLUP_FIELDS)} FROM price_history_monthly WHERE component_id=? AND month=?",
+                           (cid, month)).fetchone()
+        agg = _merge_rollup(dict(zip(ROLLUP_FIELDS, old)) if old else None, agg)
+        upserts.append((cid, month, *[agg[f] for f in ROLLUP_FIELDS]))
+        rolled.add(cid)
+        report["rolled_rows"] += agg["n"] - (old[0] if old else 0)
+    conn.executemany(f"INSERT OR REPLACE INTO price_history_monthly (component_id, month, {', '.join(ROLLUP_FIELDS)}) "
+                     f"VALUES ({','.join('?' * (len(ROLLUP_FIELDS) + 2))})", upserts)
+    conn.execute("DELETE FROM price_history WHERE date < ?", (cutoff,))
+    report["months"] = len(upserts)
+
+    # 3. Aggregati dei componenti (invalidati dai DELETE) e prezzi delle ricette toccate dal dedup
+    touched = rolled | deduped
+    for cid in touched:
+        prices, date_values, rollups = load_component_history(conn, cid)
+        if len(prices) or rollups:
+            rebuild_component_stats(conn, cid, prices, parse_price_dates(date_values, now), now, rollups)
+    report["components"] = len(touched)
+    recipe_ids = set()
+    deduped = list(deduped)
+    for i in range(0, len(deduped), 900):
+        chunk = deduped[i:i + 900]
+        recipe_ids.update(r[0] for r in conn.execute(
+            f"SELECT DISTINCT recipe_id FROM components WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+    for rid in recipe_ids:
+        recalc_recipe_stats(rid, conn)
+    conn.commit()
+    return report
+
+def recalc_recipe_stats(recipe_id, conn):
+    """
+    Ricalcola i prezzi in base alla PRICING_MODE selezionata.
+    Aggiorna anche price_snapshots con i prezzi di tutte le strategie,
+    così il preventivatore può scegliere la strategia con una sola lookup.
+    Sempre sullo storico completo: il catalogo letto dal preventivatore non contiene mai prezzi storici
+    (per un ricalcolo as-of vedi point_in_time_report).
+    Prima della lettura porta a oggi gli aggregati dei componenti della ricetta (refresh_price_stats).
+    """
+    comp_ids = [r[0] for r in conn.execute("SELECT id FROM components WHERE recipe_id=?", (recipe_id,))]
+    refresh_price_stats(conn, comp_ids)
+    result = evaluate_recipe_prices(conn, recipe_id)
+    if result is None:
+        totals = {s: {"MAT": 0.0, "MAN": 0.0} for s in PRICING_STRATEGIES}
+        result = {"components": {}, "totals": totals, "volatility": 0.0, "is_complex": 0}
+
+    # Update Cache componenti
+    conn.executemany("UPDATE components SET unit_price=?, last_calculated_at=CURRENT_TIMESTAMP WHERE id=?",
+                     [(prices.get(PRICING_MODE, prices["SMART_ADAPTIVE"]), cid)
+                      for cid, prices in result["components"].items()])
+
+    totals = result["totals"]
+    cv = result["volatility"]
+    is_complex = result["is_complex"]
+    active = totals.get(PRICING_MODE, totals["SMART_ADAPTIVE"])
+    conn.execute("UPDATE recipes SET unit_material_price=?, unit_manpower_price=?, volatility_index=?, is_complex_assembly=?, last_price_date=CURRENT_TIMESTAMP WHERE id=?", 
+                 (active["MAT"], active["MAN"], cv, is_complex, recipe_id))
+
+    # Snapshot materializzato (refresh incrementale per ricetta)
+    conn.executemany("""
+        INSERT OR REPLACE INTO price_snapshots
+            (recipe_id, strategy, unit_material_price, unit_manpower_price, volatility_index, is_complex_assembly, updated_at)
+        VALUES (?,?,?,?,?,?,CURRENT_TIMESTAMP)
+    """, [(recipe_id, strategy, t["MAT"], t["MAN"], cv, is_complex) for strategy, t in totals.items()])
+
+def rebuild_price_snapshots(conn):
+    """Ricalcola prezzi e snapshot per tutte le ricette (backfill / cambio soglie)."""
+    recipe_ids = [r[0] for r in conn.execute("SELECT id FROM recipes").fetchall()]
+    for rid in recipe_ids:
+        recalc_recipe_stats(rid, conn)
+    conn.commit()
+    return len(recipe_ids)
+
+def point_in_time_report(conn, as_of, path):
+    """
+    Prezzi di tutte le ricette alla data as_of (solo lo storico fino a quella data) in un CSV:
+    sola lettura, recipes/components/price_snapshots non vengono toccati. Le ricette senza
+    storico alla data sono escluse (nessun prezzo a zero). Ritorna (righe scritte, escluse).
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    written = skipped = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["RECIPE_ID", "CODICE", "DESCRIZIONE"]
+                        + [f"{s}_{b}" for s in PRICING_STRATEGIES for b in ("MAT", "MAN")]
+                        + ["VOLATILITA", "COMPLESSA"])
+        for rid, code, desc in conn.execute("SELECT id, code, description FROM recipes ORDER BY id").fetchall():
+            result = evaluate_recipe_prices(conn, rid, as_of=as_of)
+            if result is None:
+                skipped += 1
+                continue
+            writer.writerow([rid, code, desc]
+                            + [round(result["totals"][s][b], 4) for s in PRICING_STRATEGIES for b in ("MAT", "MAN")]
+                            + [round(result["volatility"], 4), result["is_complex"]])
+            written += 1
+    return written, skipped
 
 # --- INGESTION FLOW ---
 
-def insert_new_recipe(conn, data, filename):
+def insert_price(conn, component_id, price, filename, price_date=None):
+    """Registra un prezzo nello storico. price_date=None -> timestamp di inserimento."""
+    if price_date is not None:
+        price_date = parse_as_of(price_date).strftime(DATE_FORMAT)
+    conn.execute("INSERT INTO price_history (component_id, raw_price, source_file, date) VALUES (?,?,?,COALESCE(?, CURRENT_TIMESTAMP))",
+                 (component_id, price, filename, price_date))
+
+def insert_new_recipe(conn, data, filename, price_date=None):
     cur = conn.execute("INSERT INTO recipes (code, description, source_file) VALUES (?,?,?)",
                        (data["code"], data["desc"], filename))
     rid = cur.lastrowid
+    tech_attributes.store_attributes(conn, "recipes", rid, data["desc"])
     for c in data["components"]:
-        cur_c = conn.execute("INSERT INTO components (recipe_id, description, type, qty_coefficient, unit_price) VALUES (?,?,?,?,0)",
-                             (rid, c['desc'], c['type'], c['qty']))
-        conn.execute("INSERT INTO price_history (component_id, raw_price, source_file) VALUES (?,?,?)",
-                     (cur_c.lastrowid, c['price'], filename))
+        cur_c = conn.execute("INSERT INTO components (recipe_id, code, description, type, qty_coefficient, unit_price) VALUES (?,?,?,?,?,0)",
+                             (rid, c.get('code'), c['desc'], c['type'], c['qty']))
+        tech_attributes.store_attributes(conn, "components", cur_c.lastrowid, c['desc'])
+        insert_price(conn, cur_c.lastrowid, c['price'], filename, price_date)
     return rid
 
-def merge_into_recipe(conn, rid, data, filename):
+def merge_into_recipe(conn, rid, data, filename, price_date=None):
     existing_comps = conn.execute("SELECT id, description FROM components WHERE recipe_id=?", (rid,)).fetchall()
     for new_c in data["components"]:
         target_cid = None
@@ -261,83 +1125,555 @@ def merge_into_recipe(conn, rid, data, filename):
             cur_c = conn.execute("INSERT INTO components (recipe_id, description, type, qty_coefficient, unit_price) VALUES (?,?,?,?,0)",
                                  (rid, new_c['desc'], new_c['type'], new_c['qty']))
             target_cid = cur_c.lastrowid
-        conn.execute("INSERT INTO price_history (component_id, raw_price, source_file) VALUES (?,?,?)",
-                     (target_cid, new_c['price'], filename))
+            tech_attributes.store_attributes(conn, "components", target_cid, new_c['desc'])
+        insert_price(conn, target_cid, new_c['price'], filename, price_date)
 
-def process_file(filepath):
-    df = pd.read_excel(filepath, header=None, dtype=str)
-    filename = os.path.basename(filepath)
-    conn = get_db_connection()
-    
-    curr = None
-    foot_hits = 0
-    stats = {"branch": 0, "merge": 0}
+def parse_number(val):
+    """
+    Numero da cella letta come testo. Gestisce il formato italiano ('1.234,56')
+    e i valori numerici già convertiti da pandas ('0.15' NON diventa 15).
+    """
+    if val is None or pd.isna(val): return None
+    s = str(val).strip().replace('€','').replace(' ', '')
+    if ',' in s:
+        s = s.replace('.','').replace(',','.')
+    try: return float(s)
+    except: return None
 
-    def clean(val):
-        if pd.isna(val): return None
-        s = str(val).strip().replace('€','').replace('.','').replace(',','.')
-        try: return float(s)
-        except: return None
+def iter_recipe_blocks(rows, idx=None):
+    """
+    Parser V5 STRICT (header ricetta -> componenti -> 2 righe footer).
+    rows: iterabile di righe posizionali (tuple/liste); idx: posizioni delle colonne (Default IDX).
+    Yield un dict per ricetta: {"code", "desc", "components": [{"desc","type","qty","price"}], "total"}.
+    """
+    idx = idx or IDX
+
+    def cell(row, key):
+        i = idx[key]
+        return row[i] if i < len(row) else None
 
-    for _, row in df.iterrows():
-        raw_desc = row[IDX["DESCRIZIONE"]]
-        tot = clean(row[IDX["IMPORTO_TOT"]])
+    curr = None
+    foot_hits = 0
+    for row in rows:
+        raw_desc = cell(row, "DESCRIZIONE")
+        tot = parse_number(cell(row, "IMPORTO_TOT"))
 
         if curr:
             if tot is not None: foot_hits += 1
             if foot_hits >= 2:
-                rid, rdesc, sim = find_semantic_match(curr["desc"], conn)
-                action = "BRANCH"
-                
-                if rid:
-                    if sim >= SIMILARITY_MERGE: action = "MERGE"
-                    elif sim >= SIMILARITY_JUDGE:
-                        is_merge, _ = judge_similarity(curr["desc"], rdesc)
-                        if is_merge: action = "MERGE"
-                
-                if action == "BRANCH":
-                    rid = insert_new_recipe(conn, curr, filename)
-                    stats["branch"] += 1
-                else:
-                    merge_into_recipe(conn, rid, curr, filename)
-                    stats["merge"] += 1
-                
-                # RECALC with SELECTED STRATEGY
-                recalc_recipe_stats(rid, conn)
-                
+                curr["total"] = tot
+                yield curr
                 curr = None; foot_hits = 0; continue
 
-        if not curr and pd.notna(row[IDX["ARTICOLO"]]) and pd.notna(raw_desc) and tot is None:
-            curr = {"code": str(row[IDX["ARTICOLO"]]), "desc": str(raw_desc), "components": []}
+        if not curr and pd.notna(cell(row, "ARTICOLO")) and pd.notna(raw_desc) and tot is None:
+            curr = {"code": str(cell(row, "ARTICOLO")), "desc": str(raw_desc), "components": []}
             foot_hits = 0; continue
 
         if curr and pd.notna(raw_desc) and tot is None:
-            p = clean(row[IDX["P_COMP"]])
-            q = clean(row[IDX["Q_COMP"]])
+            p = parse_number(cell(row, "P_COMP"))
+            q = parse_number(cell(row, "Q_COMP"))
             if p is not None or q is not None:
                 is_man = "operaio" in str(raw_desc).lower()
                 curr["components"].append({"desc": str(raw_desc), "type": "MAN" if is_man else "MAT", "qty": q or 0, "price": p or 0})
 
-    conn.commit()
+def match_recipe_block(conn, block):
+    """Decide MERGE vs BRANCH per un blocco ricetta. Ritorna (action, rid, similarity)."""
+    rid, rdesc, sim = find_semantic_match(block["desc"], conn)
+    action = "BRANCH"
+    if rid:
+        if sim >= SIMILARITY_MERGE: action = "MERGE"
+        elif sim >= SIMILARITY_JUDGE:
+            is_merge, _ = judge_similarity(block["desc"], rdesc)
+            if is_merge: action = "MERGE"
+    return action, rid, sim
+
+def _label(value):
+    return str(value).strip().strip('"').upper() if value is not None and pd.notna(value) else ""
+
+def detect_layout(head_rows):
+    """
+    Layout del file dalle prime righe. Ritorna {"name", "idx", "data_start"}:
+    idx = posizioni delle colonne, data_start = prima riga dati (dopo intestazione e sotto-intestazione).
+    Senza intestazione riconoscibile: V5_STRICT con IDX dalla prima riga (comportamento storico).
+    """
+    for i, row in enumerate(head_rows):
+        labels = [_label(v) for v in row]
+        desc = next((j for j, l in enumerate(labels) if l.startswith("DESCRIZIONE")), None)
+        if desc is None:
+            continue
+        um = next((j for j, l in enumerate(labels) if l in FLAT_ALIASES["UM"]), None)
+        has_qty = any(l.startswith("QUANTIT") for l in labels)
+
+        if has_qty and um is not None:
+            shift = um - IDX["UM"]
+            idx = {k: v + shift if v > IDX["DESCRIZIONE"] else v for k, v in IDX.items()}
+            start = i + 1
+            while start < len(head_rows) and V5_SUBHEADER & {_label(v) for v in head_rows[start]}:
+                start += 1
+            return {"name": "V5_STRICT" if shift == 0 else f"V5_STRICT+{shift}", "idx": idx, "data_start": start}
+
+        if not has_qty:
+            cols = {}
+            for key, aliases in FLAT_ALIASES.items():
+                cols[key] = next((j for j, l in enumerate(labels)
+                                  if l.startswith(aliases) and j not in cols.values()), None)
+            if cols["CODICE"] is not None and cols["PREZZO"] is not None:
+                return {"name": "FLAT", "idx": {k: v for k, v in cols.items() if v is not None},
+                        "data_start": i + 1}
+    return {"name": "V5_STRICT", "idx": IDX, "data_start": 0}
+
+def read_layout(filepath):
+    """Layout di un file leggendo solo le prime HEADER_SCAN_ROWS righe."""
+    return detect_layout(fast_reader.read_head(filepath, HEADER_SCAN_ROWS))
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def track_rows(rows, stats, every=None):
+    """Conta le righe lette (stats["rows"]) e stampa avanzamento e throughput ogni `every` righe."""
+    every = every or STREAM_PROGRESS_EVERY
+    for row in rows:
+        stats["rows"] += 1
+        if stats["rows"] % every == 0:
+            elapsed = time.time() - stats["started"]
+            rss = peak_rss_mb()
+            rss_note = f" | picco RSS {rss:.0f} MB" if rss else ""
+            print(f"   ⏩ {stats['rows']} righe | {stats['rows'] / elapsed:.0f} righe/s | "
+                  f"{stats['branch'] + stats['merge']} ricette{rss_note}")
+        yield row
+
+def process_file(filepath, price_date=None, stream=None):
+    """
+    Ingestion di un file ricette. stream=None -> streaming automatico oltre STREAM_MIN_MB:
+    righe lette in modo lazy e commit ogni STREAM_COMMIT_EVERY ricette invece che a fine file.
+    """
+    if stream is None:
+        stream = os.path.getsize(filepath) >= STREAM_MIN_MB * 1024 * 1024
+    layout = read_layout(filepath)
+    if stream:
+        rows = fast_reader.iter_rows(filepath, usecols=layout["idx"].values())
+    else:
+        with tracing.span("ingest.read_excel"):
+            df = fast_reader.read_table(filepath, usecols=layout["idx"].values())
+        rows = df.itertuples(index=False, name=None)
+    # Intestazione e sotto-intestazione non sono ricette
+    rows = itertools.islice(rows, layout["data_start"], None)
+    if layout["name"] == "FLAT":
+        return ingest_flat_rows(rows, layout["idx"], os.path.basename(filepath), price_date)
+
+    filename = os.path.basename(filepath)
+    conn = get_db_connection()
+    
+    stats = {"layout": layout["name"], "branch": 0, "merge": 0, "rows": 0, "started": time.time()}
+
+    for curr in iter_recipe_blocks(track_rows(rows, stats), layout["idx"]):
+        with tracing.span("ingest.match"):
+            try:
+                action, rid, _ = match_recipe_block(conn, curr)
+            except OfflineCacheMiss:
+                # Offline senza embedding in cache: nessun match possibile -> nuova ricetta
+                action, rid = "BRANCH", None
+        
+        with tracing.span("ingest.write", action=action):
+            if action == "BRANCH":
+                rid = insert_new_recipe(conn, curr, filename, price_date)
+                stats["branch"] += 1
+            else:
+                merge_into_recipe(conn, rid, curr, filename, price_date)
+                stats["merge"] += 1
+        tracing.count("recipes_processed")
+        
+        # RECALC with SELECTED STRATEGY
+        with tracing.span("ingest.recalc"):
+            recalc_recipe_stats(rid, conn)
+
+        if stream and (stats["branch"] + stats["merge"]) % STREAM_COMMIT_EVERY == 0:
+            with tracing.span("ingest.commit"):
+                conn.commit()
+
+    with tracing.span("ingest.commit"):
+        conn.commit()
     conn.close()
+    tracing.count("rows_read", stats["rows"])
+    stats["elapsed_s"] = round(time.time() - stats.pop("started"), 3)
+    stats["rows_per_s"] = round(stats["rows"] / stats["elapsed_s"], 1) if stats["elapsed_s"] else 0.0
     return stats
 
-def sync_vectors():
+def _norm_desc(text):
+    return " ".join(str(text).lower().split())
+
+def ingest_flat_rows(rows, idx, filename, price_date=None):
+    """
+    Listino piatto: per ogni riga (codice, descrizione, UM, prezzo) il componente viene cercato
+    per codice (components.code) o per descrizione identica; i prezzi dei componenti noti vanno
+    in price_history con executemany a blocchi di FLAT_BATCH_SIZE righe. Gli articoli nuovi
+    diventano ricette a componente singolo (niente giudice LLM: li indicizza sync_vectors).
+    Le ricette toccate sono ricalcolate una volta sola a fine file.
+    """
+    if price_date is not None:
+        price_date = parse_as_of(price_date).strftime(DATE_FORMAT)
     conn = get_db_connection()
-    cursor = conn.execute("SELECT r.id, r.description FROM recipes r LEFT JOIN vec_recipes v ON r.id = v.rowid WHERE v.rowid IS NULL")
+    stats = {"layout": "FLAT", "branch": 0, "merge": 0, "skipped": 0, "rows": 0, "started": time.time()}
+
+    by_code = dict(conn.execute("SELECT code, id FROM components WHERE code IS NOT NULL AND code != ''"))
+    by_desc = {}
+    for cid, desc in conn.execute("SELECT id, description FROM components WHERE type = 'MAT' ORDER BY id"):
+        by_desc.setdefault(_norm_desc(desc), cid)
+    touched = set()
+
+    def cell(row, key):
+        i = idx.get(key)
+        return row[i] if i is not None and i < len(row) and pd.notna(row[i]) else None
+
+    rows = track_rows(rows, stats)
     while True:
-        batch = cursor.fetchmany(VECTOR_BATCH_SIZE)
-        if not batch: break
-        texts = [str(r[1]).replace("\n", " ").strip() for r in batch]
-        try:
-            resp = client.embeddings.create(input=texts, model="text-embedding-3-small")
-            vec_data = [(batch[i][0], serialize_f32(d.embedding)) for i, d in enumerate(resp.data)]
-            conn.executemany("INSERT INTO vec_recipes(rowid, embedding) VALUES(?, ?)", vec_data)
+        batch = list(itertools.islice(rows, FLAT_BATCH_SIZE))
+        if not batch:
+            break
+        prices, codes = [], []
+        with tracing.span("ingest.flat_batch", rows=len(batch)):
+            for row in batch:
+                code, desc, price = cell(row, "CODICE"), cell(row, "DESCRIZIONE"), parse_number(cell(row, "PREZZO"))
+                if code is None or price is None:
+                    stats["skipped"] += 1
+                    continue
+                code = str(code).strip()
+                cid = by_code.get(code)
+                if cid is None and desc is not None:
+                    cid = by_desc.get(_norm_desc(desc))
+                    if cid is not None:
+                        codes.append((code, cid))
+                        by_code[code] = cid
+                if cid is not None:
+                    prices.append((cid, price, filename, price_date))
+                    touched.add(cid)
+                    stats["merge"] += 1
+                    continue
+                # Articolo nuovo: ricetta a componente singolo con il codice del listino
+                item = {"code": code, "desc": str(desc or code),
+                        "components": [{"code": code, "desc": str(desc or code), "type": "MAT", "qty": 1.0, "price": price}]}
+                rid = insert_new_recipe(conn, item, filename, price_date)
+                cid = conn.execute("SELECT id FROM components WHERE recipe_id = ?", (rid,)).fetchone()[0]
+                by_code[code] = cid
+                by_desc.setdefault(_norm_desc(item["desc"]), cid)
+                touched.add(cid)
+                stats["branch"] += 1
+
+            conn.executemany("UPDATE components SET code = ? WHERE id = ?", codes)
+            conn.executemany("INSERT INTO price_history (component_id, raw_price, source_file, date) "
+                             "VALUES (?,?,?,COALESCE(?, CURRENT_TIMESTAMP))", prices)
+        with tracing.span("ingest.commit"):
             conn.commit()
-            print(f"   -> Synced {len(batch)} vectors.")
+
+    # RECALC una volta per ricetta toccata
+    recipe_ids = set()
+    touched = list(touched)
+    for i in range(0, len(touched), 900):
+        chunk = touched[i:i + 900]
+        recipe_ids.update(r[0] for r in conn.execute(
+            f"SELECT DISTINCT recipe_id FROM components WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+    with tracing.span("ingest.recalc", recipes=len(recipe_ids)):
+        for rid in recipe_ids:
+            recalc_recipe_stats(rid, conn)
+    conn.commit()
+    conn.close()
+
+    tracing.count("rows_read", stats["rows"])
+    tracing.count("recipes_processed", len(recipe_ids))
+    stats["elapsed_s"] = round(time.time() - stats.pop("started"), 3)
+    stats["rows_per_s"] = round(stats["rows"] / stats["elapsed_s"], 1) if stats["elapsed_s"] else 0.0
+    return stats
+
+# --- SPAZI DI EMBEDDING ---
+
+def space_index(space, index):
+    """Tabelle (vec e stato) di un indice nello spazio: nomi storici per 'default', suffisso __<nome> per gli altri."""
+    spec = dict(VECTOR_INDEXES[index])
+    if space != DEFAULT_SPACE:
+        spec["vec"] = f"{spec['vec']}__{space}"
+        spec["state"] = f"{spec['state']}__{space}"
+    return spec
+
+def get_space(conn, name=None):
+    """
+    Spazio di embedding per nome, o quello attivo: {"name", "model", "dim", "status"}.
+    DB senza registro degli spazi -> spazio 'default' con il modello di configurazione.
+    """
+    try:
+        if name:
+            row = conn.execute("SELECT name, model, dim, status FROM embedding_spaces WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                raise ValueError(f"Spazio di embedding sconosciuto: {name}")
+        else:
+            row = conn.execute("SELECT name, model, dim, status FROM embedding_spaces WHERE status = 'active'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is None:
+        row = (DEFAULT_SPACE, EMBEDDING_MODEL, EMBEDDING_DIM, "active")
+    return dict(zip(("name", "model", "dim", "status"), row))
+
+def create_space(conn, name, model, dim):
+    """Registra un nuovo spazio in costruzione e crea le sue tabelle ombra (vuote)."""
+    if not re.fullmatch(r"[a-z0-9_]+", name or ""):
+        raise ValueError("Nome spazio: solo minuscole, cifre e _")
+    ensure_space_schema(conn)
+    if conn.execute("SELECT 1 FROM embedding_spaces WHERE name = ?", (name,)).fetchone():
+        raise ValueError(f"Spazio di embedding già esistente: {name}")
+    conn.execute("INSERT INTO embedding_spaces (name, model, dim, status) VALUES (?,?,?,'building')", (name, model, dim))
+    create_space_tables(conn, name, dim)
+    conn.commit()
+    return get_space(conn, name)
+
+def space_progress(conn, name):
+    """Copertura dello spazio per indice: righe con vettore aggiornato sul totale delle righe da embeddare."""
+    space = get_space(conn, name)
+    report = {}
+    for index in VECTOR_INDEXES:
+        spec = space_index(space["name"], index)
+        rows = conn.execute(f"""
+            SELECT t.description, s.content_hash
+            FROM {spec['table']} t LEFT JOIN {spec['state']} s ON s.{spec['key']} = t.id
+            WHERE t.description IS NOT NULL AND TRIM(t.description) != ''
+        """).fetchall()
+        done = sum(1 for desc, h in rows if h == vector_content_hash(desc, space["model"]))
+        report[index] = {"done": done, "total": len(rows)}
+    return report
+
+def build_space(name, workers=None, rate_limit=None):
+    """
+    Riempie le tabelle ombra di uno spazio in costruzione (stesso sync incrementale e riprendibile
+    degli indici attivi), con throttling dei testi al minuto. Il preventivatore continua a usare
+    lo spazio attivo. Avanzamento in embedding_spaces (rows_done / rows_total).
+    """
+    conn = get_db_connection()
+    space = get_space(conn, name)
+    if space["status"] == "active":
+        conn.close()
+        raise ValueError(f"Lo spazio {name} è già attivo: usare sync_vectors")
+    progress = space_progress(conn, name)
+    conn.execute("UPDATE embedding_spaces SET rows_total = ?, rows_done = ?, updated_at = CURRENT_TIMESTAMP WHERE name = ?",
+                 (sum(p["total"] for p in progress.values()), sum(p["done"] for p in progress.values()), name))
+    conn.commit()
+    conn.close()
+    rate_limit = REEMBED_TEXTS_PER_MIN if rate_limit is None else rate_limit
+    return sync_vectors(workers, space=name, rate_limit=rate_limit)
+
+def activate_space(conn, name, workers=None):
+    """
+    Switch atomico dello spazio attivo: ultimo sync di recupero (righe nuove o modificate durante
+    la costruzione), poi in un'unica transazione BEGIN IMMEDIATE verifica della copertura completa
+    e vecchio spazio -> retired, nuovo -> active: nessuna ingestion può inserire righe senza
+    vettore tra la verifica e lo switch. Il vecchio spazio resta riattivabile finché non viene eliminato.
+    """
+    space = get_space(conn, name)
+    if space["status"] == "active":
+        return space
+    sync_vectors(workers, space=name)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        missing = {i: p["total"] - p["done"] for i, p in space_progress(conn, name).items() if p["done"] < p["total"]}
+        if missing:
+            raise RuntimeError(f"Spazio {name} incompleto, righe senza vettore: {missing}")
+        conn.execute("UPDATE embedding_spaces SET status = 'retired', updated_at = CURRENT_TIMESTAMP WHERE status = 'active'")
+        conn.execute("UPDATE embedding_spaces SET status = 'active', activated_at = CURRENT_TIMESTAMP, "
+                     "updated_at = CURRENT_TIMESTAMP WHERE name = ?", (name,))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return get_space(conn, name)
+
+def drop_space(conn, name):
+    """Elimina uno spazio dismesso e le sue tabelle (lo spazio attivo non si può eliminare)."""
+    space = get_space(conn, name)
+    if space["status"] == "active":
+        raise ValueError(f"Lo spazio {name} è attivo")
+    for index in VECTOR_INDEXES:
+        spec = space_index(name, index)
+        conn.execute(f"DROP TABLE IF EXISTS {spec['vec']}")
+        if name != DEFAULT_SPACE:
+            conn.execute(f"DROP TABLE IF EXISTS {spec['state']}")
+        else:
+            conn.execute(f"DELETE FROM {spec['state']}")
+    conn.execute("DELETE FROM embedding_spaces WHERE name = ?", (name,))
+    conn.commit()
+
+def delete_vectors(conn, index, keys):
+    """Elimina i vettori (e lo stato) di righe cancellate in tutti gli spazi registrati."""
+    try:
+        spaces = [r[0] for r in conn.execute("SELECT name FROM embedding_spaces")]
+    except sqlite3.OperationalError:
+        spaces = [DEFAULT_SPACE]
+    for space in spaces:
+        spec = space_index(space, index)
+        for key in keys:
+            try:
+                conn.execute(f"DELETE FROM {spec['vec']} WHERE rowid = ?", (key,))
+                conn.execute(f"DELETE FROM {spec['state']} WHERE {spec['key']} = ?", (key,))
+            except sqlite3.OperationalError:
+                pass   # Tabelle dello spazio non presenti su questo DB
+
+# --- SYNC VETTORI ---
+
+def vector_content_hash(description, model=None):
+    """Hash del testo effettivamente embeddato (stessa normalizzazione di embed_texts) e del modello."""
+    text = str(description).replace("\n", " ").strip()
+    return hashlib.sha1(f"{model or EMBEDDING_MODEL}|{text}".encode("utf-8")).hexdigest()
+
+def pending_vector_updates(conn, index="recipes", space=None):
+    """
+    Righe dell'indice da (ri)embeddare nello spazio (Default: attivo): senza stato o con hash
+    diverso dalla descrizione attuale. Le righe con vettore già presente ma senza stato
+    (DB precedenti) vengono adottate registrando l'hash attuale, senza ri-embedding.
+    Ritorna (pending, adottate).
+    """
+    space = space if isinstance(space, dict) else get_space(conn, space)
+    spec = space_index(space["name"], index)
+    model = space["model"]
+    pending, unknown = [], []
+    rows = conn.execute(f"""
+        SELECT t.id, t.description, s.content_hash
+        FROM {spec['table']} t LEFT JOIN {spec['state']} s ON s.{spec['key']} = t.id
+        WHERE t.description IS NOT NULL AND TRIM(t.description) != ''
+    """)
+    for rid, desc, old_hash in rows:
+        new_hash = vector_content_hash(desc, model)
+        if old_hash is None:
+            unknown.append((rid, desc, new_hash))
+        elif old_hash != new_hash:
+            pending.append((rid, desc, new_hash, True))
+
+    adopted = []
+    for i in range(0, len(unknown), 500):
+        chunk = unknown[i:i + 500]
+        try:
+            have = {r[0] for r in conn.execute(
+                f"SELECT rowid FROM {spec['vec']} WHERE rowid IN ({','.join('?' * len(chunk))})", [u[0] for u in chunk])}
+        except sqlite3.OperationalError:
+            have = set()
+        for rid, desc, h in chunk:
+            if rid in have:
+                adopted.append((rid, h, model))
+            else:
+                pending.append((rid, desc, h, False))
+    if adopted:
+        conn.executemany(f"INSERT OR REPLACE INTO {spec['state']} ({spec['key']}, content_hash, model) VALUES (?,?,?)", adopted)
+        conn.commit()
+    return pending, len(adopted)
+
+def _embed_with_retry(texts, model=None, limiter=None, dimensions=None):
+    """
+    Embedding di un batch con retry e backoff esponenziale (+ jitter) sugli errori transitori.
+    Un vettore di dimensione diversa da quella richiesta è un errore (la tabella vec lo rifiuterebbe).
+    """
+    if limiter:
+        limiter.acquire(len(texts))
+    for attempt in range(VECTOR_SYNC_RETRIES + 1):
+        try:
+            vectors = embed_texts(texts, model, dimensions)
+            if dimensions and any(len(v) != dimensions for v in vectors):
+                raise ValueError(f"Embedding di dimensione {len(vectors[0])} invece di {dimensions} ({model})")
+            return vectors
+        except ValueError:
+            raise
+        except OfflineCacheMiss:
+            raise
         except Exception as e:
-            print(f"Error: {e}"); break
+            if attempt == VECTOR_SYNC_RETRIES:
+                raise
+            wait = VECTOR_SYNC_BACKOFF_S * (2 ** attempt) * (1 + random.random() * 0.25)
+            print(f"   ⚠️  Embedding fallito ({type(e).__name__}), nuovo tentativo tra {wait:.1f}s...")
+            tracing.count("vector_sync_retries")
+            time.sleep(wait)
+
+def _commit_sync(conn, space, synced):
+    """Commit dei vettori; per uno spazio in costruzione aggiorna anche l'avanzamento nella stessa transazione."""
+    if space["status"] != "active" and synced:
+        conn.execute("UPDATE embedding_spaces SET rows_done = MIN(rows_done + ?, rows_total), "
+                     "updated_at = CURRENT_TIMESTAMP WHERE name = ?", (synced, space["name"]))
+    conn.commit()
+    return 0
+
+def sync_vectors(workers=None, indexes=None, space=None, rate_limit=None):
+    """
+    Allinea gli indici vettoriali (vec_recipes, vec_components) alle descrizioni,
+    nello spazio di embedding indicato (Default: quello attivo). Ritorna le statistiche per indice.
+    """
+    return {name: sync_vector_index(name, workers, space, rate_limit) for name in (indexes or VECTOR_INDEXES)}
+
+def sync_vector_index(index="recipes", workers=None, space=None, rate_limit=None):
+    """
+    Embeddings solo per righe nuove o modificate (tabella di stato dell'indice), un solo embedding
+    per testo distinto (molti componenti condividono la descrizione), batch in parallelo con retry,
+    scritture executemany in transazioni di VECTOR_COMMIT_EVERY batch. Lo stato è scritto insieme
+    ai vettori: un run interrotto riprende da dove si era fermato.
+    rate_limit: testi al minuto (re-embedding in background di uno spazio in costruzione).
+    """
+    conn = get_db_connection()
+    space = get_space(conn, space)
+    spec = space_index(space["name"], index)
+    model = space["model"]
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    stats = {"pending": 0, "synced": 0, "refreshed": 0, "failed": 0, "adopted": 0, "embedded": 0}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (spec["vec"],)).fetchone() is None:
+        print(f"   ⚠️  {spec['vec']} non disponibile (sqlite-vec non caricato): sync {spec['label']} saltato.")
+        conn.close()
+        return stats
+    pending, stats["adopted"] = pending_vector_updates(conn, index, space)
+    stats["pending"] = len(pending)
+    if not pending:
+        conn.close()
+        return stats
+
+    # Raggruppamento per testo: un embedding per descrizione distinta
+    groups = {}
+    for item in pending:
+        groups.setdefault(item[2], []).append(item)
+    groups = list(groups.values())
+    batches = [groups[i:i + VECTOR_BATCH_SIZE] for i in range(0, len(groups), VECTOR_BATCH_SIZE)]
+    workers = max(1, min(workers or VECTOR_SYNC_WORKERS, len(batches)))
+    print(f"   🧭 Sync vettori {spec['label']} [{space['name']}]: {len(pending)} righe, {len(groups)} testi distinti "
+          f"in {len(batches)} batch ({workers} in parallelo)")
+    start_time = time.time()
+    done = 0
+    uncommitted = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_embed_with_retry, [g[0][1] for g in batch], model, limiter, space["dim"]): batch
+                   for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            items = [item for group in batch for item in group]
+            try:
+                vectors = future.result()
+            except Exception as e:
+                stats["failed"] += len(items)
+                print(f"   ❌ Batch di {len(items)} {spec['label']} non sincronizzato: {e}")
+                continue
+            rows = [(item[0], serialize_f32(v)) for group, v in zip(batch, vectors) for item in group]
+            changed = [(item[0],) for item in items if item[3]]
+            with tracing.span("ingest.vector_insert", index=index, rows=len(items)):
+                # vec0 non supporta UPSERT: per le descrizioni modificate si elimina e reinserisce
+                conn.executemany(f"DELETE FROM {spec['vec']} WHERE rowid = ?", changed)
+                conn.executemany(f"INSERT INTO {spec['vec']}(rowid, embedding) VALUES(?, ?)", rows)
+                conn.executemany(f"INSERT OR REPLACE INTO {spec['state']} ({spec['key']}, content_hash, model) VALUES (?,?,?)",
+                                 [(item[0], item[2], model) for item in items])
+            stats["synced"] += len(items)
+            stats["refreshed"] += len(changed)
+            stats["embedded"] += len(batch)
+            uncommitted += len(items)
+            done += 1
+            if done % VECTOR_COMMIT_EVERY == 0:
+                uncommitted = _commit_sync(conn, space, uncommitted)
+                print(f"   -> Synced {stats['synced']}/{len(pending)} vectors ({stats['synced'] / (time.time() - start_time):.0f}/s).")
+    _commit_sync(conn, space, uncommitted)
     conn.close()
+    print(f"   -> Synced {stats['synced']} {spec['label']} ({stats['embedded']} embedding, "
+          f"{stats['refreshed']} aggiornati, {stats['failed']} falliti).")
+    return stats
 
 # --- ENTRY POINT ---
 
@@ -345,7 +1681,61 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Bulk Ingestion & Pricing Update")
     parser.add_argument("--override", type=str, choices=["MAX", "LATEST", "SMART_1Y"], 
                         help="Forza una strategia di prezzo specifica (Default: SMART_ADAPTIVE)")
+    parser.add_argument("--rebuild-snapshots", action="store_true",
+                        help="Ricalcola price_snapshots per tutte le ricette senza ingestion")
+    parser.add_argument("--as-of", type=str,
+                        help="Report point-in-time in sola lettura: prezzi con lo storico fino alla data (YYYY-MM-DD)")
+    parser.add_argument("--report-out", type=str,
+                        help="Con --as-of: CSV del report (Default: db/prezzi_as_of_<data>.csv)")
+    parser.add_argument("--price-date", type=str,
+                        help="Data dell'offerta da registrare in price_history (Default: data di inserimento)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Lettura riga per riga e commit a blocchi per ogni file (Default: solo oltre STREAM_MIN_MB)")
+    parser.add_argument("--commit-every", type=int, default=STREAM_COMMIT_EVERY,
+                        help="Ricette per commit in modalità streaming")
+    parser.add_argument("--verify-price-stats", action="store_true",
+                        help="Confronta gli aggregati incrementali dei componenti con il ricalcolo esatto dallo storico")
+    parser.add_argument("--repair", action="store_true",
+                        help="Con --verify-price-stats: ricostruisce gli aggregati divergenti o mancanti")
+    parser.add_argument("--rebuild-price-stats", action="store_true",
+                        help="Ricostruisce da zero component_price_stats dallo storico prezzi")
+    parser.add_argument("--compact-history", action="store_true",
+                        help="Dedup dello storico prezzi e compattazione in aggregati mensili delle righe fuori finestra")
+    parser.add_argument("--retention-days", type=int, default=RAW_RETENTION_DAYS,
+                        help=f"Con --compact-history: giorni di storico grezzo conservati (minimo {MIN_RAW_RETENTION_DAYS})")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Con --compact-history: VACUUM del DB a fine compattazione")
+    parser.add_argument("--extract-attributes", action="store_true",
+                        help="Estrae gli attributi tecnici (sezioni, sigle, dimensioni) delle righe non ancora elaborate")
+    parser.add_argument("--force", action="store_true",
+                        help="Con --extract-attributes: riestrae tutte le righe")
+    parser.add_argument("--sync-only", action="store_true",
+                        help="Solo sincronizzazione dei vettori (nuove ricette e descrizioni modificate)")
+    parser.add_argument("--spaces", action="store_true",
+                        help="Elenco degli spazi di embedding con stato e avanzamento")
+    parser.add_argument("--create-space", type=str, metavar="NOME",
+                        help="Registra un nuovo spazio di embedding (tabelle ombra) con --model e --dim")
+    parser.add_argument("--model", type=str, default=EMBEDDING_MODEL, help="Con --create-space: modello di embedding")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="Con --create-space: dimensione dei vettori")
+    parser.add_argument("--build-space", type=str, metavar="NOME",
+                        help="Riempie in background le tabelle ombra dello spazio (riprendibile)")
+    parser.add_argument("--rate-limit", type=int, default=REEMBED_TEXTS_PER_MIN,
+                        help="Con --build-space: testi al minuto (0 = nessun limite)")
+    parser.add_argument("--activate-space", type=str, metavar="NOME",
+                        help="Switch atomico dello spazio attivo (dopo un sync di recupero)")
+    parser.add_argument("--drop-space", type=str, metavar="NOME",
+                        help="Elimina uno spazio dismesso e le sue tabelle")
+    parser.add_argument("--vector-workers", type=int, default=VECTOR_SYNC_WORKERS,
+                        help="Batch di embedding in parallelo durante il sync dei vettori")
+    parser.add_argument("--trace", type=str,
+                        help="Report JSON-lines del run (span per stage, p50/p95, contatori)")
+    parser.add_argument("--metrics-out", type=str,
+                        help="Export delle metriche del run in formato testo Prometheus")
     args = parser.parse_args()
+    STREAM_COMMIT_EVERY = args.commit_every
+    VECTOR_SYNC_WORKERS = args.vector_workers
+    if args.trace or args.metrics_out:
+        tracing.enable_tracing()
     
     if args.override:
         PRICING_MODE = args.override
@@ -353,10 +1743,88 @@ if __name__ == "__main__":
     else:
         print(f"ℹ️  Strategia Prezzi Standard: SMART_ADAPTIVE")
 
-    files = glob.glob(os.path.join(INPUT_FOLDER, "*.xlsx"))
-    print(f"📦 SMART INGESTION: {len(files)} file.")
-    for f in files:
-        print(f"Processing {os.path.basename(f)}...")
-        s = process_file(f)
-        print(f"   -> BRANCH: {s['branch']} | MERGE: {s['merge']}")
-    sync_vectors()
\ No newline at end of file
+    if not args.as_of:
+        init_db()   # Schema creato/aggiornato una volta per run (--as-of è in sola lettura)
+
+    if args.as_of:
+        # Point-in-time: mai scritto sul catalogo (anche se combinato con --rebuild-snapshots)
+        conn = get_db_connection()
+        out = args.report_out or os.path.join(PROJECT_ROOT, "db", f"prezzi_as_of_{parse_as_of(args.as_of):%Y-%m-%d}.csv")
+        written, skipped = point_in_time_report(conn, args.as_of, out)
+        conn.close()
+        print(f"🕰️  Prezzi as-of {args.as_of}: {written} ricette in {out} ({skipped} senza storico alla data). Catalogo invariato.")
+    elif args.rebuild_snapshots:
+        conn = get_db_connection()
+        n = rebuild_price_snapshots(conn)
+        conn.close()
+        print(f"📸 Snapshot prezzi ricalcolati per {n} ricette.")
+    elif args.verify_price_stats:
+        conn = get_db_connection()
+        report = verify_price_stats(conn, repair=args.repair)
+        conn.close()
+        print(f"🔎 Aggregati verificati: {report['checked']} | mancanti: {report['missing']} | divergenti: {len(report['mismatches'])}")
+        for m in report["mismatches"][:20]:
+            print(f"   ❌ componente {m['component_id']}: {', '.join(m['fields'])}")
+        if args.repair and (report["mismatches"] or report["missing"]):
+            print("   🔧 Aggregati ricostruiti dallo storico.")
+    elif args.rebuild_price_stats:
+        conn = get_db_connection()
+        n = rebuild_price_stats(conn)
+        conn.close()
+        print(f"📈 Aggregati ricostruiti per {n} componenti.")
+    elif args.compact_history:
+        conn = get_db_connection()
+        report = compact_price_history(conn, retention_days=args.retention_days)
+        print(f"🗜️  Storico compattato (righe anteriori a {report['cutoff']}): {report['duplicates']} duplicati rimossi | "
+              f"{report['rolled_rows']} righe in {report['months']} mesi | {report['components']} componenti aggiornati")
+        if args.vacuum:
+            conn.execute("VACUUM")
+            print("   🧹 VACUUM completato.")
+        conn.close()
+    elif args.extract_attributes:
+        conn = get_db_connection()
+        for table in tech_attributes.TABLES:
+            n = tech_attributes.backfill_attributes(conn, table, force=args.force)
+            print(f"🏷️  Attributi tecnici estratti: {n} righe di {table}.")
+        conn.close()
+    elif args.spaces:
+        conn = get_db_connection()
+        for name, model, dim, status, activated_at in conn.execute(
+                "SELECT name, model, dim, status, activated_at FROM embedding_spaces ORDER BY created_at").fetchall():
+            coverage = " | ".join(f"{i}: {p['done']}/{p['total']}" for i, p in space_progress(conn, name).items())
+            print(f"   {'🟢' if status == 'active' else '⚪'} {name:<12} {status:<8} {model} [{dim}] | {coverage}")
+        conn.close()
+    elif args.create_space:
+        conn = get_db_connection()
+        space = create_space(conn, args.create_space, args.model, args.dim)
+        conn.close()
+        print(f"🆕 Spazio '{space['name']}' creato ({space['model']}, {space['dim']} dim): avviare --build-space.")
+    elif args.build_space:
+        print(f"🏗️  Costruzione spazio '{args.build_space}' (lo spazio attivo resta in uso)...")
+        build_space(args.build_space, workers=args.vector_workers, rate_limit=args.rate_limit)
+    elif args.activate_space:
+        conn = get_db_connection()
+        try:
+            space = activate_space(conn, args.activate_space, workers=args.vector_workers)
+            print(f"🔀 Spazio attivo: '{space['name']}' ({space['model']}).")
+        except RuntimeError as e:
+            print(f"❌ {e}")
+        conn.close()
+    elif args.drop_space:
+        conn = get_db_connection()
+        drop_space(conn, args.drop_space)
+        conn.close()
+        print(f"🗑️  Spazio '{args.drop_space}' eliminato.")
+    elif args.sync_only:
+        sync_vectors()
+    else:
+        files = glob.glob(os.path.join(INPUT_FOLDER, "*.xlsx")) + glob.glob(os.path.join(INPUT_FOLDER, "*.csv"))
+        print(f"📦 SMART INGESTION: {len(files)} file.")
+        for f in files:
+            print(f"Processing {os.path.basename(f)}...")
+            with tracing.span("ingest.file", file=os.path.basename(f)):
+                s = process_file(f, price_date=args.price_date, stream=True if args.stream else None)
+            print(f"   -> [{s['layout']}] BRANCH: {s['branch']} | MERGE: {s['merge']} | {s['rows']} righe in {s['elapsed_s']}s ({s['rows_per_s']} righe/s)")
+        sync_vectors()
+    tracing.export_run(args.trace, args.metrics_out,
+                       run={"command": "bulk_ingestion", "pricing_mode": PRICING_MODE, "as_of": args.as_of})
\ No newline at end of file
@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import numpy as np
+from datetime import datetime
+
+# Motore di ingestion come libreria (spazi di embedding, strategie prezzi, attributi tecnici)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import bulk_ingestion as engine
+import tech_attributes
+
+# Snapshot read-only del catalogo per il preventivatore: tutto ciò che serve a cercare e prezzare
+# una riga RDO, esportato in array colonnari .npy (matrice degli embedding float32/float16, id,
+# codici, descrizioni, prezzi per strategia, volatilità, flag, attributi tecnici) + manifest.json.
+# generate_quote --catalog li apre con np.load(mmap_mode="r"): niente SQLite né sqlite-vec
+# all'avvio, le pagine sono lette dal disco solo quando servono e restano nella page cache del
+# sistema operativo, condivise a costo zero tra tutti i processi che aprono lo stesso snapshot.
+
+# CONFIGURAZIONE
+SNAPSHOT_FORMAT = 2                  # Da incrementare se cambia il layout dei file (2: attributi TEXT come categorie)
+SNAPSHOT_DIR = os.path.join(engine.PROJECT_ROOT, "db", "catalog_snapshot")
+SNAPSHOT_DTYPES = ("float32", "float16")
+EXPORT_FETCH_ROWS = 5000             # Righe per fetchmany durante l'export
+SEARCH_BLOCK = 65536                 # Righe della matrice per blocco di prodotti in ricerca
+STRING_COLUMNS = ("code", "desc", "source_file")
+
+def catalog_fingerprint(conn):
+    """Impronta del catalogo: cambia con nuove ricette, nuovi prezzi o switch di spazio."""
+    recipes, max_recipe = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM recipes").fetchone()
+    max_price = conn.execute("SELECT COALESCE(MAX(id), 0) FROM price_history").fetchone()[0]
+    return {"recipes": recipes, "max_recipe_id": max_recipe, "max_price_id": max_price,
+            "space": engine.get_space(conn)["name"]}
+
+def _save_strings(path, name, values):
+    """Colonna di testo: byte UTF-8 concatenati + offset (slice a costo zero sul mmap)."""
+    encoded = [str(v or "").encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+    np.save(os.path.join(path, f"{name}.bytes.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+def _save_categories(path, name, values):
+    """
+    Colonna di testo a poche modalità: codici int32 (-1 = assente) + dizionario dei valori,
+    salvato nel manifest. Il filtro diventa un confronto vettoriale tra interi.
+    Ritorna il dizionario (lista ordinata dei valori distinti).
+    """
+    categories = sorted({str(v) for v in values if v})
+    index = {value: k for k, value in enumerate(categories)}
+    codes = np.array([index[str(v)] if v else -1 for v in values], dtype=np.int32)
+    np.save(os.path.join(path, f"{name}.codes.npy"), codes)
+    return categories
+
+def _strategy_rows(conn):
+    """Prezzi materializzati per strategia: {strategia: {recipe_id: (mat, man, volatilità, complessa)}}."""
+    by_strategy = {s: {} for s in engine.PRICING_STRATEGIES}
+    for rid, strategy, mat, man, vol, cplx in conn.execute(
+            "SELECT recipe_id, strategy, unit_material_price, unit_manpower_price, volatility_index, "
+            "is_complex_assembly FROM price_snapshots"):
+        if strategy in by_strategy:
+            by_strategy[strategy][rid] = (mat, man, vol, cplx)
+    return by_strategy
+
+def export_snapshot(conn, out_dir=SNAPSHOT_DIR, dtype="float32"):
+    """
+    Scrive lo snapshot delle ricette con embedding nello spazio attivo. I file sono scritti in una
+    cartella temporanea e sostituiti con un rename: i processi che hanno già mappato lo snapshot
+    precedente continuano a leggerlo. Ritorna il manifest.
+    """
+    if dtype not in SNAPSHOT_DTYPES:
+        raise ValueError(f"dtype non supportato: {dtype}")
+    space = engine.get_space(conn)
+    vec_table = engine.space_index(space["name"], "recipes")["vec"]
+    fingerprint = catalog_fingerprint(conn)
+    n, size = conn.execute(f"SELECT COUNT(*), MAX(length(v.embedding)) FROM {vec_table} v JOIN recipes r ON r.id = v.rowid "
+                           f"WHERE v.embedding IS NOT NULL").fetchone()
+    dim = (size or 4 * space["dim"]) // 4   # float32: 4 byte per componente
+
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    matrix = np.lib.format.open_memmap(os.path.join(tmp_dir, "embeddings.npy"), mode="w+",
+                                       dtype=dtype, shape=(n, dim))
+    sq_norms = np.zeros(n, dtype=np.float32)
+    ids = np.zeros(n, dtype=np.int64)
+    strings = {name: [] for name in STRING_COLUMNS}
+    base = {"mat": np.zeros(n), "man": np.zeros(n), "vol": np.zeros(n), "cplx": np.zeros(n, dtype=np.int8)}
+
+    cur = conn.execute(f"""
+        SELECT r.id, r.code, r.description, r.source_file, r.unit_material_price, r.unit_manpower_price,
+               r.volatility_index, r.is_complex_assembly, v.embedding
+        FROM {vec_table} v JOIN recipes r ON r.id = v.rowid
+        WHERE v.embedding IS NOT NULL
+        ORDER BY r.id
+    """)
+    i = 0
+    while True:
+        rows = cur.fetchmany(EXPORT_FETCH_ROWS)
+        if not rows:
+            break
+        for rid, code, desc, source, mat, man, vol, cplx, blob in rows[:n - i]:
+            vector = np.frombuffer(blob, dtype="<f4")
+            matrix[i] = vector
+            sq_norms[i] = float(np.dot(matrix[i].astype(np.float32), matrix[i].astype(np.float32)))
+            ids[i] = rid
+            for name, value in zip(STRING_COLUMNS, (code, desc, source)):
+                strings[name].append(value)
+            base["mat"][i], base["man"][i] = mat or 0.0, man or 0.0
+            base["vol"][i], base["cplx"][i] = vol or 0.0, cplx or 0
+            i += 1
+    matrix.flush()
+    del matrix
+
+    np.save(os.path.join(tmp_dir, "ids.npy"), ids)
+    np.save(os.path.join(tmp_dir, "sq_norms.npy"), sq_norms)   # ||x||² per la distanza L2 in ricerca
+    for name, values in strings.items():
+        _save_strings(tmp_dir, name, values)
+
+    # Prezzi per strategia (fallback alle colonne di recipes per le ricette senza snapshot)
+    position = {int(rid): k for k, rid in enumerate(ids)}
+    strategies = _strategy_rows(conn)
+    for strategy, rows in strategies.items():
+        cols = {key: arr.copy() for key, arr in base.items()}
+        for rid, (mat, man, vol, cplx) in rows.items():
+            k = position.get(rid)
+            if k is None:
+                continue
+            for key, value in zip(("mat", "man", "vol", "cplx"), (mat, man, vol, cplx)):
+                if value is not None:
+                    cols[key][k] = value
+        for key, arr in cols.items():
+            np.save(os.path.join(tmp_dir, f"{key}.{strategy}.npy"), arr)
+
+    # Attributi tecnici: numerici come float64 (NaN = assente), sigla del cavo come categorie int32
+    attrs = tech_attributes.load_attributes(conn, "recipes", ids.tolist())
+    categories = {}
+    for name in tech_attributes.ATTRIBUTES:
+        values = [attrs.get(int(rid), {}).get(name) for rid in ids]
+        if tech_attributes.ATTRIBUTES[name] == "TEXT":
+            categories[name] = _save_categories(tmp_dir, f"attr_{name}", values)
+        else:
+            np.save(os.path.join(tmp_dir, f"attr_{name}.npy"),
+                    np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": datetime.now().strftime("%Y%m%d%H%M%S"),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "space": space["name"], "model": space["model"], "dim": dim, "dtype": dtype,
+        "rows": int(n), "strategies": list(strategies),
+        "attribute_version": tech_attributes.ATTRIBUTE_VERSION,
+        "categories": categories,
+        "fingerprint": fingerprint,
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    # Sostituzione della cartella con due rename (i file già mappati restano leggibili)
+    old_dir = f"{out_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+class CatalogSnapshot:
+    """Snapshot mappato in memoria: ricerca KNN e candidati nel formato di search_similar_candidates."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(f"Formato snapshot {self.manifest['format']} non supportato (atteso {SNAPSHOT_FORMAT}): riesportare")
+        self.path = path
+        self.model = self.manifest["model"]
+        self.embeddings = self._load("embeddings")
+        self.sq_norms = self._load("sq_norms")
+        self.ids = self._load("ids")
+        self._columns = {}
+        self._position = None
+        self._category_codes = {name: {value: k for k, value in enumerate(values)}
+                                for name, values in self.manifest["categories"].items()}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def _column(self, name):
+        if name not in self._columns:
+            self._columns[name] = self._load(name)
+        return self._columns[name]
+
+    def _string(self, name, k):
+        offsets = self._column(f"{name}.offsets")
+        return bytes(self._column(f"{name}.bytes")[offsets[k]:offsets[k + 1]]).decode("utf-8")
+
+    def position(self, recipe_id):
+        """Indice di riga di una ricetta (None se assente dallo snapshot)."""
+        if self._position is None:
+            self._position = {int(rid): k for k, rid in enumerate(self.ids)}
+        return self._position.get(int(recipe_id))
+
+    def candidate(self, k, strategy, similarity):
+        """Candidato della riga k con i prezzi della strategia."""
+        if strategy not in self.manifest["strategies"]:
+            raise ValueError(f"Strategia {strategy} assente dallo snapshot")
+        return {
+            "id": int(self.ids[k]),
+            "code": self._string("code", k),
+            "desc": self._string("desc", k),
+            "price_mat": float(self._column(f"mat.{strategy}")[k]),
+            "price_man": float(self._column(f"man.{strategy}")[k]),
+            "source_file": self._string("source_file", k),
+            "volatility": float(self._column(f"vol.{strategy}")[k]),
+            "is_complex": int(self._column(f"cplx.{strategy}")[k]),
+            "similarity": similarity,
+        }
+
+    def _sq_distances(self, rows, query):
+        block = np.asarray(self.embeddings[rows], dtype=np.float32)
+        return self.sq_norms[rows] - 2.0 * (block @ query) + float(query @ query)
+
+    def search(self, query_vector, k, strategy):
+        """KNN esatta (distanza L2 come vec0) a blocchi sulla matrice mappata: i k più vicini."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        best_rows, best_d2 = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        for start in range(0, len(self.ids), SEARCH_BLOCK):
+            rows = np.arange(start, min(start + SEARCH_BLOCK, len(self.ids)))
+            d2 = self._sq_distances(slice(rows[0], rows[-1] + 1), query)
+            rows, d2 = np.concatenate([best_rows, rows]), np.concatenate([best_d2, d2])
+            if len(rows) > k:
+                keep = np.argpartition(d2, k - 1)[:k]
+                rows, d2 = rows[keep], d2[keep]
+            best_rows, best_d2 = rows, d2
+        # Distanze esatte sui soli k vincitori (l'espansione ||x||² - 2x·q + ||q||² perde precisione vicino a 0)
+        dist = self._distances(best_rows, query)
+        order = np.argsort(dist, kind="stable")
+        return [self.candidate(int(r), strategy, 1 / (1 + float(d))) for r, d in zip(best_rows[order], dist[order])]
+
+    def _distances(self, rows, query):
+        return np.linalg.norm(np.asarray(self.embeddings[rows], dtype=np.float32) - query, axis=1)
+
+    def candidates_by_id(self, recipe_ids, query_vector, strategy):
+        """Candidati per id (trovati per attributi) con la distanza dalla query."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        rows = [k for k in (self.position(rid) for rid in recipe_ids) if k is not None]
+        if not rows:
+            return []
+        dist = self._distances(np.array(rows), query)
+        return [self.candidate(k, strategy, 1 / (1 + float(d))) for k, d in zip(rows, dist)]
+
+    def load_attributes(self, recipe_ids):
+        """Come tech_attributes.load_attributes, dalle colonne dello snapshot."""
+        result = {}
+        for rid in recipe_ids:
+            k = self.position(rid)
+            if k is None:
+                continue
+            attrs = {}
+            for name, sql_type in tech_attributes.ATTRIBUTES.items():
+                if sql_type == "TEXT":
+                    code = int(self._column(f"attr_{name}.codes")[k])
+                    value = self.manifest["categories"][name][code] if code >= 0 else None
+                else:
+                    value = float(self._column(f"attr_{name}")[k])
+                    value = None if np.isnan(value) else (int(value) if sql_type == "INTEGER" else value)
+                if value is not None:
+                    attrs[name] = value
+            result[rid] = attrs
+        return result
+
+    def find_by_attributes(self, attrs, limit=20, min_keys=tech_attributes.MIN_MATCHES):
+        """
+        Come tech_attributes.find_by_attributes: ricette con tutti gli attributi della query uguali.
+        Filtro interamente vettoriale: prima le maschere numeriche, poi i codici delle categorie TEXT
+        (un valore assente dal dizionario non ha ricette).
+        """
+        keys = [n for n in tech_attributes.ATTRIBUTES if n in attrs]
+        if len(keys) < min_keys:
+            return []
+        mask = np.ones(len(self.ids), dtype=bool)
+        text_keys = [n for n in keys if tech_attributes.ATTRIBUTES[n] == "TEXT"]
+        for name in keys:
+            if name not in text_keys:
+                mask &= self._column(f"attr_{name}") == attrs[name]
+        for name in text_keys:
+            code = self._category_codes[name].get(str(attrs[name]))
+            if code is None:
+                return []
+            mask &= self._column(f"attr_{name}.codes") == code
+        return [int(rid) for rid in self.ids[np.nonzero(mask)[0][:limit]]]
+
+_SNAPSHOTS = {}
+
+def load_snapshot(path=SNAPSHOT_DIR):
+    """Snapshot aperto una volta per processo (le chiamate successive riusano le mappe)."""
+    if path not in _SNAPSHOTS:
+        _SNAPSHOTS[path] = CatalogSnapshot(path)
+    return _SNAPSHOTS[path]
+
+def is_stale(conn, manifest):
+    """True se il catalogo è cambiato dopo l'export (nuove ricette/prezzi o altro spazio attivo)."""
+    return catalog_fingerprint(conn) != manifest["fingerprint"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export dello snapshot read-only del catalogo per il preventivatore")
+    parser.add_argument("--out", type=str, default=SNAPSHOT_DIR, help="Cartella dello snapshot")
+    parser.add_argument("--dtype", type=str, choices=SNAPSHOT_DTYPES, default="float32",
+                        help="Precisione della matrice degli embedding (float16: metà spazio)")
+    parser.add_argument("--check", action="store_true",
+                        help="Verifica solo se lo snapshot esistente è allineato al DB")
+    parser.add_argument("--db", type=str, default=engine.DB_FILE, help="Database da esportare")
+    args = parser.parse_args()
+
+    engine.DB_FILE = args.db
+    conn = engine.get_db_connection()
+    if args.check:
+        manifest = CatalogSnapshot(args.out).manifest
+        print(f"{'⚠️  Snapshot non aggiornato' if is_stale(conn, manifest) else '✅ Snapshot aggiornato'} "
+              f"(versione {manifest['version']}, {manifest['rows']} ricette)")
+    else:
+        manifest = export_snapshot(conn, out_dir=args.out, dtype=args.dtype)
+        size_mb = sum(os.path.getsize(os.path.join(args.out, f)) for f in os.listdir(args.out)) / 1e6
+        print(f"📦 Snapshot {manifest['version']}: {manifest['rows']} ricette | spazio '{manifest['space']}' "
+              f"({manifest['model']}, {manifest['dim']} dim, {manifest['dtype']}) | {size_mb:.1f} MB in {args.out}")
+    conn.close()
@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Motore di ingestion come libreria (schema, ricalcolo prezzi, aggregati mensili)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import bulk_ingestion as engine
+
+# Deduplica offline del catalogo: process_file crea un BRANCH ogni volta che la similarità è sotto
+# SIMILARITY_JUDGE o il giudice fallisce, quindi recipes accumula quasi-duplicati che rallentano
+# la KNN e diluiscono i candidati. Il job:
+# 1. calcola tutte le coppie vicine da vec_recipes con prodotti matriciali a blocchi righe x colonne
+#    (NumPy/BLAS, blocchi in parallelo su più thread: la moltiplicazione rilascia il GIL e usa tutti
+#    i core; worker e colonne per blocco sono dimensionati su DEDUP_MEMORY_MB);
+# 2. raggruppa le ricette per soglia (union-find) e sceglie la ricetta canonica di ogni cluster;
+# 3. salva il piano in recipe_merges e lo applica a blocchi: componenti e price_history spostati
+#    sulla canonica, ricetta duplicata eliminata. Ogni blocco committa anche lo stato del piano,
+#    quindi un run interrotto riprende dalle fusioni ancora 'planned'.
+
+# CONFIGURAZIONE
+DEDUP_THRESHOLD = engine.SIMILARITY_MERGE   # Similarità (1 / (1 + distanza L2), come la KNN) per fondere
+PAIR_BLOCK = 1024                           # Righe della matrice per blocco di prodotti
+PAIR_COL_BLOCK = 16384                      # Colonne per blocco: la memoria di un blocco non cresce con il catalogo
+DEDUP_WORKERS = os.cpu_count() or 4         # Blocchi calcolati in parallelo (limitati da DEDUP_MEMORY_MB)
+DEDUP_MEMORY_MB = 2048                      # Memoria massima per i blocchi in calcolo contemporaneamente
+MERGE_COMMIT_EVERY = 200                    # Ricette canoniche per transazione
+
+def ensure_dedup_schema(conn):
+    """Piano e audit delle fusioni: una riga per ricetta eliminata (planned -> done | skipped)."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS recipe_merges (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id TEXT NOT NULL,
+        merged_id INTEGER NOT NULL,
+        canonical_id INTEGER NOT NULL,
+        similarity REAL,
+        threshold REAL,
+        status TEXT DEFAULT 'planned',
+        merged_code TEXT, merged_desc TEXT, merged_source TEXT,
+        components_json TEXT,
+        planned_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        merged_at DATETIME,
+        UNIQUE (run_id, merged_id)
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_recipe_merges_status ON recipe_merges(status, run_id)")
+
+def load_recipe_vectors(conn):
+    """Embedding delle ricette esistenti nello spazio attivo: (ids, matrice float32 N x dim)."""
+    vec_table = engine.space_index(engine.get_space(conn)["name"], "recipes")["vec"]
+    ids, vectors = [], []
+    for rowid, blob in conn.execute(
+            f"SELECT v.rowid, v.embedding FROM {vec_table} v JOIN recipes r ON r.id = v.rowid ORDER BY v.rowid"):
+        if blob is None:
+            continue
+        ids.append(rowid)
+        vectors.append(np.frombuffer(blob, dtype="<f4"))
+    matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    return np.array(ids, dtype=np.int64), matrix
+
+def similarity_to_sq_distance(threshold):
+    """Soglia di similarità 1 / (1 + d) -> distanza L2 al quadrato massima."""
+    return (1.0 / threshold - 1.0) ** 2
+
+def _block_pairs(matrix, sq_norms, start, block, col_start, col_block, max_d2):
+    """Coppie (i < j) entro max_d2 del blocco righe [start, start+block) x colonne [col_start, col_start+col_block)."""
+    q = matrix[start:start + block]
+    rest = matrix[col_start:col_start + col_block]
+    d2 = sq_norms[None, col_start:col_start + col_block] - 2.0 * (q @ rest.T) + sq_norms[start:start + block, None]
+    rows, cols = np.nonzero(d2 <= max_d2)
+    dist = np.sqrt(np.maximum(d2[rows, cols], 0.0))
+    rows, cols = rows + start, cols + col_start
+    keep = cols > rows   # triangolo superiore: ogni coppia una volta, niente diagonale
+    return rows[keep], cols[keep], 1.0 / (1.0 + dist[keep])
+
+def block_budget(itemsize, block, col_block, workers, memory_mb):
+    """
+    Dimensiona blocchi e worker sul budget di memoria. Un blocco tiene prodotto e distanze
+    (2 x itemsize per cella) più la maschera booleana: ~ block x col_block x (2 itemsize + 1) byte.
+    Se un solo blocco supera il budget si riducono le colonne; i worker sono quanti blocchi
+    stanno nel budget. Ritorna (col_block, workers).
+    """
+    budget = memory_mb * 1024 * 1024
+    cell = 2 * itemsize + 1
+    col_block = max(1, min(col_block, budget // (block * cell)))
+    workers = max(1, min(workers, budget // (block * col_block * cell)))
+    return col_block, workers
+
+def all_pairs(matrix, min_similarity, block=None, workers=None, col_block=None, memory_mb=None):
+    """
+    Tutte le coppie di righe con similarità >= min_similarity: prodotti matriciali a blocchi
+    righe x colonne (||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b) sul triangolo superiore, blocchi
+    distribuiti su un pool di thread. La memoria di lavoro è limitata da memory_mb
+    (Default DEDUP_MEMORY_MB), oltre alla matrice e alle coppie trovate.
+    Ritorna (i, j, similarità) come array con i < j.
+    """
+    block = block or PAIR_BLOCK
+    n = len(matrix)
+    if n < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    col_block, workers = block_budget(matrix.dtype.itemsize, block, col_block or PAIR_COL_BLOCK,
+                                      workers or DEDUP_WORKERS, memory_mb or DEDUP_MEMORY_MB)
+    sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+    max_d2 = similarity_to_sq_distance(min_similarity)
+    tiles = [(s, c) for s in range(0, n, block) for c in range(0, n, col_block) if c + col_block > s]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(lambda t: _block_pairs(matrix, sq_norms, t[0], block, t[1], col_block, max_d2), tiles))
+    return tuple(np.concatenate([p[k] for p in parts]) for k in range(3))
+
+def cluster_pairs(n, pairs_i, pairs_j, sims, threshold):
+    """Union-find sulle coppie sopra soglia. Ritorna i cluster (liste di indici) con almeno 2 ricette."""
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in zip(pairs_i[sims >= threshold].tolist(), pairs_j[sims >= threshold].tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    clusters = {}
+    for x in range(n):
+        clusters.setdefault(find(x), []).append(x)
+    return [c for c in clusters.values() if len(c) > 1]
+
+def _history_counts(conn):
+    """Prezzi a storico per ricetta (righe grezze + mesi compattati): la canonica è la più documentata."""
+    counts = {}
+    for rid, n in conn.execute("""
+            SELECT c.recipe_id, COUNT(*) FROM price_history ph JOIN components c ON c.id = ph.component_id
+            GROUP BY c.recipe_id"""):
+        counts[rid] = n
+    for rid, n in conn.execute("""
+            SELECT c.recipe_id, SUM(m.n) FROM price_history_monthly m JOIN components c ON c.id = m.component_id
+            GROUP BY c.recipe_id"""):
+        counts[rid] = counts.get(rid, 0) + n
+    return counts
+
+def plan_merges(conn, ids, matrix, pairs, threshold):
+    """
+    Piano di fusione alla soglia: per cluster la canonica è la ricetta con più storico prezzi
+    (a pari merito l'id più basso). Sono fuse solo le ricette simili alla canonica sopra soglia:
+    le catene del single-linkage (A~B, B~C, A!~C) non uniscono ricette lontane.
+    Ritorna [(merged_id, canonical_id, similarità)] e il numero di cluster.
+    """
+    counts = _history_counts(conn)
+    sq_norms = np.einsum("ij,ij->i", matrix, matrix) if len(matrix) else np.zeros(0)
+    plan = []
+    clusters = cluster_pairs(len(ids), *pairs, threshold)
+    for members in clusters:
+        canon = min(members, key=lambda m: (-counts.get(int(ids[m]), 0), int(ids[m])))
+        others = np.array([m for m in members if m != canon])
+        d2 = sq_norms[others] + sq_norms[canon] - 2.0 * (matrix[others] @ matrix[canon])
+        sims = 1.0 / (1.0 + np.sqrt(np.maximum(d2, 0.0)))
+        for m, sim in zip(others.tolist(), sims.tolist()):
+            if sim >= threshold:
+                plan.append((int(ids[m]), int(ids[canon]), float(sim)))
+    return plan, len(clusters)
+
+def _component_target(existing, desc):
+    """Stessa regola di merge_into_recipe: descrizioni contenute l'una nell'altra."""
+    if not desc:
+        return None
+    for ecid, edesc in existing:
+        if edesc and (desc in edesc or edesc in desc):
+            return ecid
+    return None
+
+def _move_rollups(conn, from_cid, to_cid):
+    """Mesi compattati del componente fuso uniti a quelli della canonica (stesso mese -> aggregato unico)."""
+    fields = engine.ROLLUP_FIELDS
+    for month, *values in conn.execute(
+            f"SELECT month, {', '.join(fields)} FROM price_history_monthly WHERE component_id = ?", (from_cid,)).fetchall():
+        old = conn.execute(f"SELECT {', '.join(fields)} FROM price_history_monthly WHERE component_id = ? AND month = ?",
+                           (to_cid, month)).fetchone()
+        agg = engine._merge_rollup(dict(zip(fields, old)) if old else None, dict(zip(fields, values)))
+        conn.execute(f"INSERT OR REPLACE INTO price_history_monthly (component_id, month, {', '.join(fields)}) "
+                     f"VALUES ({','.join('?' * (len(fields) + 2))})", (to_cid, month, *[agg[f] for f in fields]))
+    conn.execute("DELETE FROM price_history_monthly WHERE component_id = ?", (from_cid,))
+
+def merge_recipe(conn, merged_id, canonical_id):
+    """
+    Fonde una ricetta nella canonica: i componenti con descrizione corrispondente spostano
+    price_history e mesi compattati sul componente della canonica, gli altri passano alla canonica.
+    La ricetta fusa (snapshot e vettore compresi) viene eliminata. Ritorna la mappa dei componenti.
+    """
+    existing = conn.execute("SELECT id, description FROM components WHERE recipe_id = ?", (canonical_id,)).fetchall()
+    mapping = {"merged": {}, "moved": []}
+    for cid, desc in conn.execute("SELECT id, description FROM components WHERE recipe_id = ?", (merged_id,)).fetchall():
+        target = _component_target(existing, desc)
+        if target is None:
+            conn.execute("UPDATE components SET recipe_id = ? WHERE id = ?", (canonical_id, cid))
+            mapping["moved"].append(cid)
+            continue
+        conn.execute("UPDATE price_history SET component_id = ? WHERE component_id = ?", (target, cid))
+        _move_rollups(conn, cid, target)
+        # Aggregati incrementali invalidati anche se il componente aveva solo mesi compattati
+        for table in ("component_price_stats", "component_price_buckets"):
+            conn.execute(f"DELETE FROM {table} WHERE component_id IN (?, ?)", (cid, target))
+        conn.execute("DELETE FROM components WHERE id = ?", (cid,))
+        engine.delete_vectors(conn, "components", [cid])
+        mapping["merged"][str(cid)] = target
+    conn.execute("DELETE FROM price_snapshots WHERE recipe_id = ?", (merged_id,))
+    engine.delete_vectors(conn, "recipes", [merged_id])
+    conn.execute("DELETE FROM recipes WHERE id = ?", (merged_id,))
+    return mapping
+
+def apply_merges(conn, run_id, commit_every=None):
+    """
+    Applica le fusioni 'planned' del run, per ricetta canonica. Ogni transazione contiene fusioni,
+    ricalcolo prezzi delle canoniche e stato del piano: dopo un'interruzione si riparte da qui.
+    """
+    commit_every = commit_every or MERGE_COMMIT_EVERY
+    rows = conn.execute("SELECT id, merged_id, canonical_id FROM recipe_merges "
+                        "WHERE run_id = ? AND status = 'planned' ORDER BY canonical_id, merged_id", (run_id,)).fetchall()
+    by_canonical = {}
+    for plan_id, merged_id, canonical_id in rows:
+        by_canonical.setdefault(canonical_id, []).append((plan_id, merged_id))
+    stats = {"merged": 0, "skipped": 0, "canonicals": 0}
+    for n, (canonical_id, members) in enumerate(by_canonical.items(), 1):
+        canonical_exists = conn.execute("SELECT 1 FROM recipes WHERE id = ?", (canonical_id,)).fetchone()
+        for plan_id, merged_id in members:
+            merged = conn.execute("SELECT code, description, source_file FROM recipes WHERE id = ?", (merged_id,)).fetchone()
+            if not canonical_exists or merged is None:
+                # Ricetta modificata/eliminata dopo la pianificazione
+                conn.execute("UPDATE recipe_merges SET status = 'skipped', merged_at = CURRENT_TIMESTAMP WHERE id = ?", (plan_id,))
+                stats["skipped"] += 1
+                continue
+            mapping = merge_recipe(conn, merged_id, canonical_id)
+            conn.execute("""UPDATE recipe_merges SET status = 'done', merged_at = CURRENT_TIMESTAMP,
+                            merged_code = ?, merged_desc = ?, merged_source = ?, components_json = ? WHERE id = ?""",
+                         (*merged, json.dumps(mapping), plan_id))
+            stats["merged"] += 1
+        if canonical_exists:
+            engine.recalc_recipe_stats(canonical_id, conn)
+            stats["canonicals"] += 1
+        if n % commit_every == 0:
+            conn.commit()
+            print(f"\r⏳ Canoniche: {n}/{len(by_canonical)} | Fuse: {stats['merged']}", end="")
+    conn.commit()
+    return stats
+
+def pending_run(conn):
+    row = conn.execute("SELECT run_id FROM recipe_merges WHERE status = 'planned' ORDER BY id LIMIT 1").fetchone()
+    return row[0] if row else None
+
+def dedup_catalog(conn, threshold=None, thresholds=None, workers=None, dry_run=False, commit_every=None, memory_mb=None):
+    """
+    Job completo. Se esiste un piano non concluso lo riprende senza ricalcolare le coppie;
+    altrimenti calcola le coppie alla soglia minima richiesta, riporta i cluster per ogni
+    soglia di thresholds e (se non dry_run) pianifica e applica le fusioni alla soglia threshold.
+    """
+    ensure_dedup_schema(conn)
+    threshold = threshold or DEDUP_THRESHOLD
+    report = {"run_id": pending_run(conn), "resumed": False, "clusters": {}, "planned": 0}
+    if report["run_id"] and not dry_run:
+        report["resumed"] = True
+        print(f"🔁 Ripresa del piano {report['run_id']}")
+        report.update(apply_merges(conn, report["run_id"], commit_every))
+        return report
+
+    start = time.time()
+    ids, matrix = load_recipe_vectors(conn)
+    levels = sorted(set(thresholds or []) | {threshold})
+    pairs = all_pairs(matrix, levels[0], workers=workers, memory_mb=memory_mb)
+    report["pairs"] = len(pairs[0])
+    report["recipes"] = len(ids)
+    for level in levels:
+        report["clusters"][level] = len(cluster_pairs(len(ids), *pairs, level))
+    report["pairs_s"] = round(time.time() - start, 2)
+    if dry_run:
+        return report
+
+    plan, _ = plan_merges(conn, ids, matrix, pairs, threshold)
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    conn.executemany("INSERT INTO recipe_merges (run_id, merged_id, canonical_id, similarity, threshold) VALUES (?,?,?,?,?)",
+                     [(run_id, m, c, sim, threshold) for m, c, sim in plan])
+    conn.commit()
+    report.update(run_id=run_id, planned=len(plan))
+    report.update(apply_merges(conn, run_id, commit_every))
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deduplica offline del catalogo ricette (cluster su vec_recipes)")
+    parser.add_argument("--threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="Similarità minima con la ricetta canonica per fondere")
+    parser.add_argument("--thresholds", type=str,
+                        help="Soglie aggiuntive (es. 0.95,0.97) per cui riportare il numero di cluster")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Solo coppie e cluster per soglia, nessuna modifica al DB")
+    parser.add_argument("--workers", type=int, default=DEDUP_WORKERS,
+                        help="Blocchi della matrice calcolati in parallelo (ridotti se superano --memory-mb)")
+    parser.add_argument("--memory-mb", type=int, default=DEDUP_MEMORY_MB,
+                        help=f"Memoria massima dei blocchi in calcolo (Default {DEDUP_MEMORY_MB} MB; "
+                             f"un blocco {PAIR_BLOCK}x{PAIR_COL_BLOCK} float32 occupa ~{PAIR_BLOCK * PAIR_COL_BLOCK * 9 // 2**20} MB). "
+                             "Esclusi la matrice degli embedding (ricette x dim x 4 byte) e le coppie trovate")
+    parser.add_argument("--commit-every", type=int, default=MERGE_COMMIT_EVERY,
+                        help="Ricette canoniche per transazione")
+    parser.add_argument("--db", type=str, default=engine.DB_FILE, help="Database da deduplicare")
+    args = parser.parse_args()
+
+    engine.DB_FILE = args.db
+    conn = engine.get_db_connection()
+    levels = [float(t) for t in args.thresholds.split(",")] if args.thresholds else []
+    print(f"🧬 DEDUP CATALOGO: soglia {args.threshold} | {args.workers} worker | {args.memory_mb} MB")
+    report = dedup_catalog(conn, threshold=args.threshold, thresholds=levels, workers=args.workers,
+                           dry_run=args.dry_run, commit_every=args.commit_every, memory_mb=args.memory_mb)
+    conn.close()
+    if not report["resumed"]:
+        print(f"📐 {report['recipes']} ricette | {report['pairs']} coppie vicine in {report['pairs_s']}s")
+        for level, n in report["clusters"].items():
+            print(f"   soglia {level:.3f}: {n} cluster")
+    if not args.dry_run:
+        print(f"\n✅ Run {report['run_id']}: {report['merged']} ricette fuse in {report['canonicals']} canoniche "
+              f"| saltate: {report['skipped']}")
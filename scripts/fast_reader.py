@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+import itertools
+import pandas as pd
+
+# Lettura veloce di fogli Excel/CSV per ingestion, back-testing, preventivi e normalizzazione:
+# - motore più veloce disponibile (calamine se installato, altrimenti openpyxl/xlrd; pyarrow per i CSV);
+# - solo le colonne richieste (es. posizioni IDX), con le posizioni originali conservate;
+# - cache dei DataFrame già letti, indicizzata per hash del contenuto del file: i run successivi
+#   (back-test, benchmark, ri-esecuzioni) non riparsano l'Excel. Parquet se pyarrow/fastparquet
+#   è installato, altrimenti pickle di pandas.
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db", "frame_cache")
+CACHE_ENABLED = os.getenv("FAST_READER_CACHE", "1") != "0"
+CACHE_VERSION = 1   # Da incrementare se cambia il formato dei frame in cache
+HASH_CHUNK = 1 << 20
+
+def _has_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+HAS_CALAMINE = _has_module("python_calamine")
+HAS_PYARROW = _has_module("pyarrow")
+HAS_PARQUET = HAS_PYARROW or _has_module("fastparquet")
+
+def excel_engine(path):
+    """Motore pandas per il file: calamine (Rust) se disponibile, altrimenti quello di default."""
+    if HAS_CALAMINE:
+        return "calamine"
+    return "xlrd" if str(path).lower().endswith(".xls") else "openpyxl"
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _cache_path(key):
+    return os.path.join(CACHE_DIR, key + (".parquet" if HAS_PARQUET else ".pkl"))
+
+def _write_cache(key, df):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(key)
+    tmp = path + ".tmp"
+    if HAS_PARQUET:
+        # Parquet vuole nomi di colonna stringa: le posizioni intere sono ripristinate in lettura
+        out = df.copy()
+        out.columns = [str(c) for c in out.columns]
+        out.to_parquet(tmp, index=False)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, path)
+
+def _read_cache(key, header):
+    path = _cache_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        if HAS_PARQUET:
+            df = pd.read_parquet(path)
+            if header is None:
+                df.columns = [int(c) for c in df.columns]
+            return df
+        return pd.read_pickle(path)
+    except Exception:
+        return None   # Cache corrotta/incompatibile: si rilegge il file
+
+def _parse(path, sheet_name, header, usecols):
+    if str(path).lower().endswith(".csv"):
+        kwargs = {"engine": "pyarrow"} if HAS_PYARROW and header is not None else {}
+        return pd.read_csv(path, header=header, dtype=str, usecols=usecols, **kwargs)
+    return pd.read_excel(path, sheet_name=sheet_name, header=header, dtype=str,
+                         usecols=usecols, engine=excel_engine(path))
+
+def _cache_key(*parts):
+    return hashlib.sha1(json.dumps([CACHE_VERSION, *parts]).encode("utf-8")).hexdigest()
+
+def read_table(path, usecols=None, sheet_name=0, header=None, cache=None, digest=None):
+    """
+    Un foglio come DataFrame di testo (dtype=str).
+    header=None: colonne = posizioni originali; con usecols le colonne non richieste
+    restano vuote, così le righe posizionali (tuple) mantengono gli indici del file (IDX).
+    """
+    cache = CACHE_ENABLED if cache is None else cache
+    cols = sorted(usecols) if usecols is not None else None
+    key = None
+    if cache:
+        key = _cache_key(digest or file_hash(path), str(sheet_name), header, cols)
+        df = _read_cache(key, header)
+        if df is not None:
+            return df
+
+    df = _parse(path, sheet_name, header, cols)
+    if cols is not None and header is None:
+        df = df.reindex(columns=range(max(cols) + 1))
+
+    if cache:
+        _write_cache(key, df)
+    return df
+
+def read_sheets(path, header=None, cache=None):
+    """
+    Tutti i fogli ({nome: DataFrame}) nell'ordine del file. In cache una voce per foglio più
+    l'elenco dei fogli; se manca anche un solo foglio il workbook è letto una volta sola per intero.
+    """
+    cache = CACHE_ENABLED if cache is None else cache
+    if str(path).lower().endswith(".csv"):
+        return {"csv": read_table(path, header=header, cache=cache)}
+    if not cache:
+        return pd.read_excel(path, sheet_name=None, header=header, dtype=str, engine=excel_engine(path))
+
+    digest = file_hash(path)
+    index_key = _cache_key(digest, "sheets")
+    index_path = os.path.join(CACHE_DIR, index_key + ".json")
+    if os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            names = json.load(f)
+        sheets = {name: _read_cache(_cache_key(digest, str(name), header, None), header) for name in names}
+        if all(df is not None for df in sheets.values()):
+            return sheets
+
+    sheets = pd.read_excel(path, sheet_name=None, header=header, dtype=str, engine=excel_engine(path))
+    for name, df in sheets.items():
+        _write_cache(_cache_key(digest, str(name), header, None), df)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(list(sheets), f)
+    return sheets
+
+def _cell_text(value):
+    """Valore openpyxl come testo, come lo converte pandas: numeri interi senza decimali (12.0 -> '12')."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def iter_rows(path, usecols=None, chunk_rows=5000):
+    """
+    Righe del primo foglio lette in modo lazy (memoria costante, nessuna cache), come tuple
+    posizionali con gli stessi valori di read_table: testo, celle vuote -> None.
+    .xlsx: openpyxl read-only; .csv: pandas a blocchi di chunk_rows; .xls: lettura completa (xlrd).
+    """
+    cols = sorted(usecols) if usecols is not None else None
+    lower = str(path).lower()
+    if lower.endswith(".csv"):
+        for chunk in pd.read_csv(path, header=None, dtype=str, usecols=cols, chunksize=chunk_rows):
+            if cols is not None:
+                chunk = chunk.reindex(columns=range(max(cols) + 1))
+            yield from chunk.itertuples(index=False, name=None)
+        return
+    if lower.endswith(".xls"):
+        yield from read_table(path, usecols=cols, cache=False).itertuples(index=False, name=None)
+        return
+
+    import openpyxl
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = book.worksheets[0]
+        width = max(cols) + 1 if cols is not None else None
+        keep = set(cols) if cols is not None else None
+        for row in sheet.iter_rows(values_only=True, max_col=width):
+            yield tuple(
+                None if v is None or v == "" or (keep is not None and i not in keep) else _cell_text(v)
+                for i, v in enumerate(row)
+            )
+    finally:
+        book.close()
+
+def read_head(path, n_rows, cache=None):
+    """Prime n_rows righe (tuple posizionali, come iter_rows): per riconoscere il layout senza leggere il file."""
+    cache = CACHE_ENABLED if cache is None else cache
+    key = _cache_key(file_hash(path), "head", n_rows) if cache else None
+    df = _read_cache(key, None) if cache else None
+    if df is None:
+        rows = iter_rows(path)
+        try:
+            df = pd.DataFrame(list(itertools.islice(rows, n_rows)), dtype=object)
+        finally:
+            rows.close()
+        if cache:
+            _write_cache(key, df)
+    return [tuple(None if pd.isna(v) else v for v in row) for row in df.itertuples(index=False, name=None)]
+
+def clear_cache():
+    """Rimuove tutti i frame in cache. Ritorna il numero di file eliminati."""
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    removed = 0
+    for name in os.listdir(CACHE_DIR):
+        os.remove(os.path.join(CACHE_DIR, name))
+        removed += 1
+    return removed
@@ -0,0 +1,104 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import numpy as np
+
+# Cache persistente (SQLite) per embedding e decisioni LLM.
+# Chiave = hash SHA1 del testo normalizzato (+ modello e dimensione richiesta per gli embedding):
+# run ripetuti (backtest, benchmark) non richiamano l'API e possono girare completamente offline.
+
+def text_hash(text):
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+class LLMCache:
+    """Cache chiave/valore di embedding (float32) e decisioni JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._ensure_embeddings_schema()
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS decisions (
+            kind TEXT NOT NULL,
+            key_hash TEXT NOT NULL,
+            payload TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key_hash)
+        ) WITHOUT ROWID''')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_embeddings_schema(self):
+        """
+        Embedding per (modello, dimensione richiesta, testo): due spazi con lo stesso modello e
+        dimensioni diverse convivono. dim = 0 quando non è richiesta una dimensione (default del
+        modello). Le cache create con la chiave (model, text_hash) sono migrate una volta sola.
+        """
+        cols = self.conn.execute("PRAGMA table_info(embeddings)").fetchall()
+        legacy = cols and not any(name == "dim" and pk for _, name, _, _, _, pk in cols)
+        if legacy:
+            self.conn.execute("ALTER TABLE embeddings RENAME TO embeddings_legacy")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            text_hash TEXT NOT NULL,
+            vector BLOB,
+            PRIMARY KEY (model, dim, text_hash)
+        ) WITHOUT ROWID''')
+        if legacy:
+            # Le righe storiche registrano la dimensione del vettore: valgono per quella dimensione
+            self.conn.execute("INSERT OR IGNORE INTO embeddings (model, dim, text_hash, vector) "
+                              "SELECT model, COALESCE(dim, length(vector) / 4), text_hash, vector FROM embeddings_legacy")
+            self.conn.execute("DROP TABLE embeddings_legacy")
+
+    def get_embeddings(self, texts, model, dim=None):
+        """
+        Ritorna una lista allineata a texts: vettore (list[float]) o None se assente.
+        dim: dimensione richiesta al modello (None = default del modello).
+        """
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            # Chunk per restare sotto il limite di parametri SQLite
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model=? AND dim=? AND text_hash IN ({marks})",
+                    [model, dim or 0] + chunk
+                ).fetchall()
+                found.update({h: np.frombuffer(v, dtype=np.float32).tolist() for h, v in rows})
+        out = [found.get(h) for h in hashes]
+        hit = sum(1 for v in out if v is not None)
+        self.hits += hit
+        self.misses += len(out) - hit
+        return out
+
+    def put_embeddings(self, texts, vectors, model, dim=None):
+        rows = [(model, dim or 0, text_hash(t), np.asarray(v, dtype=np.float32).tobytes())
+                for t, v in zip(texts, vectors)]
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (model, dim, text_hash, vector) VALUES (?,?,?,?)", rows)
+            self.conn.commit()
+
+    def get_decision(self, kind, key):
+        """Decisione memorizzata (dict) per la chiave (qualsiasi oggetto serializzabile JSON)."""
+        with self._lock:
+            row = self.conn.execute("SELECT payload FROM decisions WHERE kind=? AND key_hash=?",
+                                    (kind, text_hash(json.dumps(key, sort_keys=True)))).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put_decision(self, kind, key, value):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO decisions (kind, key_hash, payload) VALUES (?,?,?)",
+                              (kind, text_hash(json.dumps(key, sort_keys=True)), json.dumps(value)))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
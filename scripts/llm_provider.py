@@ -0,0 +1,298 @@
+import os
+import re
+import copy
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+
+import tracing
+
+# Interfaccia unica verso LLM ed embedding.
+# - OpenAIProvider: client reale, creato alla prima chiamata (non all'import).
+# - OfflineProvider: stand-in deterministico per benchmark e CI (nessuna rete).
+# Selezione da env: LLM_PROVIDER=openai|offline (Default: openai).
+
+DEFAULT_EMBEDDING_DIM = 1536
+
+# Listino OpenAI (USD per 1M token: input, output) per la stima dei costi
+MODEL_PRICES_USD_PER_1M = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+def estimate_cost(usage_by_model):
+    """Costo stimato (USD) da {modello: {prompt_tokens, completion_tokens}}. Modelli ignoti = 0."""
+    total = 0.0
+    for model, usage in usage_by_model.items():
+        price_in, price_out = MODEL_PRICES_USD_PER_1M.get(model, (0.0, 0.0))
+        total += usage.get("prompt_tokens", 0) * price_in / 1e6
+        total += usage.get("completion_tokens", 0) * price_out / 1e6
+    return total
+
+def usage_delta(before, after):
+    """Differenza tra due snapshot di usage_by_model (consumo di un intervallo, es. una riga)."""
+    delta = {}
+    for model, usage in after.items():
+        prev = before.get(model, {})
+        diff = {k: v - prev.get(k, 0) for k, v in usage.items()}
+        if any(diff.values()):
+            delta[model] = diff
+    return delta
+
+class RateLimiter:
+    """
+    Token bucket thread-safe: al massimo `per_minute` unità al minuto (attesa bloccante).
+    Un'unità è una richiesta, oppure un testo con acquire(n) (es. batch di embedding). Una
+    richiesta più grande del bucket parte a bucket pieno e lascia un debito che rallenta le
+    successive: il ritmo medio resta per_minute.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited_s = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        if not self.per_minute:
+            return 0.0
+        need = min(float(n), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+                self.updated = now
+                if self.tokens >= need:
+                    self.tokens -= n
+                    self.waited_s += waited
+                    return waited
+                wait = (need - self.tokens) * 60.0 / self.per_minute
+            time.sleep(wait)
+            waited += wait
+
+class LLMProvider:
+    """Contratto comune: embed() e chat_json(). Tiene i contatori di chiamate e token."""
+
+    name = "base"
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"embedding_calls": 0, "embedding_inputs": 0, "chat_calls": 0,
+                      "prompt_tokens": 0, "completion_tokens": 0}
+        self.usage_by_model = {}
+
+    def usage_snapshot(self):
+        """Copia di usage_by_model (per calcolare il consumo di un intervallo con usage_delta)."""
+        with self._stats_lock:
+            return {m: dict(u) for m, u in self.usage_by_model.items()}
+
+    def _count(self, model=None, **deltas):
+        with self._stats_lock:
+            for key, value in deltas.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+            if model:
+                usage = self.usage_by_model.setdefault(model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+                usage["calls"] += 1
+                usage["prompt_tokens"] += deltas.get("prompt_tokens", 0)
+                usage["completion_tokens"] += deltas.get("completion_tokens", 0)
+        for key, value in deltas.items():
+            tracing.count(f"llm_{key}", value)
+
+    def embed(self, texts, model, dimensions=None):
+        """Lista di vettori (list[float]) allineata a texts."""
+        raise NotImplementedError
+
+    def chat_json(self, messages, model, temperature=0, task=None, context=None):
+        """
+        Chat in JSON mode. Ritorna (dict, usage) con usage = {prompt_tokens, completion_tokens}.
+        task/context descrivono la richiesta in forma strutturata (usati dallo stand-in offline).
+        """
+        raise NotImplementedError
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, api_key=None):
+        super().__init__()
+        self._api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        """Client OpenAI reale (anche per Files/Assistants API), creato alla prima richiesta."""
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=self._api_key or os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    def embed(self, texts, model, dimensions=None):
+        kwargs = {"dimensions": dimensions} if dimensions else {}
+        resp = self.client.embeddings.create(input=list(texts), model=model, **kwargs)
+        usage = getattr(resp, "usage", None)
+        self._count(model=model, embedding_calls=1, embedding_inputs=len(texts),
+                    prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0)
+        return [d.embedding for d in resp.data]
+
+    def chat_json(self, messages, model, temperature=0, task=None, context=None):
+        res = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            temperature=temperature
+        )
+        usage = {
+            "prompt_tokens": getattr(res.usage, "prompt_tokens", 0) if res.usage else 0,
+            "completion_tokens": getattr(res.usage, "completion_tokens", 0) if res.usage else 0,
+        }
+        self._count(model=model, chat_calls=1, **usage)
+        return json.loads(res.choices[0].message.content), usage
+
+class OfflineProvider(LLMProvider):
+    """
+    Stand-in locale e deterministico:
+    - embedding derivati da hash di token e trigrammi (testi simili -> vettori vicini);
+    - risposte judge/validator da script JSON o da euristica lessicale;
+    - latenza e rate limit simulati per misurare la pipeline in condizioni realistiche.
+    """
+
+    name = "offline"
+
+    def __init__(self, latency_ms=0, requests_per_minute=0, script=None, dim=DEFAULT_EMBEDDING_DIM):
+        super().__init__()
+        self.latency_ms = latency_ms
+        self.limiter = RateLimiter(requests_per_minute)
+        self.dim = dim
+        self.script = script or {}
+
+    @property
+    def client(self):
+        raise NotImplementedError("OfflineProvider: le API Files/Assistants non sono disponibili offline")
+
+    @staticmethod
+    def _features(text):
+        text = str(text).lower()
+        tokens = re.findall(r"[a-z0-9àèéìòù]+(?:[.,/x][0-9]+)*", text)
+        padded = f"  {' '.join(tokens)}  "
+        trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return [("t", tok) for tok in tokens] + [("g", tri) for tri in trigrams]
+
+    def hash_embedding(self, text, dim=None):
+        """Feature hashing firmato di token (peso 2) e trigrammi, normalizzato L2."""
+        dim = dim or self.dim
+        vec = np.zeros(dim, dtype=np.float32)
+        for kind, feat in self._features(text):
+            h = hashlib.blake2b(f"{kind}:{feat}".encode("utf-8"), digest_size=8).digest()
+            idx = int.from_bytes(h[:4], "little") % dim
+            sign = 1.0 if h[4] & 1 else -1.0
+            vec[idx] += sign * (2.0 if kind == "t" else 1.0)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm > 0 else vec).tolist()
+
+    def _simulate_call(self):
+        self.limiter.acquire()
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def embed(self, texts, model, dimensions=None):
+        self._simulate_call()
+        texts = list(texts)
+        self._count(model=model, embedding_calls=1, embedding_inputs=len(texts),
+                    prompt_tokens=sum(len(str(t)) // 4 for t in texts))
+        return [self.hash_embedding(t, dimensions) for t in texts]
+
+    @staticmethod
+    def lexical_similarity(a, b):
+        """Jaccard sui token alfanumerici (0..1)."""
+        ta = set(re.findall(r"[a-z0-9]+", str(a).lower()))
+        tb = set(re.findall(r"[a-z0-9]+", str(b).lower()))
+        if not ta or not tb:
+            return 0.0
+        return len(ta & tb) / len(ta | tb)
+
+    def _scripted_answer(self, messages, task):
+        prompt = messages[-1]["content"] if messages else ""
+        answers = self.script.get("answers", {})
+        key = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+        if key in answers:
+            return answers[key]
+        return self.script.get(task)
+
+    def _heuristic_answer(self, task, context):
+        context = context or {}
+        if task == "judge":
+            sim = self.lexical_similarity(context.get("existing", ""), context.get("new", ""))
+            return {"is_merge": sim >= 0.8, "reason": f"Offline: similarità lessicale {sim:.2f}"}
+        if task == "validate":
+            options = context.get("options", [])
+            if not options:
+                return {"selected_index": 0, "status": "NO MATCH", "reason": "Offline: nessuna opzione"}
+            scores = [self.lexical_similarity(context.get("rdo", ""), opt) for opt in options]
+            best = int(np.argmax(scores))
+            status = "OK" if scores[best] >= 0.6 else ("CHECK" if scores[best] >= 0.3 else "NO MATCH")
+            return {"selected_index": best + 1 if status != "NO MATCH" else 0, "status": status,
+                    "reason": f"Offline: similarità lessicale {scores[best]:.2f}"}
+        if task == "validate_batch":
+            return {"decisions": [dict(self._heuristic_answer("validate", item), riga=i + 1)
+                                  for i, item in enumerate(context.get("items", []))]}
+        return {}
+
+    def chat_json(self, messages, model, temperature=0, task=None, context=None):
+        self._simulate_call()
+        answer = self._scripted_answer(messages, task)
+        if answer is None:
+            answer = self._heuristic_answer(task, context)
+        usage = {
+            "prompt_tokens": sum(len(str(m.get("content", ""))) for m in messages) // 4,
+            "completion_tokens": len(json.dumps(answer)) // 4,
+        }
+        self._count(model=model, chat_calls=1, **usage)
+        return copy.deepcopy(answer), usage
+
+class LazyOpenAIClient:
+    """Proxy verso provider.client: il client reale nasce solo al primo utilizzo."""
+
+    def __getattr__(self, name):
+        return getattr(get_provider().client, name)
+
+_PROVIDER = None
+_PROVIDER_LOCK = threading.Lock()
+
+def provider_from_env():
+    kind = os.getenv("LLM_PROVIDER", "openai").strip().lower()
+    if kind == "offline":
+        script = None
+        script_path = os.getenv("LLM_OFFLINE_SCRIPT")
+        if script_path:
+            with open(script_path, encoding="utf-8") as f:
+                script = json.load(f)
+        return OfflineProvider(
+            latency_ms=float(os.getenv("LLM_OFFLINE_LATENCY_MS", "0")),
+            requests_per_minute=float(os.getenv("LLM_OFFLINE_RPM", "0")),
+            script=script,
+        )
+    return OpenAIProvider()
+
+def get_provider():
+    """Provider condiviso dal processo (creato da env alla prima richiesta)."""
+    global _PROVIDER
+    with _PROVIDER_LOCK:
+        if _PROVIDER is None:
+            _PROVIDER = provider_from_env()
+        return _PROVIDER
+
+def set_provider(provider):
+    """Sostituisce il provider condiviso (benchmark, test, CI)."""
+    global _PROVIDER
+    with _PROVIDER_LOCK:
+        _PROVIDER = provider
+    return provider
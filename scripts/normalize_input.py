@@ -2,9 +2,15 @@ import os
 import time
 import sys
 import re
+import json
+import hashlib
+import argparse
+import shutil
+import threading
 import pandas as pd
 import warnings
-from openai import OpenAI, RateLimitError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from openai import RateLimitError
 from dotenv import load_dotenv, find_dotenv
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -19,7 +25,12 @@ else:
     load_dotenv(dotenv_path)
     PROJECT_ROOT = os.path.dirname(dotenv_path)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Files/Assistants API: client reale del provider, creato al primo utilizzo
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from llm_provider import LazyOpenAIClient, RateLimiter
+import rule_normalizer
+from rule_normalizer import read_sheets, normalize_sheets, split_sheet_chunks, OUTPUT_COLUMNS, CHUNK_MAX_ROWS
+client = LazyOpenAIClient()
 
 # --- CONFIGURAZIONE ---
 INPUT_FILENAME = "temp_raw_exctraction.xlsx"
@@ -29,6 +40,22 @@ INPUT_FILE = os.path.join(PROJECT_ROOT, "richieste_ordine/", INPUT_FILENAME)
 OUTPUT_FILE = os.path.join(PROJECT_ROOT, "richieste_ordine", "input_cliente_clean_new.xlsx")
 TEMP_RAW_EXCEL = os.path.join(PROJECT_ROOT, "richieste_ordine", "temp_raw_extraction_new.xlsx")
 
+# --- ESECUZIONE ASSISTANTS ---
+# Run in streaming (eventi) quando l'SDK lo supporta; altrimenti polling con backoff esponenziale.
+# Gli assistant sono riutilizzati tra invocazioni (cache su disco) e tutte le richieste API,
+# anche di file normalizzati in parallelo, passano da un unico rate limiter.
+USE_STREAMING = True
+POLL_INITIAL_S = 1.0
+POLL_BACKOFF = 1.6
+POLL_MAX_S = 15.0
+ASSISTANTS_RPM = 60             # Richieste/minuto verso l'API Assistants (condiviso)
+MAX_CONCURRENT_FILES = 3        # File normalizzati in parallelo, configurabile da args
+ASSISTANT_CACHE_FILE = os.path.join(PROJECT_ROOT, "db", "assistants_cache.json")
+RUN_TERMINAL_EVENTS = ("thread.run.completed", "thread.run.failed", "thread.run.cancelled",
+                       "thread.run.expired", "thread.run.incomplete")
+ASSISTANTS_LIMITER = RateLimiter(ASSISTANTS_RPM)
+_assistant_lock = threading.Lock()
+
 # --- 1. PROMPT DIGITIZER (Solo per PDF -> Raw Excel) ---
 # Usiamo gpt-4o-mini qui perché è più veloce ed economico per task meccanici
 MODEL_DIGITIZER = "gpt-4o-mini" 
@@ -54,6 +81,23 @@ OUTPUT RICHIESTO:
 Soltanto il file "raw_input.xlsx".
 """
 
+# --- 1b. DIGITIZER LOCALE (pdfplumber, senza upload) ---
+# Stessa estrazione chiesta al code_interpreter (page.extract_table() con tolleranza standard),
+# eseguita in locale: pagine distribuite su un pool di processi, righe scritte in streaming.
+LOCAL_DIGITIZER = True   # False -> Digitizer remoto (Assistants + code_interpreter), configurabile da args
+PDF_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 4   # Pagine per task: abbastanza grande da ammortizzare l'apertura del PDF nel worker
+
+# --- 2a. NORMALIZER A REGOLE (PATTERN A/B/C deterministici, senza LLM) ---
+# I fogli riconosciuti dalle regole non passano dall'Assistant; solo quelli non classificati
+# (intestazione o colonna codici non trovata, importi incoerenti) vanno al Normalizer LLM.
+RULE_NORMALIZER = True   # False -> tutto il file al Normalizer LLM, configurabile da args
+# Fogli non classificati: chunk lungo i confini tra famiglie di codici, normalizzati in parallelo
+MAX_CONCURRENT_CHUNKS = 4
+INPUT_EXTENSIONS = (".xlsx", ".xls", ".csv", ".pdf")
+GENERATED_SUFFIXES = ("_clean", "_raw_extraction", "_temp", "_out")
+TEMP_CHUNKS_DIR = os.path.join(PROJECT_ROOT, "richieste_ordine", "temp_chunks")
+
 # --- 2. PROMPT NORMALIZER (Raw Excel -> Clean Flat Excel) ---
 # Usiamo gpt-4o qui perché serve ragionamento logico complesso
 MODEL_NORMALIZER = "gpt-4o"
@@ -116,10 +160,8 @@ def upload_file_to_openai(filepath):
     """Carica un file su OpenAI con gestione retry."""
     print(f"   ⬆️  Upload {os.path.basename(filepath)}...", end="")
     try:
-        file_obj = client.files.create(
-            file=open(filepath, "rb"),
-            purpose='assistants'
-        )
+        with open(filepath, "rb") as f:
+            file_obj = _api_call(client.files.create, file=f, purpose='assistants')
         print(f" Fatto ({file_obj.id})")
         return file_obj
     except Exception as e:
@@ -135,20 +177,97 @@ def extract_wait_time(error_message):
     except: pass
     return 60.0 # Default fallback
 
-def run_assistant_task(task_name, file_obj, instructions, model_name, output_filename=None):
+def _api_call(fn, *args, **kwargs):
+    """Ogni richiesta all'API Assistants passa dal limitatore condiviso tra file/task concorrenti."""
+    ASSISTANTS_LIMITER.acquire()
+    return fn(*args, **kwargs)
+
+def _load_assistant_cache():
+    try:
+        with open(ASSISTANT_CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def get_or_create_assistant(task_name, instructions, model_name):
+    """
+    Assistant riutilizzato tra task e invocazioni: la chiave è l'hash di nome, modello e prompt,
+    quindi una modifica al prompt crea automaticamente un nuovo assistant.
+    """
+    key = hashlib.sha1(f"{task_name}|{model_name}|{instructions}".encode("utf-8")).hexdigest()
+    with _assistant_lock:
+        cache = _load_assistant_cache()
+        assistant_id = cache.get(key)
+        if assistant_id:
+            try:
+                return _api_call(client.beta.assistants.retrieve, assistant_id).id
+            except Exception:
+                print(f"   ♻️  Assistant {task_name} in cache non più disponibile, lo ricreo...")
+
+        assistant = _api_call(
+            client.beta.assistants.create,
+            name=f"Worker_{task_name}",
+            instructions=instructions,
+            model=model_name,
+            tools=[{"type": "code_interpreter"}]
+        )
+        cache[key] = assistant.id
+        os.makedirs(os.path.dirname(ASSISTANT_CACHE_FILE), exist_ok=True)
+        with open(ASSISTANT_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+        return assistant.id
+
+def _stream_run(thread_id, assistant_id, label):
+    """Run in streaming: nessun polling, si attende l'evento terminale della run."""
+    run = None
+    with _api_call(client.beta.threads.runs.stream, thread_id=thread_id, assistant_id=assistant_id) as stream:
+        for event in stream:
+            if event.event in RUN_TERMINAL_EVENTS:
+                run = event.data
+            elif event.event == "thread.run.in_progress":
+                print(f"   ⏳ [{label}] Status: IN_PROGRESS (streaming)...")
+    return run
+
+def _poll_run(thread_id, assistant_id, label):
+    """Fallback senza streaming: polling con backoff esponenziale, riazzerato a ogni cambio di stato."""
+    run = _api_call(client.beta.threads.runs.create, thread_id=thread_id, assistant_id=assistant_id)
+    delay = POLL_INITIAL_S
+    last_status = run.status
+    while run.status in ("queued", "in_progress", "cancelling"):
+        time.sleep(delay)
+        run = _api_call(client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run.id)
+        if run.status != last_status:
+            print(f"   ⏳ [{label}] Status: {run.status.upper()}...")
+            last_status = run.status
+            delay = POLL_INITIAL_S
+        else:
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_S)
+    return run
+
+def wait_for_run(thread_id, assistant_id, label):
+    """Esegue una run fino allo stato finale: streaming se disponibile, altrimenti polling adattivo."""
+    if USE_STREAMING and hasattr(client.beta.threads.runs, "stream"):
+        try:
+            run = _stream_run(thread_id, assistant_id, label)
+            if run is not None:
+                return run
+        except RateLimitError:
+            raise
+        except Exception as e:
+            print(f"   ⚠️  [{label}] Streaming non disponibile ({type(e).__name__}), passo al polling...")
+    return _poll_run(thread_id, assistant_id, label)
+
+def run_assistant_task(task_name, file_obj, instructions, model_name, output_filename=None, label=None):
     """
     Esegue un task con gestione automatica del RATE LIMIT.
     """
-    print(f"   🤖 Avvio Agente: {task_name} (Model: {model_name})...")
-    
-    assistant = client.beta.assistants.create(
-        name=f"Worker_{task_name}",
-        instructions=instructions,
-        model=model_name,
-        tools=[{"type": "code_interpreter"}]
-    )
+    label = label or task_name
+    print(f"   🤖 Avvio Agente: {task_name} (Model: {model_name}) [{label}]...")
 
-    thread = client.beta.threads.create(
+    assistant_id = get_or_create_assistant(task_name, instructions, model_name)
+
+    thread = _api_call(
+        client.beta.threads.create,
         messages=[{
             "role": "user",
             "content": "Esegui il task sul file allegato. Genera il file richiesto.",
@@ -157,69 +276,47 @@ def run_assistant_task(task_name, file_obj, instructions, model_name, output_fil
     )
 
     max_retries = 3
-    retry_count = 0
-
-    while retry_count < max_retries:
-        # Avvio la run
-        run = client.beta.threads.runs.create(thread_id=thread.id, assistant_id=assistant.id)
-        
-        # Polling
-        spinner = ['|', '/', '-', '\\']
-        idx = 0
+    completed = False
+    for _ in range(max_retries):
         start_time = time.time()
-        
-        while True:
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-            elapsed = int(time.time() - start_time)
-            
-            sys.stdout.write(f"\r   ⏳ Status: {run_status.status.upper()}... {spinner[idx % 4]} ({elapsed}s)")
-            sys.stdout.flush()
-            idx += 1
-
-            if run_status.status == 'completed':
-                sys.stdout.write("\n")
-                print(f"   ✅ Task completato in {elapsed}s.")
-                # Successo -> Usciamo dal loop di retry e dal loop di polling
-                retry_count = 999 
-                break
-                
-            elif run_status.status == 'failed':
-                sys.stdout.write("\n")
-                err_code = run_status.last_error.code
-                err_msg = run_status.last_error.message
-                
-                if err_code == 'rate_limit_exceeded':
-                    wait_s = extract_wait_time(err_msg) + 2.0 # +2s di buffer
-                    print(f"⚠️  RATE LIMIT RAGGIUNTO. Pausa di raffreddamento: {wait_s:.1f}s...")
-                    time.sleep(wait_s)
-                    print("   🔄 Riprovo l'esecuzione...")
-                    retry_count += 1
-                    break # Usciamo dal loop di polling per ricreare la Run nel loop esterno
-                else:
-                    print(f"❌ ERRORE CRITICO AI ({task_name}): {err_code} - {err_msg}")
-                    client.beta.assistants.delete(assistant.id)
-                    return None
-            
-            elif run_status.status in ['cancelled', 'expired']:
-                sys.stdout.write("\n")
-                print(f"❌ Task {run_status.status}.")
-                client.beta.assistants.delete(assistant.id)
-                return None
-            
-            time.sleep(0.5)
-        
-        # Se abbiamo completato (retry_count 999), procediamo al download
-        if retry_count == 999:
+        try:
+            run = wait_for_run(thread.id, assistant_id, label)
+        except RateLimitError as e:
+            wait_s = extract_wait_time(e) + 2.0
+            print(f"⚠️  [{label}] RATE LIMIT RAGGIUNTO. Pausa di raffreddamento: {wait_s:.1f}s...")
+            time.sleep(wait_s)
+            continue
+        elapsed = int(time.time() - start_time)
+
+        if run.status == 'completed':
+            print(f"   ✅ [{label}] Task completato in {elapsed}s.")
+            completed = True
             break
 
+        elif run.status == 'failed':
+            err_code = run.last_error.code
+            err_msg = run.last_error.message
+
+            if err_code == 'rate_limit_exceeded':
+                wait_s = extract_wait_time(err_msg) + 2.0 # +2s di buffer
+                print(f"⚠️  [{label}] RATE LIMIT RAGGIUNTO. Pausa di raffreddamento: {wait_s:.1f}s...")
+                time.sleep(wait_s)
+                print(f"   🔄 [{label}] Riprovo l'esecuzione...")
+                continue
+            print(f"❌ ERRORE CRITICO AI ({task_name}): {err_code} - {err_msg}")
+            return None
+
+        else:
+            print(f"❌ [{label}] Task {run.status}.")
+            return None
+
     # --- RECUPERO OUTPUT ---
-    if retry_count < 999: # Se siamo usciti per max retries
-        print(f"\n❌ Troppi tentativi falliti per Rate Limit.")
-        client.beta.assistants.delete(assistant.id)
+    if not completed:
+        print(f"\n❌ [{label}] Troppi tentativi falliti per Rate Limit.")
         return None
 
-    print(f"   📥 Analisi output ({task_name})...")
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
+    print(f"   📥 Analisi output ({task_name}) [{label}]...")
+    messages = _api_call(client.beta.threads.messages.list, thread_id=thread.id)
     file_id_out = None
     
     for msg in messages.data:
@@ -237,62 +334,142 @@ def run_assistant_task(task_name, file_obj, instructions, model_name, output_fil
 
     saved_path = None
     if file_id_out:
-        data = client.files.content(file_id_out)
+        data = _api_call(client.files.content, file_id_out)
         target_path = output_filename if output_filename else f"temp_{task_name}.xlsx"
         with open(target_path, "wb") as f:
             f.write(data.read())
         saved_path = target_path
         print(f"   💾 FILE SALVATO: {saved_path}")
-        client.files.delete(file_id_out)
+        _api_call(client.files.delete, file_id_out)
     else:
-        print(f"\n⚠️  Nessun file generato da {task_name}.")
+        print(f"\n⚠️  Nessun file generato da {task_name} [{label}].")
         print("   Ultimo messaggio AI:")
         for msg in messages.data:
             if msg.role == "assistant":
                 print(f"   > {msg.content[0].text.value}")
                 break
 
-    client.beta.assistants.delete(assistant.id)
     return saved_path
 
-def convert_legacy_excel(filepath):
-    filename, ext = os.path.splitext(filepath)
-    ext = ext.lower()
-    if ext == '.xlsx': return filepath, False
-    
-    print(f"   🔄 Conversione legacy {ext} -> .xlsx...", end="")
-    try:
-        if ext == '.xls':
-            df = pd.read_excel(filepath, header=None)
-        elif ext == '.csv':
-            df = pd.read_csv(filepath, header=None)
-        else:
-            return filepath, False
-        
-        temp_path = filename + "_temp.xlsx"
-        df.to_excel(temp_path, index=False, header=False)
-        print(" Fatto.")
-        return temp_path, True
-    except Exception as e:
-        print(f"\n❌ Errore conversione locale: {e}")
-        return filepath, False
-
-def main_pipeline():
+def _extract_pages(task):
+    """Worker: tabelle (extract_table) di un gruppo di pagine. Ritorna le righe in ordine di pagina."""
+    import pdfplumber
+    pdf_path, page_numbers = task
+    rows = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for n in page_numbers:
+            page = pdf.pages[n]
+            table = page.extract_table()
+            if table:
+                rows.extend(table)
+            page.close()  # Libera la cache degli oggetti della pagina
+    return rows
+
+def extract_pdf_tables_local(pdf_path, output_path, workers=None):
+    """
+    Fase 1 in locale: estrae le tabelle di tutte le pagine e le accumula in un Excel grezzo
+    (nessuna pulizia, come il Digitizer remoto). I gruppi di pagine girano in parallelo;
+    le righe vengono scritte man mano (xlsxwriter constant_memory) nell'ordine delle pagine.
+    Ritorna (percorso, numero righe).
+    """
+    import pdfplumber
+    import xlsxwriter
+
+    with pdfplumber.open(pdf_path) as pdf:
+        n_pages = len(pdf.pages)
+    tasks = [(pdf_path, list(range(i, min(i + PDF_PAGES_PER_TASK, n_pages))))
+             for i in range(0, n_pages, PDF_PAGES_PER_TASK)]
+    workers = max(1, min(workers or PDF_WORKERS, len(tasks)))
+    print(f"   📑 {n_pages} pagine in {len(tasks)} blocchi su {workers} processi...")
+
+    workbook = xlsxwriter.Workbook(output_path, {"constant_memory": True})
+    worksheet = workbook.add_worksheet("raw")
+    row_idx = 0
+    start_time = time.time()
+
+    def write_rows(rows):
+        nonlocal row_idx
+        for row in rows:
+            for col, value in enumerate(row):
+                if value is not None:
+                    worksheet.write_string(row_idx, col, str(value))
+            row_idx += 1
+
+    if workers == 1:
+        for task in tasks:
+            write_rows(_extract_pages(task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # map() restituisce i blocchi in ordine: la scrittura procede appena il blocco successivo è pronto
+            for rows in pool.map(_extract_pages, tasks):
+                write_rows(rows)
+
+    workbook.close()
+    print(f"   ✅ Estratte {row_idx} righe in {time.time() - start_time:.1f}s -> {os.path.basename(output_path)}")
+    return output_path, row_idx
+
+def normalize_chunk(chunk_df, chunk_base, label):
+    """Un chunk grezzo -> Assistant Normalizer -> DataFrame con le colonne di output (None se fallisce)."""
+    chunk_path = chunk_base + ".xlsx"
+    chunk_df.to_excel(chunk_path, index=False, header=False)
+    excel_obj = upload_file_to_openai(chunk_path)
+    if not excel_obj:
+        return None
+    # Qui usiamo MODEL_NORMALIZER (gpt-4o) perché serve intelligenza
+    result_path = run_assistant_task(
+        "Normalizer",
+        excel_obj,
+        PROMPT_NORMALIZER,
+        model_name=MODEL_NORMALIZER,
+        output_filename=chunk_base + "_out.xlsx",
+        label=label
+    )
+    _api_call(client.files.delete, excel_obj.id)
+    if not result_path:
+        return None
+    return pd.read_excel(result_path).rename(columns={"UNITA_DI_MISURA": "UNITA_MISURA"})
+
+def job_paths(input_file):
+    """Output e file temporanei per un input: i default globali per INPUT_FILE, altrimenti accanto all'input."""
+    if os.path.abspath(input_file) == os.path.abspath(INPUT_FILE):
+        return OUTPUT_FILE, TEMP_RAW_EXCEL, TEMP_CHUNKS_DIR
+    base = os.path.splitext(input_file)[0]
+    return base + "_clean.xlsx", base + "_raw_extraction.xlsx", base + "_chunks"
+
+def main_pipeline(input_file=None, output_file=None):
+    input_file = input_file or INPUT_FILE
+    default_output, temp_raw_excel, chunk_dir = job_paths(input_file)
+    output_file = output_file or default_output
+    label = os.path.basename(input_file)
     print(f"🚀 AVVIO PIPELINE DI NORMALIZZAZIONE")
-    print(f"   Input: {INPUT_FILE}")
+    print(f"   Input: {input_file}")
 
-    if not os.path.exists(INPUT_FILE):
+    if not os.path.exists(input_file):
         print("❌ File non trovato.")
-        return
+        return None
 
     # --- FASE 0: Preparazione File ---
-    current_file_path = INPUT_FILE
+    current_file_path = input_file
     is_temp_file = False
-    filename, ext = os.path.splitext(INPUT_FILE)
+    filename, ext = os.path.splitext(input_file)
     ext = ext.lower()
 
     # --- FASE 1: DIGITIZER (Solo se PDF) ---
-    if ext == '.pdf':
+    if ext == '.pdf' and LOCAL_DIGITIZER:
+        print("\n📄 Rilevato PDF: Avvio Fase 1 (Estrazione Geometrica locale)...")
+        try:
+            raw_excel_path, n_rows = extract_pdf_tables_local(current_file_path, temp_raw_excel)
+        except Exception as e:
+            print(f"❌ Errore estrazione locale: {e}")
+            return
+        if n_rows == 0:
+            print("❌ Nessuna tabella trovata nel PDF. Impossibile procedere.")
+            return
+
+        current_file_path = raw_excel_path
+        is_temp_file = True
+
+    elif ext == '.pdf':
         print("\n📄 Rilevato PDF: Avvio Fase 1 (Estrazione Geometrica)...")
         pdf_obj = upload_file_to_openai(current_file_path)
         if not pdf_obj: return
@@ -303,10 +480,11 @@ def main_pipeline():
             pdf_obj, 
             PROMPT_DIGITIZER, 
             model_name=MODEL_DIGITIZER, # <--- SWITCH MODELLO
-            output_filename=TEMP_RAW_EXCEL
+            output_filename=temp_raw_excel,
+            label=label
         )
         
-        client.files.delete(pdf_obj.id)
+        _api_call(client.files.delete, pdf_obj.id)
         
         if not raw_excel_path:
             print("❌ Fase 1 fallita. Impossibile procedere.")
@@ -315,35 +493,115 @@ def main_pipeline():
         current_file_path = raw_excel_path
         is_temp_file = True 
 
-    elif ext in ['.xls', '.csv']:
-        current_file_path, is_temp_file = convert_legacy_excel(current_file_path)
+    # .xls/.csv letti direttamente (fast_reader): nessuna conversione intermedia in .xlsx
+    # --- FASE 2a: NORMALIZER A REGOLE ---
+    sheets = read_sheets(current_file_path)
+    if RULE_NORMALIZER:
+        print("\n📐 Avvio Fase 2a (Normalizzazione a regole)...")
+        results = normalize_sheets(sheets)
+    else:
+        results = {name: None for name in sheets}
+    pending = [name for name, out in results.items() if out is None]
 
     # --- FASE 2: NORMALIZER (Logica Semantica) ---
-    print("\n🧠 Avvio Fase 2 (Analisi Logica e Normalizzazione)...")
-    
-    excel_obj = upload_file_to_openai(current_file_path)
-    if not excel_obj: return
-
-    # Qui usiamo MODEL_NORMALIZER (gpt-4o) perché serve intelligenza
-    final_result_path = run_assistant_task(
-        "Normalizer", 
-        excel_obj, 
-        PROMPT_NORMALIZER, 
-        model_name=MODEL_NORMALIZER,
-        output_filename=OUTPUT_FILE
-    )
+    # Solo i fogli non classificati, divisi in chunk lungo i confini tra famiglie di codici
+    if pending:
+        chunks = [(name, chunk) for name in pending for chunk in split_sheet_chunks(sheets[name])]
+        print(f"\n🧠 Avvio Fase 2 (Analisi Logica e Normalizzazione): {len(pending)} fogli in {len(chunks)} chunk...")
+        os.makedirs(chunk_dir, exist_ok=True)
+        tasks = [(chunk, os.path.join(chunk_dir, f"chunk_{i:03d}"), f"{label} #{i + 1}/{len(chunks)}")
+                 for i, (_, chunk) in enumerate(chunks)]
+        workers = max(1, min(MAX_CONCURRENT_CHUNKS, len(tasks)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            chunk_outputs = list(pool.map(lambda t: normalize_chunk(*t), tasks))
+
+        failed = [t[2] for t, out in zip(tasks, chunk_outputs) if out is None]
+        if failed:
+            print(f"\n❌ Pipeline fallita: chunk senza output {failed}")
+            return None
+        # Ricomposizione nell'ordine dei chunk
+        for name in pending:
+            results[name] = pd.concat([out for (sheet, _), out in zip(chunks, chunk_outputs) if sheet == name],
+                                      ignore_index=True)
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    # Ricomposizione nell'ordine dei fogli (voci a regole e voci LLM)
+    final_df = pd.concat(list(results.values()), ignore_index=True)
+    final_df = final_df[OUTPUT_COLUMNS + [c for c in final_df.columns if c not in OUTPUT_COLUMNS]]
+    final_df.to_excel(output_file, index=False)
+    n_llm = sum(len(results[name]) for name in pending)
 
     # --- CLEANUP ---
-    print("\n🧹 Pulizia risorse temporanee...")
-    client.files.delete(excel_obj.id)
     if is_temp_file and os.path.exists(current_file_path):
         #os.remove(current_file_path)
-        print(f"   Rimosso file temporaneo: {current_file_path}")
+        print(f"   File temporaneo: {current_file_path}")
 
-    if final_result_path:
-        print(f"\n🏆 SUCCESSO! File pronto: {final_result_path}")
-    else:
-        print("\n❌ Pipeline fallita.")
+    print(f"\n🏆 SUCCESSO! {len(final_df)} voci ({n_llm} dal Normalizer LLM): {output_file}")
+    return output_file
+
+def collect_inputs(paths):
+    """
+    File e cartelle di commessa (es. richieste_ordine/0006-26) -> elenco di file da normalizzare,
+    esclusi i prodotti della pipeline stessa (_clean, _raw_extraction, _temp).
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            base, ext = os.path.splitext(name)
+            if ext.lower() not in INPUT_EXTENSIONS or name.startswith(("~$", ".")):
+                continue
+            if base.endswith(GENERATED_SUFFIXES):
+                continue
+            files.append(os.path.join(path, name))
+    return files
+
+def normalize_files(input_files, max_concurrent=None):
+    """
+    Normalizza più file in parallelo (thread: il tempo è quasi tutto attesa delle run remote).
+    Il rate limiter e la cache degli assistant sono condivisi. Ritorna {input: output | None}.
+    """
+    max_concurrent = max(1, min(max_concurrent or MAX_CONCURRENT_FILES, len(input_files)))
+    if max_concurrent == 1:
+        return {path: main_pipeline(path) for path in input_files}
+    print(f"📦 {len(input_files)} file da normalizzare ({max_concurrent} in parallelo)")
+    with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+        results = dict(zip(input_files, pool.map(main_pipeline, input_files)))
+    for path, result in results.items():
+        print(f"   {'✅' if result else '❌'} {os.path.basename(path)} -> {result or 'FALLITO'}")
+    return results
 
 if __name__ == "__main__":
-    main_pipeline()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Normalizzazione RDO (PDF/Excel -> Excel piatto)")
+    parser.add_argument("inputs", nargs="*",
+                        help="File o cartelle di commessa da normalizzare (Default: INPUT_FILE); l'output è <file>_clean.xlsx")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_FILES,
+                        help="File normalizzati in parallelo")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_MAX_ROWS,
+                        help="Righe per chunk inviato al Normalizer LLM")
+    parser.add_argument("--chunk-concurrency", type=int, default=MAX_CONCURRENT_CHUNKS,
+                        help="Chunk normalizzati in parallelo per file")
+    parser.add_argument("--rpm", type=int, default=ASSISTANTS_RPM,
+                        help="Richieste/minuto all'API Assistants, condivise tra tutti i file")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Disattiva lo streaming delle run (polling con backoff)")
+    parser.add_argument("--remote-digitizer", action="store_true",
+                        help="Estrazione PDF via Assistants code_interpreter invece che in locale")
+    parser.add_argument("--workers", type=int, default=PDF_WORKERS,
+                        help="Processi per l'estrazione locale delle pagine PDF")
+    parser.add_argument("--llm-only", action="store_true",
+                        help="Salta il normalizzatore a regole e invia tutto il file all'Assistant")
+    args = parser.parse_args()
+    LOCAL_DIGITIZER = not args.remote_digitizer
+    RULE_NORMALIZER = not args.llm_only
+    PDF_WORKERS = args.workers
+    USE_STREAMING = not args.no_stream
+    ASSISTANTS_LIMITER = RateLimiter(args.rpm)
+    rule_normalizer.CHUNK_MAX_ROWS = args.chunk_rows
+    MAX_CONCURRENT_CHUNKS = args.chunk_concurrency
+    if args.inputs:
+        normalize_files(collect_inputs(args.inputs), args.concurrency)
+    else:
+        main_pipeline()
\ No newline at end of file
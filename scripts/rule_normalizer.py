@@ -0,0 +1,300 @@
+import re
+import numpy as np
+import pandas as pd
+import fast_reader
+
+# Normalizzatore deterministico dei computi metrici (PATTERN A/B/C di PROMPT_NORMALIZER).
+# Lavora direttamente sul DataFrame grezzo (header=None, dtype=str):
+# - PATTERN A: righe piatte (codice, descrizione, quantità sulla stessa riga);
+# - PATTERN B: voci a misurazioni (righe di misura e riga 'Totale'/'Sommano', o codice ripetuto);
+# - PATTERN C: padre/figli (codice figlio che estende il padre, o sequenziale con descrizione breve).
+# I fogli che le regole non sanno classificare vengono lasciati al normalizzatore LLM.
+
+OUTPUT_COLUMNS = ["CODICE", "DESCRIZIONE", "QUANTITA", "UNITA_MISURA",
+                  "PREZZO_UNITARIO", "PREZZO_MANODOPERA", "METADATI"]
+
+# Etichette di intestazione (prefissi, confronto su testo maiuscolo senza spazi ai bordi).
+# L'ordine conta: 'man' prima di 'price' perché "PREZZO MANODOPERA" inizia per "PREZZO".
+COLUMN_ALIASES = [
+    ("n", ["N.", "N°", "NR", "N"]),
+    ("code", ["CODICE", "COD.", "ARTICOLO", "TARIFFA", "VOCE"]),
+    ("desc", ["DESCRIZIONE", "INDICAZIONE", "DESIGNAZIONE"]),
+    ("um", ["U.M.", "UM", "U.M", "UNITA", "UNITÀ"]),
+    ("qty", ["QUANTIT", "Q.TA", "QTA", "Q.TÀ"]),
+    ("man", ["MANODOPERA", "PREZZO MANODOPERA", "M.O.", "INCIDENZA M"]),
+    ("price", ["PREZZO", "P.U.", "PREZZO UNITARIO"]),
+    ("amount", ["IMPORTO"]),
+]
+HEADER_SCAN_ROWS = 40
+CODE_RE = re.compile(r"^[A-Z]{0,6}\d+[A-Z]?([.\-][\w]+)+$|^[A-Z]+\d+[.\w]*$", re.IGNORECASE)
+TOTAL_RE = r"^\s*(?:totale|sommano|tot\.|a riportare)"
+SHORT_DESC_CHARS = 60       # Figlio PATTERN C: descrizione propria più corta di così (es. "Ø esterno 90 mm")
+MAX_ORPHAN_QTY_SHARE = 0.2  # Quota massima di quantità non attribuibili a una voce
+MIN_AMOUNT_AGREEMENT = 0.8  # Quota minima di voci con QUANTITA * PREZZO ≈ IMPORTO (se verificabile)
+CHUNK_MAX_ROWS = 300        # Righe per chunk inviato al Normalizer LLM (taglio solo tra famiglie di codici)
+
+def to_number(series):
+    """Conversione vettoriale di testo numerico (formato italiano '1.234,56', '€ 12,00')."""
+    s = series.astype("string").str.replace("€", "", regex=False).str.replace(r"\s+", "", regex=True)
+    italian = s.str.contains(",", regex=False, na=False)
+    s = s.where(~italian, s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    return pd.to_numeric(s, errors="coerce")
+
+def detect_header(df):
+    """Riga di intestazione e mappa ruolo -> indice colonna. (None, {}) se non trovata."""
+    for i in range(min(HEADER_SCAN_ROWS, len(df))):
+        labels = [str(v).strip().upper() if pd.notna(v) else "" for v in df.iloc[i]]
+        cols = {}
+        for role, aliases in COLUMN_ALIASES:
+            for j, label in enumerate(labels):
+                if j in cols.values() or not label:
+                    continue
+                if role == "n":
+                    match = label in aliases
+                else:
+                    match = any(label.startswith(a) for a in aliases)
+                if match:
+                    cols[role] = j
+                    break
+        if "desc" in cols and "qty" in cols:
+            return i, cols
+    return None, {}
+
+def infer_code_column(body, cols):
+    """Colonna codici senza etichetta riconoscibile: quella con più valori in formato codice."""
+    best, best_ratio = None, 0.0
+    for j in range(body.shape[1]):
+        if j in cols.values():
+            continue
+        values = body.iloc[:, j].dropna().astype(str).str.strip()
+        if len(values) == 0:
+            continue
+        ratio = values.str.match(CODE_RE).mean()
+        if ratio > best_ratio:
+            best, best_ratio = j, ratio
+    return best if best_ratio >= 0.5 else None
+
+def locate_columns(df):
+    """detect_header + colonna codici dedotta dal contenuto se l'etichetta non è riconoscibile."""
+    header_idx, cols = detect_header(df)
+    if header_idx is not None and "code" not in cols:
+        code_col = infer_code_column(df.iloc[header_idx + 1:], cols)
+        if code_col is not None:
+            cols["code"] = code_col
+    return header_idx, cols
+
+def _common_prefix_remainder(parent, child):
+    """Parte della descrizione figlio successiva alle parole iniziali in comune con il padre."""
+    p, c = parent.split(), child.split()
+    k = 0
+    while k < min(len(p), len(c)) and p[k] == c[k]:
+        k += 1
+    return " ".join(c[k:])
+
+def _code_prefix(code):
+    return code.rsplit(".", 1)[0] if "." in code else ""
+
+def _is_next_code(prev, code):
+    """True se code segue prev nella stessa famiglia (A3.1.15 -> A3.1.16)."""
+    head, _, last = code.rpartition(".")
+    prev_head, _, prev_last = prev.rpartition(".")
+    return bool(head) and head == prev_head and last.isdigit() and prev_last.isdigit() and int(last) == int(prev_last) + 1
+
+def normalize_sheet(df):
+    """
+    Normalizza un foglio grezzo. Ritorna (DataFrame OUTPUT_COLUMNS | None, info):
+    None se il foglio non è classificabile (info["reason"] spiega perché).
+    """
+    info = {"patterns": {"A": 0, "B": 0, "C": 0}, "reason": None}
+    header_idx, cols = locate_columns(df)
+    if header_idx is None:
+        info["reason"] = "intestazione non trovata"
+        return None, info
+    if "code" not in cols:
+        info["reason"] = "colonna codici non trovata"
+        return None, info
+
+    raw = df.iloc[header_idx + 1:].reset_index(drop=True)
+
+    def text(role):
+        if role not in cols:
+            return pd.Series(pd.NA, index=raw.index, dtype="string")
+        s = raw.iloc[:, cols[role]].astype("string").str.strip()
+        return s.mask(s == "")
+
+    b = pd.DataFrame({
+        "n": text("n"), "code": text("code"), "desc": text("desc"), "um": text("um"),
+        "qty": to_number(text("qty")), "price": to_number(text("price")),
+        "man": to_number(text("man")), "amount": to_number(text("amount")),
+    })
+    # Intestazioni ripetute (es. a ogni pagina di un PDF) e righe vuote
+    header_desc = str(df.iloc[header_idx, cols["desc"]]).strip()
+    b = b[(b["desc"] != header_desc).fillna(True)]
+    b = b[b[["code", "desc", "qty", "amount"]].notna().any(axis=1)].reset_index(drop=True)
+    if b.empty:
+        info["reason"] = "nessuna riga dati"
+        return None, info
+
+    # --- Raggruppamento per voce (PATTERN B) ---
+    # Nuova voce su ogni riga con codice diverso dal precedente o con numero d'ordine;
+    # righe senza codice (misure, 'Totale') e righe con lo stesso codice restano nella voce.
+    is_total = b["desc"].str.contains(TOTAL_RE, case=False, regex=True, na=False) & b["code"].isna()
+    prev_code = b["code"].ffill().shift()
+    starts = b["code"].notna() & ((b["code"] != prev_code).fillna(True) | b["n"].notna())
+    b["group"] = starts.cumsum()
+    b["is_total"] = is_total
+    b["is_first"] = starts
+
+    qty_rows = b["qty"].fillna(0) != 0
+    orphan = int((qty_rows & (b["group"] == 0)).sum())
+    b = b[b["group"] > 0]
+
+    first = b[b["is_first"]].set_index("group")
+    totals = b[b["is_total"] & b["qty"].notna()].groupby("group").last()
+    measures = b[~b["is_first"] & ~b["is_total"]]
+    meas_qty = measures.groupby("group")["qty"].sum(min_count=1)
+    meas_n = measures[measures["qty"].fillna(0) != 0].groupby("group").size()
+    first_um = b.groupby("group")["um"].first()
+    first_price = b.groupby("group")["price"].first()
+
+    g = pd.DataFrame({
+        "code": first["code"], "n": first["n"], "desc": first["desc"].fillna(""),
+        "um": first_um, "man": first["man"],
+    })
+    g["total_qty"] = totals["qty"]
+    g["total_price"] = totals["price"]
+    g["total_amount"] = totals["amount"]
+    g["meas_qty"] = meas_qty
+    g["meas_n"] = meas_n.reindex(g.index).fillna(0)
+    # Quantità: riga 'Totale' > quantità sulla riga della voce > somma delle misure
+    g["qty"] = g["total_qty"].fillna(first["qty"]).fillna(g["meas_qty"])
+    g["price"] = g["total_price"].fillna(first["price"]).fillna(first_price)
+    g["amount"] = g["total_amount"].fillna(first["amount"])
+    g["pattern"] = np.where(g["total_qty"].notna() | (g["meas_n"] > 0), "B", "A")
+    g = g.reset_index(drop=True)
+
+    # --- Gerarchia padre/figli (PATTERN C) e metadati di sezione ---
+    is_item = g["qty"].fillna(0) > 0
+    out_desc, metadata, patterns = [], [], []
+    last_header = None           # Ultima voce senza quantità (padre o intestazione di sezione)
+    last_long = {}               # Ultima voce con descrizione lunga per prefisso di codice
+    seq_code = None              # Ultimo codice della catena sequenziale padre -> figli (A3.1.15, .16, ...)
+    for code, desc, item, pattern in zip(g["code"], g["desc"], is_item, g["pattern"]):
+        code = str(code)
+        if not item:
+            last_header = (code, desc)
+            seq_code = code
+            continue
+        parent = None
+        if last_header and code.startswith(last_header[0]):
+            parent = last_header[1]
+        elif seq_code and _is_next_code(seq_code, code) and len(last_header[1]) >= SHORT_DESC_CHARS:
+            # Padre senza quantità con figli sequenziali subito dopo (A3.1.15 -> A3.1.16, A3.1.17)
+            parent = last_header[1]
+        elif _code_prefix(code) in last_long:
+            parent = last_long[_code_prefix(code)]
+        is_child = parent is not None and len(desc) < SHORT_DESC_CHARS
+        seq_code = code if is_child and seq_code and _is_next_code(seq_code, code) else None
+        if is_child:
+            out_desc.append(f"{parent} - {_common_prefix_remainder(parent, desc)}")
+            patterns.append("C")
+        else:
+            out_desc.append(desc)
+            patterns.append(pattern)
+            if len(desc) >= 2 * SHORT_DESC_CHARS:
+                last_long[_code_prefix(code)] = desc
+        section = last_header[1] if last_header and last_header[1] != parent else ""
+        metadata.append(section[:120])
+
+    items = g[is_item].copy()
+    if items.empty:
+        info["reason"] = "nessuna voce con quantità"
+        return None, info
+    items["DESCRIZIONE"] = out_desc
+    items["METADATI"] = metadata
+    items["PATTERN"] = patterns
+
+    # --- Controlli di coerenza: il foglio è davvero classificato? ---
+    qty_total = int(qty_rows.sum())
+    if qty_total and orphan / qty_total > MAX_ORPHAN_QTY_SHARE:
+        info["reason"] = f"{orphan} righe con quantità fuori da qualsiasi voce"
+        return None, info
+    checkable = items["amount"].notna() & items["price"].notna() & (items["amount"] != 0)
+    if checkable.mean() > 0.5:
+        expected = items.loc[checkable, "qty"] * items.loc[checkable, "price"]
+        agreement = ((expected - items.loc[checkable, "amount"]).abs()
+                     <= items.loc[checkable, "amount"].abs() * 0.01 + 0.01).mean()
+        info["amount_agreement"] = round(float(agreement), 3)
+        if agreement < MIN_AMOUNT_AGREEMENT:
+            info["reason"] = f"importi incoerenti (QUANTITA x PREZZO = IMPORTO solo nel {agreement:.0%} delle voci)"
+            return None, info
+
+    for p in info["patterns"]:
+        info["patterns"][p] = int((items["PATTERN"] == p).sum())
+    out = pd.DataFrame({
+        "CODICE": items["code"].values,
+        "DESCRIZIONE": items["DESCRIZIONE"].values,
+        "QUANTITA": items["qty"].astype(float).values,
+        "UNITA_MISURA": items["um"].fillna("").values,
+        "PREZZO_UNITARIO": items["price"].values,
+        "PREZZO_MANODOPERA": items["man"].values,
+        "METADATI": items["METADATI"].values,
+    }, columns=OUTPUT_COLUMNS)
+    return out, info
+
+def read_sheets(path):
+    """Tutti i fogli come testo grezzo (header=None), nell'ordine del file."""
+    return fast_reader.read_sheets(path)
+
+def normalize_sheets(sheets):
+    """Applica le regole a ogni foglio. Ritorna {nome: DataFrame | None (non classificato)}."""
+    results = {}
+    for name, df in sheets.items():
+        out, info = normalize_sheet(df)
+        if out is None:
+            print(f"   ⚠️  Foglio '{name}' non classificato dalle regole: {info['reason']}")
+        else:
+            counts = ", ".join(f"{k}={v}" for k, v in info["patterns"].items() if v)
+            print(f"   📐 Foglio '{name}': {len(out)} voci ({counts})")
+        results[name] = out
+    return results
+
+def normalize_workbook(path):
+    """
+    Applica le regole a tutti i fogli. Ritorna (DataFrame normalizzato, fogli non classificati).
+    Il DataFrame contiene le voci dei fogli classificati nell'ordine dei fogli.
+    """
+    results = normalize_sheets(read_sheets(path))
+    frames = [out for out in results.values() if out is not None]
+    unclassified = [name for name, out in results.items() if out is None]
+    result = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=OUTPUT_COLUMNS)
+    return result, unclassified
+
+def split_sheet_chunks(df, max_rows=None):
+    """
+    Divide un foglio grezzo in chunk per il Normalizer LLM senza spezzare le relazioni padre/figli:
+    si taglia solo prima di una riga con codice di una famiglia diversa (prefisso del codice
+    cambiato e codice che non estende il precedente), così misure, 'Totale' e figli restano
+    con la loro voce. Ogni chunk ripete le righe di intestazione. Una famiglia più lunga di
+    2 * max_rows viene comunque tagliata sulla riga con codice successiva.
+    """
+    max_rows = max_rows or CHUNK_MAX_ROWS
+    header_idx, cols = locate_columns(df)
+    if header_idx is None or "code" not in cols or len(df) - header_idx - 1 <= max_rows:
+        return [df]
+
+    head = df.iloc[:header_idx + 1]
+    codes = df.iloc[header_idx + 1:, cols["code"]].astype("string").str.strip()
+    chunks, start, prev_code = [], header_idx + 1, None
+    for pos, code in zip(range(header_idx + 1, len(df)), codes):
+        if pd.isna(code) or code == "":
+            continue
+        size = pos - start
+        family_change = (prev_code is not None and _code_prefix(code) != _code_prefix(prev_code)
+                         and not code.startswith(prev_code))
+        if (size >= max_rows and family_change) or size >= 2 * max_rows:
+            chunks.append(pd.concat([head, df.iloc[start:pos]]))
+            start = pos
+        prev_code = code
+    chunks.append(pd.concat([head, df.iloc[start:]]))
+    return chunks
@@ -2,11 +2,13 @@ import sqlite3
 import os
 import sys
 import time
+import argparse
+import itertools
 from dotenv import load_dotenv, find_dotenv
 
 # Importiamo il motore di ingestion esistente come libreria
 # Assicurati che bulk_ingestion.py sia nella stessa cartella
-import scripts.bulk_ingestion as engine
+import bulk_ingestion as engine
 
 # --- PATH SETUP ---
 dotenv_path = find_dotenv()
@@ -21,11 +23,16 @@ else:
 OLD_DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v2_bulk.db")
 TARGET_DB_FILE = os.path.join(PROJECT_ROOT, "db", "preventivatore_v3_smart.db")
 
-def setup_target_db_schema():
+# MIGRAZIONE SET-BASED
+MIGRATION_COMMIT_EVERY = 2000   # Ricette legacy per transazione (+ aggiornamento del marker)
+FETCH_ROWS = 5000               # Righe per fetchmany sulla query unica ricette+componenti
+
+def setup_target_db_schema(resume=False):
     """
     Inizializza il DB Target con lo schema V3 completo (Smart Pricing).
+    Con resume=True un DB target esistente viene mantenuto (ripresa dal marker di avanzamento).
     """
-    if os.path.exists(TARGET_DB_FILE):
+    if os.path.exists(TARGET_DB_FILE) and not resume:
         print(f"⚠️  ATTENZIONE: Il DB target esiste già: {TARGET_DB_FILE}")
         confirm = input("    Vuoi sovrascriverlo e perdere i dati contenuti? (y/n): ")
         if confirm.lower() != 'y':
@@ -35,62 +42,152 @@ def setup_target_db_schema():
     
     print("🔨 Inizializzazione Schema V3 (Smart Pricing)...")
     conn = sqlite3.connect(TARGET_DB_FILE)
-    c = conn.cursor()
-    
-    # 1. Recipes (con colonne volatilità)
-    c.execute('''CREATE TABLE recipes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        code TEXT, description TEXT,
-        unit_material_price REAL, unit_manpower_price REAL,
-        source_file TEXT,
-        volatility_index REAL DEFAULT 0.0,
-        is_complex_assembly BOOLEAN DEFAULT 0,
-        confidence_score REAL DEFAULT 0.0,
-        last_price_date DATETIME
-    )''')
-    
-    # 2. Components (con cache prezzi)
-    c.execute('''CREATE TABLE components (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, recipe_id INTEGER,
-        code TEXT, description TEXT, type TEXT, qty_coefficient REAL, 
-        unit_price REAL, last_calculated_at DATETIME,
-        FOREIGN KEY(recipe_id) REFERENCES recipes(id)
-    )''')
-    
-    # 3. Price History (fondamentale per Smart Pricing)
-    c.execute('''CREATE TABLE price_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        component_id INTEGER,
-        raw_price REAL,
-        date DATETIME DEFAULT CURRENT_TIMESTAMP,
-        source_file TEXT,
-        context_tags TEXT,
-        reliability_score REAL DEFAULT 1.0,
-        FOREIGN KEY(component_id) REFERENCES components(id)
-    )''')
 
-    # 4. Ingested Files (Tracking)
-    c.execute('''CREATE TABLE IF NOT EXISTS ingested_files (
-        filename TEXT PRIMARY KEY,
-        file_hash TEXT,
-        import_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-        status TEXT,
-        recipes_count INTEGER
-    )''')
-
-    # 5. Vector Table
+    # Estensione vettoriale necessaria per vec_recipes
     try:
         conn.enable_load_extension(True)
         import sqlite_vec
         sqlite_vec.load(conn)
         conn.enable_load_extension(False)
-        c.execute("CREATE VIRTUAL TABLE vec_recipes USING vec0(embedding float[1536])")
     except Exception as e:
         print(f"⚠️  Warning Estensioni Vettoriali: {e}")
+
+    # Schema unico definito dal motore (recipes, components, price_history,
+    # ingested_files, price_snapshots, vec_recipes)
+    engine.init_db_schema(conn)
+    ensure_progress_schema(conn)
         
     conn.commit()
     conn.close()
 
+def ensure_progress_schema(conn):
+    """Marker di avanzamento: ultima ricetta legacy migrata e fase (load -> recalc -> done)."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS migration_progress (
+        source TEXT PRIMARY KEY,
+        last_legacy_id INTEGER DEFAULT 0,
+        phase TEXT DEFAULT 'load',
+        migrated INTEGER DEFAULT 0,
+        merged INTEGER DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+def _norm_desc(text):
+    return " ".join(str(text or "").lower().split())
+
+def _load_target_state(conn_tgt):
+    """Mappe di deduplica dal DB target (vuote al primo avvio, popolate in ripresa)."""
+    by_desc = {}
+    for rid, desc in conn_tgt.execute("SELECT id, description FROM recipes ORDER BY id"):
+        by_desc.setdefault(_norm_desc(desc), rid)
+    comps = {}
+    for cid, rid, desc in conn_tgt.execute("SELECT id, recipe_id, description FROM components ORDER BY id"):
+        comps.setdefault(rid, []).append((cid, desc or ""))
+    next_rid = (conn_tgt.execute("SELECT MAX(id) FROM recipes").fetchone()[0] or 0) + 1
+    next_cid = (conn_tgt.execute("SELECT MAX(id) FROM components").fetchone()[0] or 0) + 1
+    return by_desc, comps, next_rid, next_cid
+
+def iter_legacy_recipes(conn_src, after_id=0):
+    """Ricette legacy con i loro componenti da un'unica query (LEFT JOIN), lette a blocchi."""
+    cur = conn_src.execute("""
+        SELECT r.id, r.code, r.description, r.source_file,
+               c.description, c.type, c.qty_coefficient, c.unit_price
+        FROM recipes r LEFT JOIN components c ON c.recipe_id = r.id
+        WHERE r.id > ?
+        ORDER BY r.id, c.id
+    """, (after_id,))
+    rows = itertools.chain.from_iterable(iter(lambda: cur.fetchmany(FETCH_ROWS), []))
+    for rid, group in itertools.groupby(rows, key=lambda r: r[0]):
+        group = list(group)
+        _, code, desc, source = group[0][:4]
+        components = [{"desc": g[4], "type": g[5], "qty": g[6], "price": g[7] if g[7] is not None else 0.0}
+                      for g in group if g[4] is not None]
+        yield rid, {"code": code, "desc": desc, "components": components}, source
+
+def migrate_set_based(conn_src, conn_tgt, commit_every=None):
+    """
+    Migrazione set-based: una query unica sul DB legacy, deduplica in memoria per descrizione
+    normalizzata (stessa regola di merge_into_recipe per i componenti), inserimenti con executemany
+    e id assegnati in memoria. Ogni commit salva anche il marker (ultima ricetta legacy): un run
+    interrotto riprende da lì. Prezzi e snapshot sono ricalcolati una sola volta alla fine.
+    """
+    commit_every = commit_every or MIGRATION_COMMIT_EVERY
+    ensure_progress_schema(conn_tgt)
+    conn_tgt.execute("INSERT OR IGNORE INTO migration_progress (source) VALUES (?)", (OLD_DB_FILE,))
+    last_id, phase, migrated, merged = conn_tgt.execute(
+        "SELECT last_legacy_id, phase, migrated, merged FROM migration_progress WHERE source = ?",
+        (OLD_DB_FILE,)).fetchone()
+    stats = {"migrated": migrated, "merged": merged, "errors": 0, "resumed_from": last_id}
+    if last_id:
+        print(f"↩️  Ripresa dalla ricetta legacy {last_id} (fase: {phase})")
+
+    if phase == "load":
+        by_desc, comps, next_rid, next_cid = _load_target_state(conn_tgt)
+        recipes, components, prices = [], [], []
+        pending = 0
+
+        def flush(last_legacy_id):
+            conn_tgt.executemany("INSERT INTO recipes (id, code, description, source_file) VALUES (?,?,?,?)", recipes)
+            conn_tgt.executemany("INSERT INTO components (id, recipe_id, description, type, qty_coefficient, unit_price) "
+                                 "VALUES (?,?,?,?,?,0)", components)
+            conn_tgt.executemany("INSERT INTO price_history (component_id, raw_price, source_file) VALUES (?,?,?)", prices)
+            conn_tgt.execute("UPDATE migration_progress SET last_legacy_id=?, migrated=?, merged=?, updated_at=CURRENT_TIMESTAMP "
+                             "WHERE source=?", (last_legacy_id, stats["migrated"], stats["merged"], OLD_DB_FILE))
+            conn_tgt.commit()
+            recipes.clear(); components.clear(); prices.clear()
+
+        start_time = time.time()
+        for rid_old, data, r_source in iter_legacy_recipes(conn_src, last_id):
+            # Gestione Source File Dinamico
+            source = f"migration_{r_source}" if r_source else "migration_legacy_unknown"
+            key = _norm_desc(data["desc"])
+            rid = by_desc.get(key)
+            if rid is None:
+                # BRANCH (Nuova ricetta)
+                rid = next_rid
+                next_rid += 1
+                by_desc[key] = rid
+                recipes.append((rid, data["code"], data["desc"], source))
+                stats["migrated"] += 1
+            else:
+                # MERGE (duplicato testuale)
+                stats["merged"] += 1
+            existing = comps.setdefault(rid, [])
+            # Match solo sui componenti presenti prima di questa ricetta legacy (come merge_into_recipe):
+            # componenti fratelli con descrizioni sovrapposte ("Cavo" / "Cavo 3x2.5 posa") restano distinti
+            before = list(existing)
+            for c in data["components"]:
+                cid = next((ecid for ecid, edesc in before if c["desc"] in edesc or edesc in c["desc"]), None)
+                if cid is None:
+                    cid = next_cid
+                    next_cid += 1
+                    existing.append((cid, c["desc"]))
+                    components.append((cid, rid, c["desc"], c["type"], c["qty"]))
+                prices.append((cid, c["price"], source))
+
+            pending += 1
+            if pending >= commit_every:
+                flush(rid_old)
+                pending = 0
+                done = stats["migrated"] + stats["merged"]
+                print(f"\r⏳ Progress: {done} | New: {stats['migrated']} | Merged: {stats['merged']} "
+                      f"| {done / (time.time() - start_time):.0f} ricette/s", end="")
+            last_id = rid_old
+        flush(last_id)
+        conn_tgt.execute("UPDATE migration_progress SET phase='recalc' WHERE source=?", (OLD_DB_FILE,))
+        conn_tgt.commit()
+        phase = "recalc"
+
+    if phase == "recalc":
+        # RECALC unico: prezzi, volatilità e snapshot di tutte le ricette migrate
+        print("\n📊 Ricalcolo prezzi e snapshot...")
+        engine.rebuild_price_snapshots(conn_tgt)
+        # Attributi tecnici estratti in blocco (l'insert set-based non passa da insert_new_recipe)
+        for table in engine.tech_attributes.TABLES:
+            engine.tech_attributes.backfill_attributes(conn_tgt, table)
+        conn_tgt.execute("UPDATE migration_progress SET phase='done', updated_at=CURRENT_TIMESTAMP WHERE source=?", (OLD_DB_FILE,))
+        conn_tgt.commit()
+    return stats
+
 def migrate_loop():
     print(f"\n🚀 AVVIO MIGRAZIONE LEGACY")
     print(f"    Sorgente: {OLD_DB_FILE}")
@@ -203,5 +300,37 @@ def migrate_loop():
     print("\n✅ MIGRAZIONE SUCCESSFUL.")
     print(f"    Database pronto: {TARGET_DB_FILE}")
 
+def migrate(resume=False, row_by_row=False, commit_every=None):
+    if row_by_row:
+        return migrate_loop()
+    print(f"\n🚀 AVVIO MIGRAZIONE LEGACY (set-based)")
+    print(f"    Sorgente: {OLD_DB_FILE}")
+    print(f"    Destinazione: {TARGET_DB_FILE}")
+    setup_target_db_schema(resume=resume)
+
+    conn_src = sqlite3.connect(OLD_DB_FILE)
+    engine.DB_FILE = TARGET_DB_FILE
+    conn_tgt = engine.get_db_connection()
+    start_time = time.time()
+    try:
+        stats = migrate_set_based(conn_src, conn_tgt, commit_every=commit_every)
+    finally:
+        conn_src.close()
+        conn_tgt.close()
+    print(f"\n🏁 FASE 1 COMPLETATA ({time.time() - start_time:.1f}s). New: {stats['migrated']} | Merged: {stats['merged']}")
+
+    print("🧠 Generazione Embedding (Batch Async)...")
+    engine.sync_vectors()
+    print("\n✅ MIGRAZIONE SUCCESSFUL.")
+    print(f"    Database pronto: {TARGET_DB_FILE}")
+
 if __name__ == "__main__":
-    migrate_loop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migrazione DB Legacy -> Smart (V3)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Riprende una migrazione interrotta dal marker salvato nel DB target")
+    parser.add_argument("--commit-every", type=int, default=MIGRATION_COMMIT_EVERY,
+                        help="Ricette legacy per transazione")
+    parser.add_argument("--row-by-row", action="store_true",
+                        help="Vecchia migrazione riga per riga (merge_into_recipe + recalc per ricetta)")
+    args = parser.parse_args()
+    migrate(resume=args.resume, row_by_row=args.row_by_row, commit_every=args.commit_every)
\ No newline at end of file
@@ -0,0 +1,213 @@
+import re
+import sqlite3
+
+# Estrattore deterministico degli attributi tecnici dalle descrizioni (RDO, ricette, componenti).
+# Le specifiche scritte in testo libero ("7Gx1,5 mm²", "FG18(O)M16", "0,6/1 kV", "Ø32", "300x100")
+# diventano valori numerici normalizzati (mm, mm², V, A, W) salvati in colonne attr_* indicizzate
+# di recipes e components. Il preventivatore le usa per filtrare e riordinare i candidati prima
+# di qualunque chiamata LLM: le conversioni di unità (120 mm = 12 cm) non passano più da GPT.
+
+ATTRIBUTE_VERSION = 1   # Da incrementare se cambiano le regole: il backfill riestrae le righe vecchie
+ATTRIBUTES = {
+    "cable_code": "TEXT",       # Sigla CEI/CPR del cavo senza parentesi/trattini (FG18OM16)
+    "conductors": "INTEGER",    # Numero di conduttori (7G1,5 -> 7)
+    "section_mm2": "REAL",      # Sezione del conduttore
+    "voltage_v": "REAL",        # Tensione nominale (0,6/1 kV -> 1000)
+    "current_a": "REAL",        # Corrente nominale (10/16A -> 16)
+    "power_w": "REAL",          # Potenza totale (2x36W -> 72)
+    "diameter_mm": "REAL",      # Diametro (Ø32)
+    "size_a_mm": "REAL",        # Dimensione maggiore (300x100 -> 300)
+    "size_b_mm": "REAL",        # Dimensione minore
+    "ip": "INTEGER",            # Grado di protezione (IP65 -> 65)
+}
+# Indici per le ricerche esatte dei candidati (colonne più selettive per prime)
+ATTRIBUTE_INDEXES = [("cable_code", "section_mm2"), ("section_mm2", "conductors"), ("diameter_mm",),
+                     ("current_a",), ("size_a_mm", "size_b_mm")]
+ATTRIBUTE_LABELS = {
+    "cable_code": "sigla {}", "conductors": "{} conduttori", "section_mm2": "sezione {} mm²",
+    "voltage_v": "{} V", "current_a": "{} A", "power_w": "{} W", "diameter_mm": "Ø{} mm",
+    "size_a_mm": "{} mm", "size_b_mm": "{} mm", "ip": "IP{}",
+}
+TABLES = ("recipes", "components")
+REL_TOLERANCE = 1e-3    # Valori normalizzati uguali entro lo 0,1%
+MIN_MATCHES = 2         # Attributi coincidenti minimi per una ricerca/riordino per attributi
+IDENTIFYING_MIN_KEYS = 3   # Decisione senza LLM: sigla del cavo o almeno 3 attributi coincidenti
+BACKFILL_BATCH = 5000
+
+# Sezioni commerciali dei conduttori (mm²): distinguono "3x2,5" (cavo) da "30x10" (dimensioni)
+STANDARD_SECTIONS = {0.5, 0.75, 1.0, 1.5, 2.5, 4.0, 6.0, 10.0, 16.0, 25.0, 35.0, 50.0, 70.0, 95.0,
+                     120.0, 150.0, 185.0, 240.0, 300.0, 400.0, 500.0, 630.0}
+UNIT_MM = {None: 1.0, "mm": 1.0, "cm": 10.0, "m": 1000.0}
+NUM = r"(\d+(?:\.\d+)?)"
+
+CABLE_CODE_RE = re.compile(r"\b(fg\d{2}\(?o\)?[mr]\d{2}|fg\d{2}\(?o\)?r|f[gst]\d{2}|n07v-?k|n1vv-?k|h0[57][a-z]{1,3}-?[fk]|arg7\(?o\)?r|frors?)\b")
+FORMATION_RE = re.compile(rf"\b(\d{{1,3}})\s*(g\s*x?|x)\s*{NUM}\s*(mm2)?(?!\s*x\s*\d)(?![\d.])(?!\s*(?:w|kw|cm|m)\b)")
+SECTION_RE = re.compile(rf"\b{NUM}\s*mm2")
+VOLTAGE_RE = re.compile(rf"\b{NUM}(?:\s*/\s*{NUM})?\s*(kv|v)\b")
+CURRENT_RE = re.compile(rf"(?<![\d.]){NUM}(?:/{NUM})?\s?A\b")   # Case-sensitive: "a" minuscola è una preposizione
+POWER_RE = re.compile(rf"\b(?:(\d{{1,2}})\s*x\s*)?{NUM}\s*(kw|w)\b")
+DIAMETER_RE = re.compile(rf"(?:ø|diametro|diam\.)\s*(?:est\.?\s*|esterno\s*)?=?\s*{NUM}\s*(mm|cm|m)?\b")
+SIZE_RE = re.compile(rf"\b{NUM}\s*x\s*{NUM}(?:\s*x\s*{NUM})?\s*(mm|cm|m)?\b(?!\s*2)")
+IP_RE = re.compile(r"\bip\s?(\d{2})\b")
+
+def _normalize_text(text):
+    """Virgola decimale -> punto, simboli unificati (², mmq, Ø); maiuscole conservate per gli ampere."""
+    s = str(text or "")
+    s = re.sub(r"(\d),(\d)", r"\1.\2", s)
+    s = s.replace("²", "2").replace("Ø", "ø").replace("⌀", "ø").replace("φ", "ø")
+    return re.sub(r"mm\s*q\b|mmq\b", "mm2", s, flags=re.IGNORECASE)
+
+def _num(value):
+    return round(float(value), 4)
+
+def extract_attributes(text):
+    """Attributi tecnici di una descrizione: {nome: valore normalizzato}, solo quelli trovati."""
+    raw = _normalize_text(text)
+    s = raw.lower()
+    attrs = {}
+
+    m = CABLE_CODE_RE.search(s)
+    if m:
+        attrs["cable_code"] = re.sub(r"[()\-]", "", m.group(1)).upper()
+
+    # Formazione del cavo (7G1,5 / 3x2,5 mm²): con "x" solo se la sezione è commerciale
+    for m in FORMATION_RE.finditer(s):
+        n, sep, section, unit = int(m.group(1)), m.group(2), float(m.group(3)), m.group(4)
+        if "g" in sep or unit or (n <= 61 and section in STANDARD_SECTIONS):
+            attrs["conductors"], attrs["section_mm2"] = n, _num(section)
+            s = s[:m.start()] + " " * (m.end() - m.start()) + s[m.end():]   # non è una dimensione
+            break
+    if "section_mm2" not in attrs:
+        m = SECTION_RE.search(s)
+        if m:
+            attrs["section_mm2"] = _num(m.group(1))
+
+    m = VOLTAGE_RE.search(s)
+    if m:
+        volts = max(float(v) for v in m.groups()[:2] if v is not None)
+        attrs["voltage_v"] = _num(volts * (1000 if m.group(3) == "kv" else 1))
+
+    m = CURRENT_RE.search(raw)
+    if m:
+        attrs["current_a"] = _num(max(float(v) for v in m.groups() if v is not None))
+
+    m = POWER_RE.search(s)
+    if m:
+        watts = float(m.group(2)) * (1000 if m.group(3) == "kw" else 1)
+        attrs["power_w"] = _num(watts * int(m.group(1) or 1))
+        s = s[:m.start()] + " " * (m.end() - m.start()) + s[m.end():]
+
+    m = DIAMETER_RE.search(s)
+    if m:
+        attrs["diameter_mm"] = _num(float(m.group(1)) * UNIT_MM[m.group(2)])
+
+    m = SIZE_RE.search(s)
+    if m:
+        factor = UNIT_MM[m.group(4)]
+        dims = sorted((float(v) * factor for v in m.groups()[:3] if v is not None), reverse=True)
+        attrs["size_a_mm"], attrs["size_b_mm"] = _num(dims[0]), _num(dims[1])
+
+    m = IP_RE.search(s)
+    if m:
+        attrs["ip"] = int(m.group(1))
+    return attrs
+
+def column(name):
+    return f"attr_{name}"
+
+def ensure_attribute_schema(conn, tables=TABLES):
+    """Colonne attr_* (+ versione dell'estrattore) e indici su recipes/components (idempotente)."""
+    for table in tables:
+        existing = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        for name, sql_type in list(ATTRIBUTES.items()) + [("version", "INTEGER")]:
+            if column(name) not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column(name)} {sql_type}")
+        for cols in ATTRIBUTE_INDEXES + [("version",)]:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_attr_{'_'.join(cols)} "
+                         f"ON {table}({', '.join(column(c) for c in cols)})")
+
+def _row_values(text):
+    attrs = extract_attributes(text)
+    return [attrs.get(name) for name in ATTRIBUTES] + [ATTRIBUTE_VERSION]
+
+def store_attributes(conn, table, row_id, text):
+    """Estrae e salva gli attributi di una riga (chiamata all'inserimento in ingestion)."""
+    assignments = ", ".join(f"{column(n)} = ?" for n in list(ATTRIBUTES) + ["version"])
+    conn.execute(f"UPDATE {table} SET {assignments} WHERE id = ?", (*_row_values(text), row_id))
+
+def backfill_attributes(conn, table, force=False):
+    """
+    Estrae gli attributi delle righe mai elaborate o con una versione precedente dell'estrattore
+    (force=True: tutte). Aggiornamenti executemany a blocchi. Ritorna il numero di righe.
+    """
+    where = "" if force else f"WHERE {column('version')} IS NULL OR {column('version')} < {ATTRIBUTE_VERSION}"
+    rows = conn.execute(f"SELECT id, description FROM {table} {where}").fetchall()
+    assignments = ", ".join(f"{column(n)} = ?" for n in list(ATTRIBUTES) + ["version"])
+    for i in range(0, len(rows), BACKFILL_BATCH):
+        conn.executemany(f"UPDATE {table} SET {assignments} WHERE id = ?",
+                         [(*_row_values(desc), rid) for rid, desc in rows[i:i + BACKFILL_BATCH]])
+        conn.commit()
+    return len(rows)
+
+def load_attributes(conn, table, ids):
+    """Attributi salvati per id: {id: {nome: valore}}. DB senza colonne attr_* -> {}."""
+    ids = list(ids)
+    if not ids:
+        return {}
+    cols = ", ".join(column(n) for n in ATTRIBUTES)
+    try:
+        rows = conn.execute(f"SELECT id, {cols} FROM {table} WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {r[0]: {n: v for n, v in zip(ATTRIBUTES, r[1:]) if v is not None} for r in rows}
+
+def find_by_attributes(conn, table, attrs, limit=20, min_keys=MIN_MATCHES):
+    """
+    Righe con tutti gli attributi della query uguali (ricerca esatta sugli indici attr_*).
+    Serve almeno min_keys attributi, altrimenti il filtro è troppo poco selettivo.
+    """
+    keys = [n for n in ATTRIBUTES if n in attrs]
+    if len(keys) < min_keys:
+        return []
+    where = " AND ".join(f"{column(n)} = ?" for n in keys)
+    try:
+        return [r[0] for r in conn.execute(f"SELECT id FROM {table} WHERE {where} LIMIT ?",
+                                           [attrs[n] for n in keys] + [limit])]
+    except sqlite3.OperationalError:
+        return []
+
+def _same(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    return abs(a - b) <= REL_TOLERANCE * max(abs(a), abs(b), 1e-9)
+
+def compare_attributes(query, candidate):
+    """(attributi coincidenti, attributi in conflitto) tra la query e un candidato."""
+    matches, conflicts = [], []
+    for name, value in query.items():
+        if name in candidate:
+            (matches if _same(value, candidate[name]) else conflicts).append(name)
+    return matches, conflicts
+
+def rank_candidates(query_attrs, candidates, attrs_by_id, min_matches=MIN_MATCHES):
+    """
+    Annota ogni candidato con il confronto degli attributi e riordina: prima i candidati senza
+    conflitti, tra questi quelli con tutti gli attributi della query coincidenti (exact),
+    poi per similarità. Una specifica diversa (3G2,5 vs 3G1,5) non è mai un equivalente tecnico.
+    """
+    for cand in candidates:
+        matches, conflicts = compare_attributes(query_attrs, attrs_by_id.get(cand["id"], {}))
+        cand["attr_matches"], cand["attr_conflicts"] = matches, conflicts
+        cand["attr_exact"] = not conflicts and len(matches) >= min_matches and len(matches) == len(query_attrs)
+    return sorted(candidates, key=lambda c: (bool(c["attr_conflicts"]), not c["attr_exact"], -c["similarity"]))
+
+def is_identifying(names):
+    """
+    True se gli attributi coincidenti identificano il prodotto: due valori numerici (sezione e
+    conduttori) non bastano, tipo di cavo e classe di reazione al fuoco stanno nella sigla.
+    """
+    return "cable_code" in names or len(names) >= IDENTIFYING_MIN_KEYS
+
+def describe(attrs, names=None):
+    """Testo leggibile degli attributi (note del preventivo)."""
+    return ", ".join(ATTRIBUTE_LABELS[n].format(attrs[n]) for n in (names or attrs) if n in attrs)
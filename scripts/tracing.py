@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+from datetime import datetime
+
+# Tracing leggero per ingestion e preventivatore:
+# - span() misura la durata di uno stage (annidabile, es. quote.row > quote.knn);
+# - count() accumula contatori (chiamate API, token, cache hit, query DB);
+# - report JSON-lines (eventi + riepilogo p50/p95 per stage) ed export Prometheus.
+# Disabilitato (Default) ogni chiamata ritorna subito: span() restituisce un
+# context manager condiviso senza stato, count() esce alla prima istruzione.
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("tracer", "name", "attrs", "start")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._record(self.name, duration, self.attrs)
+        return False
+
+    def set(self, **attrs):
+        """Attributi aggiuntivi dello span (es. esito, numero di candidati)."""
+        self.attrs.update(attrs)
+
+class Tracer:
+    def __init__(self, enabled=False, keep_events=True):
+        self.enabled = enabled
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.durations = {}
+        self.counters = {}
+        self.events = []
+        self.started_at = datetime.now()
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, attrs)
+
+    def count(self, name, value=1):
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds, **attrs):
+        """Registra una durata misurata dal chiamante (per blocchi lunghi, senza reindentare)."""
+        if self.enabled:
+            self._record(name, seconds, attrs)
+
+    def _record(self, name, duration, attrs):
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+            if self.keep_events:
+                event = {"type": "span", "name": name, "ms": round(duration * 1000, 3)}
+                if attrs:
+                    event["attrs"] = attrs
+                self.events.append(event)
+
+    def instrument_connection(self, conn):
+        """Conta le query eseguite su una connessione SQLite (solo se il tracing è attivo)."""
+        if self.enabled:
+            conn.set_trace_callback(lambda _sql: self.count("db_queries"))
+        return conn
+
+    def summary(self):
+        """Statistiche per stage: n, totale, p50/p95/max in millisecondi."""
+        stages = {}
+        with self._lock:
+            items = {k: list(v) for k, v in self.durations.items()}
+            counters = dict(self.counters)
+        for name, values in sorted(items.items()):
+            ms = np.asarray(values) * 1000
+            stages[name] = {
+                "count": len(values),
+                "total_s": round(float(ms.sum()) / 1000, 4),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "max_ms": round(float(ms.max()), 3),
+            }
+        return {"stages": stages, "counters": counters}
+
+    def write_jsonl(self, path, run=None):
+        """Report del run: una riga per span e una riga finale di riepilogo."""
+        summary = self.summary()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for event in self.events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.write(json.dumps({
+                "type": "summary",
+                "run": run or {},
+                "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+                "elapsed_s": round((datetime.now() - self.started_at).total_seconds(), 3),
+                **summary,
+            }, ensure_ascii=False) + "\n")
+        return summary
+
+    def write_prometheus(self, path, prefix="preventivatore"):
+        """Export in formato testo Prometheus (node_exporter textfile collector)."""
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Durata degli stage (quantili del run).",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for name, s in summary["stages"].items():
+            label = _prom_label(name)
+            lines.append(f'{prefix}_stage_seconds{{stage="{label}",quantile="0.5"}} {s["p50_ms"] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_seconds{{stage="{label}",quantile="0.95"}} {s["p95_ms"] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{label}"}} {s["total_s"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{label}"}} {s["count"]}')
+        for name, value in sorted(summary["counters"].items()):
+            metric = f"{prefix}_{_prom_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\n⏱️  {'STAGE':<22}{'N':>7}{'TOT s':>10}{'P50 ms':>10}{'P95 ms':>10}")
+        for name, s in summary["stages"].items():
+            print(f"   {name:<22}{s['count']:>7}{s['total_s']:>10}{s['p50_ms']:>10}{s['p95_ms']:>10}")
+        if summary["counters"]:
+            print("   " + " | ".join(f"{k}: {v}" for k, v in sorted(summary["counters"].items())))
+
+def _prom_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _prom_label(name):
+    return name.replace("\\", "\\\\").replace('"', '\\"')
+
+# Tracer condiviso dal processo (disabilitato finché non si chiama enable_tracing)
+TRACER = Tracer(enabled=False)
+
+def get_tracer():
+    return TRACER
+
+def enable_tracing(keep_events=True):
+    TRACER.enabled = True
+    TRACER.keep_events = keep_events
+    TRACER.reset()
+    return TRACER
+
+def span(name, **attrs):
+    return TRACER.span(name, **attrs)
+
+def count(name, value=1):
+    TRACER.count(name, value)
+
+def observe(name, seconds, **attrs):
+    TRACER.observe(name, seconds, **attrs)
+
+def export_run(jsonl_path=None, prometheus_path=None, run=None):
+    """Scrive i report richiesti da CLI (--trace / --metrics-out) e stampa il riepilogo."""
+    if not TRACER.enabled:
+        return None
+    TRACER.print_summary()
+    if jsonl_path:
+        TRACER.write_jsonl(jsonl_path, run=run)
+        print(f"📝 Report tracing: {jsonl_path}")
+    if prometheus_path:
+        TRACER.write_prometheus(prometheus_path)
+        print(f"📊 Metriche Prometheus: {prometheus_path}")
+    return TRACER.summary()
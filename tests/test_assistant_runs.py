@@ -0,0 +1,84 @@
+import unittest
+import os
+import sys
+import shutil
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import normalize_input as ni
+
+TEST_DIR = "test_env_assistants"
+
+class FakeRuns:
+    """Run che resta in coda/in esecuzione per un certo numero di retrieve (nessuno streaming)."""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.retrieves = 0
+
+    def create(self, thread_id, assistant_id):
+        return SimpleNamespace(id="run_1", status="queued")
+
+    def retrieve(self, thread_id, run_id):
+        self.retrieves += 1
+        return SimpleNamespace(id=run_id, status=self.statuses.pop(0))
+
+class FakeAssistants:
+    def __init__(self):
+        self.created = 0
+
+    def create(self, **kwargs):
+        self.created += 1
+        return SimpleNamespace(id=f"asst_{self.created}")
+
+    def retrieve(self, assistant_id):
+        return SimpleNamespace(id=assistant_id)
+
+class TestAssistantRuns(unittest.TestCase):
+    """Polling adattivo e riuso degli assistant del normalizzatore remoto."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.runs = FakeRuns(["queued"] * 2 + ["in_progress"] * 6 + ["completed"])
+        self.assistants = FakeAssistants()
+        fake_client = SimpleNamespace(beta=SimpleNamespace(
+            assistants=self.assistants, threads=SimpleNamespace(runs=self.runs)))
+        self.patches = [
+            patch.object(ni, "client", fake_client),
+            patch.object(ni, "ASSISTANT_CACHE_FILE", os.path.join(TEST_DIR, "assistants.json")),
+            patch.object(ni, "ASSISTANTS_LIMITER", ni.RateLimiter(0)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_backoff_polling(self):
+        print("\n🧪 TEST: Polling con backoff esponenziale (senza streaming)")
+        with patch.object(ni.time, "sleep") as sleep:
+            run = ni.wait_for_run("thread_1", "asst_1", "test")
+        self.assertEqual(run.status, "completed")
+        self.assertEqual(self.runs.retrieves, 9)
+        delays = [c.args[0] for c in sleep.call_args_list]
+        # Il ritardo cresce finché lo stato non cambia e si riazzera al cambio di stato
+        self.assertGreater(delays[1], delays[0])
+        self.assertEqual(delays[3], ni.POLL_INITIAL_S)
+        self.assertLessEqual(max(delays), ni.POLL_MAX_S)
+
+    def test_assistant_cache(self):
+        first = ni.get_or_create_assistant("Normalizer", "prompt", "gpt-4o")
+        again = ni.get_or_create_assistant("Normalizer", "prompt", "gpt-4o")
+        other = ni.get_or_create_assistant("Normalizer", "prompt v2", "gpt-4o")
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertEqual(self.assistants.created, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import os
+import sys
+import shutil
+import pandas as pd
+from datetime import datetime
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import backtest_pricing
+import fast_reader
+from llm_provider import OfflineProvider, get_provider, set_provider
+
+# --- CONFIGURAZIONE TEST ---
+TEST_DIR = "test_env_backtest"
+TEST_INPUT_DIR = os.path.join(TEST_DIR, "data")
+REPLAY_DB = os.path.join(TEST_DIR, "backtest", "replay.db")
+
+class TestBacktestPricing(unittest.TestCase):
+    """Back-test offline: ordinamento delle offerte, replay cronologico e scoring as-of."""
+
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        os.makedirs(TEST_INPUT_DIR)
+        self.previous = get_provider()
+        set_provider(OfflineProvider())
+        # replay_archive e i worker cambiano i globali del motore: ripristinati a fine test
+        self.patches = [patch.object(bulk_ingestion, key, getattr(bulk_ingestion, key))
+                        for key in ["DB_FILE", *backtest_pricing.GRID_PARAMS]]
+        self.patches.append(patch.object(fast_reader, "CACHE_ENABLED", False))
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        set_provider(self.previous)
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def _create_offer(self, filename, desc, price):
+        """Offerta V5 minima: una voce con un componente materiale."""
+        head = [None] * 20
+        head[0] = "ART_TEST"; head[1] = desc
+        comp = [None] * 20
+        comp[1] = desc; comp[3] = 1.0; comp[8] = price
+        foot = [None] * 20
+        foot[14] = price
+        path = os.path.join(TEST_INPUT_DIR, filename)
+        pd.DataFrame([head, comp, foot, foot]).to_excel(path, index=False, header=False)
+        return path
+
+    def test_infer_offer_dates(self):
+        """Date dal codice NNNN-YY (revisioni dopo l'originale), override espliciti, file senza codice esclusi."""
+        print("\n🧪 TEST: Ordinamento cronologico delle offerte")
+        files = [os.path.join(TEST_INPUT_DIR, name) for name in
+                 ["0008-24R1FS Quadro.xlsx", "0100-23 Impianto.xlsx", "0008-24 Quadro.xlsx",
+                  "0002-24.xlsx", "listino.xlsx", "speciale.xlsx"]]
+        dated = backtest_pricing.infer_offer_dates(files, {"speciale.xlsx": "2023-06-15"})
+        names = [os.path.basename(path) for path, _ in dated]
+
+        self.assertEqual(names, ["speciale.xlsx", "0100-23 Impianto.xlsx", "0002-24.xlsx",
+                                 "0008-24 Quadro.xlsx", "0008-24R1FS Quadro.xlsx"])
+        dates = dict(zip(names, (d for _, d in dated)))
+        self.assertEqual(dates["speciale.xlsx"], datetime(2023, 6, 15, 12))
+        self.assertEqual(dates["0100-23 Impianto.xlsx"], datetime(2023, 7, 2, 12))   # unica del 2023: metà anno
+        self.assertLess(dates["0008-24 Quadro.xlsx"], dates["0008-24R1FS Quadro.xlsx"])
+        self.assertNotIn("listino.xlsx", names)
+
+    def test_build_grid_casting(self):
+        """Valori della griglia convertiti al tipo del parametro del motore."""
+        print("\n🧪 TEST: Griglia parametri del backtest")
+        grid = backtest_pricing.build_grid(["deviation_threshold=0.1,0.3", "STALENESS_DAYS=90, 365,"])
+        self.assertEqual(len(grid), 4)
+        self.assertEqual(grid[0], {"DEVIATION_THRESHOLD": 0.1, "STALENESS_DAYS": 90})
+        self.assertEqual({type(g["DEVIATION_THRESHOLD"]) for g in grid}, {float})
+        self.assertEqual({type(g["STALENESS_DAYS"]) for g in grid}, {int})
+        self.assertEqual(sorted({g["STALENESS_DAYS"] for g in grid}), [90, 365])
+
+        # Senza --grid: una sola combinazione con i valori correnti del motore
+        self.assertEqual(backtest_pricing.build_grid(None),
+                         [{key: getattr(bulk_ingestion, key) for key in backtest_pricing.GRID_PARAMS}])
+        with self.assertRaises(ValueError):
+            backtest_pricing.build_grid(["SIMILARITY_MERGE=0.9"])
+
+    @patch('bulk_ingestion.find_semantic_match')
+    def test_replay_and_score_strictly_earlier(self, mock_find):
+        """Ogni offerta è prezzata solo con lo storico strettamente precedente, mai col proprio prezzo."""
+        print("\n🧪 TEST: Replay cronologico e scoring as-of del backtest")
+        # Senza sqlite-vec la KNN è simulata: 1a offerta nuova, 2a unita sulla ricetta 1
+        mock_find.side_effect = [(None, None, 0.0), (None, None, 0.0), (1, "Quadro", 0.99), (1, "Quadro", 0.99)]
+        files = [self._create_offer("0001-24 Quadro.xlsx", "Quadro", 200.0),
+                 self._create_offer("0001-23 Quadro.xlsx", "Quadro", 100.0)]
+
+        dated = backtest_pricing.infer_offer_dates(files)
+        stats = backtest_pricing.replay_archive(dated, REPLAY_DB)
+        self.assertEqual((stats["files"], stats["items"], stats["matched"]), (2, 2, 1))
+
+        result = backtest_pricing.score_parameters((REPLAY_DB, backtest_pricing.build_grid(None)[0]))
+        self.assertEqual(result["priced"], 1)
+        latest = result["strategies"]["LATEST"]["MAT"]
+        # Prezzo 2023 (100) contro reale 2024 (200): il prezzo del giorno dell'offerta è escluso
+        self.assertEqual(latest["n"], 1)
+        self.assertAlmostEqual(latest["bias"], -0.5)
+
+if __name__ == '__main__':
+    unittest.main()
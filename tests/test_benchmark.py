@@ -0,0 +1,69 @@
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+from argparse import Namespace
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import benchmark
+import generate_quote
+from llm_provider import OfflineProvider, get_provider, set_provider
+
+TEST_DIR = "test_env_benchmark"
+
+def connect_with_plain_vec(db_path):
+    """Come connect_bench_db, con vec_recipes come tabella normale (sqlite-vec non caricabile nei test)."""
+    bulk_ingestion.DB_FILE = db_path
+    conn = bulk_ingestion.get_db_connection()
+    bulk_ingestion.init_db_schema(conn)
+    conn.execute("CREATE TABLE IF NOT EXISTS vec_recipes (rowid INTEGER PRIMARY KEY, embedding BLOB, distance REAL)")
+    return conn
+
+class TestBenchmark(unittest.TestCase):
+    """Smoke test degli stage del benchmark sul provider offline."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.previous = get_provider()
+        set_provider(OfflineProvider())
+        self.db_patch = patch.object(bulk_ingestion, "DB_FILE", bulk_ingestion.DB_FILE)
+        self.db_patch.start()
+        conn = connect_with_plain_vec(benchmark.bench_db_path(TEST_DIR))
+        conn.executemany("INSERT INTO recipes (id, description) VALUES (?,?)",
+                         [(1, "Cavo FG16OM16 3G2,5"), (2, "Presa 10A"), (3, "Quadro IP65")])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        set_provider(self.previous)
+        self.db_patch.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_stage_search(self):
+        print("\n🧪 TEST: Stage search del benchmark (embedding nello spazio attivo)")
+        args = Namespace(work_dir=TEST_DIR, sizes=[5], queries=4)
+        embedded = []
+        offline_embed = OfflineProvider.embed
+        def spy(provider, texts, model, dimensions=None):
+            embedded.append(dimensions)
+            return offline_embed(provider, texts, model, dimensions)
+        # Senza sqlite-vec la KNN fallisce e la ricerca ritorna []: si verifica che lo stage arrivi in fondo
+        with patch.object(benchmark, "connect_bench_db", side_effect=connect_with_plain_vec), \
+             patch("generate_quote.get_db_connection", side_effect=lambda: sqlite3.connect(generate_quote.DB_FILE)), \
+             patch.object(OfflineProvider, "embed", spy), \
+             patch.object(generate_quote, "DB_FILE", generate_quote.DB_FILE):
+            result = benchmark.run_stage("search", args)
+        self.assertEqual(result["status"], "ok", result.get("error"))
+        self.assertEqual(result["by_size"]["5"]["queries"], 4)
+        self.assertEqual(result["rows"], 4)
+        self.assertEqual(set(embedded), {bulk_ingestion.EMBEDDING_DIM})   # query nella dimensione dello spazio
+
+if __name__ == '__main__':
+    unittest.main()
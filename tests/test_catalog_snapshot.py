@@ -0,0 +1,102 @@
+import unittest
+import os
+import sys
+import shutil
+import struct
+import numpy as np
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import generate_quote
+import catalog_snapshot
+import tech_attributes
+
+TEST_DIR = "test_env_snapshot"
+DIM = 8
+
+class TestCatalogSnapshot(unittest.TestCase):
+    """Export colonnare + mmap: stessi candidati e prezzi della ricerca sul DB."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.db_patch = patch.object(bulk_ingestion, "DB_FILE", os.path.join(TEST_DIR, "catalog.db"))
+        self.db_patch.start()
+        bulk_ingestion.init_db()
+        conn = bulk_ingestion.get_db_connection()
+        conn.execute("DROP TABLE IF EXISTS vec_recipes")
+        conn.execute("CREATE TABLE vec_recipes (rowid INTEGER PRIMARY KEY, embedding BLOB, distance REAL)")
+        rng = np.random.default_rng(7)
+        self.vectors = rng.normal(size=(40, DIM)).astype(np.float32)
+        for k, vec in enumerate(self.vectors):
+            rid = bulk_ingestion.insert_new_recipe(conn, {"code": f"R{k}", "desc": f"Linea FG16OM16 3G{[1.5, 2.5][k % 2]} n.{k}",
+                                                          "components": [{"desc": "Cavo", "type": "MAT", "qty": 1.0, "price": 1.0 + k}]},
+                                                   "offerta.xlsx")
+            conn.execute("INSERT INTO vec_recipes (rowid, embedding) VALUES (?,?)", (rid, struct.pack(f"<{DIM}f", *vec)))
+        bulk_ingestion.rebuild_price_snapshots(conn)
+        conn.commit()
+        self.conn = conn
+        self.out = os.path.join(TEST_DIR, "snapshot")
+
+    def tearDown(self):
+        self.conn.close()
+        self.db_patch.stop()
+        catalog_snapshot._SNAPSHOTS.clear()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_export_and_search(self):
+        print("\n🧪 TEST: Snapshot del catalogo (export, mmap, KNN e prezzi)")
+        manifest = catalog_snapshot.export_snapshot(self.conn, out_dir=self.out)
+        self.assertEqual((manifest["rows"], manifest["dim"], manifest["format"]), (40, DIM, catalog_snapshot.SNAPSHOT_FORMAT))
+        self.assertFalse(catalog_snapshot.is_stale(self.conn, manifest))
+
+        snapshot = catalog_snapshot.CatalogSnapshot(self.out)
+        self.assertIsInstance(snapshot.embeddings, np.memmap)
+        query = self.vectors[3] + 0.01
+        with patch.object(catalog_snapshot, "SEARCH_BLOCK", 16):   # più blocchi: top-k fuso tra i blocchi
+            found = snapshot.search(query, 5, "MAX")
+        dist = np.linalg.norm(self.vectors - query, axis=1)
+        self.assertEqual([c["id"] for c in found], [int(i) + 1 for i in np.argsort(dist)[:5]])
+        self.assertAlmostEqual(found[0]["similarity"], 1 / (1 + dist[3]), places=5)
+        self.assertEqual((found[0]["code"], found[0]["price_mat"]), ("R3", 4.0))
+
+        attrs = tech_attributes.extract_attributes("Cavo FG16OM16 3x2,5")
+        self.assertEqual(snapshot.find_by_attributes(attrs, limit=100),
+                         tech_attributes.find_by_attributes(self.conn, "recipes", attrs, limit=100))
+        self.assertEqual(snapshot.load_attributes([2]), tech_attributes.load_attributes(self.conn, "recipes", [2]))
+        self.assertEqual(manifest["categories"]["cable_code"], ["FG16OM16"])   # sigla come categoria int32
+        self.assertEqual(snapshot._column("attr_cable_code.codes").dtype, np.int32)
+        other = dict(attrs, cable_code="FG18OM16")   # sigla assente dal dizionario
+        self.assertEqual(snapshot.find_by_attributes(other), [])
+        self.assertEqual(snapshot.find_by_attributes(other), tech_attributes.find_by_attributes(self.conn, "recipes", other))
+
+        # float16: metà spazio, stesso ordinamento dei vicini
+        catalog_snapshot.export_snapshot(self.conn, out_dir=self.out, dtype="float16")
+        half = catalog_snapshot.CatalogSnapshot(self.out)
+        self.assertEqual(half.embeddings.dtype, np.float16)
+        self.assertEqual([c["id"] for c in half.search(query, 5, "MAX")], [c["id"] for c in found])
+
+        # Nuovi prezzi dopo l'export -> snapshot da rigenerare
+        bulk_ingestion.insert_price(self.conn, 1, 9.0, "listino.xlsx")
+        self.assertTrue(catalog_snapshot.is_stale(self.conn, manifest))
+
+    def test_quote_search_from_snapshot(self):
+        print("\n🧪 TEST: Preventivo con --catalog (nessuna connessione al DB)")
+        catalog_snapshot.export_snapshot(self.conn, out_dir=self.out)
+        query = self.vectors[6]   # ricetta 7: sezione 1,5 mm² -> in conflitto con la riga RDO
+        with patch.object(generate_quote, "CATALOG_SNAPSHOT", self.out), \
+             patch.object(generate_quote, "PRICING_STRATEGY", "LATEST"), \
+             patch("generate_quote.get_embedding", return_value=query.tolist()), \
+             patch("generate_quote.get_db_connection", side_effect=AssertionError("DB non atteso")):
+            candidates = generate_quote.search_similar_candidates("Cavo FG16OM16 3x2,5 mm²", limit=3)
+        self.assertEqual(len(candidates), 3)
+        self.assertTrue(candidates[0]["attr_exact"])
+        self.assertEqual(candidates[0]["attributes"]["section_mm2"], 2.5)
+        self.assertNotIn(7, [c["id"] for c in candidates[:1]])
+
+if __name__ == '__main__':
+    unittest.main()
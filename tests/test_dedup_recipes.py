@@ -0,0 +1,101 @@
+import unittest
+import os
+import sys
+import shutil
+import struct
+import numpy as np
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import dedup_recipes
+
+TEST_DIR = "test_env_dedup"
+RECIPES = [
+    # (id, descrizione, vettore, [(componente, prezzo)])
+    (1, "Presa 10/16A", [1.0, 0.0, 0.0], [("Presa bipasso", 5.0), ("Scatola", 1.0)]),
+    (2, "Presa 10/16 A", [1.0, 0.01, 0.0], [("Presa bipasso", 6.0), ("Placca", 2.0)]),
+    (3, "Presa 10/16A bianca", [1.0, 0.025, 0.0], [("Presa bipasso", 5.5)]),   # vicina a 2, non alla canonica
+    (4, "Canale 300x100", [0.0, 1.0, 0.0], [("Canale zincato", 20.0)]),
+]
+
+class TestRecipeDedup(unittest.TestCase):
+    """Cluster su vec_recipes, fusione nella canonica e ripresa del piano interrotto."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.db_patch = patch.object(bulk_ingestion, "DB_FILE", os.path.join(TEST_DIR, "catalog.db"))
+        self.db_patch.start()
+        bulk_ingestion.init_db()
+        conn = bulk_ingestion.get_db_connection()
+        conn.execute("DROP TABLE IF EXISTS vec_recipes")
+        conn.execute("CREATE TABLE vec_recipes (rowid INTEGER PRIMARY KEY, embedding BLOB, distance REAL)")
+        for rid, desc, vec, comps in RECIPES:
+            conn.execute("INSERT INTO recipes (id, description) VALUES (?,?)", (rid, desc))
+            conn.execute("INSERT INTO vec_recipes (rowid, embedding) VALUES (?,?)", (rid, struct.pack("<3f", *vec)))
+            for cdesc, price in comps:
+                cid = conn.execute("INSERT INTO components (recipe_id, description, type, qty_coefficient) VALUES (?,?,'MAT',1.0)",
+                                   (rid, cdesc)).lastrowid
+                bulk_ingestion.insert_price(conn, cid, price, "offerta.xlsx")
+        bulk_ingestion.insert_price(conn, 1, 5.2, "listino.xlsx")   # la ricetta 1 ha più storico: è la canonica
+        conn.commit()
+        self.conn = conn
+
+    def tearDown(self):
+        self.conn.close()
+        self.db_patch.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_all_pairs_blocked(self):
+        _, matrix = dedup_recipes.load_recipe_vectors(self.conn)
+        i, j, sims = dedup_recipes.all_pairs(matrix, 0.95, block=2, workers=2)
+        self.assertEqual(sorted(zip(i.tolist(), j.tolist())), [(0, 1), (0, 2), (1, 2)])
+        self.assertEqual(len(dedup_recipes.cluster_pairs(4, i, j, sims, 0.98)), 1)
+
+        # Blocchi anche sulle colonne: stesse coppie e similarità
+        bi, bj, bsims = dedup_recipes.all_pairs(matrix, 0.95, block=1, workers=3, col_block=2)
+        self.assertEqual(sorted(zip(bi.tolist(), bj.tolist(), np.round(bsims, 6).tolist())),
+                         sorted(zip(i.tolist(), j.tolist(), np.round(sims, 6).tolist())))
+
+        # Budget di memoria: colonne per blocco e worker ridotti, mai sotto 1
+        self.assertEqual(dedup_recipes.block_budget(4, 1024, 16384, 64, 2048), (16384, 14))
+        self.assertEqual(dedup_recipes.block_budget(4, 1024, 16384, 64, 64), (7281, 1))
+
+    def test_resumable_merge(self):
+        print("\n🧪 TEST: Deduplica catalogo (cluster, fusione, ripresa)")
+        n_prices = self.conn.execute("SELECT COUNT(*) FROM price_history").fetchone()[0]
+        report = dedup_recipes.dedup_catalog(self.conn, threshold=0.98, thresholds=[0.95], dry_run=True)
+        self.assertEqual(report["clusters"], {0.95: 1, 0.98: 1})
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM recipes").fetchone()[0], 4)
+
+        # Interruzione dopo il piano: nessuna fusione applicata
+        with patch.object(dedup_recipes, "merge_recipe", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                dedup_recipes.dedup_catalog(self.conn, threshold=0.98)
+        self.conn.rollback()
+        planned = self.conn.execute("SELECT merged_id, canonical_id, status FROM recipe_merges ORDER BY merged_id").fetchall()
+        self.assertEqual(planned, [(2, 1, "planned")])   # 3 resta: catena del cluster, sotto soglia con la canonica
+
+        report = dedup_recipes.dedup_catalog(self.conn, threshold=0.98)
+        self.assertTrue(report["resumed"])
+        self.assertEqual((report["merged"], report["canonicals"]), (1, 1))
+
+        recipes = [r[0] for r in self.conn.execute("SELECT id FROM recipes ORDER BY id")]
+        comps = self.conn.execute("SELECT description FROM components WHERE recipe_id = 1 ORDER BY id").fetchall()
+        presa = self.conn.execute("SELECT COUNT(*) FROM price_history ph JOIN components c ON c.id = ph.component_id "
+                                  "WHERE c.recipe_id = 1 AND c.description = 'Presa bipasso'").fetchone()[0]
+        self.assertEqual(recipes, [1, 3, 4])
+        self.assertEqual([c[0] for c in comps], ["Presa bipasso", "Scatola", "Placca"])
+        self.assertEqual(presa, 3)   # storico di entrambe le ricette sullo stesso componente
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM price_history").fetchone()[0], n_prices)
+        self.assertIsNone(self.conn.execute("SELECT 1 FROM vec_recipes WHERE rowid = 2").fetchone())
+        self.assertAlmostEqual(self.conn.execute("SELECT unit_material_price FROM recipes WHERE id = 1").fetchone()[0],
+                               (5.0 + 6.0 + 5.2) / 3 + 1.0 + 2.0)
+        audit = self.conn.execute("SELECT status, merged_desc FROM recipe_merges WHERE merged_id = 2").fetchone()
+        self.assertEqual(audit, ("done", "Presa 10/16 A"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import sys
+import shutil
+import zipfile
+import pandas as pd
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import fast_reader
+
+TEST_DIR = "test_env_reader"
+
+class TestFastReader(unittest.TestCase):
+    """Lettura per colonne (posizioni IDX conservate) e cache dei frame per hash del file."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.cache_patch = patch.object(fast_reader, "CACHE_DIR", os.path.join(TEST_DIR, "cache"))
+        self.cache_patch.start()
+        self.path = os.path.join(TEST_DIR, "listino.xlsx")
+        rows = [[f"r{r}c{c}" for c in range(16)] for r in range(5)]
+        pd.DataFrame(rows).to_excel(self.path, index=False, header=False)
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_usecols_keep_positions(self):
+        df = fast_reader.read_table(self.path, usecols=[14, 0, 3], cache=False)
+        self.assertEqual(df.shape, (5, 15))
+        row = next(df.itertuples(index=False, name=None))
+        self.assertEqual((row[0], row[3], row[14]), ("r0c0", "r0c3", "r0c14"))
+        self.assertTrue(pd.isna(row[1]))
+
+    def test_cache_by_content_hash(self):
+        print("\n🧪 TEST: Cache dei frame letti (hash del contenuto)")
+        first = fast_reader.read_table(self.path, usecols=[0, 1])
+        with patch.object(fast_reader, "_parse", side_effect=AssertionError("Excel riletto")):
+            cached = fast_reader.read_table(self.path, usecols=[0, 1])
+        self.assertTrue(first.equals(cached))
+
+        # Contenuto modificato -> nuova chiave, il file viene riletto
+        pd.DataFrame([["nuovo", "valore"]]).to_excel(self.path, index=False, header=False)
+        fresh = fast_reader.read_table(self.path, usecols=[0, 1])
+        self.assertEqual(fresh.iloc[0, 0], "nuovo")
+
+    def test_iter_rows_matches_read_table(self):
+        print("\n🧪 TEST: iter_rows e read_table danno lo stesso testo per un CODICE numerico")
+        path = os.path.join(TEST_DIR, "rdo.xlsx")
+        pd.DataFrame([["CODICE", "DESCRIZIONE", "QUANTITA"], [12, "Cavo", 2.5], [7, "Presa", 3]]).to_excel(
+            path, index=False, header=False)
+        # Altri esportatori salvano gli interi come "12.0": openpyxl li legge come float
+        with zipfile.ZipFile(path) as src:
+            files = {name: src.read(name) for name in src.namelist()}
+        sheet = "xl/worksheets/sheet1.xml"
+        files[sheet] = files[sheet].replace(b'r="A2"><v>12</v>', b'r="A2"><v>12.0</v>').replace(
+            b'r="C3"><v>3</v>', b'r="C3"><v>3.0</v>')
+        with zipfile.ZipFile(path, "w") as out:
+            for name, data in files.items():
+                out.writestr(name, data)
+
+        lazy = list(fast_reader.iter_rows(path))
+        table = [tuple(None if pd.isna(v) else v for v in row)
+                 for row in fast_reader.read_table(path, cache=False).itertuples(index=False, name=None)]
+        self.assertEqual(lazy, table)
+        self.assertEqual((lazy[1][0], lazy[2][2]), ("12", "3"))
+
+    def test_csv_and_sheets(self):
+        csv_path = os.path.join(TEST_DIR, "rdo.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write("CODICE,DESCRIZIONE\nA1,Cavo\n")
+        sheets = fast_reader.read_sheets(csv_path)
+        self.assertEqual(list(sheets), ["csv"])
+        self.assertEqual(sheets["csv"].iloc[1, 1], "Cavo")
+        self.assertEqual(list(fast_reader.read_sheets(self.path)), ["Sheet1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import hashlib
+import numpy as np
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+from llm_provider import OfflineProvider, RateLimiter, get_provider, set_provider
+from llm_cache import LLMCache, text_hash
+
+TEST_DIR = "test_env_llm_cache"
+
+class TestOfflineProvider(unittest.TestCase):
+    """
+    Test dello stand-in offline usato da benchmark e CI:
+    1. Embedding deterministici e semanticamente ordinati
+    2. Risposte judge/validator (script ed euristica)
+    3. Contatori e latenza simulata
+    """
+
+    def setUp(self):
+        self.provider = OfflineProvider(dim=256)
+
+    def test_embeddings_deterministic_and_ordered(self):
+        print("\n🧪 TEST: Embedding offline deterministici")
+        texts = ["Cavo FG16OR16 3x1.5 mmq", "Cavo FG16OR16 3x2.5 mmq", "Quadro elettrico da parete IP65"]
+        a = np.array(self.provider.embed(texts, "text-embedding-3-small"))
+        b = np.array(OfflineProvider(dim=256).embed(texts, "text-embedding-3-small"))
+
+        np.testing.assert_array_equal(a, b)
+        self.assertEqual(a.shape, (3, 256))
+        np.testing.assert_allclose(np.linalg.norm(a, axis=1), 1.0, rtol=1e-5)
+        # I due cavi sono più vicini tra loro che al quadro
+        self.assertGreater(a[0] @ a[1], a[0] @ a[2])
+
+    def test_judge_heuristic_and_script(self):
+        print("\n🧪 TEST: Judge offline (euristica + script)")
+        msgs = [{"role": "user", "content": "prompt judge"}]
+        data, _ = self.provider.chat_json(msgs, "gpt-4o-mini", task="judge",
+                                          context={"existing": "Presa 10A bianca", "new": "Presa 10A bianca"})
+        self.assertTrue(data["is_merge"])
+        data, _ = self.provider.chat_json(msgs, "gpt-4o-mini", task="judge",
+                                          context={"existing": "Presa 10A bianca", "new": "Quadro IP65 metallico"})
+        self.assertFalse(data["is_merge"])
+
+        # Una risposta a script (per hash del prompt) ha la precedenza sull'euristica
+        key = hashlib.sha1("prompt judge".encode("utf-8")).hexdigest()
+        scripted = OfflineProvider(script={"answers": {key: {"is_merge": True, "reason": "script"}}})
+        data, _ = scripted.chat_json(msgs, "gpt-4o-mini", task="judge",
+                                     context={"existing": "A", "new": "B"})
+        self.assertEqual(data["reason"], "script")
+
+    def test_validate_heuristic(self):
+        print("\n🧪 TEST: Validator offline")
+        data, _ = self.provider.chat_json(
+            [{"role": "user", "content": "x"}], "gpt-4o", task="validate",
+            context={"rdo": "Cavo FG16OR16 3x1.5", "options": ["Quadro IP65", "Cavo FG16OR16 3x1.5"]})
+        self.assertEqual(data["selected_index"], 2)
+        self.assertEqual(data["status"], "OK")
+
+    def test_stats_and_latency(self):
+        print("\n🧪 TEST: Contatori e latenza simulata")
+        slow = OfflineProvider(latency_ms=20, dim=32)
+        start = time.monotonic()
+        slow.embed(["a", "b"], "m")
+        slow.chat_json([{"role": "user", "content": "ciao"}], "gpt-4o-mini", task="judge")
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(slow.stats["embedding_calls"], 1)
+        self.assertEqual(slow.stats["embedding_inputs"], 2)
+        self.assertEqual(slow.stats["chat_calls"], 1)
+
+    def test_rate_limiter_blocks(self):
+        limiter = RateLimiter(per_minute=600)  # 10/s, bucket da 600 token
+        limiter.tokens = 0.0
+        self.assertGreater(limiter.acquire(), 0.0)
+
+        # Acquisizione pesata (testi di un batch): oltre la capacità resta un debito
+        weighted = RateLimiter(per_minute=6000)   # 100/s
+        self.assertEqual(weighted.acquire(6000), 0.0)
+        self.assertAlmostEqual(weighted.tokens, 0.0, delta=1.0)
+        weighted.tokens = -5.0
+        start = time.monotonic()
+        weighted.acquire(1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_shared_provider_override(self):
+        previous = get_provider()
+        try:
+            self.assertIs(set_provider(self.provider), get_provider())
+        finally:
+            set_provider(previous)
+
+class TestLLMCache(unittest.TestCase):
+    """Cache persistente degli embedding: chiave (modello, dimensione, testo)."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.path = os.path.join(TEST_DIR, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_dimensions_do_not_overwrite(self):
+        print("\n🧪 TEST: Cache embedding per dimensione (due spazi, stesso modello)")
+        cache = LLMCache(self.path)
+        cache.put_embeddings(["cavo"], [[0.5] * 4], "m", 4)
+        cache.put_embeddings(["cavo"], [[0.25] * 2], "m", 2)
+        self.assertEqual(cache.get_embeddings(["cavo"], "m", 4), [[0.5] * 4])
+        self.assertEqual(cache.get_embeddings(["cavo"], "m", 2), [[0.25] * 2])
+        self.assertEqual(cache.get_embeddings(["cavo"], "m"), [None])   # dimensione di default: non richiesta
+        cache.close()
+
+    def test_legacy_schema_migration(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE embeddings (model TEXT NOT NULL, text_hash TEXT NOT NULL, dim INTEGER, "
+                     "vector BLOB, PRIMARY KEY (model, text_hash)) WITHOUT ROWID")
+        conn.execute("INSERT INTO embeddings VALUES ('m', ?, 3, ?)", (text_hash("cavo"), np.ones(3, dtype=np.float32).tobytes()))
+        conn.commit()
+        conn.close()
+        cache = LLMCache(self.path)
+        self.assertEqual(cache.get_embeddings(["cavo"], "m", 3), [[1.0, 1.0, 1.0]])
+        cache.put_embeddings(["cavo"], [[0.0] * 2], "m", 2)
+        self.assertEqual(cache.get_embeddings(["cavo"], "m", 3), [[1.0, 1.0, 1.0]])
+        cache.close()
+        LLMCache(self.path).close()   # seconda apertura: nessuna nuova migrazione
+
+if __name__ == '__main__':
+    unittest.main()
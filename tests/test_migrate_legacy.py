@@ -0,0 +1,122 @@
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import step17_migrate_legacy as migration
+
+TEST_DIR = "test_env_migration"
+LEGACY = [
+    # (id, descrizione ricetta, [(componente, prezzo)])
+    (1, "Presa 10/16A", [("Presa bipasso", 5.0), ("Manodopera", 10.0)]),
+    (2, "Quadro di piano", [("Carpenteria", 300.0)]),
+    (3, "presa  10/16a", [("Presa bipasso", 6.0)]),           # duplicato di 1 (descrizione normalizzata)
+    (4, "Canale 300x100", [("Canale zincato", 20.0)]),
+    (5, "Punto luce", []),
+]
+
+class TestLegacyMigration(unittest.TestCase):
+    """Migrazione set-based: deduplica in memoria, commit a blocchi e ripresa dal marker."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.src_path = os.path.join(TEST_DIR, "legacy.db")
+        src = sqlite3.connect(self.src_path)
+        src.execute("CREATE TABLE recipes (id INTEGER PRIMARY KEY, code TEXT, description TEXT, source_file TEXT)")
+        src.execute("CREATE TABLE components (id INTEGER PRIMARY KEY, recipe_id INTEGER, description TEXT, "
+                    "type TEXT, qty_coefficient REAL, unit_price REAL)")
+        for rid, desc, comps in LEGACY:
+            src.execute("INSERT INTO recipes VALUES (?,?,?,?)", (rid, f"C{rid}", desc, "offerta.xlsx"))
+            src.executemany("INSERT INTO components (recipe_id, description, type, qty_coefficient, unit_price) "
+                            "VALUES (?,?,?,?,?)", [(rid, d, "MAT", 1.0, p) for d, p in comps])
+        src.commit()
+        src.close()
+        self.tgt_path = os.path.join(TEST_DIR, "target.db")
+        self.patches = [patch.object(migration, "OLD_DB_FILE", self.src_path),
+                        patch.object(bulk_ingestion, "DB_FILE", self.tgt_path)]
+        for p in self.patches:
+            p.start()
+        bulk_ingestion.init_db()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def _run(self, **kwargs):
+        src, tgt = sqlite3.connect(self.src_path), bulk_ingestion.get_db_connection()
+        try:
+            return migration.migrate_set_based(src, tgt, **kwargs)
+        finally:
+            src.close()
+            tgt.close()
+
+    def test_resumable_set_based_migration(self):
+        print("\n🧪 TEST: Migrazione legacy set-based e ripresa")
+        original = migration.iter_legacy_recipes
+
+        def interrupted(conn, after_id=0):
+            for i, item in enumerate(original(conn, after_id)):
+                if i == 3:
+                    raise KeyboardInterrupt
+                yield item
+
+        with patch.object(migration, "iter_legacy_recipes", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self._run(commit_every=2)
+
+        tgt = sqlite3.connect(self.tgt_path)
+        marker = tgt.execute("SELECT last_legacy_id, phase FROM migration_progress").fetchone()
+        tgt.close()
+        self.assertEqual(marker, (2, "load"))   # solo il primo blocco è stato committato
+
+        stats = self._run(commit_every=2)
+        self.assertEqual((stats["resumed_from"], stats["migrated"], stats["merged"]), (2, 4, 1))
+
+        tgt = sqlite3.connect(self.tgt_path)
+        recipes = tgt.execute("SELECT description, unit_material_price FROM recipes ORDER BY id").fetchall()
+        presa_prices = [r[0] for r in tgt.execute(
+            "SELECT ph.raw_price FROM price_history ph JOIN components c ON c.id = ph.component_id "
+            "WHERE c.description = 'Presa bipasso' ORDER BY ph.id")]
+        phase = tgt.execute("SELECT phase FROM migration_progress").fetchone()[0]
+        n_snapshots = tgt.execute("SELECT COUNT(DISTINCT recipe_id) FROM price_snapshots").fetchone()[0]
+        tgt.close()
+        self.assertEqual([r[0] for r in recipes], ["Presa 10/16A", "Quadro di piano", "Canale 300x100", "Punto luce"])
+        self.assertEqual(presa_prices, [5.0, 6.0])   # il duplicato è unito allo stesso componente
+        self.assertEqual(recipes[1][1], 300.0)      # prezzi ricalcolati a fine migrazione
+        self.assertEqual((phase, n_snapshots), ("done", 4))
+
+        # Migrazione già completata: nessun nuovo inserimento
+        self.assertEqual(self._run()["migrated"], 4)
+
+    def test_overlapping_sibling_components(self):
+        print("\n🧪 TEST: Migrazione di componenti fratelli con descrizioni sovrapposte (MAT/MAN)")
+        src = sqlite3.connect(self.src_path)
+        src.execute("INSERT INTO recipes VALUES (6, 'C6', 'Linea dorsale', 'offerta.xlsx')")
+        src.executemany("INSERT INTO components (recipe_id, description, type, qty_coefficient, unit_price) VALUES (6,?,?,1.0,?)",
+                        [("Cavo", "MAT", 2.0), ("Cavo 3x2.5 posa", "MAN", 5.0)])
+        src.commit()
+        src.close()
+        self._run()
+
+        tgt = sqlite3.connect(self.tgt_path)
+        comps = tgt.execute(
+            "SELECT c.description, c.type, GROUP_CONCAT(ph.raw_price) FROM components c "
+            "JOIN recipes r ON r.id = c.recipe_id JOIN price_history ph ON ph.component_id = c.id "
+            "WHERE r.description = 'Linea dorsale' GROUP BY c.id ORDER BY c.id").fetchall()
+        prices = tgt.execute("SELECT unit_material_price, unit_manpower_price FROM recipes "
+                             "WHERE description = 'Linea dorsale'").fetchone()
+        tgt.close()
+        # Come insert_new_recipe (--row-by-row): due componenti distinti, manodopera conservata
+        self.assertEqual(comps, [("Cavo", "MAT", "2.0"), ("Cavo 3x2.5 posa", "MAN", "5.0")])
+        self.assertEqual(prices, (2.0, 5.0))
+
+if __name__ == '__main__':
+    unittest.main()
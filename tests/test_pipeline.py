@@ -5,6 +5,7 @@ import sqlite3
 import pandas as pd
 import shutil
 import json
+import time
 from unittest.mock import MagicMock, patch
 from datetime import datetime, timedelta
 
@@ -20,6 +21,7 @@ sys.path.append(SCRIPTS_DIR)
 try:
     import bulk_ingestion
     import generate_quote
+    import fast_reader
 except ImportError as e:
     raise ImportError(f"Errore import moduli. Verifica che bulk_ingestion.py sia in /scripts e generate_quote.py in root. Dettagli: {e}")
 
@@ -54,6 +56,8 @@ class TestEndToEndPipeline(unittest.TestCase):
         bulk_ingestion.DB_FILE = TEST_DB
         bulk_ingestion.INPUT_FOLDER = TEST_INPUT_DIR
         generate_quote.DB_FILE = TEST_DB
+        # I file di test cambiano a ogni run: niente cache dei frame letti
+        fast_reader.CACHE_ENABLED = False
         
         # Reset Pricing Mode default
         bulk_ingestion.PRICING_MODE = "SMART_ADAPTIVE"
@@ -91,8 +95,10 @@ class TestEndToEndPipeline(unittest.TestCase):
 
         conn.commit()
         conn.close()
+        # Resto dello schema del motore, come all'avvio dell'ingestion
+        bulk_ingestion.init_db()
 
-    def _create_excel_input(self, filename, items):
+    def _create_excel_input(self, filename, items, man_price=None):
         rows = []
         for desc, price in items:
             row_head = [None]*20
@@ -102,6 +108,11 @@ class TestEndToEndPipeline(unittest.TestCase):
             row_comp = [None]*20
             row_comp[1] = desc; row_comp[3] = 1.0; row_comp[8] = price
             rows.append(row_comp)
+
+            if man_price is not None:
+                row_man = [None]*20
+                row_man[1] = "Operaio specializzato"; row_man[3] = 1.0; row_man[8] = man_price
+                rows.append(row_man)
             
             row_foot = [None]*20
             row_foot[14] = price
@@ -152,6 +163,177 @@ class TestEndToEndPipeline(unittest.TestCase):
         # Logica Adaptive: (0.9 * 150) + (0.1 * 100) = 145.0
         self.assertAlmostEqual(price, 145.0, delta=1.0)
 
+    @patch('bulk_ingestion.find_semantic_match')
+    def test_streaming_ingestion_batches(self, mock_find):
+        """Streaming: stesse ricette della lettura completa, commit a blocchi."""
+        print("\n🧪 TEST: Ingestion in streaming (commit a blocchi)")
+        mock_find.return_value = (None, None, 0.0)
+        items = [(f"Articolo {i}", 10.0 + i) for i in range(7)]
+        path = self._create_excel_input("listino.xlsx", items)
+
+        with patch.object(bulk_ingestion, "STREAM_COMMIT_EVERY", 3):
+            stats = bulk_ingestion.process_file(path, stream=True)
+        self.assertEqual(stats["branch"], 7)
+        self.assertEqual(stats["rows"], 28)
+
+        conn = sqlite3.connect(TEST_DB)
+        prices = [r[0] for r in conn.execute("SELECT unit_price FROM components ORDER BY id")]
+        conn.close()
+        self.assertEqual(prices, [p for _, p in items])
+
+    def test_layout_detection(self):
+        """Intestazione V5 (15 e 16 colonne) e listino piatto riconosciuti dalle prime righe."""
+        v5 = [[None] * 15, ['"N. ARTICOLO"', "DESCRIZIONE", "U.M.", "QUANTITA COMP."] + [None] * 11,
+              ["N.", None, None, "COMP.", "ART.", "MAN."] + [None] * 9]
+        layout = bulk_ingestion.detect_layout(v5)
+        self.assertEqual((layout["name"], layout["data_start"]), ("V5_STRICT", 3))
+        self.assertEqual(layout["idx"], bulk_ingestion.IDX)
+
+        v5_16 = [["N.", "DESCRIZIONE", None, "U.M.", "QUANTITA'"] + [None] * 11]
+        layout = bulk_ingestion.detect_layout(v5_16)
+        self.assertEqual(layout["name"], "V5_STRICT+1")
+        self.assertEqual((layout["idx"]["DESCRIZIONE"], layout["idx"]["P_COMP"], layout["idx"]["IMPORTO_TOT"]), (1, 9, 15))
+
+        flat = [["Listino 2025"], ["CODICE", "DESCRIZIONE", "UM", "PREZZO NETTO"]]
+        layout = bulk_ingestion.detect_layout(flat)
+        self.assertEqual(layout["name"], "FLAT")
+        self.assertEqual(layout["idx"], {"CODICE": 0, "DESCRIZIONE": 1, "UM": 2, "PREZZO": 3})
+
+    @patch('bulk_ingestion.find_semantic_match')
+    def test_flat_price_list_bulk_load(self, mock_find):
+        """Listino piatto: prezzi in blocco per descrizione/codice, articoli nuovi come ricette singole."""
+        print("\n🧪 TEST: Listino fornitore piatto (caricamento per codice)")
+        mock_find.return_value = (None, None, 0.0)
+        bulk_ingestion.process_file(self._create_excel_input("ricette.xlsx", [("Presa Test", 100.0)]))
+
+        def flat_list(name, rows):
+            path = os.path.join(TEST_INPUT_DIR, name)
+            pd.DataFrame([["CODICE", "DESCRIZIONE", "U.M.", "PREZZO"]] + rows).to_excel(path, index=False, header=False)
+            return path
+
+        stats = bulk_ingestion.process_file(flat_list("listino1.xlsx", [
+            ["PR-01", "presa  test", "cad", "110,00"],      # componente esistente (descrizione)
+            ["CV-02", "Cavo FG16OM16 3G2,5", "m", "2,50"],  # articolo nuovo
+            ["XX-03", "Senza prezzo", "cad", None],
+        ]))
+        self.assertEqual((stats["layout"], stats["merge"], stats["branch"], stats["skipped"]), ("FLAT", 1, 1, 1))
+        mock_find.assert_called_once()   # nessuna ricerca semantica per il listino
+
+        # Secondo listino: match per codice anche con descrizione diversa
+        stats = bulk_ingestion.process_file(flat_list("listino2.xlsx", [["PR-01", "Presa 10/16A", "cad", "120"]]))
+        self.assertEqual((stats["merge"], stats["branch"]), (1, 0))
+
+        conn = sqlite3.connect(TEST_DB)
+        prices = [r[0] for r in conn.execute(
+            "SELECT ph.raw_price FROM price_history ph JOIN components c ON c.id = ph.component_id "
+            "WHERE c.code = 'PR-01' ORDER BY ph.id")]
+        n_recipes = conn.execute("SELECT COUNT(*) FROM recipes").fetchone()[0]
+        conn.close()
+        self.assertEqual(prices, [100.0, 110.0, 120.0])
+        self.assertEqual(n_recipes, 2)
+
+    def test_vector_sync_incremental(self):
+        """Sync vettori: solo ricette nuove/modificate, adozione dei vettori esistenti, batch falliti ripresi."""
+        print("\n🧪 TEST: Sync vettori incrementale (hash del contenuto)")
+        conn = sqlite3.connect(TEST_DB)
+        conn.executemany("INSERT INTO recipes (id, description) VALUES (?, ?)",
+                         [(i, f"Voce {i}") for i in range(1, 6)])
+        conn.execute("INSERT INTO vec_recipes(rowid, embedding) VALUES(1, NULL)")   # vettore pre-esistente
+        conn.commit()
+        conn.close()
+
+        embedded = []
+        def fake_embed(texts, model=None, dimensions=None):
+            if "Voce 5" in texts:
+                raise RuntimeError("rate limit")
+            embedded.extend(texts)
+            return [[0.1] * dimensions] * len(texts)
+
+        with patch.object(bulk_ingestion, "embed_texts", side_effect=fake_embed), \
+             patch.object(bulk_ingestion, "VECTOR_BATCH_SIZE", 2), \
+             patch.object(bulk_ingestion, "VECTOR_SYNC_RETRIES", 1), \
+             patch.object(bulk_ingestion.time, "sleep"):
+            stats = bulk_ingestion.sync_vectors()["recipes"]
+            self.assertEqual((stats["adopted"], stats["synced"], stats["failed"]), (1, 2, 2))
+            self.assertEqual(sorted(embedded), ["Voce 2", "Voce 3"])
+
+            # Riavvio: solo il batch fallito; poi una descrizione modificata viene ri-embeddata
+            embedded.clear()
+            conn = sqlite3.connect(TEST_DB)
+            conn.execute("DELETE FROM recipes WHERE id = 5")
+            conn.execute("UPDATE recipes SET description = 'Voce 2 bis' WHERE id = 2")
+            conn.commit()
+            conn.close()
+            stats = bulk_ingestion.sync_vectors()["recipes"]
+            self.assertEqual(sorted(embedded), ["Voce 2 bis", "Voce 4"])
+            self.assertEqual((stats["synced"], stats["refreshed"], stats["failed"]), (2, 1, 0))
+            self.assertEqual(bulk_ingestion.sync_vectors()["recipes"]["pending"], 0)
+
+        conn = sqlite3.connect(TEST_DB)
+        n_vec = conn.execute("SELECT COUNT(*) FROM vec_recipes").fetchone()[0]
+        conn.close()
+        self.assertEqual(n_vec, 4)
+
+    def test_embedding_space_swap(self):
+        """Nuovo spazio di embedding costruito in ombra alla sua dimensione e attivato con uno switch atomico."""
+        print("\n🧪 TEST: Re-embedding in ombra e switch dello spazio attivo")
+        from llm_provider import OfflineProvider, get_provider, set_provider
+
+        class FlakyProvider(OfflineProvider):
+            """Stand-in offline che registra le dimensioni richieste e fallisce una volta su 'Voce 3'."""
+            def __init__(self):
+                super().__init__()
+                self.requests, self.fail_once = [], True
+
+            def embed(self, texts, model, dimensions=None):
+                self.requests.append((model, dimensions))
+                if model == "embed-v2" and "Voce 3" in texts and self.fail_once:
+                    raise RuntimeError("rate limit")
+                return super().embed(texts, model, dimensions)
+
+        provider, previous = FlakyProvider(), get_provider()
+        set_provider(provider)
+        conn = bulk_ingestion.get_db_connection()
+        conn.executemany("INSERT INTO recipes (id, description) VALUES (?, ?)", [(i, f"Voce {i}") for i in range(1, 4)])
+        conn.commit()
+        try:
+            with patch.object(bulk_ingestion, "VECTOR_BATCH_SIZE", 1), \
+                 patch.object(bulk_ingestion, "VECTOR_SYNC_RETRIES", 0):
+                bulk_ingestion.sync_vectors()
+                bulk_ingestion.create_space(conn, "v2", "embed-v2", 3)
+                conn.execute("CREATE TABLE vec_recipes__v2 (rowid INTEGER PRIMARY KEY, embedding BLOB, distance REAL)")
+                conn.commit()
+
+                # Costruzione parziale: lo spazio attivo resta il precedente, l'attivazione è rifiutata
+                bulk_ingestion.build_space("v2", rate_limit=0)
+                self.assertEqual(conn.execute("SELECT rows_total, rows_done FROM embedding_spaces WHERE name = 'v2'").fetchone(), (3, 2))
+                with self.assertRaises(RuntimeError):
+                    bulk_ingestion.activate_space(conn, "v2")
+                self.assertEqual(bulk_ingestion.get_space(conn)["name"], "default")
+
+                # Recupero all'attivazione (anche delle righe nuove nel frattempo), poi switch
+                provider.fail_once = False
+                conn.execute("INSERT INTO recipes (id, description) VALUES (4, 'Voce 4')")
+                conn.commit()
+                space = bulk_ingestion.activate_space(conn, "v2")
+                self.assertEqual((space["name"], space["model"]), ("v2", "embed-v2"))
+                self.assertEqual(conn.execute("SELECT status FROM embedding_spaces WHERE name = 'default'").fetchone()[0], "retired")
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM vec_recipes__v2").fetchone()[0], 4)
+
+                # Dopo lo switch il sync scrive solo nel nuovo spazio
+                conn.execute("INSERT INTO recipes (id, description) VALUES (5, 'Voce 5')")
+                conn.commit()
+                self.assertEqual(bulk_ingestion.sync_vectors()["recipes"]["synced"], 1)
+        finally:
+            set_provider(previous)
+
+        # La dimensione dello spazio arriva al provider: vettori da 3 float nel nuovo spazio
+        self.assertEqual({d for m, d in provider.requests if m == "embed-v2"}, {3})
+        self.assertEqual({d for m, d in provider.requests if m != "embed-v2"}, {bulk_ingestion.EMBEDDING_DIM})
+        self.assertEqual({len(r[0]) for r in conn.execute("SELECT embedding FROM vec_recipes__v2")}, {12})
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM vec_recipes").fetchone()[0], 3)
+        conn.close()
+
     @patch('bulk_ingestion.get_embedding_single')
     @patch('bulk_ingestion.find_semantic_match')
     def test_pricing_override_max(self, mock_find, mock_embed):
@@ -182,6 +364,221 @@ class TestEndToEndPipeline(unittest.TestCase):
         print(f"   -> Result MAX: {price}")
         self.assertEqual(price, 15.0)
 
+    @patch('bulk_ingestion.get_embedding_single')
+    @patch('bulk_ingestion.find_semantic_match')
+    def test_price_snapshots_all_strategies(self, mock_find, mock_embed):
+        """Verifica snapshot materializzato per tutte le strategie (incl. manodopera)."""
+        print("\n🧪 TEST: Price Snapshots")
+
+        mock_embed.return_value = [0.1]*1536
+        mock_find.side_effect = [(None, None, 0), (1, "Cavo", 0.99), (1, "Cavo", 0.99)]
+
+        # Sequenza 10 -> 15 -> 12, con manodopera fissa a 20
+        for i, price in enumerate([10.0, 15.0, 12.0]):
+            self._create_excel_input(f"s{i}.xlsx", [("Cavo", price)], man_price=20.0)
+            bulk_ingestion.process_file(os.path.join(TEST_INPUT_DIR, f"s{i}.xlsx"))
+
+            # Date distinte per rendere deterministico LATEST
+            conn = sqlite3.connect(TEST_DB)
+            day = (datetime.now() - timedelta(days=10 - i)).strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute("UPDATE price_history SET date = ? WHERE source_file = ?", (day, f"s{i}.xlsx"))
+            conn.commit()
+            conn.close()
+
+        conn = bulk_ingestion.get_db_connection()
+        bulk_ingestion.recalc_recipe_stats(1, conn)
+        conn.commit()
+        snap = dict((r[0], (r[1], r[2])) for r in conn.execute(
+            "SELECT strategy, unit_material_price, unit_manpower_price FROM price_snapshots WHERE recipe_id=1"))
+        man_recipe = conn.execute("SELECT unit_manpower_price FROM recipes WHERE id=1").fetchone()[0]
+        conn.close()
+
+        print(f"   -> Snapshot: {snap}")
+        self.assertEqual(set(snap), set(bulk_ingestion.PRICING_STRATEGIES))
+        self.assertEqual(snap["MAX"][0], 15.0)
+        self.assertEqual(snap["LATEST"][0], 12.0)
+        self.assertAlmostEqual(snap["SMART_1Y"][0], 37.0 / 3)
+        self.assertAlmostEqual(snap["SMART_ADAPTIVE"][1], 20.0)
+        self.assertAlmostEqual(man_recipe, 20.0)
+
+    @patch('bulk_ingestion.get_embedding_single')
+    @patch('bulk_ingestion.find_semantic_match')
+    def test_point_in_time_pricing(self, mock_find, mock_embed):
+        """Verifica pricing as-of: solo lo storico fino alla data richiesta."""
+        print("\n🧪 TEST: Point-in-Time Pricing")
+
+        mock_embed.return_value = [0.1]*1536
+        mock_find.side_effect = [(None, None, 0), (1, "Quadro", 0.99)]
+
+        # Offerta 2023 a 100€, offerta 2024 a 200€ (date esplicite)
+        self._create_excel_input("o2023.xlsx", [("Quadro", 100.0)])
+        bulk_ingestion.process_file(os.path.join(TEST_INPUT_DIR, "o2023.xlsx"), price_date="2023-03-01")
+        self._create_excel_input("o2024.xlsx", [("Quadro", 200.0)])
+        bulk_ingestion.process_file(os.path.join(TEST_INPUT_DIR, "o2024.xlsx"), price_date="2024-03-01")
+
+        conn = bulk_ingestion.get_db_connection()
+        before = bulk_ingestion.evaluate_recipe_prices(conn, 1, as_of="2022-12-31")
+        mid = bulk_ingestion.evaluate_recipe_prices(conn, 1, as_of="2023-12-31")
+        after = bulk_ingestion.evaluate_recipe_prices(conn, 1, as_of="2024-06-01")
+        indexes = [r[1] for r in conn.execute("PRAGMA index_list(price_history)")]
+
+        # Report as-of in sola lettura: il catalogo resta sui prezzi attuali, nessuno zero scritto
+        live = conn.execute("SELECT unit_material_price FROM recipes WHERE id = 1").fetchone()
+        snaps = conn.execute("SELECT * FROM price_snapshots ORDER BY strategy").fetchall()
+        report_path = os.path.join(TEST_DIR, "as_of.csv")
+        self.assertEqual(bulk_ingestion.point_in_time_report(conn, "2022-12-31", report_path), (0, 1))
+        self.assertEqual(bulk_ingestion.point_in_time_report(conn, "2023-12-31", report_path), (1, 0))
+        report = pd.read_csv(report_path)
+        self.assertEqual(report["LATEST_MAT"].tolist(), [100.0])
+        self.assertEqual(conn.execute("SELECT unit_material_price FROM recipes WHERE id = 1").fetchone(), live)
+        self.assertEqual(conn.execute("SELECT * FROM price_snapshots ORDER BY strategy").fetchall(), snaps)
+        conn.close()
+
+        print(f"   -> 2022: {before} | 2023: {mid['totals']['LATEST']} | 2024: {after['totals']['LATEST']}")
+        self.assertIsNone(before)
+        self.assertEqual(mid["totals"]["LATEST"]["MAT"], 100.0)
+        self.assertEqual(after["totals"]["LATEST"]["MAT"], 200.0)
+        # Shock +100% -> 0.9 * 200 + 0.1 * 100
+        self.assertAlmostEqual(after["totals"]["SMART_ADAPTIVE"]["MAT"], 190.0)
+        self.assertIn("idx_price_history_component_date", indexes)
+
+    def test_incremental_price_stats(self):
+        """Aggregati per componente mantenuti dai trigger: stessi prezzi del ricalcolo esatto, anche col passare del tempo."""
+        print("\n🧪 TEST: Aggregati incrementali dei prezzi (component_price_stats)")
+        conn = bulk_ingestion.get_db_connection()
+        now = bulk_ingestion.utc_now().replace(microsecond=0)
+        conn.execute("INSERT INTO recipes (id, description) VALUES (1, 'Quadro')")
+        conn.executemany("INSERT INTO components (id, recipe_id, description, type, qty_coefficient) VALUES (?,1,?,?,?)",
+                         [(1, "Carpenteria", "MAT", 1.0), (2, "Interruttore", "MAT", 4.0), (3, "Cablaggio", "MAN", 2.0)])
+        history = {1: [(100.0, 900), (110.0, 500), (150.0, 20), (150.0, 20)],   # shock recente + pari merito
+                   2: [(12.0, 364), (13.0, 200), (12.5, 10)],                  # prezzo che passa di fascia
+                   3: [(30.0, 40)]}
+        conn.executemany("INSERT INTO price_history (component_id, raw_price, date) VALUES (?,?,?)",
+                         [(cid, price, (now - timedelta(days=days)).strftime(bulk_ingestion.DATE_FORMAT))
+                          for cid, rows in history.items() for price, days in rows])
+        conn.commit()
+        self.assertEqual(conn.execute("SELECT n FROM component_price_stats WHERE component_id = 1").fetchone()[0], 4)
+
+        with patch.object(bulk_ingestion, "PRICE_STATS_ENABLED", False):
+            exact = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+        incremental = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+        for strategy, totals in exact["totals"].items():
+            for bucket in ("MAT", "MAN"):
+                self.assertAlmostEqual(incremental["totals"][strategy][bucket], totals[bucket], places=6)
+        self.assertAlmostEqual(incremental["volatility"], exact["volatility"], places=9)
+
+        # Dopo mesi le fasce d'età vengono spostate dai bucket; la verifica esatta non trova differenze
+        report = bulk_ingestion.verify_price_stats(conn, now=now + timedelta(days=400))
+        self.assertEqual((report["checked"], report["mismatches"]), (3, []))
+
+        # La lettura non scrive: fasce spostate solo in memoria
+        banded_at = conn.execute("SELECT banded_at FROM component_price_stats WHERE component_id = 2").fetchone()[0]
+        with patch.object(bulk_ingestion, "utc_now", return_value=now + timedelta(days=30)):
+            shifted = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+        self.assertEqual(shifted["components"][2]["SMART_1Y"], 12.75)   # 12.0 esce dall'anno
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute("SELECT banded_at FROM component_price_stats WHERE component_id = 2").fetchone()[0],
+                         banded_at)
+
+        # Storico modificato a mano -> aggregati invalidati: la lettura usa lo storico, il ricalcolo li ricostruisce
+        conn.execute("UPDATE price_history SET raw_price = 50.0 WHERE component_id = 3")
+        conn.commit()
+        self.assertIsNone(conn.execute("SELECT 1 FROM component_price_stats WHERE component_id = 3").fetchone())
+        self.assertEqual(bulk_ingestion.evaluate_recipe_prices(conn, 1)["components"][3]["LATEST"], 50.0)
+        self.assertFalse(conn.in_transaction)
+        self.assertIsNone(conn.execute("SELECT 1 FROM component_price_stats WHERE component_id = 3").fetchone())
+        bulk_ingestion.recalc_recipe_stats(1, conn)
+        self.assertIsNotNone(conn.execute("SELECT 1 FROM component_price_stats WHERE component_id = 3").fetchone())
+        self.assertEqual(conn.execute("SELECT unit_price FROM components WHERE id = 3").fetchone()[0], 50.0)
+
+        # Aggregato corrotto -> rilevato e riparato dalla verifica
+        conn.execute("UPDATE component_price_stats SET max_price = 1.0 WHERE component_id = 2")
+        report = bulk_ingestion.verify_price_stats(conn, repair=True)
+        self.assertEqual(report["mismatches"], [{"component_id": 2, "fields": ["MAX"]}])
+        self.assertEqual(bulk_ingestion.verify_price_stats(conn)["mismatches"], [])
+        conn.close()
+
+    def test_price_stats_clock_outside_utc(self):
+        """Trigger (CURRENT_TIMESTAMP) e motore Python usano lo stesso orologio anche con fuso diverso da UTC."""
+        print("\n🧪 TEST: Fasce d'età degli aggregati con fuso orario locale")
+        if not hasattr(time, "tzset"):
+            self.skipTest("tzset non disponibile")
+        previous = os.environ.get("TZ")
+        os.environ["TZ"] = "Etc/GMT-10"   # UTC+10: l'ora locale è avanti di 10 ore
+        time.tzset()
+        try:
+            conn = bulk_ingestion.get_db_connection()
+            conn.execute("INSERT INTO recipes (id, description) VALUES (1, 'Presa')")
+            conn.execute("INSERT INTO components (id, recipe_id, description, type, qty_coefficient) VALUES (1,1,'Presa','MAT',1)")
+            edge = (bulk_ingestion.utc_now() - timedelta(days=365, hours=-5)).strftime(bulk_ingestion.DATE_FORMAT)
+            conn.executemany("INSERT INTO price_history (component_id, raw_price, date) VALUES (1,?,?)", [(10.0, edge)])
+            conn.execute("INSERT INTO price_history (component_id, raw_price) VALUES (1, 20.0)")   # data di default (UTC)
+            banded_at = conn.execute("SELECT banded_at FROM component_price_stats WHERE component_id = 1").fetchone()[0]
+            now = bulk_ingestion.utc_now().replace(microsecond=0)
+            self.assertLess(abs((now - datetime.strptime(banded_at, bulk_ingestion.DATE_FORMAT)).total_seconds()), 60)
+
+            # Prezzo a 5 ore dal limite dell'anno: dentro SMART_1Y per entrambi i calcoli
+            result = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+            self.assertAlmostEqual(result["components"][1]["SMART_1Y"], 15.0)
+            self.assertEqual(bulk_ingestion.verify_price_stats(conn, now=now + timedelta(hours=1))["mismatches"], [])
+            conn.close()
+        finally:
+            if previous is None:
+                os.environ.pop("TZ", None)
+            else:
+                os.environ["TZ"] = previous
+            time.tzset()
+
+    def test_compact_price_history(self):
+        """Storico vecchio compattato in aggregati mensili: stessi prezzi, meno righe, duplicati rimossi."""
+        print("\n🧪 TEST: Compattazione dello storico prezzi (price_history_monthly)")
+        conn = bulk_ingestion.get_db_connection()
+        now = bulk_ingestion.utc_now().replace(microsecond=0)
+        conn.execute("INSERT INTO recipes (id, description) VALUES (1, 'Canale')")
+        conn.executemany("INSERT INTO components (id, recipe_id, description, type, qty_coefficient) VALUES (?,1,?,?,?)",
+                         [(1, "Canale zincato", "MAT", 2.0), (2, "Posa", "MAN", 1.0)])
+        history = [(1, 18.0, 1500, "a.xlsx"), (1, 19.0, 1499, "b.xlsx"), (1, 21.0, 1000, "c.xlsx"),
+                   (1, 20.0, 900, "d.xlsx"), (1, 22.0, 60, "e.xlsx"), (1, 22.0, 60, "e.xlsx"),   # e.xlsx ingerito due volte
+                   (2, 9.0, 1200, "a.xlsx"), (2, 9.5, 1190, "a.xlsx")]                           # solo storico vecchio
+        conn.executemany("INSERT INTO price_history (component_id, raw_price, date, source_file) VALUES (?,?,?,?)",
+                         [(cid, price, (now - timedelta(days=days)).strftime(bulk_ingestion.DATE_FORMAT), src)
+                          for cid, price, days, src in history])
+        conn.execute("DELETE FROM price_history WHERE id = 6")   # riferimento esatto senza il duplicato
+        with patch.object(bulk_ingestion, "PRICE_STATS_ENABLED", False):
+            expected = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+        conn.execute("INSERT INTO price_history (component_id, raw_price, date, source_file) VALUES (1, 22.0, ?, 'e.xlsx')",
+                     ((now - timedelta(days=60)).strftime(bulk_ingestion.DATE_FORMAT),))
+        conn.commit()
+
+        report = bulk_ingestion.compact_price_history(conn, retention_days=30, now=now)   # minimo 731 giorni
+        self.assertEqual((report["duplicates"], report["rolled_rows"]), (1, 6))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM price_history").fetchone()[0], 1)
+
+        for as_stats in (False, True):
+            with patch.object(bulk_ingestion, "PRICE_STATS_ENABLED", as_stats):
+                result = bulk_ingestion.evaluate_recipe_prices(conn, 1)
+            for strategy, totals in expected["totals"].items():
+                for bucket in ("MAT", "MAN"):
+                    self.assertAlmostEqual(result["totals"][strategy][bucket], totals[bucket], places=6)
+            self.assertAlmostEqual(result["volatility"], expected["volatility"], places=9)
+        self.assertEqual(bulk_ingestion.verify_price_stats(conn, now=now + timedelta(days=300))["mismatches"], [])
+
+        # Nuovo prezzo dopo la compattazione: aggregati mantenuti dal trigger
+        conn.execute("INSERT INTO price_history (component_id, raw_price) VALUES (2, 10.0)")
+        self.assertEqual(conn.execute("SELECT n FROM component_price_stats WHERE component_id = 2").fetchone()[0], 3)
+        self.assertEqual(bulk_ingestion.verify_price_stats(conn)["mismatches"], [])
+        conn.close()
+
+    def test_parse_number_formats(self):
+        """Verifica parsing numeri: formato italiano e valori già numerici."""
+        print("\n🧪 TEST: Parsing Numeri")
+        self.assertEqual(bulk_ingestion.parse_number("1.234,56"), 1234.56)
+        self.assertEqual(bulk_ingestion.parse_number("16,00"), 16.0)
+        self.assertEqual(bulk_ingestion.parse_number("0.15"), 0.15)
+        self.assertEqual(bulk_ingestion.parse_number("€ 240"), 240.0)
+        self.assertIsNone(bulk_ingestion.parse_number("Cadauno"))
+        self.assertIsNone(bulk_ingestion.parse_number(float("nan")))
+
     @patch('bulk_ingestion.get_embedding_single')
     @patch('generate_quote.get_embedding')
     @patch('generate_quote.validate_match_with_gpt')
@@ -216,5 +613,146 @@ class TestEndToEndPipeline(unittest.TestCase):
             print(f"   -> Is Complex: {is_complex}")
             self.assertEqual(is_complex, 1)
 
+    def test_budget_aware_routing(self):
+        print("\n🧪 TEST: Routing validazione per costo e budget per preventivo")
+        from llm_provider import OfflineProvider, get_provider, set_provider
+        previous = get_provider()
+        set_provider(OfflineProvider())
+
+        rdo_path = os.path.join(TEST_DIR, "rdo_clean.xlsx")
+        pd.DataFrame({
+            "DESCRIZIONE": ["Cavo FG16 3x1.5", "Cavo FG16 3x2.5", "Cavo FG16 5x6"],
+            "QUANTITA": [10, 20, 30], "UNITA_MISURA": ["m", "m", "m"],
+        }).to_excel(rdo_path, index=False)
+        out_path = os.path.join(TEST_DIR, "preventivo.xlsx")
+
+        # Top-1 netto (0.85 vs 0.70): basta il modello economico
+        candidates = [
+            {"id": 1, "code": "A", "desc": "Cavo FG16 3x1.5", "price_mat": 2.0, "price_man": 1.0,
+             "source_file": "t", "volatility": 0.0, "is_complex": 0, "similarity": 0.85},
+            {"id": 2, "code": "B", "desc": "Quadro IP65", "price_mat": 90.0, "price_man": 10.0,
+             "source_file": "t", "volatility": 0.0, "is_complex": 0, "similarity": 0.70},
+        ]
+        try:
+            with patch('generate_quote.search_similar_candidates', return_value=candidates), \
+                 patch.object(generate_quote, 'FILE_INPUT_RDO', rdo_path), \
+                 patch.object(generate_quote, 'FILE_FINAL_XLSX', out_path), \
+                 patch.object(generate_quote, 'QUOTE_BUDGET_USD', 1e-9), \
+                 patch.object(generate_quote, 'VALIDATION_BATCH_SIZE', 1):
+                generate_quote.main()
+        finally:
+            set_provider(previous)
+
+        usage = pd.read_csv(os.path.join(TEST_DIR, "preventivo_costi_ai.csv"))
+        # Prima riga sul modello economico, poi budget esaurito -> solo vettori (nessun token)
+        self.assertEqual(list(usage["ROUTE"]), ["FAST", "BUDGET", "BUDGET"])
+        self.assertEqual(usage["MODELLO"][0], "gpt-4o-mini")
+        self.assertGreater(usage["PROMPT_TOKENS"][0], 0)
+        self.assertEqual(usage["PROMPT_TOKENS"][1:].sum(), 0)
+
+        # Caso ambiguo -> modello completo
+        ambiguous = [dict(candidates[0], similarity=0.75), dict(candidates[1], similarity=0.74)]
+        self.assertEqual(generate_quote.route_validation(ambiguous), ("STRONG", "gpt-4o"))
+
+    def test_component_fallback_tier(self):
+        print("\n🧪 TEST: Fallback ai componenti per righe senza ricetta")
+        conn = sqlite3.connect(TEST_DB)
+        conn.execute("INSERT INTO recipes (id, description) VALUES (1, 'Linea dorsale quadro')")
+        conn.executemany("INSERT INTO components (id, recipe_id, description, type, qty_coefficient) VALUES (?,1,?,?,?)",
+                         [(10, "Cavo FG16OM16 3G2,5", "MAT", 1.5), (11, "Operaio specializzato", "MAN", 0.5)])
+        conn.executemany("INSERT INTO price_history (component_id, raw_price) VALUES (?,?)",
+                         [(10, 2.5), (10, 2.5), (11, 30.0)])
+        conn.commit()
+        conn.close()
+
+        hit = lambda cid, desc, ctype, sim: {"component_id": cid, "recipe_id": 1, "desc": desc, "type": ctype,
+                                             "unit_price": None, "recipe_desc": "Linea dorsale quadro", "similarity": sim}
+        far = lambda rid, desc, sim: {"id": rid, "code": f"R{rid}", "desc": desc, "price_mat": 50.0, "price_man": 0.0,
+                                      "source_file": "t", "volatility": 0.0, "is_complex": 0, "similarity": sim}
+        line = lambda desc, candidates: {"desc": desc, "candidates": candidates, "usage": {}, "best_match": None,
+                                         "validation": {}, "route": "NONE", "model": None}
+        # Righe con candidati reali ma lontani: la KNN restituisce sempre i k più vicini
+        lines = [
+            line("Cavo FG16 3x2,5", [far(5, "Quadro standard", 0.55), far(6, "Plafoniera", 0.52)]),
+            line("Presa", [far(7, "Presa 10A", 0.97)]),
+            line("Quadro speciale", [far(5, "Quadro standard", 0.62)]),
+            line("Manodopera operaio", [far(8, "Scavo", 0.51)]),
+            line("Canale speciale", []),
+        ]
+        from llm_provider import OfflineProvider, get_provider, set_provider
+        previous = get_provider()
+        set_provider(OfflineProvider())
+        try:
+            generate_quote.decide_lines(lines[:2] + lines[3:], budget_usd=0.0)   # budget esaurito: solo vettori
+        finally:
+            set_provider(previous)
+        lines[2].update(route="STRONG", model="gpt-4o",
+                        validation={"selected_index": 0, "status": "NO MATCH", "reason": "scartato dal giudice"})
+        self.assertEqual([l["route"] for l in lines], ["BUDGET", "VECTOR", "STRONG", "BUDGET", "NONE"])
+        self.assertEqual(lines[0]["validation"]["status"], "NO MATCH")
+
+        search_results = [
+            [hit(10, "Cavo FG16OM16 3G2,5", "MAT", 0.88), hit(11, "Operaio specializzato", "MAN", 0.60)],
+            [hit(10, "Cavo FG16OM16 3G2,5", "MAT", 0.81)],
+            [hit(11, "Operaio specializzato", "MAN", 0.91)],   # sola manodopera
+            [hit(10, "Cavo FG16OM16 3G2,5", "MAT", 0.55)],     # sotto soglia -> resta NO MATCH
+        ]
+        with patch('generate_quote.search_component_candidates', return_value=search_results) as mock_search, \
+             patch('generate_quote.get_db_connection', side_effect=lambda: sqlite3.connect(TEST_DB)):
+            found = generate_quote.apply_component_fallback(lines)
+
+        # Una sola ricerca a batch per tutte le righe senza ricetta valida, scartate dall'LLM comprese
+        mock_search.assert_called_once_with(["Cavo FG16 3x2,5", "Quadro speciale", "Manodopera operaio", "Canale speciale"])
+        self.assertEqual(found, 3)
+        self.assertEqual(lines[0]["route"], "COMPONENT")
+        self.assertEqual(lines[0]["validation"]["status"], "CHECK")
+        self.assertAlmostEqual(lines[0]["best_match"]["price_mat"], 2.5)   # prezzo unitario, senza il coefficiente della ricetta (1.5)
+        self.assertEqual(lines[0]["best_match"]["price_man"], 0.0)   # manodopera sotto soglia
+        self.assertEqual(lines[1]["best_match"]["id"], 7)
+        self.assertEqual((lines[2]["route"], lines[2]["validation"]["status"]), ("COMPONENT", "CHECK"))
+        self.assertEqual(lines[3]["route"], "COMPONENT")
+        self.assertEqual((lines[3]["best_match"]["price_mat"], lines[3]["best_match"]["price_man"]), (0.0, 30.0))
+        self.assertIsNone(lines[4]["best_match"])
+
+    def test_batched_validation_with_fallback(self):
+        print("\n🧪 TEST: Validazione GPT a batch con fallback su output malformato")
+        options = [{"id": 1, "desc": "Cavo FG16 3x1.5", "price_mat": 2.0},
+                   {"id": 2, "desc": "Quadro IP65", "price_mat": 90.0}]
+        items = [("Cavo FG16 3x1.5", options), ("Quadro IP65", options), ("Presa 10A", options)]
+
+        # Riga 2 malformata (indice fuori range), riga 3 assente -> 2 richieste singole
+        batch_answer = ({"decisions": [
+            {"riga": 1, "selected_index": 1, "status": "OK", "reason": "batch"},
+            {"riga": 2, "selected_index": 7, "status": "OK", "reason": "batch"},
+        ]}, {"prompt_tokens": 100, "completion_tokens": 20})
+        single_answer = ({"selected_index": 0, "status": "NO MATCH", "reason": "single"},
+                         {"prompt_tokens": 50, "completion_tokens": 10})
+        provider = MagicMock()
+        provider.chat_json.side_effect = [batch_answer, single_answer, single_answer]
+
+        with patch('generate_quote.get_provider', return_value=provider):
+            results = generate_quote.validate_batch_with_gpt(items, model="gpt-4o-mini")
+
+        self.assertEqual(provider.chat_json.call_count, 3)
+        self.assertEqual([r["reason"] for r in results], ["batch", "single", "single"])
+        self.assertEqual(provider.chat_json.call_args_list[0].kwargs["task"], "validate_batch")
+
+        # Raggruppamento: stessa sezione e stesso modello, al più batch_size righe
+        lines = [{"code": c, "model": m} for c, m in
+                 [("A3.1.1", "gpt-4o"), ("A3.1.2", "gpt-4o"), ("A3.1.3", "gpt-4o-mini"),
+                  ("A3.2.1", "gpt-4o-mini"), ("A3.2.2", "gpt-4o-mini"), ("A3.2.3", "gpt-4o-mini")]]
+        sizes = [len(b) for b in generate_quote.group_validation_batches(lines, batch_size=2)]
+        self.assertEqual(sizes, [2, 1, 2, 1])
+
+        # RDO senza CODICE: sezione dai METADATI, altrimenti ordine di input
+        lines = [{"code": "", "section": s, "model": "gpt-4o-mini"} for s in
+                 ["Quadri", "Quadri", "Cavi", "Cavi", "Cavi"]]
+        sizes = [len(b) for b in generate_quote.group_validation_batches(lines, batch_size=2)]
+        self.assertEqual(sizes, [2, 2, 1])
+        lines = [{"code": "", "model": "gpt-4o-mini"} for _ in range(5)]
+        batches = generate_quote.group_validation_batches(lines, batch_size=2)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual([l for b in batches for l in b], lines)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,113 @@
+import unittest
+import os
+import sys
+import pandas as pd
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+from rule_normalizer import normalize_sheet, split_sheet_chunks, to_number
+
+HEADER = ["N.", "CODICE", "DESCRIZIONE", "U.M.", "QUANTITA'", "PREZZO", "IMPORTO"]
+LONG_PARENT = ("Cavo multipolare flessibile resistente al fuoco, non propagante l'incendio, "
+               "senza alogeni, tensione nominale 0,6/1 kV")
+
+def sheet(rows):
+    title = [["COMPUTO METRICO ESTIMATIVO", None, None, None, None, None, None]]
+    return pd.DataFrame(title + [HEADER] + rows, dtype=object)
+
+class TestRuleNormalizer(unittest.TestCase):
+    """Normalizzazione deterministica dei PATTERN A/B/C senza LLM."""
+
+    def test_italian_numbers(self):
+        values = to_number(pd.Series(["1.234,56", "€ 5.841,50", "16,00", "3", None, "n.d."]))
+        self.assertEqual(values.iloc[:4].tolist(), [1234.56, 5841.5, 16.0, 3.0])
+        self.assertTrue(values.iloc[4:].isna().all())
+
+    def test_patterns_abc(self):
+        print("\n🧪 TEST: Normalizzatore a regole (PATTERN A/B/C)")
+        df = sheet([
+            # PATTERN A: riga piatta
+            ["1", "A1.1", "Quadro elettrico di piano", "cad", "2", "1.500,00", "3.000,00"],
+            # PATTERN B: misure + Totale
+            ["2", "A1.2", "Canale in lamiera zincata 300x100", "m", None, None, None],
+            [None, None, "Piano terra", None, "10,50", None, None],
+            [None, None, "Piano primo", None, "4,50", None, None],
+            [None, None, "Totale", "m", "15,00", "20,00", "300,00"],
+            # PATTERN C: padre senza quantità e figli con codice esteso
+            [None, "A1.3", LONG_PARENT, None, None, None, None],
+            ["3", "A1.3.a", "sez. 3x1,5 mm²", "m", "100", "2,00", "200,00"],
+            ["4", "A1.3.b", "sez. 4x2,5 mm²", "m", "50", "3,00", "150,00"],
+            # Intestazione ripetuta (cambio pagina PDF)
+            HEADER,
+            ["5", "A1.4", "Oneri per la sicurezza non soggetti a ribasso", "a corpo", "1", "500", "500"],
+        ])
+        out, info = normalize_sheet(df)
+        self.assertIsNotNone(out, info["reason"])
+        self.assertEqual(out["CODICE"].tolist(), ["A1.1", "A1.2", "A1.3.a", "A1.3.b", "A1.4"])
+        self.assertEqual(out["QUANTITA"].tolist(), [2.0, 15.0, 100.0, 50.0, 1.0])
+        self.assertEqual(out["PREZZO_UNITARIO"].tolist(), [1500.0, 20.0, 2.0, 3.0, 500.0])
+        self.assertEqual(out.loc[2, "DESCRIZIONE"], f"{LONG_PARENT} - sez. 3x1,5 mm²")
+        self.assertEqual(info["patterns"], {"A": 2, "B": 1, "C": 2})
+
+    def test_sequential_children(self):
+        # Figli con codice sequenziale (A3.1.16, A3.1.17) che ereditano dalla voce precedente
+        df = sheet([
+            ["1", "A3.1.15", LONG_PARENT + " del tipo FG18OM16", "m", "10", "1,00", "10,00"],
+            ["2", "A3.1.16", "7G1,5 mm²", "m", "20", "2,00", "40,00"],
+            ["3", "A3.1.17", "Fornitura e posa di scatola di derivazione IP55 in materiale isolante", "cad", "5", "8,00", "40,00"],
+        ])
+        out, info = normalize_sheet(df)
+        self.assertEqual(info["patterns"]["C"], 1)
+        self.assertTrue(out.loc[1, "DESCRIZIONE"].endswith(" - 7G1,5 mm²"))
+        self.assertFalse(" - " in out.loc[2, "DESCRIZIONE"])
+
+    def test_sequential_children_of_header(self):
+        # Esempio di PROMPT_NORMALIZER: padre A3.1.15 senza quantità, figli sequenziali brevi
+        df = sheet([
+            [None, "A3.1.15", LONG_PARENT, None, None, None, None],
+            ["1", "A3.1.16", "7G1,5 mm²", "m", "20", "2,00", "40,00"],
+            ["2", "A3.1.17", "5G2,5 mm²", "m", "10", "3,00", "30,00"],
+        ])
+        out, info = normalize_sheet(df)
+        self.assertEqual(info["patterns"]["C"], 2)
+        self.assertEqual(out["DESCRIZIONE"].tolist(), [f"{LONG_PARENT} - 7G1,5 mm²", f"{LONG_PARENT} - 5G2,5 mm²"])
+        self.assertEqual(out["METADATI"].tolist(), ["", ""])   # il padre non è un'intestazione di sezione
+
+    def test_chunks_keep_families_together(self):
+        # Tre famiglie (A1.1, A1.2, A2.1) con padre, figli e misure: i chunk non devono separarli
+        rows = []
+        for family in ["A1.1", "A1.2", "A2.1"]:
+            rows.append([None, family, LONG_PARENT, None, None, None, None])
+            for child in "abc":
+                rows.append([None, f"{family}.{child}", "sez. 3x1,5 mm²", "m", None, "2,00", None])
+                rows.append([None, None, "Piano terra", None, "10", None, None])
+                rows.append([None, None, "Totale", "m", "10", "2,00", "20,00"])
+        df = sheet(rows)
+        chunks = split_sheet_chunks(df, max_rows=8)
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertEqual(chunk.iloc[1].tolist(), HEADER)      # intestazione ripetuta
+            self.assertEqual(chunk.iloc[2, 2], LONG_PARENT)        # ogni chunk parte dal padre
+        whole, _ = normalize_sheet(df)
+        stitched = pd.concat([normalize_sheet(c)[0] for c in chunks], ignore_index=True)
+        self.assertEqual(stitched["DESCRIZIONE"].tolist(), whole["DESCRIZIONE"].tolist())
+
+    def test_unclassified_falls_back(self):
+        no_header = pd.DataFrame([["voce", "10"], ["altra voce", "5"]])
+        out, info = normalize_sheet(no_header)
+        self.assertIsNone(out)
+        self.assertEqual(info["reason"], "intestazione non trovata")
+
+        # Importi incoerenti: colonne probabilmente disallineate -> al Normalizer LLM
+        df = sheet([
+            ["1", "A1.1", "Quadro elettrico", "cad", "2", "10,00", "999,00"],
+            ["2", "A1.2", "Interruttore", "cad", "3", "5,00", "777,00"],
+        ])
+        out, info = normalize_sheet(df)
+        self.assertIsNone(out)
+        self.assertIn("importi incoerenti", info["reason"])
+
+if __name__ == '__main__':
+    unittest.main()
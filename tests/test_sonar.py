@@ -0,0 +1,63 @@
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import numpy as np
+from unittest.mock import MagicMock, patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'debug'))
+
+import interactive_sonar as sonar
+
+TEST_DIR = "test_env_sonar"
+
+class TestSonarBatch(unittest.TestCase):
+    """Sonar con indice in memoria: top-k vettorizzato per molte query in un passaggio."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.db_path = os.path.join(TEST_DIR, "sonar.db")
+        rng = np.random.default_rng(7)
+        self.vectors = rng.normal(size=(50, 8)).astype(np.float32)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE recipes (id INTEGER PRIMARY KEY, code TEXT, description TEXT, "
+                     "unit_material_price REAL, unit_manpower_price REAL)")
+        conn.execute("CREATE TABLE vec_recipes (rowid INTEGER PRIMARY KEY, embedding BLOB)")
+        for i, v in enumerate(self.vectors, start=1):
+            conn.execute("INSERT INTO recipes VALUES (?,?,?,?,?)", (i, f"C{i}", f"Voce {i}", float(i), 1.0))
+            conn.execute("INSERT INTO vec_recipes VALUES (?,?)", (i, sonar.serialize_f32(v.tolist())))
+        conn.commit()
+        conn.close()
+        self.db_patch = patch.object(sonar, "DB_FILE", self.db_path)
+        self.db_patch.start()
+
+    def tearDown(self):
+        self.db_patch.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_batch_matches_brute_force(self):
+        print("\n🧪 TEST: Sonar batch su indice in memoria")
+        index = sonar.load_index()
+        self.assertEqual(index["matrix"].shape, (50, 8))
+
+        queries = self.vectors[[3, 17, 42]] + 0.01
+        provider = MagicMock()
+        provider.embed.return_value = queries.tolist()
+        with patch.object(sonar, "get_provider", return_value=provider), \
+             patch.object(sonar, "SEARCH_BLOCK", 2):
+            results, timings = sonar.sonar_batch(["a", "b", "c"], k=4, index=index)
+
+        provider.embed.assert_called_once()   # un solo embedding per tutte le query
+        self.assertEqual([hits[0]["id"] for hits in results], [4, 18, 43])
+        for q, hits in zip(queries, results):
+            expected = np.sort(np.linalg.norm(self.vectors - q, axis=1))[:4]
+            np.testing.assert_allclose([h["distance"] for h in hits], expected, rtol=1e-4, atol=1e-4)
+        self.assertEqual(results[0][0]["price_mat"], 4.0)
+        self.assertIn("search_s", timings)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import os
+import sys
+import shutil
+from unittest.mock import patch
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+import bulk_ingestion
+import generate_quote
+import tech_attributes
+
+TEST_DIR = "test_env_attributes"
+
+def candidate(rid, desc, similarity):
+    return {"id": rid, "code": f"C{rid}", "desc": desc, "price_mat": 1.0, "price_man": 0.0,
+            "source_file": "t", "volatility": 0.0, "is_complex": 0, "similarity": similarity}
+
+class TestTechAttributes(unittest.TestCase):
+    """Estrazione deterministica degli attributi, colonne indicizzate e routing senza LLM."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+        self.db_patch = patch.object(bulk_ingestion, "DB_FILE", os.path.join(TEST_DIR, "catalog.db"))
+        self.db_patch.start()
+        bulk_ingestion.init_db()
+        self.conn = bulk_ingestion.get_db_connection()
+
+    def tearDown(self):
+        self.conn.close()
+        self.db_patch.stop()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_extraction_normalizes_units(self):
+        print("\n🧪 TEST: Estrazione attributi tecnici (sezioni, sigle, tensioni, dimensioni)")
+        ex = tech_attributes.extract_attributes
+        self.assertEqual(ex("Cavo FG18(O)M16 0,6/1 kV 7Gx1,5 mm²"),
+                         {"cable_code": "FG18OM16", "conductors": 7, "section_mm2": 1.5, "voltage_v": 1000.0})
+        self.assertEqual(ex("Cavo FG16OM16 3x2.5"), {"cable_code": "FG16OM16", "conductors": 3, "section_mm2": 2.5})
+        self.assertEqual(ex("Canale 30x10 cm"), ex("Canale 300x100 mm"))
+        self.assertEqual(ex("Tubo diametro 3,2 cm")["diameter_mm"], ex("Tubo Ø32")["diameter_mm"])
+        self.assertEqual(ex("Interruttore 4x63A 6kA"), {"current_a": 63.0})
+        self.assertEqual(ex("Plafoniera 2x36W IP65"), {"power_w": 72.0, "ip": 65})
+        self.assertEqual(ex("Scatola 44 a parete"), {})
+
+    def test_columns_backfill_and_lookup(self):
+        print("\n🧪 TEST: Colonne attr_* all'ingestion, backfill e ricerca esatta")
+        rid = bulk_ingestion.insert_new_recipe(self.conn, {"code": "A", "desc": "Linea FG16OM16 3G2,5", "components": [
+            {"desc": "Cavo FG16OM16 3G2,5 mm²", "type": "MAT", "qty": 1.0, "price": 2.5}]}, "offerta.xlsx")
+        self.conn.execute("INSERT INTO recipes (id, description) VALUES (50, 'Linea FG16OM16 3G1,5')")   # senza attributi
+        self.conn.commit()
+        self.assertEqual(tech_attributes.load_attributes(self.conn, "components", [1])[1]["section_mm2"], 2.5)
+        self.assertEqual(tech_attributes.backfill_attributes(self.conn, "recipes"), 1)   # solo la riga mancante
+        self.assertEqual(tech_attributes.backfill_attributes(self.conn, "recipes"), 0)
+        self.assertEqual(tech_attributes.backfill_attributes(self.conn, "recipes", force=True), 2)
+
+        query = tech_attributes.extract_attributes("Cavo FG16OM16 3x2,5")
+        self.assertEqual(tech_attributes.find_by_attributes(self.conn, "recipes", query), [rid])
+        self.assertEqual(tech_attributes.find_by_attributes(self.conn, "recipes", {"section_mm2": 2.5}), [])  # poco selettivo
+        plan = " ".join(str(r) for r in self.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM recipes WHERE attr_cable_code = 'FG16OM16' AND attr_section_mm2 = 2.5"))
+        self.assertIn("idx_recipes_attr_cable_code_section_mm2", plan)
+
+    def test_rerank_and_deterministic_route(self):
+        print("\n🧪 TEST: Riordino per attributi e decisione senza LLM")
+        for rid, desc in [(1, "Linea FG16OM16 3G1,5"), (2, "Linea FG16OM16 3G2,5")]:
+            self.conn.execute("INSERT INTO recipes (id, description) VALUES (?,?)", (rid, desc))
+            tech_attributes.store_attributes(self.conn, "recipes", rid, desc)
+        self.conn.commit()
+
+        # Il KNN preferisce la sezione sbagliata: gli attributi la spostano in fondo
+        knn = [candidate(1, "Linea FG16OM16 3G1,5", 0.93), candidate(2, "Linea FG16OM16 3G2,5", 0.86)]
+        ranked = generate_quote.apply_attribute_filter(self.conn, "Cavo FG16OM16 3x2,5 mm²", knn, None, "vec_recipes")
+        self.assertEqual([c["id"] for c in ranked], [2, 1])
+        self.assertEqual(ranked[1]["attr_conflicts"], ["section_mm2"])
+        self.assertTrue(ranked[0]["attr_exact"])
+
+        self.assertEqual(generate_quote.route_validation(ranked), ("ATTRIBUTES", None))
+        lines = generate_quote.decide_lines([{"desc": "Cavo FG16OM16 3x2,5 mm²", "candidates": ranked,
+                                              "usage": {}, "best_match": None, "validation": {}}])
+        self.assertEqual(lines[0]["best_match"]["id"], 2)
+        self.assertEqual(lines[0]["validation"]["status"], "OK")
+        self.assertIn("sezione 2.5 mm²", lines[0]["validation"]["reason"])
+
+        # Solo sezione e conduttori coincidenti (senza sigla): non identificano il prodotto -> LLM
+        generic = generate_quote.apply_attribute_filter(self.conn, "Cavo 3x2,5 mm²", [dict(c) for c in knn], None, "vec_recipes")
+        self.assertTrue(generic[0]["attr_exact"])
+        self.assertNotEqual(generate_quote.route_validation(generic)[0], "ATTRIBUTES")
+
+        # Top-1 oltre la soglia strict ma con attributi in conflitto: niente scorciatoia vettoriale
+        self.assertNotEqual(generate_quote.route_validation(ranked[1:])[0], "VECTOR")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import os
+import sys
+import json
+import shutil
+import sqlite3
+
+# --- GESTIONE PATH ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+
+from tracing import Tracer
+
+TEST_DIR = "test_env_tracing"
+
+class TestTracing(unittest.TestCase):
+    """Span, contatori e report (JSON-lines / Prometheus) del layer di tracing."""
+
+    def setUp(self):
+        os.makedirs(TEST_DIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_disabled_is_noop(self):
+        tracer = Tracer(enabled=False)
+        with tracer.span("quote.row") as s:
+            s.set(status="MATCH")
+        tracer.count("llm_chat_calls", 3)
+        tracer.observe("quote.xlsx_write", 0.1)
+        self.assertEqual(tracer.summary(), {"stages": {}, "counters": {}})
+
+    def test_summary_and_reports(self):
+        print("\n🧪 TEST: Report di tracing (p50/p95, JSONL, Prometheus)")
+        tracer = Tracer(enabled=True)
+        for ms in [10, 20, 30, 40, 100]:
+            tracer.observe("quote.knn", ms / 1000)
+        with tracer.span("quote.gpt_validate", options=5):
+            pass
+        tracer.count("llm_prompt_tokens", 120)
+
+        conn = tracer.instrument_connection(sqlite3.connect(":memory:"))
+        conn.execute("SELECT 1").fetchall()
+        conn.execute("SELECT 2").fetchall()
+        conn.close()
+
+        summary = tracer.summary()
+        self.assertEqual(summary["stages"]["quote.knn"]["count"], 5)
+        self.assertAlmostEqual(summary["stages"]["quote.knn"]["p50_ms"], 30.0, places=3)
+        self.assertGreater(summary["stages"]["quote.knn"]["p95_ms"], 40.0)
+        self.assertEqual(summary["counters"]["db_queries"], 2)
+
+        jsonl = os.path.join(TEST_DIR, "run.jsonl")
+        tracer.write_jsonl(jsonl, run={"command": "test"})
+        with open(jsonl, encoding="utf-8") as f:
+            lines = [json.loads(l) for l in f]
+        self.assertEqual(len(lines), 7)  # 6 span + riepilogo
+        self.assertEqual(lines[-1]["type"], "summary")
+        self.assertEqual(lines[-1]["counters"]["llm_prompt_tokens"], 120)
+
+        prom = os.path.join(TEST_DIR, "metrics.prom")
+        tracer.write_prometheus(prom)
+        with open(prom, encoding="utf-8") as f:
+            text = f.read()
+        self.assertIn('preventivatore_stage_seconds{stage="quote.knn",quantile="0.5"} 0.030000', text)
+        self.assertIn("preventivatore_llm_prompt_tokens_total 120", text)
+
+if __name__ == '__main__':
+    unittest.main()